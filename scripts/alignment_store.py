@@ -0,0 +1,710 @@
+#!/usr/bin/env python3
+
+"""
+A columnar binary store for the alignments of a sam file.
+
+The SortMeRNA alignments go through several filters before being handed
+to ovgraphbuild. The sam text is parsed once into columns, the filters
+work on numpy arrays, and sam text is only written back for the
+alignments they keep: lines are copied from the parsed sam file when it
+is still there, or rebuilt from the record columns.
+
+File layout: a magic string, the length of a json header (uint64, little
+endian), the json header (counts, sam header lines, dtype, offset and
+length of each column), then the columns, each one starting on a 64
+bytes boundary. Columns are memory mapped when read.
+
+Key columns, for n alignments of r reads and f references:
+    read_index  int32[n]  read of each alignment (a read is a run of
+                          consecutive alignments with the same name)
+    ref_index   int32[n]  reference of each alignment, -1 for '*'
+    flag        uint16[n]
+    pos         int32[n]  0-based position, -1 when not available
+    ref_span    int32[n]  reference nucleotides covered
+    score       int32[n]  AS tag, MISSING_SCORE without tag
+    line_offset int64[n]  position of the line in the parsed sam file
+    line_length int32[n]
+    read_names  uint8     r names, concatenated
+    ref_names   uint8     f names, concatenated
+Record columns (optional):
+    mapq        uint8[n]
+    next_ref_index, next_pos, tlen  int32[n]  mate fields (next_ref_index
+                          is -2 for '='), next_pos is 0-based
+    seq_length  int32[n]
+    cigar       uint32    BAM packing (count << 4 | operation code)
+    seq         uint8     BAM 4 bits encoding, 2 nucleotides by byte,
+                          each sequence starting on a new byte
+    qual, tags  uint8     concatenated qualities and optional fields
+Each variable length column X has an int64 X_offsets column (number of
+records + 1) holding the start of each record.
+"""
+
+import os
+import re
+import json
+import mmap
+import shutil
+import struct
+import logging
+import tempfile
+import functools
+import itertools
+
+import numpy as np
+
+from fastx_utils import iter_chunks
+from cigar_utils import cigar_info, OPERATIONS
+from bam_utils import BgzfWriter, BAM_RECORD_DTYPE, QUAL_TABLE, reg2bin, encode_tags, bam_header
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MATAMALN'
+VERSION = 1
+_ALIGNMENT = 64
+
+MISSING_SCORE = np.iinfo(np.int32).min
+
+# Columns needed by the filters, sam lines are copied from the parsed file
+KEY_COLUMNS = (
+    ('read_index', '<i4'),
+    ('ref_index', '<i4'),
+    ('flag', '<u2'),
+    ('pos', '<i4'),
+    ('ref_span', '<i4'),
+    ('score', '<i4'),
+    ('line_offset', '<i8'),
+    ('line_length', '<i4'),
+    ('read_names', 'u1'),
+    ('ref_names', 'u1'),
+)
+# Columns needed to rebuild the alignment records
+RECORD_COLUMNS = (
+    ('mapq', 'u1'),
+    ('next_ref_index', '<i4'),
+    ('next_pos', '<i4'),
+    ('tlen', '<i4'),
+    ('seq_length', '<i4'),
+    ('cigar', '<u4'),
+    ('seq', 'u1'),
+    ('qual', 'u1'),
+    ('tags', 'u1'),
+)
+VARIABLE_COLUMNS = ('read_names', 'ref_names', 'cigar', 'seq', 'qual', 'tags')
+
+# BAM 4 bits nucleotide encoding
+NT16 = b'=ACMGRSVTWYHKDBN'
+_NT16_CODES = np.full(256, 15, dtype=np.uint8)
+for _code, _nt in enumerate(NT16):
+    _NT16_CODES[_nt] = _code
+    _NT16_CODES[ord(chr(_nt).lower())] = _code
+_NT16_TABLE = _NT16_CODES.tobytes()
+_NT16_LETTERS = np.frombuffer(NT16, dtype=np.uint8)
+
+_AS_TAG = b'AS:i:'
+_AS_TAG_REGEX = re.compile(rb'(?:^|\t)AS:i:(-?\d+)')
+
+# Size of the sam chunks parsed at once
+_READ_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Number of alignments written to sam at once
+_WRITE_BATCH_SIZE = 100000
+
+
+def _all_columns(records=True):
+    """
+    Return the (name, dtype) of the columns, offsets included
+    """
+    for name, dtype in KEY_COLUMNS + (RECORD_COLUMNS if records else ()):
+        yield name, dtype
+        if name in VARIABLE_COLUMNS:
+            yield name + '_offsets', '<i8'
+
+
+@functools.lru_cache(maxsize=65536)
+def pack_cigar(cigar):
+    """
+    Return the BAM packing of a CIGAR string, as a tuple of int
+    """
+    if cigar == b'*':
+        return ()
+    info = cigar_info(cigar)
+    return tuple(count << 4 | code for code, count in zip(info.codes, info.counts))
+
+
+@functools.lru_cache(maxsize=65536)
+def _cigar_record(cigar):
+    """
+    Return the BAM packing and the reference span of a CIGAR string
+    """
+    if cigar == b'*':
+        return (), 0
+    return pack_cigar(cigar), cigar_info(cigar).ref_span
+
+
+def get_tag_score(tags):
+    """
+    Return the AS tag value of the optional fields of an alignment
+    """
+    match = _AS_TAG_REGEX.search(tags)
+    return int(match.group(1)) if match else MISSING_SCORE
+
+
+def _parse_ints(buf, starts, ends):
+    """
+    Parse the integers written in buf[starts:ends], with an optional
+    minus sign. Raise ValueError if a field is not an integer
+    """
+    negative = (ends > starts) & (buf[starts] == 45)
+    starts = starts + negative
+    lengths = ends - starts
+    values = np.zeros(len(starts), dtype=np.int64)
+    for j in range(int(lengths.max()) if len(lengths) else 0):
+        in_number = j < lengths
+        digits = buf[np.where(in_number, starts + j, 0)].astype(np.int64) - 48
+        if ((digits < 0) | (digits > 9))[in_number].any():
+            raise ValueError('Not an integer sam field')
+        values = np.where(in_number, values * 10 + digits, values)
+    if (lengths <= 0).any():
+        raise ValueError('Not an integer sam field')
+    return np.where(negative, -values, values)
+
+
+def _parse_scores(data, buf, tabs, tag_starts, ends):
+    """
+    Return the AS tag value of each alignment, MISSING_SCORE without
+    tag. The tag is read vectorized when it is the first optional
+    field (SortMeRNA), it is searched otherwise
+    """
+    tag_ends = np.minimum(tabs[np.searchsorted(tabs, tag_starts)], ends)
+    is_as_tag = tag_ends - tag_starts > len(_AS_TAG)
+    for j, c in enumerate(_AS_TAG):
+        is_as_tag &= buf[np.where(is_as_tag, tag_starts + j, 0)] == c
+    scores = np.full(len(tag_starts), MISSING_SCORE, dtype=np.int64)
+    scores[is_as_tag] = _parse_ints(buf, tag_starts[is_as_tag] + len(_AS_TAG), tag_ends[is_as_tag])
+    for i in np.flatnonzero(~is_as_tag & (ends > tag_starts)).tolist():
+        scores[i] = get_tag_score(data[tag_starts[i]:ends[i]])
+    return scores
+
+
+def encode_sequences(seqs):
+    """
+    Return the BAM 4 bits encoding of a list of sequences (bytes), each
+    one starting on a new byte, and the byte length of each encoding
+    """
+    padded = b''.join(s + b'=' if len(s) & 1 else s for s in seqs)
+    codes = np.frombuffer(padded.translate(_NT16_TABLE), dtype=np.uint8)
+    return (codes[0::2] << 4) | codes[1::2], [(len(s) + 1) >> 1 for s in seqs]
+
+
+class AlignmentStoreWriter:
+    """
+    Write the alignments of sam lines to a store file. Columns are
+    spooled to temporary files, which are gathered on close.
+    Without records, only the key columns are stored
+    """
+
+    def __init__(self, filepath, records=True):
+        self.filepath = filepath
+        self.records = records
+        self.tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(filepath) + '.',
+                                        dir=os.path.dirname(os.path.abspath(filepath)))
+        self.dtypes = dict(_all_columns(records))
+        self.lengths = dict.fromkeys(self.dtypes, 0)
+        self.files = {name: open(os.path.join(self.tmp_dir, name), 'wb') for name in self.dtypes}
+        self.blob_sizes = dict()
+        for name in VARIABLE_COLUMNS:
+            if name in self.dtypes:
+                self.blob_sizes[name] = 0
+                self._append(name + '_offsets', [0])
+        self.sam_header = list()
+        self.alignments_nb = 0
+        self.reads_nb = 0
+        self.last_read_name = None
+        self.source_size = 0
+        self.ref_indices = {b'*': -1, b'=': -2}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _append(self, name, values):
+        array = np.asarray(values, dtype=self.dtypes[name])
+        array.tofile(self.files[name])
+        self.lengths[name] += len(array)
+
+    def _append_variable(self, name, data, record_lengths):
+        """
+        Append the concatenated records of a variable length column
+        """
+        self._append(name, data)
+        offsets = self.blob_sizes[name] + np.cumsum(record_lengths, dtype=np.int64)
+        self._append(name + '_offsets', offsets)
+        if len(offsets):
+            self.blob_sizes[name] = int(offsets[-1])
+
+    def _append_strings(self, name, values):
+        self._append_variable(name, np.frombuffer(b''.join(values), dtype=np.uint8), list(map(len, values)))
+
+    def add_sam_chunk(self, data):
+        """
+        Add a chunk of sam lines (bytes made of complete lines). Fields
+        are located with numpy on the whole chunk. Header lines are
+        kept apart
+        """
+        source_offset = self.source_size
+        self.source_size += len(data)
+        if data[-1:] != b'\n':
+            data += b'\n'
+        buf = np.frombuffer(data, dtype=np.uint8)
+
+        ends = np.flatnonzero(buf == 10)
+        starts = np.empty_like(ends)
+        starts[:1] = 0
+        starts[1:] = ends[:-1] + 1
+        # Carriage returns are not part of the lines
+        ends -= (ends > starts) & (buf[ends - 1] == 13)
+        valid = ends > starts
+        starts, ends = starts[valid], ends[valid]
+        is_header = buf[starts] == 64
+        if is_header.any():
+            self.sam_header.extend(data[s:e].decode() for s, e in
+                                   zip(starts[is_header].tolist(), ends[is_header].tolist()))
+            starts, ends = starts[~is_header], ends[~is_header]
+        if not len(starts):
+            return
+
+        # Start and end of the 11 mandatory fields of each line
+        tabs = np.append(np.flatnonzero(buf == 9), len(buf))
+        first_tab_index = np.searchsorted(tabs, starts)
+        field_ends = [tabs[np.minimum(first_tab_index + j, len(tabs) - 1)] for j in range(11)]
+        if (field_ends[9] >= ends).any():
+            line_index = int(np.flatnonzero(field_ends[9] >= ends)[0])
+            raise ValueError('Not a sam file (less than 11 fields): {0}'.format(
+                data[starts[line_index]:ends[line_index]]))
+        field_ends[10] = np.minimum(field_ends[10], ends)
+        field_starts = [starts] + [e + 1 for e in field_ends[:10]]
+        tag_starts = np.minimum(field_ends[10] + 1, ends)
+
+        def strings(j):
+            return [data[s:e] for s, e in zip(field_starts[j].tolist(), field_ends[j].tolist())]
+
+        # A new read starts when the name changes
+        name_lengths = field_ends[0] - starts
+        new_read = np.ones(len(starts), dtype=bool)
+        new_read[1:] = name_lengths[1:] != name_lengths[:-1]
+        for j in range(int(name_lengths.max())):
+            in_name = j < name_lengths
+            name_bytes = np.where(in_name, buf[np.where(in_name, starts + j, 0)], 0)
+            new_read[1:] |= name_bytes[1:] != name_bytes[:-1]
+        new_read_first = np.flatnonzero(new_read)
+        new_read_names = [data[s:e] for s, e in zip(starts[new_read_first].tolist(),
+                                                    field_ends[0][new_read_first].tolist())]
+        if new_read_names[0] == self.last_read_name:
+            # The read continues from the previous chunk
+            new_read[0] = False
+            del new_read_names[0]
+        self._append('read_index', self.reads_nb - 1 + np.cumsum(new_read))
+        self._append_strings('read_names', new_read_names)
+        self.reads_nb += len(new_read_names)
+        self.last_read_name = data[starts[-1]:field_ends[0][-1]]
+
+        rnames = strings(2)
+        if self.records:
+            # Mate references are mostly unavailable ('*')
+            has_next_ref = (field_ends[6] - field_starts[6] != 1) | (buf[field_starts[6]] != 42)
+            rnexts = [data[s:e] for s, e in zip(field_starts[6][has_next_ref].tolist(),
+                                                field_ends[6][has_next_ref].tolist())]
+        else:
+            rnexts = list()
+        # References are indexed in the order they appear
+        new_ref_names = [r for r in dict.fromkeys(rnames + rnexts) if r not in self.ref_indices]
+        for rname in new_ref_names:
+            self.ref_indices[rname] = len(self.ref_indices) - 2
+        self._append('ref_index', [self.ref_indices[r] for r in rnames])
+        self._append_strings('ref_names', new_ref_names)
+
+        self._append('flag', _parse_ints(buf, field_starts[1], field_ends[1]))
+        self._append('pos', _parse_ints(buf, field_starts[3], field_ends[3]) - 1)
+        cigar_records = [_cigar_record(c) for c in strings(5)]
+        self._append('ref_span', [r[1] for r in cigar_records])
+        self._append('score', _parse_scores(data, buf, tabs, tag_starts, ends))
+        self._append('line_offset', source_offset + starts)
+        self._append('line_length', ends - starts)
+
+        if self.records:
+            self._append('mapq', _parse_ints(buf, field_starts[4], field_ends[4]))
+            next_ref_index = np.full(len(starts), -1, dtype=np.int64)
+            next_ref_index[has_next_ref] = [self.ref_indices[r] for r in rnexts]
+            self._append('next_ref_index', next_ref_index)
+            self._append('next_pos', _parse_ints(buf, field_starts[7], field_ends[7]) - 1)
+            self._append('tlen', _parse_ints(buf, field_starts[8], field_ends[8]))
+
+            self._append_variable('cigar', list(itertools.chain.from_iterable(r[0] for r in cigar_records)),
+                                  [len(r[0]) for r in cigar_records])
+
+            # An unavailable sequence ('*') is stored empty
+            seqs = [b'' if seq == b'*' else seq for seq in strings(9)]
+            self._append('seq_length', list(map(len, seqs)))
+            self._append_variable('seq', *encode_sequences(seqs))
+
+            self._append_strings('qual', strings(10))
+            self._append_strings('tags', [data[s:e] for s, e in zip(tag_starts.tolist(), ends.tolist())])
+
+        self.alignments_nb += len(starts)
+
+    def add_sam_lines(self, lines):
+        """
+        Add sam lines (bytes, without line return)
+        """
+        if lines:
+            self.add_sam_chunk(b'\n'.join(lines) + b'\n')
+
+    def close(self):
+        """
+        Gather the columns into the store file
+        """
+        for fh in self.files.values():
+            fh.close()
+        header = {
+            'version': VERSION,
+            'alignments_nb': self.alignments_nb,
+            'reads_nb': self.reads_nb,
+            'refs_nb': len(self.ref_indices) - 2,
+            'source_size': self.source_size,
+            'records': self.records,
+            'sam_header': self.sam_header,
+            'columns': dict(),
+        }
+        # Column offsets depend on the header length, which depends on
+        # the offsets: they are relative to the end of the header
+        offset = 0
+        for name, dtype in self.dtypes.items():
+            header['columns'][name] = {'dtype': dtype, 'offset': offset, 'length': self.lengths[name]}
+            offset += -(-self.lengths[name] * np.dtype(dtype).itemsize // _ALIGNMENT) * _ALIGNMENT
+        header_bytes = json.dumps(header).encode()
+        data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // _ALIGNMENT) * _ALIGNMENT
+
+        with open(self.filepath, 'wb') as out_fh:
+            out_fh.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+            for name, column in header['columns'].items():
+                out_fh.seek(data_start + column['offset'])
+                with open(os.path.join(self.tmp_dir, name), 'rb') as column_fh:
+                    shutil.copyfileobj(column_fh, out_fh)
+            out_fh.truncate(data_start + offset)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def abort(self):
+        for fh in self.files.values():
+            fh.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def sam_to_store(sam_filepath, store_filepath, records=True):
+    """
+    Parse a sam file (path or file handle) into a store file, with only
+    the key columns unless records.
+    Return the number of alignments
+    """
+    with AlignmentStoreWriter(store_filepath, records) as writer:
+        for chunk in iter_chunks(sam_filepath, as_bytes=True, buffer_size=_READ_BUFFER_SIZE):
+            writer.add_sam_chunk(chunk)
+    return writer.alignments_nb
+
+
+class AlignmentStore:
+    """
+    Read access to a store file. Columns are memory mapped numpy arrays
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, 'rb') as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError('Not an alignment store: {0}'.format(filepath))
+            header_length, = struct.unpack('<Q', fh.read(8))
+            header = json.loads(fh.read(header_length).decode())
+        if header['version'] != VERSION:
+            raise ValueError('Unsupported alignment store version: {0}'.format(header['version']))
+        self.data_start = -(-(len(MAGIC) + 8 + header_length) // _ALIGNMENT) * _ALIGNMENT
+        self.alignments_nb = header['alignments_nb']
+        self.reads_nb = header['reads_nb']
+        self.sam_header = header['sam_header']
+        self.source_size = header['source_size']
+        self.records = header['records']
+        self.columns = header['columns']
+        self._arrays = dict()
+        with open(filepath, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ref_names = self.strings('ref_names', np.arange(header['refs_nb']))
+
+    def __len__(self):
+        return self.alignments_nb
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release the memory mapping
+        """
+        self._arrays.clear()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Columns are still referenced, the mapping is released with them
+            pass
+
+    def column(self, name):
+        """
+        Return a column, as a read-only numpy array
+        """
+        if name not in self._arrays:
+            column = self.columns[name]
+            self._arrays[name] = np.frombuffer(self._mmap, dtype=column['dtype'], count=column['length'],
+                                               offset=self.data_start + column['offset'])
+        return self._arrays[name]
+
+    def _records(self, name, indices):
+        """
+        Return the data of the records of a variable length column
+        (increasing indices), the start of each record in this data,
+        and the end of each record
+        """
+        offsets = self.column(name + '_offsets')
+        starts = offsets[indices]
+        ends = offsets[np.asarray(indices) + 1]
+        if not len(starts):
+            return np.zeros(0, dtype=self.column(name).dtype), starts, ends
+        base = starts[0]
+        return self.column(name)[base:ends[-1]], starts - base, ends - base
+
+    def strings(self, name, indices):
+        """
+        Return the records of a bytes column, for increasing indices
+        """
+        data, starts, ends = self._records(name, indices)
+        data = data.tobytes()
+        return [data[s:e] for s, e in zip(starts.tolist(), ends.tolist())]
+
+    def cigars(self, indices):
+        """
+        Return the CIGAR strings of alignments, for increasing indices
+        """
+        data, starts, ends = self._records('cigar', indices)
+        values = data.tolist()
+        raw = data.tobytes()
+        itemsize = data.itemsize
+        cache = dict()
+        cigars = list()
+        for s, e in zip(starts.tolist(), ends.tolist()):
+            key = raw[itemsize * s:itemsize * e]
+            cigar = cache.get(key)
+            if cigar is None:
+                cigar = b''.join(b'%d%s' % (v >> 4, OPERATIONS[v & 15].encode()) for v in values[s:e]) or b'*'
+                cache[key] = cigar
+            cigars.append(cigar)
+        return cigars
+
+    def sequences(self, indices):
+        """
+        Return the sequences of alignments, for increasing indices
+        """
+        data, starts, _ = self._records('seq', indices)
+        letters = np.empty(2 * len(data), dtype=np.uint8)
+        letters[0::2] = _NT16_LETTERS[data >> 4]
+        letters[1::2] = _NT16_LETTERS[data & 15]
+        letters = letters.tobytes()
+        lengths = self.column('seq_length')[indices]
+        return [letters[2 * s:2 * s + l] or b'*' for s, l in zip(starts.tolist(), lengths.tolist())]
+
+    def _iter_record_batches(self, indices):
+        """
+        Return a generator of (batch, order) for the given indices (all
+        by default): batches of increasing indices, as variable length
+        columns are read by increasing indices, and the position of
+        each one in the batch of indices
+        """
+        if not self.records:
+            raise ValueError('{0} has no alignment records, sam lines can only be copied '
+                             'from the parsed sam file'.format(self.filepath))
+        if indices is None:
+            indices = np.arange(self.alignments_nb)
+        for k in range(0, len(indices), _WRITE_BATCH_SIZE):
+            batch = np.asarray(indices[k:k + _WRITE_BATCH_SIZE], dtype=np.int64)
+            order = np.argsort(batch, kind='stable')
+            yield batch[order], order.tolist()
+
+    def _read_names(self, batch):
+        read_index = self.column('read_index')[batch]
+        unique_reads, read_rank = np.unique(read_index, return_inverse=True)
+        read_names = self.strings('read_names', unique_reads)
+        return [read_names[r] for r in read_rank.tolist()]
+
+    def iter_sam_lines(self, indices=None):
+        """
+        Return a generator of lists of sam lines (bytes, without line
+        return) rebuilt from the columns, for the given indices (all
+        by default), in this order
+        """
+        # Negative indices: -2 for '=', -1 for '*'
+        ref_names = self.ref_names + [b'=', b'*']
+        for batch, order in self._iter_record_batches(indices):
+            qnames = self._read_names(batch)
+            rnames = [ref_names[r] for r in self.column('ref_index')[batch].tolist()]
+            flags = self.column('flag')[batch].tolist()
+            positions = (self.column('pos')[batch].astype(np.int64) + 1).tolist()
+            mapqs = self.column('mapq')[batch].tolist()
+            rnexts = [ref_names[r] for r in self.column('next_ref_index')[batch].tolist()]
+            pnexts = (self.column('next_pos')[batch].astype(np.int64) + 1).tolist()
+            tlens = self.column('tlen')[batch].tolist()
+            lines = [None] * len(batch)
+            for i, fields in zip(order, zip(qnames, flags, rnames, positions, mapqs, self.cigars(batch),
+                                            rnexts, pnexts, tlens, self.sequences(batch),
+                                            self.strings('qual', batch), self.strings('tags', batch))):
+                line = b'%s\t%d\t%s\t%d\t%d\t%s\t%s\t%d\t%d\t%s\t%s' % fields[:11]
+                if fields[11]:
+                    line += b'\t' + fields[11]
+                lines[i] = line
+            yield lines
+
+    def references(self):
+        """
+        Return the references of the @SQ header lines, as (name, length)
+        pairs of bytes and int
+        """
+        references = list()
+        for line in self.sam_header:
+            if line.startswith('@SQ\t'):
+                fields = dict(f.split(':', 1) for f in line.split('\t')[1:] if ':' in f)
+                references.append((fields['SN'].encode(), int(fields['LN'])))
+        return references
+
+    def iter_bam_records(self, indices=None, references=None):
+        """
+        Return a generator of blocks of BAM records (bytes) for the
+        given indices (all by default), in this order. References are
+        (name, length) pairs giving the BAM reference ids (the @SQ
+        header lines by default)
+        """
+        if references is None:
+            references = self.references()
+        bam_ids = {name: i for i, (name, _) in enumerate(references)}
+        missing = [name for name in self.ref_names if name not in bam_ids]
+        if missing:
+            raise ValueError('Reference not in the BAM references: {0}'.format(missing[0].decode()))
+        # Negative indices: -2 for '=', -1 for '*'
+        ref_bam_ids = np.array([bam_ids[name] for name in self.ref_names] + [-2, -1], dtype=np.int64)
+        for batch, order in self._iter_record_batches(indices):
+            read_names = [name + b'\0' for name in self._read_names(batch)]
+            cigars, cigar_starts, cigar_ends = self._records('cigar', batch)
+            cigars = cigars.tobytes()
+            seqs, seq_starts, seq_ends = self._records('seq', batch)
+            seqs = seqs.tobytes()
+            seq_lengths = self.column('seq_length')[batch].astype(np.int64)
+            quals = list()
+            for qual, seq_length in zip(self.strings('qual', batch), seq_lengths.tolist()):
+                if qual == b'*':
+                    quals.append(b'\xff' * seq_length)
+                elif len(qual) == seq_length:
+                    quals.append(qual.translate(QUAL_TABLE))
+                else:
+                    raise ValueError('Sequence and quality lengths differ: {0}'.format(qual))
+            tags = [encode_tags(t) for t in self.strings('tags', batch)]
+
+            fixed = np.zeros(len(batch), dtype=BAM_RECORD_DTYPE)
+            fixed['ref_id'] = ref_bam_ids[self.column('ref_index')[batch]]
+            fixed['pos'] = self.column('pos')[batch]
+            fixed['l_read_name'] = list(map(len, read_names))
+            fixed['mapq'] = self.column('mapq')[batch]
+            ref_spans = self.column('ref_span')[batch].astype(np.int64)
+            fixed['bin'] = reg2bin(fixed['pos'], fixed['pos'] + np.maximum(ref_spans, 1))
+            fixed['n_cigar_op'] = cigar_ends - cigar_starts
+            fixed['flag'] = self.column('flag')[batch]
+            fixed['l_seq'] = seq_lengths
+            next_ref_ids = ref_bam_ids[self.column('next_ref_index')[batch]]
+            fixed['next_ref_id'] = np.where(next_ref_ids == -2, fixed['ref_id'], next_ref_ids)
+            fixed['next_pos'] = self.column('next_pos')[batch]
+            fixed['tlen'] = self.column('tlen')[batch]
+            # The block size does not count itself
+            fixed['block_size'] = (BAM_RECORD_DTYPE.itemsize - 4 + fixed['l_read_name'].astype(np.int64)
+                                   + 4 * (cigar_ends - cigar_starts) + (seq_ends - seq_starts)
+                                   + seq_lengths + list(map(len, tags)))
+            fixed = fixed.tobytes()
+
+            records = [None] * len(batch)
+            itemsize = BAM_RECORD_DTYPE.itemsize
+            for j, (i, read_name, cigar_start, cigar_end, seq_start, seq_end, qual, tag) in enumerate(zip(
+                    order, read_names, cigar_starts.tolist(), cigar_ends.tolist(),
+                    seq_starts.tolist(), seq_ends.tolist(), quals, tags)):
+                records[i] = b''.join((fixed[itemsize * j:itemsize * (j + 1)], read_name,
+                                       cigars[4 * cigar_start:4 * cigar_end],
+                                       seqs[seq_start:seq_end], qual, tag))
+            yield b''.join(records)
+
+    def write_bam(self, out_bam, indices=None, references=None, level=6, threads=1):
+        """
+        Write the alignments of the given indices (all by default), in
+        this order, to a BGZF compressed BAM file (path or binary file
+        handle). References are (name, length) pairs (the @SQ header
+        lines by default). Blocks are compressed by threads.
+        Return the number of alignments written
+        """
+        if references is None:
+            references = self.references()
+        with BgzfWriter(out_bam, level, threads) as out_fh:
+            out_fh.write(bam_header(self.sam_header, references))
+            for records in self.iter_bam_records(indices, references):
+                out_fh.write(records)
+        return self.alignments_nb if indices is None else len(indices)
+
+    def _iter_source_blocks(self, source, indices):
+        """
+        Return a generator of blocks of sam lines (bytes, line returns
+        included) copied from the parsed sam file, for the given indices
+        """
+        if os.path.getsize(source) != self.source_size:
+            raise ValueError('{0} is not the sam file parsed into {1}'.format(source, self.filepath))
+        if not self.source_size:
+            return
+        with open(source, 'rb') as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as source_mmap:
+                for k in range(0, len(indices), _WRITE_BATCH_SIZE):
+                    batch = np.asarray(indices[k:k + _WRITE_BATCH_SIZE], dtype=np.int64)
+                    starts = self.column('line_offset')[batch]
+                    ends = starts + self.column('line_length')[batch]
+                    yield b'\n'.join([source_mmap[s:e] for s, e in zip(starts.tolist(), ends.tolist())]) + b'\n'
+
+    def write_sam(self, out_sam, indices=None, header=False, source=None):
+        """
+        Write the alignments of the given indices (all by default), in
+        this order, to a sam file (path or binary file handle).
+        The lines are copied from source, the sam file parsed into the
+        store, when available. They are rebuilt from the columns
+        otherwise.
+        Return the number of alignments written
+        """
+        if indices is None:
+            indices = np.arange(self.alignments_nb)
+        out_fh = open(out_sam, 'wb') if isinstance(out_sam, str) else out_sam
+        try:
+            if header and self.sam_header:
+                out_fh.write('\n'.join(self.sam_header).encode() + b'\n')
+            if source is not None:
+                for block in self._iter_source_blocks(source, indices):
+                    out_fh.write(block)
+            else:
+                for lines in self.iter_sam_lines(indices):
+                    if lines:
+                        out_fh.write(b'\n'.join(lines) + b'\n')
+        finally:
+            if out_fh is not out_sam:
+                out_fh.close()
+        return len(indices)
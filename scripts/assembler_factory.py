@@ -6,6 +6,7 @@ import sys
 import logging
 import runner
 import shutil
+import olc_assembler
 
 logger = logging.getLogger(__name__)
 
@@ -57,6 +58,17 @@ class Assembler:
             logger.fatal('You have to call "build_command_line" method before "run" method')
             sys.exit("No command line available")
 
+        self._prepare_workdir()
+
+        runner.logged_check_call(self.cmd_line)
+
+        return self.fasta_file
+
+    def _prepare_workdir(self):
+        """
+        Check the input reads and make an empty working dir
+        """
+
         if self.fastq_file is None or not os.path.isfile(self.fastq_file):
             logger.fatal('The input reads file does not exists:%s' % self.fastq_file)
             sys.exit("Can't assemble %s" % self.fastq_file)
@@ -70,10 +82,6 @@ class Assembler:
             shutil.rmtree(self.workdir)
         os.mkdir(self.workdir)
 
-        runner.logged_check_call(self.cmd_line)
-
-        return self.fasta_file
-
 
 class SGA(Assembler):
 
@@ -106,11 +114,63 @@ class SGA(Assembler):
 
         self.cmd_line = cmd_line
 
+class OLC(Assembler):
+    """
+    In-process assembler (cf. olc_assembler), following SGA without
+    read correction. No process is launched, which makes it cheaper
+    than SGA on small components
+    """
+
+    def _assembler_wrapper(self):
+        return None
+
+    def _assembler_bin(self):
+        return None
+
+    def build_command_line(self, fastq_file, workdir, read_correction='no', cpu=1, *args, **kwargs):
+        self.fastq_file = fastq_file
+        self.workdir = workdir
+        self.cpu = cpu
+        self.read_correction = read_correction
+
+        self.fasta_file = os.path.join(workdir, 'assembly.fasta')
+
+    def run(self):
+        """
+        Check I/O and assemble the reads in process
+        """
+
+        if self.read_correction == 'yes':
+            logger.warning('%s does not correct reads, assembling without read correction' % self.name())
+
+        self._prepare_workdir()
+
+        contigs_nb = olc_assembler.assemble_fastq(self.fastq_file, self.fasta_file)
+        logger.debug('%s contigs assembled in process: %s' % (contigs_nb, self.fastq_file))
+
+        return self.fasta_file
+
+
 class AssemblerFactory:
-    ASSEMBLER_ENGINES = [SGA,]
+    ASSEMBLER_ENGINES = [SGA]
+
+    # Engine of the small components assembled without read correction.
+    # Not a selectable assembler, cf. get_for_component
+    IN_PROCESS_ENGINE = OLC
 
     def get(self, name):
         for assembler in self.ASSEMBLER_ENGINES:
             if assembler.name() == name:
                 return assembler() #instantiate
         raise KeyError('Not a valid assembler. Valid keys: %s' % [a.name() for a in self.ASSEMBLER_ENGINES])
+
+    def get_for_component(self, name, nucleotides_nb, read_correction, small_component_nt=None):
+        """
+        Return the assembler of a component: components of at most
+        small_component_nt nucleotides are assembled in process,
+        unless their reads have to be corrected
+        """
+        if (small_component_nt and nucleotides_nb is not None and nucleotides_nb <= small_component_nt
+                and read_correction != 'yes'):
+            return self.IN_PROCESS_ENGINE()
+        return self.get(name)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+BGZF compressed BAM writing, following the SAM/BAM format specification.
+
+BGZF is a series of gzip members of at most 64 kB of data each, whose
+compressed size is written in a gzip extra field. The members are
+compressed independently, by a pool of threads (zlib releases the GIL).
+"""
+
+import re
+import zlib
+import struct
+import functools
+import collections
+import concurrent.futures
+
+import numpy as np
+
+# Uncompressed data of a BGZF block, so that the compressed block fits
+# in 64 kB even when the data does not compress
+BGZF_BLOCK_SIZE = 0xff00
+
+# Empty BGZF block ending a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+_BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+
+# Fixed length part of a BAM record, after block_size
+BAM_RECORD_DTYPE = np.dtype([
+    ('block_size', '<i4'),
+    ('ref_id', '<i4'),
+    ('pos', '<i4'),
+    ('l_read_name', 'u1'),
+    ('mapq', 'u1'),
+    ('bin', '<u2'),
+    ('n_cigar_op', '<u2'),
+    ('flag', '<u2'),
+    ('l_seq', '<i4'),
+    ('next_ref_id', '<i4'),
+    ('next_pos', '<i4'),
+    ('tlen', '<i4'),
+])
+
+# SAM qualities are Phred + 33, BAM ones are Phred
+QUAL_TABLE = bytes((c - 33) % 256 for c in range(256))
+
+_TAG_REGEX = re.compile(rb'^([A-Za-z][A-Za-z0-9]):([AifZHB]):(.*)$', re.DOTALL)
+
+# Smallest BAM integer type holding a value, unsigned for positive
+# values (as htslib)
+_UNSIGNED_TYPES = ((b'C', '<B', 0xff), (b'S', '<H', 0xffff), (b'I', '<I', 0xffffffff))
+_SIGNED_TYPES = ((b'c', '<b', 0x80), (b's', '<h', 0x8000), (b'i', '<i', 0x80000000))
+_ARRAY_TYPES = {b'c': '<b', b'C': '<B', b's': '<h', b'S': '<H', b'i': '<i', b'I': '<I', b'f': '<f'}
+
+
+def compress_block(data, level=6):
+    """
+    Return a BGZF block of data (at most BGZF_BLOCK_SIZE bytes)
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    # The block size is written minus 1, header and footer included
+    header = _BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                               len(compressed) + 25)
+    return header + compressed + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+class BgzfWriter:
+    """
+    Write a BGZF compressed file (path or binary file handle). Blocks
+    are compressed by threads, and written in order
+    """
+
+    def __init__(self, out_file, level=6, threads=1):
+        self.fh = open(out_file, 'wb') if isinstance(out_file, str) else out_file
+        self.owned = self.fh is not out_file
+        self.level = level
+        self.buffer = bytearray()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.threads = threads
+        self.pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_blocks(self, data):
+        blocks = [bytes(data[k:k + BGZF_BLOCK_SIZE]) for k in range(0, len(data), BGZF_BLOCK_SIZE)]
+        if self.executor is None:
+            for block in blocks:
+                self.fh.write(compress_block(block, self.level))
+            return
+        for block in blocks:
+            self.pending.append(self.executor.submit(compress_block, block, self.level))
+        # A few blocks by thread are compressed ahead
+        while len(self.pending) > 4 * self.threads:
+            self.fh.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= 16 * BGZF_BLOCK_SIZE:
+            full_size = len(self.buffer) - len(self.buffer) % BGZF_BLOCK_SIZE
+            self._write_blocks(self.buffer[:full_size])
+            del self.buffer[:full_size]
+
+    def close(self):
+        if self.fh is None:
+            return
+        try:
+            self._write_blocks(self.buffer)
+            self.buffer = bytearray()
+            while self.pending:
+                self.fh.write(self.pending.popleft().result())
+            self.fh.write(BGZF_EOF)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            if self.owned:
+                self.fh.close()
+            self.fh = None
+
+
+def reg2bin(starts, ends):
+    """
+    Return the BAI bins of 0-based [start, end) regions, as int arrays
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    last = np.asarray(ends, dtype=np.int64) - 1
+    bins = np.zeros(len(starts), dtype=np.int64)
+    done = np.zeros(len(starts), dtype=bool)
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        same = ~done & ((starts >> shift) == (last >> shift))
+        bins[same] = offset + (starts[same] >> shift)
+        done |= same
+    return bins
+
+
+@functools.lru_cache(maxsize=65536)
+def encode_tag(tag):
+    """
+    Return the BAM encoding of a SAM optional field (bytes). Integers
+    use the smallest fitting type
+    """
+    match = _TAG_REGEX.match(tag)
+    if match is None:
+        raise ValueError('Invalid optional field: {0}'.format(tag))
+    name, value_type, value = match.groups()
+    if value_type == b'i':
+        value = int(value)
+        int_types = _UNSIGNED_TYPES if value >= 0 else _SIGNED_TYPES
+        for bam_type, fmt, limit in int_types:
+            if abs(value) <= limit:
+                return name + bam_type + struct.pack(fmt, value)
+        raise ValueError('Optional field value out of range: {0}'.format(tag))
+    if value_type == b'A':
+        return name + b'A' + value[:1]
+    if value_type == b'f':
+        return name + b'f' + struct.pack('<f', float(value))
+    if value_type in (b'Z', b'H'):
+        return name + value_type + value + b'\0'
+    # Numeric array
+    subtype, _, values = value.partition(b',')
+    values = values.split(b',') if values else []
+    array = np.array([float(v) if subtype == b'f' else int(v) for v in values], dtype=_ARRAY_TYPES[subtype])
+    return name + b'B' + subtype + struct.pack('<i', len(values)) + array.tobytes()
+
+
+@functools.lru_cache(maxsize=65536)
+def encode_tags(tags):
+    """
+    Return the BAM encoding of the optional fields of a SAM line
+    (tab separated bytes)
+    """
+    if not tags:
+        return b''
+    return b''.join(encode_tag(tag) for tag in tags.split(b'\t'))
+
+
+def bam_header(sam_header, references):
+    """
+    Return the BAM header given the SAM header lines (str) and the
+    references, as (name, length) pairs of bytes and int. The @SQ lines
+    are written from the references
+    """
+    lines = [l for l in sam_header if not l.startswith('@SQ\t')]
+    sq_lines = ['@SQ\tSN:{0}\tLN:{1}'.format(name.decode(), length) for name, length in references]
+    # @HD comes first
+    text = '\n'.join(lines[:1] + sq_lines + lines[1:] if lines[:1] and lines[0].startswith('@HD')
+                     else sq_lines + lines)
+    text = (text + '\n' if text else '').encode()
+    header = [b'BAM\1', struct.pack('<i', len(text)), text, struct.pack('<i', len(references))]
+    for name, length in references:
+        header.append(struct.pack('<i', len(name) + 1) + name + b'\0' + struct.pack('<i', length))
+    return b''.join(header)
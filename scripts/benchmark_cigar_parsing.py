@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the shared CIGAR parser (cigar_utils) against the character
+loop previously copied in every SAM consumer.
+
+Without input file, random CIGAR strings of SortMeRNA-like alignments
+are generated.
+"""
+
+import sys
+import time
+import random
+import argparse
+
+import cigar_utils
+
+
+def legacy_parse_cigar(cigar):
+    """
+    Character loop CIGAR parser, as it was copied in the scripts
+    (without the merge of adjacent operations, which failed on tuples)
+    """
+    cigar_tab = list()
+    count_str = ''
+    for c in cigar:
+        if c.isdigit():
+            count_str += c
+        else:
+            operation = c
+            count = 1
+            if count_str:
+                count = int(count_str)
+            cigar_tab.append((operation, count))
+            count_str = ''
+    #
+    return cigar_tab
+
+
+def legacy_ref_span(cigar):
+    return sum((count for operation, count in legacy_parse_cigar(cigar) if operation in ('M','D','N','=','X')))
+
+
+def random_cigars(cigars_nb, length, distinct_nb):
+    """
+    Return a list of random CIGAR strings, drawn from distinct_nb
+    distinct ones
+    """
+    rng = random.Random(0)
+    distinct = list()
+    for _ in range(distinct_nb):
+        left_clip = rng.choice([0, 0, 0, rng.randint(1, 20)])
+        right_clip = rng.choice([0, 0, 0, rng.randint(1, 20)])
+        aligned = length - left_clip - right_clip
+        cigar = '{0}S'.format(left_clip) if left_clip else ''
+        if rng.random() < 0.3:
+            indel_pos = rng.randint(1, aligned - 2)
+            cigar += '{0}M{1}{2}{3}M'.format(indel_pos, rng.randint(1, 3), rng.choice('ID'), aligned - indel_pos - 1)
+        else:
+            cigar += '{0}M'.format(aligned)
+        cigar += '{0}S'.format(right_clip) if right_clip else ''
+        distinct.append(cigar)
+    return [rng.choice(distinct) for _ in range(cigars_nb)]
+
+
+def time_parser(name, func, cigars, repeat):
+    """
+    Return the best wall time of a parser over several runs
+    """
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for cigar in cigars:
+            func(cigar)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return name, best
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the CIGAR parsers.')
+    parser.add_argument('-i', '--input_sam',
+                        metavar='INPUT',
+                        help='input sam file (default: random CIGAR strings)')
+    parser.add_argument('-n', '--cigars_nb',
+                        type=int,
+                        default=500000,
+                        help='number of random CIGAR strings')
+    parser.add_argument('-d', '--distinct_nb',
+                        type=int,
+                        default=2000,
+                        help='number of distinct random CIGAR strings')
+    parser.add_argument('-l', '--length',
+                        type=int,
+                        default=150,
+                        help='length of the random reads')
+    parser.add_argument('-r', '--repeat',
+                        type=int,
+                        default=3,
+                        help='number of runs of each parser')
+    args = parser.parse_args()
+
+    if args.input_sam is None:
+        cigars = random_cigars(args.cigars_nb, args.length, args.distinct_nb)
+    else:
+        with open(args.input_sam, 'r') as sam_fh:
+            cigars = [l.split('\t', 6)[5] for l in sam_fh if l.strip() and not l.startswith('@')]
+
+    parsers = [
+        ('legacy parse', legacy_parse_cigar),
+        ('legacy ref span', legacy_ref_span),
+        ('cigar_utils parse', cigar_utils.parse_cigar),
+        ('cigar_utils info', cigar_utils.cigar_info),
+        ('cigar_utils ref span', cigar_utils.get_ref_span),
+    ]
+
+    sys.stdout.write('{0} CIGAR strings ({1} distinct)\n'.format(len(cigars), len(set(cigars))))
+    for name, func in parsers:
+        cigar_utils.cigar_info.cache_clear()
+        cigar_utils._operations.cache_clear()
+        name, elapsed = time_parser(name, func, cigars, args.repeat)
+        sys.stdout.write('{0:<24}{1:>10.3f} s{2:>12.0f} CIGAR/s\n'.format(name, elapsed, len(cigars) / elapsed))
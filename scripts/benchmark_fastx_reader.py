@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the shared fasta/fastq reader (fastx_utils) against the
+line by line parser previously copied in every script.
+
+Without input file, a random fasta or fastq file is generated.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+import fastx_utils
+
+
+def legacy_read_fasta_file_handle(fasta_file_handle):
+    """
+    Line by line fasta parser, as it was copied in the scripts
+    """
+    header = ''
+    seqlines = list()
+    sequence_nb = 0
+    for line in (l.strip() for l in fasta_file_handle if l.strip()):
+        if line[0] == '>':
+            if sequence_nb:
+                yield (header, ''.join(seqlines))
+                del seqlines[:]
+            header = line[1:].rstrip()
+            sequence_nb += 1
+        else:
+            seqlines.append(line.strip())
+    if header or seqlines:
+        yield (header, ''.join(seqlines))
+    fasta_file_handle.close()
+
+
+def legacy_read_fastq_file_handle(fastq_file_handle):
+    """
+    Line by line fastq parser, as it was copied in the scripts
+    """
+    count = 0
+    header = ''
+    seq = ''
+    qual = ''
+    for line in (l.strip() for l in fastq_file_handle if l.strip()):
+        count += 1
+        if count % 4 == 1:
+            if header:
+                yield header, seq, qual
+            header = line[1:].split()[0]
+        elif count % 4 == 2:
+            seq = line
+        elif count % 4 == 0:
+            qual = line
+    yield header, seq, qual
+    fastq_file_handle.close()
+
+
+def write_random_file(filepath, fmt, records_nb, length):
+    """
+    Write a random fasta or fastq file
+    """
+    rng = random.Random(0)
+    with open(filepath, 'w') as out_fh:
+        for i in range(records_nb):
+            seq = ''.join(rng.choice('ACGT') for _ in range(length))
+            if fmt == 'fastq':
+                out_fh.write('@read{0} desc\n{1}\n+\n{2}\n'.format(i, seq, 'I' * length))
+            else:
+                out_fh.write('>read{0} desc\n'.format(i))
+                for j in range(0, length, 80):
+                    out_fh.write(seq[j:j+80] + '\n')
+
+
+def time_parser(name, func, repeat):
+    """
+    Return the best wall time of a parser over several runs
+    """
+    best = None
+    records_nb = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        records_nb = sum(1 for _ in func())
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return name, records_nb, best
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the fasta/fastq readers.')
+    parser.add_argument('-i', '--input_file',
+                        metavar='INPUT',
+                        help='input fasta or fastq file (default: random file)')
+    parser.add_argument('-f', '--format',
+                        choices=['fasta', 'fastq'],
+                        default='fastq',
+                        help='input file format')
+    parser.add_argument('-n', '--records_nb',
+                        type=int,
+                        default=200000,
+                        help='number of random records')
+    parser.add_argument('-l', '--length',
+                        type=int,
+                        default=150,
+                        help='length of random records')
+    parser.add_argument('-r', '--repeat',
+                        type=int,
+                        default=3,
+                        help='number of runs of each parser')
+    args = parser.parse_args()
+
+    tmp_filepath = None
+    input_filepath = args.input_file
+    if input_filepath is None:
+        fd, tmp_filepath = tempfile.mkstemp(suffix='.' + args.format)
+        os.close(fd)
+        write_random_file(tmp_filepath, args.format, args.records_nb, args.length)
+        input_filepath = tmp_filepath
+
+    if args.format == 'fastq':
+        parsers = [
+            ('legacy', lambda: legacy_read_fastq_file_handle(open(input_filepath, 'r'))),
+            ('fastx_utils', lambda: fastx_utils.read_fastq(input_filepath)),
+            ('fastx_utils bytes', lambda: fastx_utils.read_fastq(input_filepath, as_bytes=True)),
+        ]
+    else:
+        parsers = [
+            ('legacy', lambda: legacy_read_fasta_file_handle(open(input_filepath, 'r'))),
+            ('fastx_utils', lambda: fastx_utils.read_fasta(input_filepath)),
+            ('fastx_utils bytes', lambda: fastx_utils.read_fasta(input_filepath, as_bytes=True)),
+        ]
+
+    try:
+        size_mb = os.path.getsize(input_filepath) / 1024.0 / 1024.0
+        sys.stdout.write('{0} ({1:.1f} MB)\n'.format(input_filepath, size_mb))
+        for name, func in parsers:
+            name, records_nb, elapsed = time_parser(name, func, args.repeat)
+            sys.stdout.write('{0:<20}{1:>10} records{2:>10.3f} s{3:>10.1f} MB/s\n'.format(
+                name, records_nb, elapsed, size_mb / elapsed))
+    finally:
+        if tmp_filepath is not None:
+            os.remove(tmp_filepath)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the taxonomy trie LCA (compute_lca_from_tab) against the
+prefix strings implementation it replaced.
+
+Without input file, random components are generated: component sizes
+follow a heavy tailed distribution, and the reads of a component map
+mostly to the references of a few related clades, as in the components
+of the overlap graph.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from collections import defaultdict
+
+import compute_lca_from_tab
+
+
+def legacy_compute_lca(factor_taxo_list, min_proportion):
+    """
+    Prefix strings LCA, as it was implemented in compute_lca_from_tab
+    """
+    lca_tab = list()
+
+    if min_proportion >= 1.0:
+        total_taxo_tab_list = [t.split(';') for g in factor_taxo_list for t in g]
+        lca_tab = os.path.commonprefix(total_taxo_tab_list)
+    else:
+        lca_count = defaultdict(float)
+        for group_by_taxo_list in factor_taxo_list:
+            for taxo in group_by_taxo_list:
+                taxo_tab = taxo.split(';')
+                for i in range(len(taxo_tab)):
+                    lca = ';'.join(taxo_tab[:i+1])
+                    lca_count[lca] += 1.0/len(group_by_taxo_list)
+        lca_count_list = [ (lca.split(';'), count) for (lca, count) in lca_count.items()]
+        lca_count_list.sort(key = lambda x: (x[1], -len(x[0])), reverse=True)
+
+        threshold = float(len(factor_taxo_list)) * float(min_proportion)
+
+        for cur_lca_tab, count in lca_count_list:
+            if float(count) < float(threshold):
+                break
+            lca_tab = cur_lca_tab
+
+    lca = ';'.join(lca_tab)
+    if not lca:
+        lca = 'Root'
+
+    return lca
+
+
+def random_taxonomies(taxo_nb, depth, rng):
+    """
+    Return random SILVA-like taxonomies of a given depth, as a list of
+    lists sharing their upper levels
+    """
+    taxonomies = [['Bacteria']]
+    for level in range(1, depth):
+        # Roughly 4 times more taxa at each level
+        taxa_nb = min(taxo_nb, 4 ** level)
+        taxonomies = [rng.choice(taxonomies) + ['Taxon_{0}_{1}'.format(level, i)] for i in range(taxa_nb)]
+    return [';'.join(t) for t in taxonomies]
+
+
+def random_components(components_nb, max_reads_nb, taxonomies, rng):
+    """
+    Return a list of components, as lists of reads taxo lists
+    """
+    components = list()
+    for _ in range(components_nb):
+        reads_nb = min(max_reads_nb, int(rng.paretovariate(1.2) * 20))
+        # Taxonomies of the references of a few related clades
+        center = rng.randrange(len(taxonomies))
+        clade = taxonomies[max(0, center - 30):center + 30]
+        factor_taxo_list = list()
+        for _ in range(reads_nb):
+            refs_nb = rng.choice((1, 1, 1, 2, 3, rng.randint(4, 40)))
+            factor_taxo_list.append(sorted(rng.choice(clade) for _ in range(refs_nb)))
+        components.append(factor_taxo_list)
+    return components
+
+
+def read_components(tab_filepath):
+    """
+    Read the components of a (read, metanode, component, taxo) tab file
+    sorted by component and read
+    """
+    with open(tab_filepath, 'r') as tab_fh:
+        return [[[t[3] for t in g] for g in c]
+                for c in compute_lca_from_tab.read_tab_file_handle_sorted(tab_fh, 2, 0, None)]
+
+
+def time_lca(name, func, components, min_proportion, repeat):
+    """
+    Return the best wall time of a LCA implementation over several runs,
+    and its LCAs
+    """
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        lcas = [func(c, min_proportion) for c in components]
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return name, best, lcas
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the LCA computations.')
+    parser.add_argument('-i', '--input_tab',
+                        metavar='INPUT',
+                        help='input (read, metanode, component, taxo) tab file, '
+                             'sorted by component and read (default: random components)')
+    parser.add_argument('-c', '--components_nb',
+                        type=int,
+                        default=2000,
+                        help='number of random components')
+    parser.add_argument('-n', '--max_reads_nb',
+                        type=int,
+                        default=50000,
+                        help='maximum number of reads of a random component')
+    parser.add_argument('-d', '--depth',
+                        type=int,
+                        default=7,
+                        help='depth of the random taxonomies')
+    parser.add_argument('-m', '--min_proportion',
+                        type=float,
+                        default=0.51,
+                        help='LCA quorum')
+    parser.add_argument('-r', '--repeat',
+                        type=int,
+                        default=3,
+                        help='number of runs of each implementation')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    if args.input_tab is None:
+        taxonomies = random_taxonomies(20000, args.depth, rng)
+        components = random_components(args.components_nb, args.max_reads_nb, taxonomies, rng)
+    else:
+        components = read_components(args.input_tab)
+
+    sys.stdout.write('{0} components, {1} reads, {2} taxonomies\n'.format(
+        len(components), sum(len(c) for c in components), sum(len(g) for c in components for g in c)))
+
+    results = list()
+    for name, func in (('prefix strings', legacy_compute_lca), ('taxonomy trie', compute_lca_from_tab.compute_lca)):
+        name, elapsed, lcas = time_lca(name, func, components, args.min_proportion, args.repeat)
+        results.append(lcas)
+        sys.stdout.write('{0:<18}{1:>10.3f} s{2:>12.0f} components/s\n'.format(name, elapsed, len(components) / elapsed))
+
+    if results[0] != results[1]:
+        sys.stdout.write('LCAs differ\n')
+        sys.exit(1)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+CIGAR string parsing shared by the SAM consumers.
+
+A CIGAR string is parsed with a regex into BAM operation codes and
+counts, along with the alignment geometry (spans on the reference and
+on the query, soft clips). Reads of a sample have few distinct CIGAR
+strings, so the parsing is cached.
+"""
+
+import re
+import functools
+import collections
+
+# The BAM code of an operation is its index in this string
+OPERATIONS = 'MIDNSHP=X'
+OPERATION_CODES = {operation: code for code, operation in enumerate(OPERATIONS)}
+
+# Operations consuming the reference or the query sequence
+REF_OPERATIONS = 'MDN=X'
+QUERY_OPERATIONS = 'MIS=X'
+
+_CIGAR_REGEX = re.compile(r'(\d*)([MIDNSHP=X])')
+
+CigarInfo = collections.namedtuple('CigarInfo', [
+    'codes',        # BAM operation codes, one byte by operation
+    'counts',       # Tuple of the operation counts
+    'ref_span',     # Reference nucleotides covered by the alignment
+    'query_span',   # Query nucleotides aligned (soft clips excluded)
+    'left_clip',    # Soft clipped query nucleotides before the alignment
+    'right_clip',   # Soft clipped query nucleotides after the alignment
+])
+
+
+@functools.lru_cache(maxsize=65536)
+def cigar_info(cigar):
+    """
+    Parse a CIGAR string (str or bytes) and return a CigarInfo.
+    Adjacent operations of the same type are merged, a missing count
+    is 1. '*' (unavailable CIGAR) gives an empty alignment.
+    Raise ValueError for an invalid CIGAR string
+    """
+    if isinstance(cigar, bytes):
+        cigar = cigar.decode()
+    matches = _CIGAR_REGEX.findall(cigar)
+    if sum(len(count) + 1 for count, _ in matches) != len(cigar) and cigar != '*':
+        raise ValueError('Invalid CIGAR string: {0}'.format(cigar))
+
+    codes = list()
+    counts = list()
+    for count, operation in matches:
+        count = int(count) if count else 1
+        code = OPERATION_CODES[operation]
+        if codes and codes[-1] == code:
+            counts[-1] += count
+        else:
+            codes.append(code)
+            counts.append(count)
+
+    ref_span = 0
+    query_span = 0
+    for code, count in zip(codes, counts):
+        operation = OPERATIONS[code]
+        if operation in REF_OPERATIONS:
+            ref_span += count
+        if operation in QUERY_OPERATIONS and operation != 'S':
+            query_span += count
+
+    # Soft clips are the first and last operations, or next to hard clips
+    clipped = [(OPERATIONS[code], count) for code, count in zip(codes, counts) if OPERATIONS[code] != 'H']
+    left_clip = clipped[0][1] if clipped and clipped[0][0] == 'S' else 0
+    right_clip = clipped[-1][1] if len(clipped) > 1 and clipped[-1][0] == 'S' else 0
+
+    return CigarInfo(bytes(codes), tuple(counts), ref_span, query_span, left_clip, right_clip)
+
+
+@functools.lru_cache(maxsize=65536)
+def _operations(cigar):
+    info = cigar_info(cigar)
+    return tuple((OPERATIONS[code], count) for code, count in zip(info.codes, info.counts))
+
+
+def parse_cigar(cigar):
+    """
+    Parse a CIGAR string and return a list of (operation, count) tuples
+    """
+    return list(_operations(cigar))
+
+
+def get_ref_span(cigar):
+    """
+    Return the number of reference nucleotides covered by an alignment
+    """
+    return cigar_info(cigar).ref_span
+
+
+def get_operations_count(cigar, operations):
+    """
+    Return the total count of the given operations (eg. 'ID' for indels)
+    """
+    info = cigar_info(cigar)
+    return sum(count for code, count in zip(info.codes, info.counts) if OPERATIONS[code] in operations)
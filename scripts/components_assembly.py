@@ -3,18 +3,132 @@ import os
 import sys
 import subprocess
 import logging
-from collections import defaultdict
+import logging.handlers
+import contextlib
+import json
+import time
+import collections
+import threading
 import multiprocessing
 import argparse
 
 from fasta_utils import read_fasta_file_handle, format_seq
-from fastq_utils import read_fastq_file_handle
+from fastx_utils import read_fasta, read_fastq, sniff_format, strip_compression_suffix, iter_line_blocks
 
+from stage_cache import file_signature
 from assembler_factory import AssemblerFactory
 
 logger = logging.getLogger(__name__)
 
-def extract_reads_by_component(fastq, read_metanode_component_filepath):
+# Assembled components of the workdir, cf. AssemblyCheckpoint
+CHECKPOINT_FILENAME = 'assembly.checkpoint'
+
+# Reads, nucleotides and fastq file of a component
+ComponentReads = collections.namedtuple('ComponentReads', ['fastq', 'reads_nb', 'nucleotides_nb'])
+
+
+class ComponentFilePool:
+    """
+    Append fastq records to one file per component through a bounded
+    pool of open files. The least recently used file is closed when the
+    pool is full, and reopened in append mode when needed
+    """
+
+    def __init__(self, directory, max_open_files=256, buffer_size=32 * 1024):
+        self.directory = directory
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+        self.handles = collections.OrderedDict()
+        # Components in order of their first read
+        self.fastq_paths = dict()
+        self.reads_nb = collections.Counter()
+        self.nucleotides_nb = collections.Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open(self, component_id):
+        if len(self.handles) >= self.max_open_files:
+            _, lru_fh = self.handles.popitem(last=False)
+            lru_fh.close()
+        fq_path = self.fastq_paths.get(component_id)
+        if fq_path is None:
+            fq_path = os.path.join(self.directory, 'component%s_reads.fq' % component_id.decode())
+            self.fastq_paths[component_id] = fq_path
+            # Overwrite the files of a previous run
+            mode = 'wb'
+        else:
+            mode = 'ab'
+        component_fh = self.handles[component_id] = open(fq_path, mode, buffering=self.buffer_size)
+        return component_fh
+
+    def write(self, component_id, header, seq, qual):
+        """
+        Append a fastq record to a component file (all bytes)
+        """
+        component_fh = self.handles.get(component_id)
+        if component_fh is None:
+            component_fh = self._open(component_id)
+        else:
+            self.handles.move_to_end(component_id)
+        component_fh.write(b'@' + header + b'\n' + seq + b'\n+\n' + qual + b'\n')
+        self.reads_nb[component_id] += 1
+        self.nucleotides_nb[component_id] += len(seq)
+
+    def close(self):
+        for component_fh in self.handles.values():
+            component_fh.close()
+        self.handles.clear()
+
+    def components(self):
+        """
+        Return a dict (key=component_id, value=ComponentReads)
+        """
+        return {c.decode(): ComponentReads(fq_path, self.reads_nb[c], self.nucleotides_nb[c])
+                for c, fq_path in self.fastq_paths.items()}
+
+
+def write_read_component_map(components_csv_filepath, read_metanode_component_filepath, sep=b';'):
+    """
+    Write the read --> metanode, component file (tabulated, sorted by
+    read) from a componentsearch components csv file. The reads excluded
+    from the components (negative component id) are not written
+    """
+    rows = list()
+    first = True
+    for lines in iter_line_blocks(components_csv_filepath, as_bytes=True):
+        if first:
+            # Skip header
+            lines = lines[1:]
+            first = False
+        for line in lines:
+            tab = line.split(sep)
+            row = tuple(tab[1:2] + tab[3:5])
+            component_id = row[-1]
+            if component_id[:1] == b'-' and component_id[1:].isdigit() and int(component_id[1:]):
+                continue
+            rows.append(row)
+    rows.sort()
+    with open(read_metanode_component_filepath, 'wb') as read_metanode_component_fh:
+        read_metanode_component_fh.writelines(b'\t'.join(row) + b'\n' for row in rows)
+    return len(rows)
+
+
+def partition_reads_by_component(fastq, read_metanode_component_filepath, directory, max_open_files=256):
+    """
+    Stream the reads of a fastq file (plain or compressed) to one fastq
+    file per component into the given directory:
+    directory/
+        component%s_reads.fq % component_id
+    Only the read --> component map is held in memory, reads are written
+    as they are read.
+
+    Return a dict (key=component_id, value=ComponentReads), components
+    in order of their first read
+    """
     if not os.path.isfile(fastq):
         logger.fatal('The input reads file does not exists:%s' % fastq)
         sys.exit("An error occured. Can't extract component's reads")
@@ -25,20 +139,27 @@ def extract_reads_by_component(fastq, read_metanode_component_filepath):
 
     # Reading read --> component file
     logger.debug('Reading read-->component from {}'.format(read_metanode_component_filepath))
+    component_ids = dict()
     read_component_dict = dict()
-    with open(read_metanode_component_filepath, 'r') as read_metanode_component_fh:
-        read_component_dict = {t[0]:t[2] for t in (l.split() for l in read_metanode_component_fh) if t[2] != 'NULL'}
+    with open(read_metanode_component_filepath, 'rb') as read_metanode_component_fh:
+        for t in (l.split() for l in read_metanode_component_fh):
+            if t[2] != b'NULL':
+                # Component ids are shared by their reads
+                read_component_dict[t[0]] = component_ids.setdefault(t[2], t[2])
 
-    # Storing reads for each component
-    logger.debug('Storing reads by component from {}'.format(fastq))
-    component_reads_dict = defaultdict(list)
-    with open(fastq, 'r') as fastq_fh:
-        for header, seq, qual in read_fastq_file_handle(fastq_fh):
-            try:
-                component_reads_dict[read_component_dict[header]].append(tuple((header, seq, qual)))
-            except KeyError:
-                pass
-    return component_reads_dict
+    try:
+        os.mkdir(directory)
+    except FileExistsError as fee:
+        pass
+
+    # Writing reads to their component file
+    logger.debug('Writing reads by component from {}'.format(fastq))
+    with ComponentFilePool(directory, max_open_files) as file_pool:
+        for header, seq, qual in read_fastq(fastq, as_bytes=True):
+            component_id = read_component_dict.get(header)
+            if component_id is not None:
+                file_pool.write(component_id, header, seq, qual)
+    return file_pool.components()
 
 
 def extract_lca_by_component(components_lca_filepath):
@@ -54,41 +175,13 @@ def extract_lca_by_component(components_lca_filepath):
     return component_lca_dict
 
 
-def save_components(component_reads_dict, directory):
-    """
-    Take a dict (key=component_id, value=[header,seq,qual])
-    and save each component to a file into the given directory:
-    directory/
-        component_%s.fq % component_id
-
-    Return a dict (key=component_id, value=fastq_path)
-    """
-
-    try:
-        os.mkdir(directory)
-    except FileExistsError as fee:
-        pass
-
-    components_fq = {}
-    for component_id, reads_list in component_reads_dict.items():
-        fq_name = "component%s_reads.fq" % component_id
-        fq_path = os.path.join(directory, fq_name)
-        #logger.debug("Save component %s into %s" % (component_id, fq_path))
-        components_fq[component_id] = fq_path
-
-        with open(fq_path, 'w') as component_fh:
-            for (header, seq, qual) in reads_list:
-                component_fh.write('@{}\n{}\n+\n{}\n'.format(header, seq, qual))
-    return components_fq
-
-
 def isfastq(filepath):
     """
     Determine if filepath is a fastq file based on the extension
     """
 
     suffix = ('.fq', '.fastq')
-    return any( [ filepath.endswith(s) for s in suffix] )
+    return any( [ strip_compression_suffix(filepath).endswith(s) for s in suffix] )
 
 
 def isfasta(filepath):
@@ -97,38 +190,40 @@ def isfasta(filepath):
     """
 
     suffix = ('.fa', '.fasta', '.fna')
-    return any( [filepath.endswith(s) for s in suffix] )
+    return any( [strip_compression_suffix(filepath).endswith(s) for s in suffix] )
 
 
 def nucleotidic_number(fastx):
     """
     Compute the total number of nucleotides in the fastx file
+    (plain or compressed). The format is detected from the file content,
+    the extension is only used for empty files
     """
 
     parser = None
-    if isfasta(fastx):
-        parser = read_fasta_file_handle
-    elif isfastq(fastx):
-        parser = read_fastq_file_handle
+    fastx_format = sniff_format(fastx)
+    if fastx_format == 'fasta' or (fastx_format is None and isfasta(fastx)):
+        parser = read_fasta
+    elif fastx_format == 'fastq' or (fastx_format is None and isfastq(fastx)):
+        parser = read_fastq
 
     if parser is None:
         logger.fatal("Can't dertermine whether this file is a fasta or fastq")
         sys.exit('Aborting assembly step')
 
-
     count = 0
-    with open(fastx, 'r') as fastx_handle:
-        for rec in parser(fastx_handle):
-            seq = rec[1]
-            count += len(seq)
+    for rec in parser(fastx, as_bytes=True):
+        count += len(rec[1])
     return count
 
-def estimate_coverage(reads_fq, contigs_fa):
+def estimate_coverage(reads_fq, contigs_fa, reads_nt=None):
     """
     estimated_cov = reads_nt/contigs_nt
+    The reads are only counted when reads_nt is not given
     """
 
-    reads_nt = nucleotidic_number(reads_fq)
+    if reads_nt is None:
+        reads_nt = nucleotidic_number(reads_fq)
     contigs_nt = nucleotidic_number(contigs_fa)
     estimated_cov = None
 
@@ -145,25 +240,32 @@ def estimate_coverage(reads_fq, contigs_fa):
 
 def assemble_component(assembler_name,
                        in_fastq, workdir,
-                       read_correction, cpu, coverage_threshold):
+                       read_correction, cpu, coverage_threshold,
+                       reads_nt=None, small_component_nt=None):
+    """
+    Assemble the reads of a component. Components of at most
+    small_component_nt nucleotides (reads_nt) are assembled in process
+    when their reads are not corrected
+    """
 
     if read_correction != 'auto' and coverage_threshold is not None:
         logger.warning("Coverage_threshold %s makes no sense when read_correction is not auto. This argument will be ignored" % coverage_threshold)
 
     logger.debug('Assembling: %s' % in_fastq)
     assembler_factory = AssemblerFactory()
-    assembler = assembler_factory.get(assembler_name)
+    assembler = assembler_factory.get_for_component(assembler_name, reads_nt, read_correction, small_component_nt)
     assembler.build_command_line(in_fastq, workdir, read_correction, cpu)
 
     fasta_file = assembler.run()
-    estimated_cov = estimate_coverage(in_fastq, fasta_file)
+    estimated_cov = estimate_coverage(in_fastq, fasta_file, reads_nt)
     logger.debug("Estimated coverage:%s, %s" % (estimated_cov, in_fastq))
 
     # Re-run the assembly with error correction activated when read_correction == auto
     if read_correction == 'auto' and estimated_cov is not None and estimated_cov > coverage_threshold:
+        assembler = assembler_factory.get_for_component(assembler_name, reads_nt, 'yes', small_component_nt)
         assembler.build_command_line(in_fastq, workdir, 'yes', cpu)
         fasta_file = assembler.run()
-        estimated_cov2 = estimate_coverage(in_fastq, fasta_file)
+        estimated_cov2 = estimate_coverage(in_fastq, fasta_file, reads_nt)
         logger.debug("Estimated coverage, before:%s, after:%s, component:%s, cov_threshold:%s" % (estimated_cov, estimated_cov2, in_fastq, coverage_threshold))
 
         # suspicious when estimate_cov is not None and estimated_cov2 is None
@@ -184,16 +286,128 @@ def concat_components_fasta_with_lca(assembled_components_fasta, contigs_fasta,
     for component_id, component_fasta in assembled_components_fasta.items():
         if component_id in component_lca_dict:
             component_lca = component_lca_dict[component_id]
-        with open(component_fasta, 'r') as assembler_contigs_fh:
-            for header, seq in read_fasta_file_handle(assembler_contigs_fh):
-                if len(seq):
-                    contig_count += 1
-                    contigs_fh.write('>{0} component={1} '.format(contig_count, component_id))
-                    contigs_fh.write('lca={0}\n{1}\n'.format(component_lca, format_seq(seq)))
+        contig_count = write_component_contigs(contigs_fh, component_id, component_fasta, component_lca, contig_count)
 
     contigs_fh.close()
 
 
+def write_component_contigs(contigs_fh, component_id, component_fasta, component_lca, contig_count):
+    """
+    Append the non-empty contigs of a component to the pooled contigs,
+    numbered from contig_count + 1.
+    Return the new contig count
+    """
+    with open(component_fasta, 'r') as assembler_contigs_fh:
+        for header, seq in read_fasta_file_handle(assembler_contigs_fh):
+            if len(seq):
+                contig_count += 1
+                contigs_fh.write('>{0} component={1} '.format(contig_count, component_id))
+                contigs_fh.write('lca={0}\n{1}\n'.format(component_lca, format_seq(seq)))
+    return contig_count
+
+
+class ContigsStream:
+    """
+    Append the contigs of the components to the pooled contigs file as
+    they are assembled. Components are written in a fixed order, each
+    one as soon as all the previous ones are, so that the contigs file
+    does not depend on the assembly timing
+    """
+
+    def __init__(self, contigs_fh, component_ids):
+        self.contigs_fh = contigs_fh
+        self.component_ids = component_ids
+        self.next_index = 0
+        self.pending = dict()
+        self.contig_count = 0
+
+    def add(self, component_id, component_fasta):
+        self.pending[component_id] = component_fasta
+        while self.next_index < len(self.component_ids) and self.component_ids[self.next_index] in self.pending:
+            component_id = self.component_ids[self.next_index]
+            self.contig_count = write_component_contigs(self.contigs_fh, component_id, self.pending.pop(component_id),
+                                                        'NULL', self.contig_count)
+            self.next_index += 1
+        self.contigs_fh.flush()
+
+
+class AssemblyCheckpoint:
+    """
+    Record the assembled components, so that a killed run only assembles
+    the unfinished ones. The checkpoint file starts with the run key (the
+    inputs and assembly options), then has a (component_id, contigs
+    fasta) line per assembled component, written once its contigs are
+    """
+
+    def __init__(self, filepath, run_key):
+        self.filepath = filepath
+        self.run_key = json.dumps(run_key, sort_keys=True)
+        self.fh = None
+
+    def read(self):
+        """
+        Return a dict (key=component_id, value=contigs fasta path) of the
+        components assembled by a previous run with the same key
+        """
+        assembled = dict()
+        if not os.path.isfile(self.filepath):
+            return assembled
+        with open(self.filepath, 'r') as checkpoint_fh:
+            if checkpoint_fh.readline().rstrip('\n') != '# ' + self.run_key:
+                logger.debug('Ignore the checkpoint of another run: %s' % self.filepath)
+                return assembled
+            for t in (l.rstrip('\n').split('\t') for l in checkpoint_fh):
+                # The last line of a killed run can be truncated
+                if len(t) == 2 and os.path.isfile(t[1]):
+                    assembled[t[0]] = t[1]
+        return assembled
+
+    def open(self, assembled):
+        """
+        Start a checkpoint file holding the given assembled components
+        """
+        self.fh = open(self.filepath, 'w')
+        self.fh.write('# ' + self.run_key + '\n')
+        for component_id, component_fasta in assembled.items():
+            self.add(component_id, component_fasta)
+
+    def add(self, component_id, component_fasta):
+        self.fh.write('{0}\t{1}\n'.format(component_id, component_fasta))
+        self.fh.flush()
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+class AssemblyProgress:
+    """
+    Log the assembly progress every step components, with an estimated
+    time of arrival from the cost of the components left
+    """
+
+    def __init__(self, components_nb, total_cost, step):
+        self.components_nb = components_nb
+        self.total_cost = total_cost
+        self.step = max(1, step)
+        self.done_nb = 0
+        self.done_cost = 0
+        self.t0 = time.time()
+
+    def update(self, cost):
+        self.done_nb += 1
+        self.done_cost += cost
+        if self.done_nb % self.step and self.done_nb != self.components_nb:
+            return
+        elapsed = time.time() - self.t0
+        eta = ''
+        if self.done_cost and self.done_nb != self.components_nb:
+            eta = ', ETA {0:.0f} s'.format(elapsed * (self.total_cost - self.done_cost) / self.done_cost)
+        logger.info('Assembled {0} / {1} components ({2:.1f}% of the nucleotides) in {3:.0f} s{4}'.format(
+            self.done_nb, self.components_nb, self.done_cost * 100.0 / max(self.total_cost, 1), elapsed, eta))
+
+
 def _get_workdir(fq):
     """
     Convenient function to build a workdir from the name of the fastqfile
@@ -202,36 +416,240 @@ def _get_workdir(fq):
     return '%s_assembly_wkdir' % assembler_wkdir_basename
 
 
-def assemble_all_components(assembler_name,
-                            fastq, read_metanode_component_filepath, components_lca_filepath,
-                            out_contigs_fasta, workdir,
-                            cpu, read_correction, coverage_threshold):
+class AssemblyScheduler:
+    """
+    Iterable of the component assembly jobs, to be consumed by the pool
+    task handler. Jobs are (cost, component_id, params) and are handed
+    out largest first, each one taking some of the cpu cores, and
+    waiting for free cores. Components holding a large share of the
+    total cost get several cores, and so do the last components once
+    cores are left idle
+    """
 
+    def __init__(self, jobs, cpu):
+        self.jobs = sorted(jobs, key=lambda j: j[0], reverse=True)
+        self.cpu = cpu
+        self.total_cost = sum(j[0] for j in jobs)
+        self.free_cores = cpu
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def __iter__(self):
+        for i, (cost, component_id, params) in enumerate(self.jobs):
+            with self.condition:
+                while self.free_cores < 1 and not self.cancelled:
+                    self.condition.wait()
+                if self.cancelled:
+                    return
+                threads = 1
+                if self.total_cost:
+                    threads = cost * self.cpu // self.total_cost
+                # Fewer jobs left than free cores
+                threads = max(threads, self.free_cores // (len(self.jobs) - i))
+                threads = max(1, min(threads, self.free_cores))
+                self.free_cores -= threads
+            if threads > 1:
+                logger.debug('Component %s assembled with %s threads' % (component_id, threads))
+            yield (component_id, threads, params)
+
+    def release(self, threads):
+        """
+        Give back the cores of a finished job
+        """
+        with self.condition:
+            self.free_cores += threads
+            self.condition.notify()
+
+    def cancel(self):
+        """
+        Stop handing out jobs
+        """
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify()
+
+
+def _assemble_job(job):
+    """
+    Run assemble_component for a job handed out by an AssemblyScheduler,
+    retrying a failed assembly.
+    Return (component_id, threads, fasta path, error), error being None
+    unless all the attempts failed
+    """
+    component_id, threads, (assembler_name, in_fastq, workdir, read_correction, coverage_threshold,
+                            reads_nt, small_component_nt, retries) = job
+    for attempt in range(retries + 1):
+        try:
+            fasta = assemble_component(assembler_name, in_fastq, workdir, read_correction, threads, coverage_threshold,
+                                       reads_nt, small_component_nt)
+            return component_id, threads, fasta, None
+        except subprocess.CalledProcessError as cpe:
+            error = 'Command %s returned non-zero exit status %s' % (cpe.cmd, cpe.returncode)
+        except (Exception, SystemExit) as e:
+            # A SystemExit would end the pool worker without returning
+            error = '%s: %s' % (type(e).__name__, e)
+        if attempt < retries:
+            logger.warning('Component %s assembly failed (%s), retrying' % (component_id, error))
+    return component_id, threads, None, error
+
+
+class _ParentLogHandler(logging.Handler):
+    """
+    Handle the log records of the pool workers with the loggers of the
+    parent process
+    """
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def _init_pool_worker(log_queue, level):
+    """
+    Send the logs of a pool worker to the parent process
+    """
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(level)
+
+
+def _iter_assembled_jobs(scheduler, cpu):
+    """
+    Return a generator of the results of the jobs handed out by the
+    scheduler (cf. _assemble_job), run by cpu processes.
+    The processes are started by a fork server: forking this process,
+    whose other threads may hold locks, could deadlock them
+    """
+    if cpu <= 1:
+        for job in scheduler:
+            yield _assemble_job(job)
+        return
+    context = multiprocessing.get_context('forkserver')
+    log_queue = context.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, _ParentLogHandler())
+    log_listener.start()
+    try:
+        with context.Pool(processes=cpu, initializer=_init_pool_worker,
+                          initargs=(log_queue, logging.getLogger().getEffectiveLevel())) as pool:
+            # Jobs are handed to the pool as cores get free
+            yield from pool.imap_unordered(_assemble_job, scheduler, chunksize=1)
+    finally:
+        log_listener.stop()
+
+
+def assemble_components(assembler_name,
+                        fastq, read_metanode_component_filepath,
+                        out_contigs_fasta, workdir,
+                        cpu, read_correction, coverage_threshold,
+                        retries=1, progress_step=None, small_component_nt=None):
+    """
+    Save each component reads into a fastq file, assemble them and pool
+    all the contigs into out_contigs_fasta, largest components first.
+    Contigs are not tagged with their component LCA yet (lca=NULL, cf.
+    tag_contigs_with_lca).
+
+    Components of at most small_component_nt nucleotides are assembled
+    in process (cf. AssemblerFactory.get_for_component).
+
+    Assembled components are recorded in a checkpoint file of the
+    workdir, a new run with the same inputs only assembles the others.
+    A failed component assembly is retried, and does not stop the other
+    ones: the step fails once they are done.
+
+    Return a dict (key=component_id, value=contigs fasta path)
+    """
 
     logger.info("Save components to fastq files")
-    components_dict = extract_reads_by_component(fastq, read_metanode_component_filepath)
-    components_reads_fq = save_components(components_dict, workdir).items()
-    assembled_components_fasta = {}
+    components_reads = partition_reads_by_component(fastq, read_metanode_component_filepath, workdir)
+    logger.debug('{0} reads in {1} components'.format(sum(c.reads_nb for c in components_reads.values()),
+                                                       len(components_reads)))
+
+    run_key = {'fastq': file_signature(fastq),
+               'read_metanode_component': file_signature(read_metanode_component_filepath),
+               'assembler': assembler_name, 'read_correction': read_correction,
+               'coverage_threshold': coverage_threshold, 'small_component_nt': small_component_nt}
+    checkpoint = AssemblyCheckpoint(os.path.join(workdir, CHECKPOINT_FILENAME), run_key)
+    assembled = {c: f for c, f in checkpoint.read().items() if c in components_reads}
+    if assembled:
+        logger.info('Resume assembly: %s / %s components already assembled' % (len(assembled), len(components_reads)))
 
     logger.info("Assemble components")
 
-    # Foreach component, build the parameters used by assemble_component and save
-    # them into a list to be able to apply a map function on it
-    params = []
-    component_id_list = []
-    for component_id, fq in components_reads_fq:
-        params.append((assembler_name, fq, _get_workdir(fq), read_correction, 1, coverage_threshold))
-        component_id_list.append(component_id)
-
-    with multiprocessing.Pool(processes=cpu) as pool:
+    # Foreach component, build the parameters used by assemble_component,
+    # the number of threads is set when the job starts
+    jobs = []
+    for component_id, component_reads in components_reads.items():
+        if component_id in assembled:
+            continue
+        fq = component_reads.fastq
+        params = (assembler_name, fq, _get_workdir(fq), read_correction, coverage_threshold,
+                  component_reads.nucleotides_nb, small_component_nt, retries)
+        jobs.append((component_reads.nucleotides_nb, component_id, params))
+
+    scheduler = AssemblyScheduler(jobs, cpu)
+    # Contigs are pooled largest components first, as they are assembled
+    component_ids = sorted(components_reads, key=lambda c: components_reads[c].nucleotides_nb, reverse=True)
+    if progress_step is None:
+        progress_step = len(jobs) // 20
+    progress = AssemblyProgress(len(jobs), sum(j[0] for j in jobs), progress_step)
+    failed = dict()
+    checkpoint.open(assembled)
+    with open(out_contigs_fasta, 'w') as contigs_fh, \
+            contextlib.closing(_iter_assembled_jobs(scheduler, cpu)) as assembled_jobs:
+        contigs_stream = ContigsStream(contigs_fh, component_ids)
+        for component_id, component_fasta in assembled.items():
+            contigs_stream.add(component_id, component_fasta)
         try:
-            fasta_list = pool.starmap(assemble_component, params)
-        except subprocess.CalledProcessError as cpe:
-            logger.fatal('Command %s returned non-zero exit status %s' % (cpe.cmd, cpe.returncode))
-            sys.exit('Components assembly step failed')
+            for component_id, threads, fasta, error in assembled_jobs:
+                scheduler.release(threads)
+                if error is None:
+                    assembled[component_id] = fasta
+                    checkpoint.add(component_id, fasta)
+                    contigs_stream.add(component_id, fasta)
+                else:
+                    failed[component_id] = error
+                    logger.error('Component %s assembly failed: %s' % (component_id, error))
+                progress.update(components_reads[component_id].nucleotides_nb)
+        finally:
+            scheduler.cancel()
+            checkpoint.close()
+
+    if failed:
+        logger.fatal('%s / %s components could not be assembled: %s' % (len(failed), len(components_reads),
+                                                                         ' '.join(sorted(failed))))
+        sys.exit('Components assembly step failed')
+
+    logger.debug("Pooled components contigs into: %s" % out_contigs_fasta)
+
+    return {c: assembled[c] for c in component_ids}
+
+
+def tag_contigs_with_lca(contigs_fasta, components_lca_filepath, out_contigs_fasta):
+    """
+    Rewrite the contigs pooled by assemble_components, tagging each contig
+    with the LCA of its component
+    """
+    component_lca_dict = extract_lca_by_component(components_lca_filepath)
+    logger.debug("Tag contigs with their component LCA into: %s" % out_contigs_fasta)
 
-    # Make the correspondance between the component_id and the fasta file
-    assembled_components_fasta = dict(zip(component_id_list, fasta_list))
+    with open(contigs_fasta, 'r') as contigs_fh, open(out_contigs_fasta, 'w') as out_contigs_fh:
+        for header, seq in read_fasta_file_handle(contigs_fh):
+            contig_id, component_tag = header.split()[:2]
+            component_id = component_tag.split('=', 1)[1]
+            component_lca = component_lca_dict.get(component_id, 'NULL')
+            out_contigs_fh.write('>{0} component={1} '.format(contig_id, component_id))
+            out_contigs_fh.write('lca={0}\n{1}\n'.format(component_lca, format_seq(seq)))
+
+
+def assemble_all_components(assembler_name,
+                            fastq, read_metanode_component_filepath, components_lca_filepath,
+                            out_contigs_fasta, workdir,
+                            cpu, read_correction, coverage_threshold, small_component_nt=None):
+
+    assembled_components_fasta = assemble_components(assembler_name,
+                                                     fastq, read_metanode_component_filepath,
+                                                     out_contigs_fasta, workdir,
+                                                     cpu, read_correction, coverage_threshold,
+                                                     small_component_nt=small_component_nt)
 
     lca_dict = extract_lca_by_component(components_lca_filepath)
     logger.debug("Pool components contigs into: %s" % out_contigs_fasta)
@@ -265,6 +683,14 @@ if __name__ == '__main__':
                         action = 'store',
                         type = str,
                         help = 'Working  directory')
+    parser.add_argument('--small_component_nt',
+                        action = 'store',
+                        metavar = 'INT',
+                        type = int,
+                        default = 0,
+                        help = 'Assemble the components of at most this number of nucleotides '
+                        'in process, when their reads are not corrected. '
+                        'Default is %(default)s (disabled)')
     parser.add_argument('-o', '--output_fasta',
                         help='output fasta file',
                         required=True)
@@ -294,4 +720,5 @@ if __name__ == '__main__':
     assemble_all_components(args.assembler,
                             args.input_fastq.name, args.reads_metanode.name, args.components_lca.name,
                             args.output_fasta, args.workdir,
-                            args.cpu, args.read_correction, args.contig_coverage_threshold)
+                            args.cpu, args.read_correction, args.contig_coverage_threshold,
+                            small_component_nt=args.small_component_nt)
@@ -6,6 +6,7 @@ import sys
 import argparse
 import re
 from collections import defaultdict
+from taxonomy_index import TaxoTrie
 
 
 def load_nodes_arity (edges_contracted_fh):
@@ -105,6 +106,9 @@ if __name__ == '__main__':
     # Load nodes arity dict
     nodes_arity_dict = load_nodes_arity(args.edges_contracted)
 
+    # Lineages are compared as interned taxa paths
+    taxo_trie = TaxoTrie()
+
     # Load components LCA
     components_lca_dict = load_components_lca(args.components_lca)
     components_num = len(components_lca_dict)
@@ -133,10 +137,10 @@ if __name__ == '__main__':
         node_specie = node_t[2]
         unitig_id = node_t[3]
         # Get LCA
-        predicted_lca_tab = components_lca_dict[unitig_id].split(';')
-        if len(predicted_lca_tab) > max_lca_length:
-            max_lca_length = len(predicted_lca_tab)
-        lca_level_count_list[len(predicted_lca_tab)-1] += node_size
+        predicted_lca_path = taxo_trie.path(components_lca_dict[unitig_id])
+        if len(predicted_lca_path) > max_lca_length:
+            max_lca_length = len(predicted_lca_path)
+        lca_level_count_list[len(predicted_lca_path)-1] += node_size
         # Basic stats
         reads_num += node_size
         nodes_num += 1
@@ -148,7 +152,7 @@ if __name__ == '__main__':
             singleton_nodes_num += 1
         elif node_category == 1:
             hubs_num += 1
-        lca_level_count_by_category_list[node_category][len(predicted_lca_tab)-1] += node_size
+        lca_level_count_by_category_list[node_category][len(predicted_lca_path)-1] += node_size
 
     # Compute final stats
     node_strings_num = components_num - singleton_nodes_num - hubs_num
@@ -176,13 +180,13 @@ if __name__ == '__main__':
             if unitig_id != 'NULL':
                 specie_id = read_name[:3]
                 node_category = get_node_category(node_id, nodes_arity_dict)
-                read_taxo = species_taxo_dict[specie_id].split(';')
-                predicted_lca = components_lca_dict[unitig_id].split(';')
-                # Compare true taxo vs. predicted LCA
-                is_same = True
-                for i in range(len(predicted_lca)):
-                    if is_same:
-                        is_same = (predicted_lca[i]==read_taxo[i])
+                read_taxo_path = taxo_trie.path(species_taxo_dict[specie_id])
+                predicted_lca_path = taxo_trie.path(components_lca_dict[unitig_id])
+                # Compare true taxo vs. predicted LCA. Taxa are interned
+                # given their parent, so the lineages are the same down
+                # to a level as long as the taxa ids are
+                for i in range(len(predicted_lca_path)):
+                    is_same = i < len(read_taxo_path) and predicted_lca_path[i] == read_taxo_path[i]
                     if is_same:
                         column = 0
                     else:
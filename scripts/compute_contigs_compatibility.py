@@ -8,6 +8,8 @@ import subprocess
 import time
 import logging
 
+from cigar_utils import cigar_info, parse_cigar, get_operations_count
+
 # Create logger
 logger = logging.getLogger(__name__)
 
@@ -47,63 +49,18 @@ class SamAlignment():
         self.query_length = len(self.query_seq)
 
         # Parse CIGAR
-        self.cigar_tab = self.parse_cigar(self.cigar)
-
-        # Compute subject_end, query_start, query_end
-        tmp_cigar_tab = self.cigar_tab[:]
-        # Deal with soft clipping and get the query start (0-based)
-        self.query_start = 0
-        self.left_softclip_num = 0
-        self.overhang_num = 0
-        if tmp_cigar_tab[0][0] == 'S':
-            count = tmp_cigar_tab[0][1]
-            self.query_start += count
-            self.left_softclip_num += count
-            self.overhang_num += count
-            del tmp_cigar_tab[0]
-        # Parse CIGAR
-        self.query_end = self.query_start - 1
-        self.subject_end = self.subject_start - 1
-        self.indel_num = 0
-        self.matches_mismatches_num = 0
-        self.right_softclip_num = 0
-        for operation, count in tmp_cigar_tab:
-            if operation == 'M':
-                self.matches_mismatches_num += count
-                self.subject_end += count
-                self.query_end += count
-            elif operation == 'I':
-                self.query_end += count
-                self.indel_num += count
-            elif operation == 'D':
-                self.subject_end += count
-                self.indel_num += count
-            elif operation == 'S':
-                self.right_softclip_num += count
-                self.overhang_num += count
-
-    @staticmethod
-    def parse_cigar(cigar):
-        """
-        Parse a CIGAR string and return a list of (operation, count) tuples
-        """
-        cigar_tab = list()
-        count_str = ''
-        for c in cigar:
-            if c.isdigit():
-                count_str += c
-            else:
-                operation = c
-                count = 1
-                if count_str:
-                    count = int(count_str)
-                if cigar_tab and operation == cigar_tab[-1][0]:
-                    cigar_tab[-1][1] += count
-                else:
-                    cigar_tab.append((operation, count))
-                count_str = ''
-        #
-        return cigar_tab
+        self.cigar_tab = parse_cigar(self.cigar)
+        cigar = cigar_info(self.cigar)
+
+        # Compute subject_end, query_start, query_end (0-based)
+        self.left_softclip_num = cigar.left_clip
+        self.right_softclip_num = cigar.right_clip
+        self.overhang_num = cigar.left_clip + cigar.right_clip
+        self.query_start = cigar.left_clip
+        self.query_end = self.query_start + cigar.query_span - 1
+        self.subject_end = self.subject_start + cigar.ref_span - 1
+        self.indel_num = get_operations_count(self.cigar, 'ID')
+        self.matches_mismatches_num = get_operations_count(self.cigar, 'M=X')
 
 
 def read_tab_file_handle_sorted(tab_file_handle, factor_index=0):
@@ -4,36 +4,8 @@
 import os
 import sys
 import argparse
-import re
-import operator
-from collections import Counter, defaultdict
-
-def read_fasta_file_handle(fasta_file_handle):
-    """
-    Parse a fasta file and return a generator
-    """
-    # Variables initialization
-    header = ''
-    seqlines = list()
-    sequence_nb = 0
-    # Reading input file
-    for line in fasta_file_handle:
-        if line[0] == '>':
-            # Yield the last read header and sequence
-            if sequence_nb:
-                yield (header, ''.join(seqlines))
-                del seqlines[:]
-            # Get header
-            header = line[1:].rstrip()
-            sequence_nb += 1
-        else:
-            # Concatenate sequence
-            seqlines.append(line.strip())
-    # Yield the input file last sequence
-    yield (header, ''.join(seqlines))
-    # Close input file
-    fasta_file_handle.close()
-
+from collections import defaultdict
+from taxonomy_index import TaxoTrie
 
 def read_tab_file_handle_sorted(tab_file_handle, factor_index, group_by_index, sep):
     """
@@ -67,46 +39,115 @@ def read_tab_file_handle_sorted(tab_file_handle, factor_index, group_by_index, s
     tab_file_handle.close()
 
 
-def compute_lca(factor_taxo_list, min_proportion):
+# Taxonomies are shared by all the factors
+_TAXO_TRIE = TaxoTrie()
+
+
+def compute_lca(factor_taxo_list, min_proportion, taxonomy=None):
     """
-    Given a list of taxonomies, compute the LCA using a minimal proportion
+    Given a list of taxonomies, compute the LCA using a minimal proportion.
+    Taxonomies are interned in a TaxoTrie (taxonomy strings, shared trie
+    by default) or a TaxonomyIndex (taxon ids)
     """
-    lca_tab = list()
+    if taxonomy is None:
+        taxonomy = _TAXO_TRIE
+    path = taxonomy.path
+    lca_id = -1
 
     # Deals with the canonic LCA right away
     if min_proportion >= 1.0:
-        # List comprehension for 2 embriqued loops into a flat list
-        total_taxo_tab_list = [t.split(';') for g in factor_taxo_list for t in g]
-        lca_tab = os.path.commonprefix(total_taxo_tab_list)
+        lca_path = os.path.commonprefix([path(t) for g in factor_taxo_list for t in g])
+        if lca_path:
+            lca_id = lca_path[-1]
     # Try to find a more recent LCA using at least min_proportion of the population
     else:
-        lca_count = defaultdict(float)
+        # Each read weights 1, shared by its taxonomies, and votes for
+        # all the nodes of their paths. Nodes are kept in order of
+        # first vote
+        lca_count = dict()
+        get_count = lca_count.get
         for group_by_taxo_list in factor_taxo_list:
+            weight = 1.0 / len(group_by_taxo_list)
             for taxo in group_by_taxo_list:
-                taxo_tab = taxo.split(';')
-                #~ for i in range(1, len(taxo_tab)): # Here, there was a bug, but in fact we learned that we can have better results by setting the LCA level we want in advance
-                for i in range(len(taxo_tab)):
-                    lca = ';'.join(taxo_tab[:i+1])
-                    lca_count[lca] += 1.0/len(group_by_taxo_list)
-        #~ print(len(factor_taxo_list), lca_count['Bacteria'])
-        lca_count_list = [ (lca.split(';'), count) for (lca, count) in lca_count.items()]
-        lca_count_list.sort(key = lambda x: (x[1], -len(x[0])), reverse=True)
-        #~ print(lca_count_list)
+                for node_id in path(taxo):
+                    lca_count[node_id] = get_count(node_id, 0.0) + weight
 
         threshold = float(len(factor_taxo_list)) * float(min_proportion)
 
-        for cur_lca_tab, count in lca_count_list:
-            if float(count) < float(threshold):
-                break
-            lca_tab = cur_lca_tab
-
-    lca = ';'.join(lca_tab)
+        # Counts decrease along the paths, so the nodes reaching the
+        # threshold are a subtree. The LCA is the least voted of them,
+        # then the deepest, then the last voted
+        depths = taxonomy.depths
+        best_key = None
+        for rank, (node_id, count) in enumerate(lca_count.items()):
+            if count >= threshold:
+                key = (-count, depths[node_id], rank)
+                if best_key is None or key > best_key:
+                    best_key = key
+                    lca_id = node_id
+
+    lca = taxonomy.lineage(lca_id)
     if not lca:
         lca = 'Root'
 
     return lca
 
 
+def read_components_taxo(sam_filepath, taxonomy_index, read_component_filepath):
+    """
+    Join the alignments of a sam file with the read --> component file
+    (read, metanode, component) and the ref --> taxon map of a
+    TaxonomyIndex. The read --> component map is loaded in a dict and
+    the sam file is streamed once, then only the aligned references are
+    looked up in the index.
+    Return a dict: component --> list of the taxon ids lists of its
+    reads, as given to compute_lca. Components, reads and taxa are
+    ordered as the sorted join output
+    """
+    read_component_dict = defaultdict(list)
+    with open(read_component_filepath, 'r') as read_component_fh:
+        for tab in (l.split() for l in read_component_fh if l.strip()):
+            read_component_dict[tab[0]].append(tab[2])
+
+    # component --> read --> aligned refs
+    component_read_refs_dict = defaultdict(lambda: defaultdict(list))
+    with open(sam_filepath, 'r') as sam_fh:
+        for line in sam_fh:
+            if line.startswith('@'):
+                continue
+            read_id, _, ref_id = line.split('\t', 3)[:3]
+            for component_id in read_component_dict.get(read_id, ()):
+                component_read_refs_dict[component_id][read_id].append(ref_id)
+
+    aligned_refs = list({ref_id for read_refs_dict in component_read_refs_dict.values()
+                         for refs in read_refs_dict.values() for ref_id in refs})
+    ref_taxon_dict = {r: t for r, t in zip(aligned_refs, taxonomy_index.ref_taxa(aligned_refs).tolist()) if t >= 0}
+
+    components_taxo_dict = dict()
+    for component_id in sorted(component_read_refs_dict):
+        read_refs_dict = component_read_refs_dict[component_id]
+        factor_taxo_list = list()
+        for read_id in sorted(read_refs_dict):
+            # Refs without taxonomy are dropped, as by the join.
+            # Taxon ids are in the order of their lineages
+            taxo_list = sorted(ref_taxon_dict[r] for r in read_refs_dict[read_id] if r in ref_taxon_dict)
+            if taxo_list:
+                factor_taxo_list.append(taxo_list)
+        if factor_taxo_list:
+            components_taxo_dict[component_id] = factor_taxo_list
+
+    return components_taxo_dict
+
+
+def write_lca_tab(factor_taxo_dict, min_proportion, out_fh, sep='\t', taxonomy=None):
+    """
+    Compute the LCA of each factor (factor --> list of taxo lists) and
+    write it to a tab file
+    """
+    for factor_id, factor_taxo_list in factor_taxo_dict.items():
+        out_fh.write('{0}{1}{2}\n'.format(factor_id, sep, compute_lca(factor_taxo_list, min_proportion, taxonomy)))
+
+
 if __name__ == '__main__':
 
     # Arguments parsing
@@ -6,6 +6,8 @@ import argparse
 from collections import defaultdict
 import matplotlib.pyplot as plt
 import logging
+from fastx_utils import read_fasta_file_handle
+from cigar_utils import get_operations_count
 
 
 # Create logger
@@ -36,56 +38,6 @@ def read_tab_file_handle_sorted(tab_file_handle, factor_index=0):
     tab_file_handle.close()
 
 
-def read_fasta_file_handle(fasta_file_handle):
-    """
-    Parse a fasta file and return a generator
-    """
-    # Variables initialization
-    header = ''
-    seqlines = list()
-    sequence_nb = 0
-    # Reading input file
-    for line in fasta_file_handle:
-        if line[0] == '>':
-            # Yield the last read header and sequence
-            if sequence_nb:
-                yield (header, ''.join(seqlines))
-                del seqlines[:]
-            # Get header
-            header = line[1:].rstrip()
-            sequence_nb += 1
-        else:
-            # Concatenate sequence
-            seqlines.append(line.strip())
-    # Yield the input file last sequence
-    yield (header, ''.join(seqlines))
-    # Close input file
-    fasta_file_handle.close()
-
-
-def parse_cigar(cigar):
-    """
-    Parse a CIGAR string and return a list of (operation, count) tuples
-    """
-    cigar_tab = list()
-    count_str = ''
-    for c in cigar:
-        if c.isdigit():
-            count_str += c
-        else:
-            operation = c
-            count = 1
-            if count_str:
-                count = int(count_str)
-            if cigar_tab and operation == cigar_tab[-1][0]:
-                cigar_tab[-1][1] += count
-            else:
-                cigar_tab.append((operation, count))
-            count_str = ''
-    #
-    return cigar_tab
-
-
 if __name__ == '__main__':
 
     # Arguments parsing
@@ -164,10 +116,7 @@ if __name__ == '__main__':
         ref_len = len(ref_seq_dict[ref_id])
         total_aligned_nt = 0
         for alignment_tab in alignment_tabs_list:
-            cigar = alignment_tab[5]
-            for operation, count in parse_cigar(cigar):
-                if operation == 'M':
-                    total_aligned_nt += count
+            total_aligned_nt += get_operations_count(alignment_tab[5], 'M')
         # Compute reference coverage
         ref_coverage = total_aligned_nt/ref_len
         #
@@ -5,6 +5,7 @@ import os
 import sys
 import argparse
 import re
+from taxonomy_index import TaxoTrie
 
 if __name__ == '__main__':
 
@@ -46,11 +47,14 @@ if __name__ == '__main__':
     level_count_list = [0 for i in range(7)]
     stats_level_list = [[0,0] for i in range(7)] # [PredictedLCA==TrueTaxo, PredictedLCA!=TrueTaxo]
 
+    # Lineages are ',' separated here
+    taxo_trie = TaxoTrie(sep=',')
+
     # Count
     for line in args.input_file:
         tab = line.strip().split(args.separator)
-        predicted_lca = tab[args.predicted_lca].split(',')
-        true_taxo = tab[args.true_taxo].split(',')
+        predicted_lca = taxo_trie.path(tab[args.predicted_lca])
+        true_taxo = taxo_trie.path(tab[args.true_taxo])
         size = int(tab[args.size])
 
         # Predicted LCA level count
@@ -60,11 +64,10 @@ if __name__ == '__main__':
             level_count_list[len(predicted_lca)-1] += 1
 
         # Is LCA prediction compatible with true taxonomy
-        if true_taxo[0] != 'NULL':
-            is_same = True
+        if taxo_trie.names[true_taxo[0]] != 'NULL':
             for i in range(len(predicted_lca)):
-                if is_same:
-                    is_same = (predicted_lca[i]==true_taxo[i])
+                # Same taxon id, same lineage down to this level
+                is_same = i < len(true_taxo) and predicted_lca[i] == true_taxo[i]
 
                 if is_same:
                     column = 0
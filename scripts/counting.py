@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import re
+import logging
+
+from fastx_utils import open_file
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks read when scanning a file
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def _read_blocks(filepath, buffer_size=BUFFER_SIZE):
+    """
+    Read a file by large binary blocks and return a generator.
+    Compressed files are decompressed on the fly
+    """
+    with open_file(filepath, 'rb') as fh:
+        block = fh.read(buffer_size)
+        while block:
+            yield block
+            block = fh.read(buffer_size)
+
+
+def count_lines(filepath, buffer_size=BUFFER_SIZE):
+    """
+    Count the lines of a file in a single buffered scan.
+    bytes.count relies on memchr-like routines, so this is as fast as wc -l.
+    A last line without trailing newline is counted
+    """
+    line_nb = 0
+    last_byte = b'\n'
+    for block in _read_blocks(filepath, buffer_size):
+        line_nb += block.count(b'\n')
+        last_byte = block[-1:]
+    if last_byte != b'\n':
+        line_nb += 1
+    return line_nb
+
+
+def count_fasta_records(filepath, buffer_size=BUFFER_SIZE):
+    """
+    Count the sequences of a fasta file (lines starting with '>')
+    """
+    record_nb = 0
+    previous_byte = b'\n'
+    for block in _read_blocks(filepath, buffer_size):
+        record_nb += block.count(b'\n>')
+        # Header at the beginning of the file or of the block
+        if previous_byte == b'\n' and block[:1] == b'>':
+            record_nb += 1
+        previous_byte = block[-1:]
+    return record_nb
+
+
+def count_fastq_records(filepath):
+    """
+    Count the sequences of a fastq file (4 lines per sequence)
+    """
+    line_nb = count_lines(filepath)
+    if line_nb % 4 != 0:
+        logger.warning('FastQ file {0} does not have a number of lines multiple of 4'.format(filepath))
+    return line_nb // 4
+
+
+def count_csv_rows(filepath, header=True):
+    """
+    Count the rows of a csv file, without the header line
+    """
+    return max(0, count_lines(filepath) - int(header))
+
+
+def count_components(components_csv_filepath, sep=';', component_index=4):
+    """
+    Scan a componentsearch components csv file once.
+    Return the number of reads belonging to a component and the
+    number of components. Reads excluded from the components have
+    the component id -1
+    """
+    reads_nb = 0
+    components = set()
+    with open(components_csv_filepath, 'r') as components_fh:
+        # Skip header
+        components_fh.readline()
+        for line in components_fh:
+            tab = line.rstrip('\n').split(sep)
+            if len(tab) <= component_index:
+                continue
+            component_id = tab[component_index]
+            if component_id != '-1':
+                reads_nb += 1
+                components.add(component_id)
+    return reads_nb, len(components)
+
+
+_sortmerna_total_pattern = re.compile(r'Total reads\s*=\s*(\d+)')
+_sortmerna_passing_pattern = re.compile(r'Total reads passing E-value threshold\s*=\s*(\d+)')
+
+
+def read_sortmerna_log(log_filepath):
+    """
+    Get the number of input reads and the number of reads passing the
+    e-value threshold from a SortMeRNA log file, as counted by SortMeRNA
+    while reading the input.
+    Return (None, None) if they cannot be found
+    """
+    total_reads_nb = passing_reads_nb = None
+    try:
+        with open(log_filepath, 'r') as log_fh:
+            log = log_fh.read()
+    except OSError:
+        return total_reads_nb, passing_reads_nb
+    m = _sortmerna_total_pattern.search(log)
+    if m:
+        total_reads_nb = int(m.group(1))
+    m = _sortmerna_passing_pattern.search(log)
+    if m:
+        passing_reads_nb = int(m.group(1))
+    return total_reads_nb, passing_reads_nb
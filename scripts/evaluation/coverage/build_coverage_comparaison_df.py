@@ -13,6 +13,7 @@ SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', '..')
 sys.path.append(SCRIPTS_DIR)
 
 from sample_sam_by_coverage import *
+from fastx_utils import read_fasta_file_handle
 
 logger = logging.getLogger(__name__)
 
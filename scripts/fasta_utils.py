@@ -1,32 +1,7 @@
 #!/usr/bin/env python3
 
-def read_fasta_file_handle(fasta_file_handle):
-    """
-    Parse a fasta file and return a generator
-    """
-    # Variables initialization
-    header = ''
-    seqlines = list()
-    sequence_nb = 0
-    # Reading input file
-    for line in (l.strip() for l in fasta_file_handle if l.strip()):
-        if line[0] == '>':
-            # Yield the last read header and sequence
-            if sequence_nb:
-                yield (header, ''.join(seqlines))
-                del seqlines[:]
-            # Get header
-            header = line[1:].rstrip()
-            sequence_nb += 1
-        else:
-            # Concatenate sequence
-            seqlines.append(line.strip())
-    # Yield the input file last sequence
-    if header or seqlines:
-        yield (header, ''.join(seqlines))
-    # Close input file
-    fasta_file_handle.close()
-
+# The fasta parser is shared by all scripts, cf. fastx_utils
+from fastx_utils import read_fasta_file_handle
 
 
 def format_seq(seq, linereturn=80):
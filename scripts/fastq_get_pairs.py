@@ -38,31 +38,7 @@ import os
 import argparse
 import string
 import re
-
-
-def read_fastq_file_handle(fastq_file_handle):
-    """
-    Parse a fastq file and return a generator
-    """
-    # Variables initialization
-    count = 0
-    header = ''
-    seq = ''
-    qual = ''
-    # Reading input file
-    for line in (l.strip() for l in fastq_file_handle if l.strip()):
-        count += 1
-        if count % 4 == 1:
-            if header:
-                yield header, seq, qual
-            header = line[1:]
-        elif count % 4 == 2:
-            seq = line
-        elif count % 4 == 0:
-            qual = line
-    yield header, seq, qual
-    # Close input file
-    fastq_file_handle.close()
+from fastx_utils import read_fastq_file_handle
 
 
 def buffer_paired_reads(fastq_fh):
@@ -71,7 +47,7 @@ def buffer_paired_reads(fastq_fh):
     previous_read_id = ''
     read_buffer = list()
     # Reading each read in fastq file
-    for header, seq, qual in read_fastq_file_handle(fastq_fh):
+    for header, seq, qual in read_fastq_file_handle(fastq_fh, full_header=True):
         #~ read_id = header.split()[0]
         read_id = header.split()[0][:-2]
         # Yield read buffer
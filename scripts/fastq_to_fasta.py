@@ -36,40 +36,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
-
-
-def read_fastq_file_handle(fastq_file_handle):
-    """
-    Parse a fastq file and return a generator
-    """
-    
-    # Variables initialization
-    line_count = 0
-    header = ''
-    seq = ''
-    qual = ''
-    
-    # Reading input file
-    for line in (l.strip() for l in fastq_file_handle if l.strip()):
-        line_count += 1
-        if line_count % 4 == 1:
-            if header:
-                # Yield previous sequence
-                yield header, seq, qual
-            # Get read complete header (sequence id and description)
-            header = line[1:]
-        elif line_count % 4 == 2:
-            # Get read sequence
-            seq = line
-        elif line_count % 4 == 0:
-            # Get read quality
-            qual = line
-    
-    # Yield the last sequence
-    yield header, seq, qual
-    
-    # Close input file
-    fastq_file_handle.close()
+from fastx_utils import read_fastq_file_handle
 
 
 def format_seq(seq, linereturn=80):
@@ -110,7 +77,7 @@ if __name__ == '__main__':
     
     
     # Read fastq file and write fasta sequences
-    for header, seq, qual in read_fastq_file_handle(args.input_fastq):
+    for header, seq, qual in read_fastq_file_handle(args.input_fastq, full_header=True):
         args.output_fasta.write(">{0}\n".format(header))
         args.output_fasta.write("{0}\n".format(format_seq(seq, 80)))
     
@@ -33,31 +33,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
-
-
-def read_fastq_file_handle(fastq_file_handle):
-    """
-    Parse a fastq file and return a generator
-    """
-    # Variables initialization
-    count = 0
-    header = ''
-    seq = ''
-    qual = ''
-    # Reading input file
-    for line in (l.strip() for l in fastq_file_handle if l.strip()):
-        count += 1
-        if count % 4 == 1:
-            if header:
-                yield header, seq, qual
-            header = line[1:]
-        elif count % 4 == 2:
-            seq = line
-        elif count % 4 == 0:
-            qual = line
-    yield header, seq, qual
-    # Close input file
-    fastq_file_handle.close()
+from fastx_utils import read_fastq_file_handle
 
 
 if __name__ == '__main__':
@@ -71,5 +47,5 @@ if __name__ == '__main__':
                         help='ouput tab file')
     args = parser.parse_args()
 
-    for header, seq, qual in read_fastq_file_handle(args.input_fastq):
+    for header, seq, qual in read_fastq_file_handle(args.input_fastq, full_header=True):
         args.output_tab.write('{0}\t{1}\t{2}\n'.format(header, seq, qual))
@@ -1,26 +1,4 @@
 #!/usr/bin/env python3
 
-def read_fastq_file_handle(fastq_file_handle):
-    """
-    Parse a fastq file and return a generator
-    """
-    # Variables initialization
-    count = 0
-    header = ''
-    seq = ''
-    qual = ''
-    # Reading input file
-    for line in (l.strip() for l in fastq_file_handle if l.strip()):
-        count += 1
-        if count % 4 == 1:
-            if header:
-                yield header, seq, qual
-            header = line[1:].split()[0]
-        elif count % 4 == 2:
-            seq = line
-        elif count % 4 == 0:
-            qual = line
-    # yield last fastq sequence
-    yield header, seq, qual
-    # Close input file
-    fastq_file_handle.close()
+# The fastq parser is shared by all scripts, cf. fastx_utils
+from fastx_utils import read_fastq_file_handle
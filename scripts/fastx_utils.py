@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import bz2
+import gzip
+import logging
+import subprocess
+
+from binary_utils import Binary
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Size of the binary blocks read from the input files.
+# Records are cut from these blocks with bytes methods (split, partition)
+# instead of being parsed line by line in Python
+BUFFER_SIZE = 1024 * 1024
+
+_MAGICS = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bzip2'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+COMPRESSION_SUFFIXES = ('.gz', '.gzip', '.bz2', '.bzip2', '.zst', '.zstd')
+
+# External decompressors, by order of preference. The parallel ones are
+# used when available. Their output is read through a pipe, so
+# decompression runs alongside the parsing
+_DECOMPRESSORS = {
+    'gzip': (('pigz', ['-dc', '-p', '{threads}']),
+             ('gzip', ['-dc'])),
+    'bzip2': (('pbzip2', ['-dc', '-p{threads}']),
+              ('lbzip2', ['-dc', '-n', '{threads}']),
+              ('bzip2', ['-dc'])),
+    'zstd': (('zstd', ['-dcq']),),
+}
+
+
+def sniff_compression(first_bytes):
+    """
+    Return the compression format ('gzip', 'bzip2', 'zstd' or None)
+    of a file given its first bytes
+    """
+    for magic, compression in _MAGICS:
+        if first_bytes.startswith(magic):
+            return compression
+    return None
+
+
+def file_compression(filepath):
+    """
+    Return the compression format of a file, detected from its content
+    """
+    with open(filepath, 'rb') as fh:
+        return sniff_compression(fh.read(4))
+
+
+def strip_compression_suffix(filename):
+    """
+    Remove the compression extension (eg. .gz) of a file name
+    """
+    root, ext = os.path.splitext(filename)
+    if ext.lower() in COMPRESSION_SUFFIXES:
+        return root
+    return filename
+
+
+def decompression_command(compression, threads=1):
+    """
+    Return the command line (list) of the best available external
+    decompressor writing to stdout, or None if there is none
+    """
+    for program, options in _DECOMPRESSORS.get(compression, ()):
+        binary = Binary.which(program)
+        if binary:
+            return [binary] + [o.format(threads=max(1, threads)) for o in options]
+    return None
+
+
+class _ProcessReader(io.BufferedReader):
+    """
+    Buffered reader on the stdout of a decompression process.
+    Closing it waits for the process, and a decompression error
+    is raised when the whole output was read
+    """
+
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=0)
+        super().__init__(self._process.stdout, BUFFER_SIZE)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        returncode = self._process.wait()
+        # A negative return code means the process was killed,
+        # eg. by SIGPIPE when the file is closed before its end
+        if returncode > 0:
+            raise IOError('Decompression failed ({0}): {1}'.format(returncode, ' '.join(self._cmd)))
+
+
+def _decompressing_handle(binary_fh, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=binary_fh, mode='rb')
+    if compression == 'bzip2':
+        return bz2.BZ2File(binary_fh, mode='rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise IOError('Cannot read a zstd stream, the zstandard module is not installed')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(binary_fh), BUFFER_SIZE)
+    return binary_fh
+
+
+def open_file(filepath, mode='rb', threads=1):
+    """
+    Open a plain, gzip, bzip2 or zstd file for reading. The compression
+    is detected from the file content, not from the file extension.
+    Compressed files are decompressed by an external (parallel when
+    available) decompressor, or else by the python modules.
+    mode is 'rb' (bytes) or 'rt' (text)
+    """
+    if mode not in ('rb', 'rt', 'r'):
+        raise ValueError('open_file only opens files for reading, not {0}'.format(mode))
+    compression = file_compression(filepath)
+    cmd = decompression_command(compression, threads) if compression else None
+    if cmd is not None:
+        fh = _ProcessReader(cmd + [filepath])
+    elif compression == 'zstd' and zstandard is None:
+        raise IOError('Cannot read {0}: install zstd or the zstandard python module'.format(filepath))
+    else:
+        fh = _decompressing_handle(open(filepath, 'rb'), compression)
+    if mode == 'rb':
+        return fh
+    return io.TextIOWrapper(fh)
+
+
+def sniff_format(filepath):
+    """
+    Return the format ('fasta', 'fastq' or None) of a plain or compressed
+    file, from its first non blank character
+    """
+    with open_file(filepath, 'rb') as fh:
+        for line in fh:
+            line = line.strip()
+            if line:
+                if line.startswith(b'>'):
+                    return 'fasta'
+                if line.startswith(b'@'):
+                    return 'fastq'
+                return None
+    return None
+
+
+def _binary_source(source):
+    """
+    Return (binary handle, text encoding) for a binary or a text handle.
+    Compressed streams are decompressed on the fly
+    """
+    encoding = 'utf-8'
+    fh = source
+    if isinstance(fh, io.TextIOWrapper):
+        encoding = fh.encoding or encoding
+        fh = fh.buffer
+    if not hasattr(fh, 'peek') and not isinstance(fh, io.TextIOBase):
+        # Buffer the binary streams that cannot be peeked (eg. io.BytesIO)
+        fh = io.BufferedReader(fh)
+    if hasattr(fh, 'peek'):
+        fh = _decompressing_handle(fh, sniff_compression(fh.peek(4)[:4]))
+    return fh, encoding
+
+
+def _read_blocks(fh, encoding, buffer_size):
+    """
+    Read a handle by large blocks, encoding the blocks of text handles
+    that do not expose their binary buffer (eg. io.StringIO)
+    """
+    block = fh.read(buffer_size)
+    while block:
+        if isinstance(block, str):
+            block = block.encode(encoding)
+        yield block
+        block = fh.read(buffer_size)
+
+
+def _iter_chunks(fh, encoding, buffer_size, as_bytes):
+    """
+    Return a generator of chunks made of complete lines, as bytes or
+    decoded. Decoding a whole chunk at once is much cheaper than
+    decoding each line or field
+    """
+    remainder = b''
+    for block in _read_blocks(fh, encoding, buffer_size):
+        k = block.rfind(b'\n')
+        if k < 0:
+            remainder += block
+            continue
+        chunk = remainder + block[:k+1]
+        remainder = block[k+1:]
+        yield chunk if as_bytes else chunk.decode(encoding)
+    if remainder:
+        yield remainder if as_bytes else remainder.decode(encoding)
+
+
+def iter_chunks(source, as_bytes=True, buffer_size=BUFFER_SIZE):
+    """
+    Read a file by large blocks and return a generator of chunks made
+    of complete lines (bytes or str), line returns included
+    """
+    if isinstance(source, str):
+        with open_file(source, 'rb') as fh:
+            yield from iter_chunks(fh, as_bytes, buffer_size)
+        return
+    fh, encoding = _binary_source(source)
+    yield from _iter_chunks(fh, encoding, buffer_size, as_bytes)
+
+
+def iter_line_blocks(source, as_bytes=True, buffer_size=BUFFER_SIZE):
+    """
+    Read a file by large blocks and return a generator of lists of
+    complete lines (without line return), as bytes or str.
+    Lines are stripped, blank lines are removed
+    """
+    if isinstance(source, str):
+        with open_file(source, 'rb') as fh:
+            yield from iter_line_blocks(fh, as_bytes, buffer_size)
+        return
+    fh, encoding = _binary_source(source)
+    for chunk in _iter_chunks(fh, encoding, buffer_size, as_bytes):
+        # splitlines also removes carriage returns. The lines are always
+        # stripped, so the result does not depend on the block boundaries
+        lines = [l.strip() for l in chunk.splitlines()]
+        yield [l for l in lines if l]
+
+
+def read_fasta(source, as_bytes=False, buffer_size=BUFFER_SIZE):
+    """
+    Parse a fasta file (path or file handle, plain or compressed)
+    and return a generator of (header, sequence). Multi-line sequences
+    are joined. Headers and sequences are str, or bytes if as_bytes
+    """
+    if isinstance(source, str):
+        with open_file(source, 'rb') as fh:
+            yield from read_fasta(fh, as_bytes, buffer_size)
+        return
+    fh, encoding = _binary_source(source)
+    if as_bytes:
+        empty, nl, record_sep = b'', b'\n', b'\n>'
+    else:
+        empty, nl, record_sep = '', '\n', '\n>'
+    remainder = empty
+    first = True
+    for chunk in _iter_chunks(fh, encoding, buffer_size, as_bytes):
+        data = remainder + chunk
+        if first:
+            data = data.lstrip()
+            if not data:
+                continue
+            if data[0] not in ('>', 62):
+                # No header: skip everything up to the first one
+                i = data.find(record_sep)
+                if i < 0:
+                    remainder = empty
+                    continue
+                logger.warning('Fasta data found before the first header were skipped')
+                data = data[i+1:]
+            data = data[1:]
+            first = False
+        records = data.split(record_sep)
+        remainder = records.pop()
+        for record in records:
+            header, _, seq = record.partition(nl)
+            # Remove line returns and any other whitespace in a single C loop
+            yield header.rstrip(), empty.join(seq.split())
+    if not first:
+        header, _, seq = remainder.partition(nl)
+        yield header.rstrip(), empty.join(seq.split())
+
+
+def read_fastq(source, as_bytes=False, full_header=False, buffer_size=BUFFER_SIZE):
+    """
+    Parse a fastq file (path or file handle, plain or compressed)
+    and return a generator of (header, sequence, quality).
+    Headers are cut at the first whitespace unless full_header.
+    Records are expected to have 4 lines
+    """
+    if isinstance(source, str):
+        with open_file(source, 'rb') as fh:
+            yield from read_fastq(fh, as_bytes, full_header, buffer_size)
+        return
+    pending = list()
+    for lines in iter_line_blocks(source, as_bytes, buffer_size):
+        if pending:
+            lines = pending + lines
+        n = len(lines) - len(lines) % 4
+        if full_header:
+            headers = [h[1:] for h in lines[0:n:4]]
+        else:
+            headers = [h[1:].split(None, 1)[0] if len(h) > 1 else h[1:] for h in lines[0:n:4]]
+        yield from zip(headers, lines[1:n:4], lines[3:n:4])
+        pending = lines[n:]
+    if pending:
+        logger.warning('Fastq file does not have a number of lines multiple of 4')
+        if len(pending) >= 2:
+            header = pending[0][1:]
+            if not full_header and header:
+                header = header.split(None, 1)[0]
+            yield header, pending[1], pending[0][:0]
+
+
+def read_fasta_file_handle(fasta_file_handle, as_bytes=False):
+    """
+    Parse a fasta file and return a generator
+    """
+    try:
+        yield from read_fasta(fasta_file_handle, as_bytes=as_bytes)
+    finally:
+        # Close input file
+        fasta_file_handle.close()
+
+
+def read_fastq_file_handle(fastq_file_handle, as_bytes=False, full_header=False):
+    """
+    Parse a fastq file and return a generator
+    """
+    try:
+        yield from read_fastq(fastq_file_handle, as_bytes=as_bytes, full_header=full_header)
+    finally:
+        # Close input file
+        fastq_file_handle.close()
+
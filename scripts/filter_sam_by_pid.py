@@ -3,56 +3,8 @@
 
 import sys
 import argparse
-
-
-def read_fasta_file_handle(fasta_file_handle):
-    """
-    Parse a fasta file and return a generator
-    """
-    # Variables initialization
-    header = ''
-    seqlines = list()
-    sequence_nb = 0
-    # Reading input file
-    for line in fasta_file_handle:
-        if line[0] == '>':
-            # Yield the last read header and sequence
-            if sequence_nb:
-                yield (header, ''.join(seqlines))
-                del seqlines[:]
-            # Get header
-            header = line[1:].rstrip()
-            sequence_nb += 1
-        else:
-            # Concatenate sequence
-            seqlines.append(line.strip())
-    # Yield the input file last sequence
-    yield (header, ''.join(seqlines))
-    # Close input file
-    fasta_file_handle.close()
-
-
-def parse_cigar(cigar):
-    """
-    Parse a CIGAR string and return a list of (operation, count) tuples
-    """
-    cigar_tab = list()
-    count_str = ''
-    for c in cigar:
-        if c.isdigit():
-            count_str += c
-        else:
-            operation = c
-            count = 1
-            if count_str:
-                count = int(count_str)
-            if cigar_tab and operation == cigar_tab[-1][0]:
-                cigar_tab[-1][1] += count
-            else:
-                cigar_tab.append((operation, count))
-            count_str = ''
-    #
-    return cigar_tab
+from fastx_utils import read_fasta_file_handle
+from cigar_utils import parse_cigar
 
 
 if __name__ == '__main__':
@@ -1,20 +1,211 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
+"""
+Filter the multiple alignments of each read on their score.
+
+The alignments of a read are sorted by decreasing score, and only the
+best ones are kept: alignments scoring at least threshold*max score
+(straight mode), or at least threshold*previous score (geometric mode).
+Once an alignment is discarded, all the following ones are discarded.
+
+Alignments are expected to be grouped by read, as output by SortMeRNA,
+so the filter streams the sam file without sorting it.
+"""
+
 import sys
+import time
+import logging
 import argparse
-import re
+
+import numpy as np
+
+from fastx_utils import iter_chunks, BUFFER_SIZE
+
+logger = logging.getLogger(__name__)
+
+# In SortMeRNA sam output, the AS and NM tags are the last two fields
+_AS_TAG = b'AS:i:'
+
+
+def get_alignment_score(line):
+    """
+    Return the AS tag value of a sam line (bytes). The tag is read at
+    its SortMeRNA position (second to last field), which avoids scanning
+    the sequence and quality fields. It is searched in all the optional
+    fields otherwise
+    """
+    field = line.rsplit(b'\t', 2)[-2]
+    if field[:5] == _AS_TAG:
+        return int(field[5:])
+    for field in line.split(b'\t')[11:]:
+        if field[:5] == _AS_TAG:
+            return int(field[5:])
+    raise ValueError('No AS tag in alignment: {0}'.format(line))
+
+
+def _parse_digits(buf, starts, lengths):
+    """
+    Parse the unsigned integers written in buf[starts:starts+lengths]
+    """
+    values = np.zeros(len(starts), dtype=np.int64)
+    for j in range(int(lengths.max()) if len(lengths) else 0):
+        in_number = j < lengths
+        digits = buf[np.where(in_number, starts + j, 0)].astype(np.int64) - 48
+        values = np.where(in_number, values * 10 + digits, values)
+    return values
+
+
+def filter_scores(read_index, scores, threshold, geometric=False):
+    """
+    Filter alignments given the read index (alignments grouped by read)
+    and the score of each one, as int arrays.
+    Return the indices of the kept alignments, sorted by read and by
+    decreasing score
+    """
+    if not len(scores):
+        return np.zeros(0, dtype=np.int64)
+    # Sort the alignments of each read by decreasing score,
+    # alignments with the same score keep the input order
+    order = np.lexsort((-scores, read_index))
+    scores = np.asarray(scores)[order].astype(np.float64)
+    read_index = np.asarray(read_index)[order]
+    read_first = np.concatenate(([True], read_index[1:] != read_index[:-1]))
+    read_first_index = np.flatnonzero(read_first)
+    read_rank = np.cumsum(read_first) - 1
+
+    if geometric:
+        previous_scores = np.concatenate(([0.0], scores[:-1]))
+        discarded = ~read_first & (scores < previous_scores * threshold)
+        # Once an alignment is discarded, the following ones are too
+        discarded_nb = np.cumsum(discarded)
+        discarded_before_read = (discarded_nb - discarded)[read_first_index]
+        keep = discarded_nb == discarded_before_read[read_rank]
+    else:
+        # Scores are sorted, so a discarded alignment is followed
+        # by discarded alignments only
+        keep = scores >= scores[read_first_index][read_rank] * threshold
+    keep |= read_first
+
+    return order[keep]
+
+
+def filter_chunk(data, threshold, geometric=False, last=True):
+    """
+    Filter a chunk of sam lines (bytes made of complete lines) grouped
+    by read. Read ids and scores are located with numpy on the whole
+    chunk, and the per-read filtering is vectorized too.
+
+    Return the kept lines, the number of alignments read, and the
+    remaining data: unless last, the alignments of the last read of
+    the chunk are not processed since they may continue in the next
+    chunk
+    """
+    if data[-1:] != b'\n':
+        data += b'\n'
+    buf = np.frombuffer(data, dtype=np.uint8)
+
+    # Lines, without empty and header lines
+    ends = np.flatnonzero(buf == 10)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    valid = ends > starts
+    valid[valid] = buf[starts[valid]] != 64
+    starts, ends = starts[valid], ends[valid]
+    if not len(starts):
+        return list(), 0, b''
+
+    tabs = np.flatnonzero(buf == 9)
+    if not len(tabs):
+        raise ValueError('Not a sam file')
+    tabs = np.append(tabs, len(buf))
+    first_tab_index = np.searchsorted(tabs, starts)
+    id_ends = tabs[first_tab_index]
+    id_lengths = np.minimum(id_ends, ends) - starts
+
+    # Group consecutive lines with the same read id
+    same_read = id_lengths[1:] == id_lengths[:-1]
+    max_id_length = int(id_lengths.max())
+    for j in range(max_id_length):
+        in_id = j < id_lengths
+        id_bytes = np.where(in_id, buf[np.where(in_id, starts + j, 0)], 0)
+        same_read &= id_bytes[1:] == id_bytes[:-1]
+    read_index = np.concatenate(([0], np.cumsum(~same_read)))
+
+    remainder = b''
+    if not last:
+        # Keep the last read alignments for the next chunk
+        last_read_start = int(np.searchsorted(read_index, read_index[-1]))
+        remainder = data[starts[last_read_start]:]
+        starts, ends = starts[:last_read_start], ends[:last_read_start]
+        first_tab_index = first_tab_index[:last_read_start]
+        read_index = read_index[:last_read_start]
+        if not len(starts):
+            return list(), 0, remainder
+
+    # The AS tag is expected in the second to last field (SortMeRNA)
+    tag_tab_index = np.searchsorted(tabs, ends) - 2
+    tag_tab_index = np.maximum(tag_tab_index, first_tab_index)
+    tag_starts = tabs[tag_tab_index] + 1
+    tag_lengths = tabs[tag_tab_index + 1] - tag_starts
+    is_as_tag = (tag_tab_index > first_tab_index) & (tag_lengths > 5)
+    for j, c in enumerate(_AS_TAG):
+        is_as_tag &= buf[np.where(is_as_tag, tag_starts + j, 0)] == c
+    scores = _parse_digits(buf, tag_starts + 5, np.where(is_as_tag, tag_lengths - 5, 0))
+    for i in np.flatnonzero(~is_as_tag):
+        scores[i] = get_alignment_score(data[starts[i]:ends[i]])
+
+    kept = filter_scores(read_index, scores, threshold, geometric)
+    kept_lines = [data[s:e] for s, e in zip(starts[kept].tolist(), ends[kept].tolist())]
+    return kept_lines, len(starts), remainder
+
+
+def filter_sam_file(in_sam, out_sam, threshold, geometric=False, buffer_size=BUFFER_SIZE):
+    """
+    Filter a sam file (path or file handle) and write the kept alignments
+    to out_sam (path or binary file handle).
+    Return the number of input and output alignments
+    """
+    in_alignments_nb = 0
+    out_alignments_nb = 0
+    t0_wall = time.time()
+
+    out_fh = open(out_sam, 'wb') if isinstance(out_sam, str) else out_sam
+    try:
+        remainder = b''
+        for chunk in iter_chunks(in_sam, as_bytes=True, buffer_size=buffer_size):
+            kept_lines, alignments_nb, remainder = filter_chunk(remainder + chunk, threshold, geometric, last=False)
+            in_alignments_nb += alignments_nb
+            if kept_lines:
+                out_fh.write(b'\n'.join(kept_lines) + b'\n')
+                out_alignments_nb += len(kept_lines)
+        if remainder:
+            kept_lines, alignments_nb, _ = filter_chunk(remainder, threshold, geometric, last=True)
+            in_alignments_nb += alignments_nb
+            if kept_lines:
+                out_fh.write(b'\n'.join(kept_lines) + b'\n')
+                out_alignments_nb += len(kept_lines)
+    finally:
+        if out_fh is not out_sam:
+            out_fh.close()
+
+    elapsed = time.time() - t0_wall
+    logger.debug('{0} / {1} alignments kept in {2:.2f} s ({3:.0f} alignments/s)'.format(
+        out_alignments_nb, in_alignments_nb, elapsed, in_alignments_nb / max(elapsed, 1e-6)))
+
+    return in_alignments_nb, out_alignments_nb
+
 
 if __name__ == '__main__':
 
     # Arguments
-    parser = argparse.ArgumentParser(description='')
+    parser = argparse.ArgumentParser(description='Filter the multiple alignments of each read on their score.')
     parser.add_argument('-i', '--input_sam', metavar='input.sam',
-                        type=argparse.FileType('r', 0), default='-',
-                        help='input sam file')
+                        type=argparse.FileType('rb'), default='-',
+                        help='input sam file, alignments grouped by read')
     parser.add_argument('-o', '--output_sam', metavar='output.sam',
-                        type=argparse.FileType('w', 0), default='-',
+                        type=argparse.FileType('wb'), default='-',
                         help='output sam file')
     parser.add_argument('--geometric', action='store_true',
                         help='Uses an adaptative geometric threshold (straigth treshold by default)')
@@ -23,34 +214,6 @@ if __name__ == '__main__':
                         help='Threshold will be either threshold*max score (straigth mode) or threshold*previous score (geometric mode)')
     args = parser.parse_args()
 
-    #
-    blank = re.compile(r'^\s*$')
-    score_pattern = re.compile(r"\s+AS:i:(\d+)\s+")
-    previous_read_id = ""
-    previous_score = 0
-    threshold = 0.0
-    to_write = True
-
-    for line in args.input_sam:
-        if not blank.match(line):
-            tab = line.split()
-            read_id = tab[0]
-            score = score_pattern.search(line).group(1)
-            if read_id != previous_read_id:
-                to_write = True
-                if not args.geometric:
-                    threshold = float(score) * args.threshold
-            else:
-                if args.geometric:
-                    threshold = float(previous_score) * (args.threshold)
-                if (float(score) < threshold):
-                    to_write = False
-
-            previous_read_id = read_id
-            previous_score = score
-
-            #~ args.output_sam.write('{0}\t{1}\t{2}\t{3}\n'.format(read_id, score, threshold, to_write))
-
-            if to_write:
-                args.output_sam.write("{0}\n".format(line.strip()))
+    filter_sam_file(args.input_sam, args.output_sam, args.threshold, args.geometric)
 
+    sys.exit(0)
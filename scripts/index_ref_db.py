@@ -8,6 +8,7 @@ import subprocess
 import time
 import logging
 from binary_utils import Binary
+from taxonomy_index import write_taxonomy_index
 
 # Create logger
 logger = logging.getLogger(__name__)
@@ -128,6 +129,7 @@ if __name__ == '__main__':
 
     complete_ref_db_taxo_filename = complete_ref_db_basename + '.taxo.tab'
     complete_ref_db_taxo_filepath = os.path.join(ref_db_dir, complete_ref_db_taxo_filename)
+    complete_ref_db_taxo_index_filepath = os.path.join(ref_db_dir, complete_ref_db_basename + '.taxo.idx')
 
     clustered_ref_db_basename = ref_db_basename + '.clustered'
     clustered_ref_db_basepath = os.path.join(ref_db_dir, clustered_ref_db_basename)
@@ -165,6 +167,13 @@ if __name__ == '__main__':
     if args.verbose:
         sys.stdout.write('\n')
 
+    ###################################
+    # Complete ref db taxonomy indexing
+
+    logger.info('Indexing complete ref db taxonomies')
+
+    write_taxonomy_index(complete_ref_db_taxo_filepath, complete_ref_db_taxo_index_filepath)
+
     ###############
     # Exit program
 
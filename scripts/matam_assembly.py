@@ -7,18 +7,30 @@ import argparse
 import statistics
 import subprocess
 import time
+import json
 import logging
-import cProfile
 from collections import defaultdict
 import shutil
+import functools
 
 import runner
+import counting
 from compute_abundance import get_abundance_by_scaffold, complete_fasta_with_abundance, get_abundance_from_fasta
 from rdp import run_rdp_classifier, filter_rdp_file
 from krona import rdp_file_to_krona_text_file, make_krona_plot
 from binary_utils import Binary
 import components_assembly
 from assembler_factory import AssemblerFactory
+from pipeline import Pipeline, Step
+from stage_cache import StageCache
+from profiler import Profiler
+from resources import ResourcePool
+from filter_score_multialign import filter_scores
+from sample_sam_by_coverage import sample_alignments, read_ref_lengths
+from alignment_store import AlignmentStore, sam_to_store, MISSING_SCORE
+from compute_lca_from_tab import read_components_taxo, write_lca_tab
+from taxonomy_index import TaxonomyIndex, write_taxonomy_index
+from fastx_utils import read_fasta_file_handle, file_compression, sniff_format, strip_compression_suffix, decompression_command
 
 # Set LC_LANG to C for standard sort behaviour
 os.environ["LC_ALL"] = "C"
@@ -74,9 +86,10 @@ default_ref_db = os.path.join(matam_db_dir, 'SILVA_128_SSURef_NR95')
 # Get all dependencies bin
 matam_script_dir = os.path.join(matam_root_dir, 'scripts')
 clean_name_bin = os.path.join(matam_script_dir, 'fasta_clean_name.py')
-sample_sam_cov_bin = Binary.assert_which('sample_sam_by_coverage.py')
 filter_score_bin = os.path.join(matam_script_dir, 'filter_score_multialign.py')
+sample_sam_cov_bin = os.path.join(matam_script_dir, 'sample_sam_by_coverage.py')
 compute_lca_bin = os.path.join(matam_script_dir, 'compute_lca_from_tab.py')
+olc_assembler_bin = os.path.join(matam_script_dir, 'olc_assembler.py')
 compute_compressed_graph_stats_bin = os.path.join(matam_script_dir, 'compute_compressed_graph_stats.py')
 remove_redundant_bin = os.path.join(matam_script_dir, 'remove_redundant_sequences.py')
 fastq_name_filter_bin = os.path.join(matam_script_dir, 'fastq_name_filter.py')
@@ -95,10 +108,13 @@ krona_bin = Binary.assert_which('ktImportText')
 
 rdp_jar = Binary.which('classifier.jar')
 
+# Memory (MBi) used by the RDP classifier jvm
+rdp_memory = 1024
+
 # the rdp exe name is different between submodule installation and conda installation
 if rdp_jar is not None:
     java = Binary.assert_which('java')
-    rdp_exe = '{java} -Xmx1g -jar {jar}'.format(java=java, jar=rdp_jar)
+    rdp_exe = '{java} -Xmx{memory}m -jar {jar}'.format(java=java, memory=rdp_memory, jar=rdp_jar)
 else:
     rdp_exe = Binary.assert_which('classifier')
 
@@ -134,60 +150,6 @@ def read_tab_file_handle_sorted(tab_file_handle, factor_index):
     tab_file_handle.close()
 
 
-def read_fasta_file_handle(fasta_file_handle):
-    """
-    Parse a fasta file and return a generator
-    """
-    # Variables initialization
-    header = ''
-    seqlines = list()
-    sequence_nb = 0
-    # Reading input file
-    for line in (l.strip() for l in fasta_file_handle if l.strip()):
-        if line[0] == '>':
-            # Yield the last read header and sequence
-            if sequence_nb:
-                yield (header, ''.join(seqlines))
-                del seqlines[:]
-            # Get header
-            header = line[1:].rstrip()
-            sequence_nb += 1
-        else:
-            # Concatenate sequence
-            seqlines.append(line.strip())
-    # Yield the input file last sequence
-    if header or seqlines:
-        yield (header, ''.join(seqlines))
-    # Close input file
-    fasta_file_handle.close()
-
-
-def read_fastq_file_handle(fastq_file_handle):
-    """
-    Parse a fastq file and return a generator
-    """
-    # Variables initialization
-    count = 0
-    header = ''
-    seq = ''
-    qual = ''
-    # Reading input file
-    for line in (l.strip() for l in fastq_file_handle if l.strip()):
-        count += 1
-        if count % 4 == 1:
-            if header:
-                yield header, seq, qual
-            header = line[1:].split()[0]
-        elif count % 4 == 2:
-            seq = line
-        elif count % 4 == 0:
-            qual = line
-    # yield last fastq sequence
-    yield header, seq, qual
-    # Close input file
-    fastq_file_handle.close()
-
-
 class FastaStats():
     """
     """
@@ -253,9 +215,10 @@ class DefaultHelpParser(argparse.ArgumentParser):
         sys.exit(2)
 
 
-def parse_arguments():
+def parse_arguments(argv=None):
     """
-    Parse the command line, and check if arguments are correct
+    Parse the command line (or the given argument list),
+    and check if arguments are correct
     """
     # Initiate argument parser
     parser = DefaultHelpParser(description='MATAM assembly',
@@ -270,7 +233,8 @@ def parse_arguments():
                             metavar = 'FASTX',
                             type = str,
                             required = True,
-                            help = 'Input reads file (fasta or fastq format)')
+                            help = 'Input reads file (fasta or fastq format, '
+                                   'plain or compressed with gzip, bzip2 or zstd)')
     # -d / --ref_db
     group_main.add_argument('-d', '--ref_db',
                             action = 'store',
@@ -306,8 +270,8 @@ def parse_arguments():
                             metavar = 'MAXMEM',
                             type = int,
                             default = 10000,
-                            help = 'Maximum memory to use (in MBi). '
-                                   'Default is %(default)s MBi')
+                            help = 'Maximum memory to use (in MBi). Steps running concurrently '
+                                   'share this budget. Default is %(default)s MBi')
 
     # Reads mapping parameters
     group_mapping = parser.add_argument_group('Read mapping')
@@ -377,6 +341,12 @@ def parse_arguments():
                            default = 50,
                            help = 'Minimum length of an overlap. '
                                   'Default is %(default)s')
+    # --bam_alignments
+    group_ovg.add_argument('--bam_alignments',
+                           action = 'store_true',
+                           help = 'Give the filtered alignments to ovgraphbuild as '
+                                  'BGZF compressed BAM (ovgraphbuild must be built '
+                                  'with zlib). Default is SAM')
 
     # Graph compaction & Components identification
     group_gcomp = parser.add_argument_group('Graph compaction & Components identification')
@@ -401,8 +371,9 @@ def parse_arguments():
                              action = 'store',
                              metavar = 'INT',
                              type = int,
-                             help = 'Seed to initialize random generator. '
-                                    'Default is picking seed from system time')
+                             help = 'Seed to initialize random generators (graph components search '
+                                    'and ref coverage filtering). The same reads and seed always '
+                                    'give the same results. Default is picking seed from system time')
     # --optimize_components
     group_gcomp.add_argument('--optimize_components',
                              action = 'store_true',
@@ -447,6 +418,17 @@ def parse_arguments():
                               choices = [20, 50],
                               default = 20,
                               help = argparse.SUPPRESS)
+    # --small_component_nt
+    group_contig.add_argument('--small_component_nt',
+                              action = 'store',
+                              metavar = 'INT',
+                              type = int,
+                              default = 0,
+                              help = 'Components of at most this number of nucleotides are assembled '
+                                     'in process instead of by the assembler, unless their reads are corrected. '
+                                     'Experimental: the in-process contigs are not yet validated against SGA ones, '
+                                     'eg. a single mismatch can break a contig. '
+                                     'Default is %(default)s (disabled)')
 
     # Scaffolding
     group_scaff = parser.add_argument_group('Scaffolding')
@@ -519,9 +501,21 @@ def parse_arguments():
                            choices = ['reads_mapping', 'alignments_filtering', 'overlap_graph_building',
                                       'graph_compaction', 'contigs_assembly', 'scaffolding',
                                       'abundance_calculation', 'taxonomic_assignment'],
-                           help = 'Try to resume from given step. '
+                           help = 'Try to resume from given step, even if the following steps are up to date. '
                                   'Steps are: %(choices)s')
 
+    # --no_cache
+    group_adv.add_argument('--no_cache',
+                            action = 'store_true',
+                            help = 'Run all steps, even the ones whose outputs are up to date '
+                                   '(same inputs, parameters and binaries than the last run)')
+
+    # --profile
+    group_adv.add_argument('--profile',
+                            action = 'store_true',
+                            help = 'Also dump a cProfile file for each step in out_dir/profile '
+                                   '(a per-step resources report is always written to out_dir/matam_profile.json)')
+
     # --filter_only
     group_adv.add_argument('--filter_only',
                             action = 'store_true',
@@ -529,7 +523,7 @@ def parse_arguments():
                                    'Relevant options for this step correspond to the "Read mapping" section.')
 
     #
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Arguments checking
     if args.score_threshold < 0 or args.score_threshold > 1:
@@ -548,6 +542,10 @@ def parse_arguments():
         parser.print_help()
         raise Exception("cutoff not in range [0,1]")
 
+    if args.small_component_nt < 0:
+        parser.print_help()
+        raise Exception("small component nucleotides number is negative")
+
     # contig_coverage_threshold default value makes no sense when args.read_correction is not auto
     if args.read_correction != 'auto':
         args.contig_coverage_threshold = None
@@ -600,6 +598,12 @@ def print_intro(args):
     if args.keep_tmp:
         cmd_line += '--keep_tmp '
 
+    if args.no_cache:
+        cmd_line += '--no_cache '
+
+    if args.profile:
+        cmd_line += '--profile '
+
     if args.resume_from:
         cmd_line += '--resume_from {} '.format(args.resume_from)
 
@@ -626,6 +630,8 @@ def print_intro(args):
     # Overlap-graph building
     cmd_line += '--min_identity {0:.2f} '.format(args.min_identity)
     cmd_line += '--min_overlap_length {0} '.format(args.min_overlap_length)
+    if args.bam_alignments:
+        cmd_line += '--bam_alignments '
 
     # Graph compaction & Components identification
     cmd_line += '--min_read_node {0} '.format(args.min_read_node)
@@ -642,6 +648,7 @@ def print_intro(args):
     cmd_line += '--read_correction {0} '.format(args.read_correction)
     if args.read_correction == 'auto':
         cmd_line += '--contig_coverage_threshold {0} '.format(args.contig_coverage_threshold)
+    cmd_line += '--small_component_nt {0} '.format(args.small_component_nt)
 
     # Scaffolding
     if args.contigs_binning:
@@ -680,881 +687,1118 @@ def rm_files(filepath_list):
             pass
 
 
-def main():
+def get_abundance_memory(args):
     """
+    Return the memory (MBi) used by the abundance calculation. When it is
+    large enough, the RDP classifier memory is left aside so that both
+    steps run concurrently
     """
-    # Set global t0
-    global_t0_wall = time.time()
-
-    # Arguments parsing
-    args = parse_arguments()
-
-    # Init error code
-    error_code = 0
-
-    # Init list of tmp files to delete at the end
-    to_rm_filepath_list = list()
-
-    # Set resume tag
-    run_step = True
-    if args.resume_from:
-        run_step = False
-
-    ##############################################
-    # Set all files and directories names + paths
-
-    workdir = os.path.join(args.out_dir, 'workdir')
-
-    try:
-        if not os.path.exists(workdir):
-            logger.debug('mkdir {0}'.format(workdir))
-            os.makedirs(workdir)
-    except OSError:
-        logger.exception('Could not create output directory {0}'.format(workdir))
-        raise
-
-    logger_filepath = os.path.join(args.out_dir, 'matam.log')
-    update_logger_settings(logger_filepath, args.verbose, args.debug)
-
-    # Print intro infos
-    if not args.filter_only:
-        print_intro(args)
-
-    sort_bin = 'sort -T ' + workdir + ' -S ' + str(args.max_memory)
-    sort_bin += 'M --parallel ' + str(args.cpu)
+    if args.perform_taxonomic_assignment and args.max_memory > 2 * rdp_memory:
+        return args.max_memory - rdp_memory
+    return args.max_memory
 
-    input_fastx_filepath = args.input_fastx
-    input_fastx_filename = os.path.basename(input_fastx_filepath)
-    input_fastx_basename, input_fastx_extension = os.path.splitext(input_fastx_filename)
 
-    ref_db_basepath = args.ref_db
-    ref_db_dir, ref_db_basename = os.path.split(ref_db_basepath)
-
-    complete_ref_db_basename = ref_db_basename + '.complete'
-    complete_ref_db_basepath = os.path.join(ref_db_dir, complete_ref_db_basename)
-    complete_ref_db_filename = complete_ref_db_basename + '.fasta'
-    complete_ref_db_filepath = os.path.join(ref_db_dir, complete_ref_db_filename)
+def get_sort_command(workdir, max_memory, cpu):
+    """
+    Return the sort command (argument list) used for all the external sorts
+    """
+    return ['sort', '-T', workdir, '-S', str(max_memory) + 'M', '--parallel', str(cpu)]
 
-    complete_ref_db_taxo_filename = complete_ref_db_basename + '.taxo.tab'
-    complete_ref_db_taxo_filepath = os.path.join(ref_db_dir, complete_ref_db_taxo_filename)
 
-    clustered_ref_db_basename = ref_db_basename + '.clustered'
-    clustered_ref_db_basepath = os.path.join(ref_db_dir, clustered_ref_db_basename)
-    clustered_ref_db_filename = clustered_ref_db_basename + '.fasta'
-    clustered_ref_db_filepath = os.path.join(ref_db_dir, clustered_ref_db_filename)
+def get_filepaths(args):
+    """
+    Set all files and directories names + paths.
+    Return a namespace holding them
+    """
+    fp = argparse.Namespace()
+
+    fp.workdir = os.path.join(args.out_dir, 'workdir')
+    fp.stage_cache_dir = os.path.join(fp.workdir, 'stage_cache')
+
+    fp.input_fastx_filepath = args.input_fastx
+    fp.input_fastx_filename = os.path.basename(fp.input_fastx_filepath)
+    # Compressed input files are named after the uncompressed file
+    fp.input_fastx_basename, fp.input_fastx_extension = os.path.splitext(strip_compression_suffix(fp.input_fastx_filename))
+    # Compression and format are detected from the file content
+    fp.input_fastx_compression = None
+    fp.input_fastx_format = None
+    if os.path.isfile(fp.input_fastx_filepath):
+        fp.input_fastx_compression = file_compression(fp.input_fastx_filepath)
+        fp.input_fastx_format = sniff_format(fp.input_fastx_filepath)
+
+    fp.ref_db_basepath = args.ref_db
+    fp.ref_db_dir, fp.ref_db_basename = os.path.split(fp.ref_db_basepath)
+
+    fp.complete_ref_db_basename = fp.ref_db_basename + '.complete'
+    fp.complete_ref_db_basepath = os.path.join(fp.ref_db_dir, fp.complete_ref_db_basename)
+    fp.complete_ref_db_filename = fp.complete_ref_db_basename + '.fasta'
+    fp.complete_ref_db_filepath = os.path.join(fp.ref_db_dir, fp.complete_ref_db_filename)
+
+    fp.complete_ref_db_taxo_filename = fp.complete_ref_db_basename + '.taxo.tab'
+    fp.complete_ref_db_taxo_filepath = os.path.join(fp.ref_db_dir, fp.complete_ref_db_taxo_filename)
+    fp.complete_ref_db_taxo_index_filepath = os.path.join(fp.ref_db_dir, fp.complete_ref_db_basename + '.taxo.idx')
+
+    fp.clustered_ref_db_basename = fp.ref_db_basename + '.clustered'
+    fp.clustered_ref_db_basepath = os.path.join(fp.ref_db_dir, fp.clustered_ref_db_basename)
+    fp.clustered_ref_db_filename = fp.clustered_ref_db_basename + '.fasta'
+    fp.clustered_ref_db_filepath = os.path.join(fp.ref_db_dir, fp.clustered_ref_db_filename)
 
     # Read mapping
-    sortme_output_basename = input_fastx_basename
-    sortme_output_basename += '.sortmerna_vs_' + ref_db_basename
-    sortme_output_basename += '_b' + str(args.best) + '_m' + str(args.min_lis)
-    sortme_output_basepath = os.path.join(workdir, sortme_output_basename)
+    fp.sortme_output_basename = fp.input_fastx_basename
+    fp.sortme_output_basename += '.sortmerna_vs_' + fp.ref_db_basename
+    fp.sortme_output_basename += '_b' + str(args.best) + '_m' + str(args.min_lis)
+    fp.sortme_output_basepath = os.path.join(fp.workdir, fp.sortme_output_basename)
+
+    fp.sortme_output_fastx_filepath = fp.sortme_output_basepath + fp.input_fastx_extension
 
-    sortme_output_fastx_filepath = sortme_output_basepath + input_fastx_extension
-    sortme_output_sam_filepath = sortme_output_basepath + '.sam'
+    # SortMeRNA reads plain and gzip files. Other compressed files are
+    # recompressed on the fly to gzip
+    fp.sortme_reads_filepath = fp.input_fastx_filepath
+    if fp.input_fastx_compression not in (None, 'gzip'):
+        fp.sortme_reads_filepath = os.path.join(fp.workdir, fp.input_fastx_basename + fp.input_fastx_extension + '.gz')
+    fp.sortme_output_sam_filepath = fp.sortme_output_basepath + '.sam'
+    fp.sortme_output_log_filepath = fp.sortme_output_basepath + '.log'
 
     # Alignments filtering
-    score_threshold_int = int(args.score_threshold * 100)
+    fp.score_threshold_int = int(args.score_threshold * 100)
 
-    sam_filt_basename = sortme_output_basename + '.scr_filt_'
+    fp.sam_filt_basename = fp.sortme_output_basename + '.scr_filt_'
     if args.straight_mode:
-        sam_filt_basename += 'str_'
+        fp.sam_filt_basename += 'str_'
     else:
-        sam_filt_basename += 'geo_'
-    sam_filt_basename += str(score_threshold_int) + 'pct'
-    sam_filt_filename = sam_filt_basename + '.sam'
-    sam_filt_filepath = os.path.join(workdir, sam_filt_filename)
+        fp.sam_filt_basename += 'geo_'
+    fp.sam_filt_basename += str(fp.score_threshold_int) + 'pct'
+    fp.sam_filt_filename = fp.sam_filt_basename + '.sam'
+    fp.sam_filt_filepath = os.path.join(fp.workdir, fp.sam_filt_filename)
+    fp.alignment_store_filepath = fp.sortme_output_basepath + '.alignments'
 
     # Poorly covered references filtering
-    sam_cov_filt_basename = sam_filt_basename
+    fp.sam_cov_filt_basename = fp.sam_filt_basename
     if args.coverage_threshold:
-        sam_cov_filt_basename += '.cov_filt_{0}'.format(args.coverage_threshold)
-    sam_cov_filt_filename = sam_cov_filt_basename + '.sam'
-    sam_cov_filt_filepath = os.path.join(workdir, sam_cov_filt_filename)
+        fp.sam_cov_filt_basename += '.cov_filt_{0}'.format(args.coverage_threshold)
+    fp.sam_cov_filt_filename = fp.sam_cov_filt_basename + ('.bam' if args.bam_alignments else '.sam')
+    fp.sam_cov_filt_filepath = os.path.join(fp.workdir, fp.sam_cov_filt_filename)
 
     # Overlap-graph building
-    min_identity_int = int(args.min_identity * 100)
+    fp.min_identity_int = int(args.min_identity * 100)
 
-    ovgraphbuild_basename = sam_cov_filt_basename + '.ovgb_i' + str(min_identity_int)
-    ovgraphbuild_basename += '_o' + str(args.min_overlap_length)
-    ovgraphbuild_basepath = os.path.join(workdir, ovgraphbuild_basename)
+    fp.ovgraphbuild_basename = fp.sam_cov_filt_basename + '.ovgb_i' + str(fp.min_identity_int)
+    fp.ovgraphbuild_basename += '_o' + str(args.min_overlap_length)
+    fp.ovgraphbuild_basepath = os.path.join(fp.workdir, fp.ovgraphbuild_basename)
 
-    ovgraphbuild_asqg_filepath = ovgraphbuild_basepath + '.asqg'
-    ovgraphbuild_nodes_csv_filepath = ovgraphbuild_basepath + '.nodes.csv'
-    ovgraphbuild_edges_csv_filepath = ovgraphbuild_basepath + '.edges.csv'
+    fp.ovgraphbuild_asqg_filepath = fp.ovgraphbuild_basepath + '.asqg'
+    fp.ovgraphbuild_nodes_csv_filepath = fp.ovgraphbuild_basepath + '.nodes.csv'
+    fp.ovgraphbuild_edges_csv_filepath = fp.ovgraphbuild_basepath + '.edges.csv'
 
     # Graph compaction & Components identification
-    componentsearch_basename = ovgraphbuild_basename + '.cpts'
-    componentsearch_basename += '_N' + str(args.min_read_node)
-    componentsearch_basename += '_E' + str(args.min_overlap_edge)
+    fp.componentsearch_basename = fp.ovgraphbuild_basename + '.cpts'
+    fp.componentsearch_basename += '_N' + str(args.min_read_node)
+    fp.componentsearch_basename += '_E' + str(args.min_overlap_edge)
     if args.optimize_components:
-        componentsearch_basename += '_oc'
-    componentsearch_basepath = os.path.join(workdir, componentsearch_basename)
+        fp.componentsearch_basename += '_oc'
+    fp.componentsearch_basepath = os.path.join(fp.workdir, fp.componentsearch_basename)
 
-    componentsearch_metanodes_csv_basename = componentsearch_basename + '.metaNodes'
-    componentsearch_metanodes_csv_filename = componentsearch_metanodes_csv_basename + '.csv'
-    componentsearch_metanodes_csv_filepath = os.path.join(workdir, componentsearch_metanodes_csv_filename)
+    fp.componentsearch_metanodes_csv_basename = fp.componentsearch_basename + '.metaNodes'
+    fp.componentsearch_metanodes_csv_filename = fp.componentsearch_metanodes_csv_basename + '.csv'
+    fp.componentsearch_metanodes_csv_filepath = os.path.join(fp.workdir, fp.componentsearch_metanodes_csv_filename)
 
-    componentsearch_metaedges_csv_basename = componentsearch_basename + '.metaEdges'
-    componentsearch_metaedges_csv_filename = componentsearch_metaedges_csv_basename + '.csv'
-    componentsearch_metaedges_csv_filepath = os.path.join(workdir, componentsearch_metaedges_csv_filename)
+    fp.componentsearch_metaedges_csv_basename = fp.componentsearch_basename + '.metaEdges'
+    fp.componentsearch_metaedges_csv_filename = fp.componentsearch_metaedges_csv_basename + '.csv'
+    fp.componentsearch_metaedges_csv_filepath = os.path.join(fp.workdir, fp.componentsearch_metaedges_csv_filename)
 
-    componentsearch_components_csv_basename = componentsearch_basename + '.components'
-    componentsearch_components_csv_filename = componentsearch_components_csv_basename + '.csv'
-    componentsearch_components_csv_filepath = os.path.join(workdir, componentsearch_components_csv_filename)
+    fp.componentsearch_components_csv_basename = fp.componentsearch_basename + '.components'
+    fp.componentsearch_components_csv_filename = fp.componentsearch_components_csv_basename + '.csv'
+    fp.componentsearch_components_csv_filepath = os.path.join(fp.workdir, fp.componentsearch_components_csv_filename)
 
     # LCA labelling
-    read_metanode_component_filepath = componentsearch_basepath + '.read_metanode_component.tab'
-    complete_taxo_filepath = componentsearch_basepath + '.read_metanode_component_taxo.tab'
+    fp.read_metanode_component_filepath = fp.componentsearch_basepath + '.read_metanode_component.tab'
+    # Taxonomy index built when the ref db one is missing or outdated
+    fp.taxo_index_filepath = os.path.join(fp.workdir, fp.complete_ref_db_basename + '.taxo.idx')
 
-    quorum_int = int(args.quorum * 100)
+    fp.quorum_int = int(args.quorum * 100)
 
-    labelled_nodes_basename = componentsearch_metanodes_csv_basename
-    labelled_nodes_basename += '.component_lca' + str(quorum_int) + 'pct'
+    fp.labelled_nodes_basename = fp.componentsearch_metanodes_csv_basename
+    fp.labelled_nodes_basename += '.component_lca' + str(fp.quorum_int) + 'pct'
 
-    components_lca_filename = componentsearch_basename + '.component_lca' + str(quorum_int) + 'pct.tab'
-    components_lca_filepath = os.path.join(workdir, components_lca_filename)
+    fp.components_lca_filename = fp.componentsearch_basename + '.component_lca' + str(fp.quorum_int) + 'pct.tab'
+    fp.components_lca_filepath = os.path.join(fp.workdir, fp.components_lca_filename)
 
     # Computing compressed graph stats
-    stats_filename = componentsearch_basename + '.graph.stats'
-    stats_filepath = os.path.join(workdir, stats_filename)
+    fp.stats_filename = fp.componentsearch_basename + '.graph.stats'
+    fp.stats_filepath = os.path.join(fp.workdir, fp.stats_filename)
 
     # Contigs assembly
-    component_read_filepath = componentsearch_basepath + '.component_read.tab'
+    fp.component_read_filepath = fp.componentsearch_basepath + '.component_read.tab'
 
-    contigs_assembly_wkdir = os.path.join(workdir, "components_assembly")
+    fp.contigs_assembly_wkdir = os.path.join(fp.workdir, "components_assembly")
 
-    contigs_basename = componentsearch_basename + '.'
-    contigs_basename += args.assembler + '_by_component'
-    contigs_basepath = os.path.join(workdir, contigs_basename)
-    contigs_filename = contigs_basename + '.fasta'
-    contigs_filepath = os.path.join(workdir, contigs_filename)
+    fp.contigs_basename = fp.componentsearch_basename + '.'
+    fp.contigs_basename += args.assembler + '_by_component'
+    fp.contigs_basepath = os.path.join(fp.workdir, fp.contigs_basename)
+    fp.contigs_filename = fp.contigs_basename + '.fasta'
+    fp.contigs_filepath = os.path.join(fp.workdir, fp.contigs_filename)
+    fp.untagged_contigs_filepath = fp.contigs_basepath + '.untagged.fasta'
 
-    contigs_assembly_log_filename = contigs_basename + '.log'
-    contigs_assembly_log_filepath = os.path.join(workdir, contigs_assembly_log_filename)
-    # Remove log file from previous assemblies
-    # because we will only append to this file
-    if os.path.exists(contigs_assembly_log_filepath):
-        os.remove(contigs_assembly_log_filepath)
+    fp.contigs_assembly_log_filename = fp.contigs_basename + '.log'
+    fp.contigs_assembly_log_filepath = os.path.join(fp.workdir, fp.contigs_assembly_log_filename)
 
-    contigs_symlink_basename = 'contigs'
-    contigs_symlink_filename = contigs_symlink_basename + '.fasta'
-    contigs_symlink_filepath = os.path.join(workdir, contigs_symlink_filename)
+    fp.contigs_symlink_basename = 'contigs'
+    fp.contigs_symlink_filename = fp.contigs_symlink_basename + '.fasta'
+    fp.contigs_symlink_filepath = os.path.join(fp.workdir, fp.contigs_symlink_filename)
 
-    contigs_NR_basename = contigs_symlink_basename + '.NR'
-    contigs_NR_filename = contigs_NR_basename + '.fasta'
-    contigs_NR_filepath = os.path.join(workdir, contigs_NR_filename)
+    fp.contigs_NR_basename = fp.contigs_symlink_basename + '.NR'
+    fp.contigs_NR_filename = fp.contigs_NR_basename + '.fasta'
+    fp.contigs_NR_filepath = os.path.join(fp.workdir, fp.contigs_NR_filename)
 
-    large_NR_contigs_basename = contigs_NR_basename + '.min_' + str(args.min_scaffold_length) + 'bp'
-    large_NR_contigs_filename = large_NR_contigs_basename + '.fasta'
-    large_NR_contigs_filepath = os.path.join(workdir, large_NR_contigs_filename)
+    fp.large_NR_contigs_basename = fp.contigs_NR_basename + '.min_' + str(args.min_scaffold_length) + 'bp'
+    fp.large_NR_contigs_filename = fp.large_NR_contigs_basename + '.fasta'
+    fp.large_NR_contigs_filepath = os.path.join(fp.workdir, fp.large_NR_contigs_filename)
 
     # Scaffolding
-    scaff_sortme_output_basename = contigs_symlink_basename
-    scaff_sortme_output_basename += '.sortmerna_vs_complete_' + ref_db_basename
-    scaff_sortme_output_basename += '_num_align_0'
-    scaff_sortme_output_basepath = os.path.join(workdir, scaff_sortme_output_basename)
+    fp.scaff_sortme_output_basename = fp.contigs_symlink_basename
+    fp.scaff_sortme_output_basename += '.sortmerna_vs_complete_' + fp.ref_db_basename
+    fp.scaff_sortme_output_basename += '_num_align_0'
+    fp.scaff_sortme_output_basepath = os.path.join(fp.workdir, fp.scaff_sortme_output_basename)
 
-    scaff_sortme_output_blast_filename = scaff_sortme_output_basename + '.blast'
-    scaff_sortme_output_blast_filepath = os.path.join(workdir, scaff_sortme_output_blast_filename)
+    fp.scaff_sortme_output_blast_filename = fp.scaff_sortme_output_basename + '.blast'
+    fp.scaff_sortme_output_blast_filepath = os.path.join(fp.workdir, fp.scaff_sortme_output_blast_filename)
 
-    scaff_sortme_output_sam_filename = scaff_sortme_output_basename + '.sam'
-    scaff_sortme_output_sam_filepath = os.path.join(workdir, scaff_sortme_output_sam_filename)
+    fp.scaff_sortme_output_sam_filename = fp.scaff_sortme_output_basename + '.sam'
+    fp.scaff_sortme_output_sam_filepath = os.path.join(fp.workdir, fp.scaff_sortme_output_sam_filename)
 
-    best_only_blast_basename = scaff_sortme_output_blast_filename + '.best_only'
-    best_only_blast_filename = best_only_blast_basename + '.tab'
-    best_only_blast_filepath = os.path.join(workdir, best_only_blast_filename)
+    fp.best_only_blast_basename = fp.scaff_sortme_output_blast_filename + '.best_only'
+    fp.best_only_blast_filename = fp.best_only_blast_basename + '.tab'
+    fp.best_only_blast_filepath = os.path.join(fp.workdir, fp.best_only_blast_filename)
 
-    selected_best_only_blast_basename = best_only_blast_basename + '.selected'
-    selected_best_only_blast_filename = selected_best_only_blast_basename + '.tab'
-    selected_best_only_blast_filepath = os.path.join(workdir, selected_best_only_blast_filename)
+    fp.selected_best_only_blast_basename = fp.best_only_blast_basename + '.selected'
+    fp.selected_best_only_blast_filename = fp.selected_best_only_blast_basename + '.tab'
+    fp.selected_best_only_blast_filepath = os.path.join(fp.workdir, fp.selected_best_only_blast_filename)
 
-    selected_sam_basename = selected_best_only_blast_basename
-    selected_sam_filename = selected_sam_basename + '.sam'
-    selected_sam_filepath = os.path.join(workdir, selected_sam_filename)
+    fp.selected_sam_basename = fp.selected_best_only_blast_basename
+    fp.selected_sam_filename = fp.selected_sam_basename + '.sam'
+    fp.selected_sam_filepath = os.path.join(fp.workdir, fp.selected_sam_filename)
 
-    binned_sam_basename = selected_best_only_blast_basename + '.binned'
-    binned_sam_filename = binned_sam_basename + '.sam'
-    binned_sam_filepath = os.path.join(workdir, binned_sam_filename)
+    fp.binned_sam_basename = fp.selected_best_only_blast_basename + '.binned'
+    fp.binned_sam_filename = fp.binned_sam_basename + '.sam'
+    fp.binned_sam_filepath = os.path.join(fp.workdir, fp.binned_sam_filename)
 
-    processed_sam_basename = selected_sam_basename
-    processed_sam_filepath = selected_sam_filepath
+    fp.processed_sam_basename = fp.selected_sam_basename
+    fp.processed_sam_filepath = fp.selected_sam_filepath
 
     if args.contigs_binning:
-        processed_sam_basename = binned_sam_basename
-        processed_sam_filepath = binned_sam_filepath
+        fp.processed_sam_basename = fp.binned_sam_basename
+        fp.processed_sam_filepath = fp.binned_sam_filepath
 
-    bam_basename = processed_sam_basename
-    bam_filename = bam_basename + '.bam'
-    bam_filepath = os.path.join(workdir, bam_filename)
+    fp.bam_basename = fp.processed_sam_basename
+    fp.bam_filename = fp.bam_basename + '.bam'
+    fp.bam_filepath = os.path.join(fp.workdir, fp.bam_filename)
 
-    sorted_bam_basename = processed_sam_basename + '.sorted'
-    sorted_bam_basepath = os.path.join(workdir, sorted_bam_basename)
-    sorted_bam_filename = sorted_bam_basename + '.bam'
-    sorted_bam_filepath = os.path.join(workdir, sorted_bam_filename)
+    fp.sorted_bam_basename = fp.processed_sam_basename + '.sorted'
+    fp.sorted_bam_basepath = os.path.join(fp.workdir, fp.sorted_bam_basename)
+    fp.sorted_bam_filename = fp.sorted_bam_basename + '.bam'
+    fp.sorted_bam_filepath = os.path.join(fp.workdir, fp.sorted_bam_filename)
 
-    mpileup_filename = sorted_bam_basename + '.mpileup'
-    mpileup_filepath = os.path.join(workdir, mpileup_filename)
+    fp.mpileup_filename = fp.sorted_bam_basename + '.mpileup'
+    fp.mpileup_filepath = os.path.join(fp.workdir, fp.mpileup_filename)
 
-    scaffolds_basename = sorted_bam_basename + '.scaffolds'
-    scaffolds_filename = scaffolds_basename + '.fa'
-    scaffolds_filepath = os.path.join(workdir, scaffolds_filename)
+    fp.scaffolds_basename = fp.sorted_bam_basename + '.scaffolds'
+    fp.scaffolds_filename = fp.scaffolds_basename + '.fa'
+    fp.scaffolds_filepath = os.path.join(fp.workdir, fp.scaffolds_filename)
 
-    scaffolds_symlink_basename = 'scaffolds'
+    fp.scaffolds_symlink_basename = 'scaffolds'
     if args.contigs_binning:
-        scaffolds_symlink_basename += '.contigs_binning'
-    scaffolds_symlink_filename = scaffolds_symlink_basename + '.fa'
-    scaffolds_symlink_filepath = os.path.join(workdir, scaffolds_symlink_filename)
-
-    scaffolds_NR_basename = scaffolds_symlink_basename + '.NR'
-    scaffolds_NR_filename = scaffolds_NR_basename + '.fa'
-    scaffolds_NR_filepath = os.path.join(workdir, scaffolds_NR_filename)
-
-    large_NR_scaffolds_basename = scaffolds_NR_basename + '.min_' + str(args.min_scaffold_length) + 'bp'
-    large_NR_scaffolds_filename = large_NR_scaffolds_basename + '.fa'
-    large_NR_scaffolds_filepath = os.path.join(workdir, large_NR_scaffolds_filename)
-
-    final_assembly_symlink_basename = 'final_assembly'
-    final_assembly_symlink_filename = final_assembly_symlink_basename + '.fa'
-    final_assembly_symlink_filepath = os.path.join(args.out_dir, final_assembly_symlink_filename)
-
-    final_krona_tab_symlink_filepath = os.path.join(args.out_dir, 'krona.tab')
-    final_krona_html_symlink_filepath = os.path.join(args.out_dir, 'krona.html')
-
-    #################################
-    # Compute input reads statistics
-
-    if args.resume_from == 'reads_mapping':
-        run_step = True
-
-    # Get input reads number
-    input_reads_nb = -1
-
-    if run_step:
-        if input_fastx_extension in ('.fq', '.fastq'):
-            input_fastx_line_nb = int(subprocess.check_output('wc -l {0}'.format(input_fastx_filepath), shell=True, bufsize=0).split()[0])
-            if input_fastx_line_nb % 4 != 0:
-                logger.warning('FastQ input file does not have a number of lines multiple of 4')
-            input_reads_nb = input_fastx_line_nb // 4
-        elif input_fastx_extension in ('.fa', '.fasta'):
-            input_reads_nb = int(subprocess.check_output('grep -c "^>" {0}'.format(input_fastx_filepath), shell=True, bufsize=0))
-        else:
-            logger.warning('Input fastx file extension was not recognised ({0})'.format(input_fastx_extension))
+        fp.scaffolds_symlink_basename += '.contigs_binning'
+    fp.scaffolds_symlink_filename = fp.scaffolds_symlink_basename + '.fa'
+    fp.scaffolds_symlink_filepath = os.path.join(fp.workdir, fp.scaffolds_symlink_filename)
 
-        logger.info('=== Input ===')
-        logger.info('Input file: {}'.format(input_fastx_filepath))
-        logger.info('Input file reads nb: {} reads'.format(input_reads_nb))
+    fp.scaffolds_NR_basename = fp.scaffolds_symlink_basename + '.NR'
+    fp.scaffolds_NR_filename = fp.scaffolds_NR_basename + '.fa'
+    fp.scaffolds_NR_filepath = os.path.join(fp.workdir, fp.scaffolds_NR_filename)
 
-    ###############################
-    # Reads mapping against ref db
+    fp.large_NR_scaffolds_basename = fp.scaffolds_NR_basename + '.min_' + str(args.min_scaffold_length) + 'bp'
+    fp.large_NR_scaffolds_filename = fp.large_NR_scaffolds_basename + '.fa'
+    fp.large_NR_scaffolds_filepath = os.path.join(fp.workdir, fp.large_NR_scaffolds_filename)
 
-    if args.resume_from == 'reads_mapping':
-        logger.info('Resuming from reads mapping')
-        run_step = True
+    fp.final_assembly_symlink_basename = 'final_assembly'
+    fp.final_assembly_symlink_filename = fp.final_assembly_symlink_basename + '.fa'
+    fp.final_assembly_symlink_filepath = os.path.join(args.out_dir, fp.final_assembly_symlink_filename)
 
-    if run_step:
-        logger.info('=== Reads mapping against ref db ===')
+    fp.final_krona_tab_symlink_filepath = os.path.join(args.out_dir, 'krona.tab')
+    fp.final_krona_html_symlink_filepath = os.path.join(args.out_dir, 'krona.html')
 
-        cmd_line = sortmerna_bin + ' --ref ' + clustered_ref_db_filepath
-        cmd_line += ',' + clustered_ref_db_basepath + ' --reads '
-        cmd_line += input_fastx_filepath + ' --aligned ' + sortme_output_basepath
-        cmd_line += ' --fastx --sam --blast "1" --log --best '
-        cmd_line += str(args.best) + ' --min_lis ' + str(args.min_lis)
-        cmd_line += ' -e {0:.2e}'.format(args.evalue)
-        cmd_line += ' -a ' + str(args.cpu)
-        if args.verbose:
-            cmd_line += ' -v '
+    fp.run_summary_filepath = os.path.join(args.out_dir, 'run_summary.json')
 
-        # Set t0
-        t0_wall = time.time()
+    # Profiling
+    fp.profile_report_filepath = os.path.join(args.out_dir, 'matam_profile.json')
+    fp.cprofile_dir = os.path.join(args.out_dir, 'profile')
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Abundance calculation
+    fp.fasta_with_abundance_filepath = '%s.abd%s' % os.path.splitext(fp.large_NR_scaffolds_filepath)
 
-        # Output running time
-        logger.info('Reads mapping completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+    # Taxonomic assignment
+    fp.rdp_classification_filepath = '%s.rdp.tab' % os.path.splitext(fp.fasta_with_abundance_filepath)[0]
+    fp.fltr_rdp_classification_filepath = '%s.fltr.tab' % os.path.splitext(fp.rdp_classification_filepath)[0]
+    fp.final_rdp_tab_symlink_filepath = os.path.join(args.out_dir, 'rdp.tab')
 
-    # Get selected reads number
-    selected_reads_nb = -1
+    # Krona visualization
+    fp.krona_text_filepath = '%s.krona.tab' % os.path.splitext(fp.fltr_rdp_classification_filepath)[0]
+    fp.krona_html_filepath = '%s.html' % os.path.splitext(fp.krona_text_filepath)[0]
 
-    if input_fastx_extension in ('.fq', '.fastq'):
-        selected_fastx_line_nb = int(subprocess.check_output('wc -l {0}'.format(sortme_output_fastx_filepath), shell=True, bufsize=0).split()[0])
-        selected_reads_nb = selected_fastx_line_nb // 4
-    elif input_fastx_extension in ('.fa', '.fasta'):
-        selected_reads_nb = int(subprocess.check_output('grep -c "^>" {0}'.format(sortme_output_fastx_filepath), shell=True, bufsize=0))
+    return fp
 
-    logger.info('Identified as marker: {} / {} reads ({:.2f}%)'.format(selected_reads_nb, input_reads_nb, selected_reads_nb*100.0/input_reads_nb))
 
-    # Tag tmp files for removal
-    to_rm_filepath_list.append(sortme_output_basepath + '.log')
-    to_rm_filepath_list.append(sortme_output_basepath + '.blast')
+def grep_assembly_stat(stats_filepath, stat_name):
+    """
+    Retrieve a percentage value from an evaluate_assembly.py stats file
+    """
+    cmd_line = 'grep "{0}" {1}'.format(stat_name, stats_filepath)
+    return float(subprocess.check_output(cmd_line, shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
 
-    if args.filter_only:
-        return error_code
-    #############################
-    # Alignment filtering
 
-    if args.resume_from == 'alignments_filtering':
-        logger.info('Resuming from alignments filtering')
-        run_step = True
+def evaluate_fasta(args, fp, state, fasta_filepath, fasta_basename, key, allow_missing=False):
+    """
+    Evaluate an assembly against the true references, and store the
+    error rates and ref coverage in state[key]
+    """
+    true_ref_filename = os.path.basename(args.true_references)
+    true_ref_basename, true_ref_extension = os.path.splitext(true_ref_filename)
 
-    if run_step:
-        logger.info('=== Alignment filtering ===')
+    runner.check_run([evaluate_assembly_bin, '-r', args.true_references, '-i', fasta_filepath],
+                     verbose=args.verbose)
 
-        cmd_line = 'cat ' + sortme_output_sam_filepath
-        cmd_line += ' | grep -v "^@" | '
-        cmd_line += sort_bin + ' -k 1,1V -k 12,12nr'
-        cmd_line += ' | ' + filter_score_bin + ' -t ' + str(args.score_threshold)
-        if not args.straight_mode:
-            cmd_line += ' --geometric'
-        cmd_line += ' > ' + sam_filt_filepath
+    assembly_stats_filename = fasta_basename + '.exonerate_vs_'
+    assembly_stats_filename += true_ref_basename + '.assembly.stats'
+    assembly_stats_filepath = os.path.join(fp.workdir, assembly_stats_filename)
 
-        # Set t0
-        t0_wall = time.time()
+    try:
+        state[key] = (grep_assembly_stat(assembly_stats_filepath, 'error rate   ='),
+                      grep_assembly_stat(assembly_stats_filepath, 'error rate 2 ='),
+                      grep_assembly_stat(assembly_stats_filepath, 'ref coverage'))
+    except subprocess.CalledProcessError:
+        if not allow_missing:
+            raise
+        state[key] = (float(), float(), float())
+
+
+###################
+# Pipeline stages
+#
+# Each stage is called as stage(args, fp, state, cpu) with the parsed
+# arguments, the files paths namespace, the run state dict (shared by
+# all stages) and the number of cpu granted by the pipeline.
+
+def get_reads_mapping_command(args, fp, reads_filepath, compressed, output_basepath, cpu, evalue=None):
+    """
+    Return the SortMeRNA command mapping the reads against the clustered ref db.
+    The E-value threshold defaults to args.evalue
+    """
+    cmd = [sortmerna_bin, '--ref', fp.clustered_ref_db_filepath + ',' + fp.clustered_ref_db_basepath]
+    if compressed:
+        cmd += ['--reads-gz', reads_filepath]
+    else:
+        cmd += ['--reads', reads_filepath]
+    cmd += ['--aligned', output_basepath]
+    cmd += ['--fastx', '--sam', '--blast', '1', '--log']
+    cmd += ['--best', str(args.best), '--min_lis', str(args.min_lis)]
+    cmd += ['-e', '{0:.2e}'.format(args.evalue if evalue is None else evalue)]
+    cmd += ['-a', str(cpu)]
+    if args.verbose:
+        cmd.append('-v')
+    return cmd
 
-        logger.debug('CMD: {0}'.format(cmd_line))
-        runner.logged_call(cmd_line, verbose=args.verbose)
 
-        # Output running time
-        logger.info('Good alignments filtering completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+def run_reads_mapping(args, fp, state, cpu):
+    """
+    Reads mapping against ref db
+    """
+    logger.info('=== Reads mapping against ref db ===')
 
-        if args.coverage_threshold:
-            cmd_line = 'cat ' + sam_filt_filepath
-            cmd_line += ' | ' + sort_bin + ' -k 3,3 -k 4,4n'
-            cmd_line += ' | ' + sample_sam_cov_bin + ' -c ' + str(args.coverage_threshold)
-            cmd_line += ' -r ' + clustered_ref_db_filepath
-            cmd_line += ' | ' + sort_bin + ' -k 1,1V -k 12,12nr'
-            cmd_line += ' > ' + sam_cov_filt_filepath
+    if fp.sortme_reads_filepath != fp.input_fastx_filepath:
+        recompress_to_gzip(fp.input_fastx_filepath, fp.input_fastx_compression,
+                           fp.sortme_reads_filepath, cpu)
+        state['to_rm_filepath_list'].append(fp.sortme_reads_filepath)
 
-            # Set t0
-            t0_wall = time.time()
+    cmd = get_reads_mapping_command(args, fp, fp.sortme_reads_filepath,
+                                    fp.input_fastx_compression is not None,
+                                    fp.sortme_output_basepath, cpu)
 
-            runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Set t0
+    t0_wall = time.time()
 
-            # Output running time
-            logger.info('Ref coverage filtering completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+    runner.check_run(cmd, verbose=args.verbose)
 
-    # Tag tmp files for removal
-    if args.coverage_threshold:
-        to_rm_filepath_list.append(sam_filt_filepath)
+    # SortMeRNA names its fastx output after the extension of the reads
+    # file, ie. .gz for compressed reads. Its content is not compressed
+    sortme_fastx_filepath = fp.sortme_output_basepath + os.path.splitext(fp.sortme_reads_filepath)[1]
+    if sortme_fastx_filepath != fp.sortme_output_fastx_filepath and os.path.exists(sortme_fastx_filepath):
+        os.replace(sortme_fastx_filepath, fp.sortme_output_fastx_filepath)
 
-    #########################
-    # Overlap-graph building
+    # Output running time
+    logger.info('Reads mapping completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-    if args.resume_from == 'overlap_graph_building':
-        logger.info('Resuming from overlap-graph building')
-        run_step = True
 
-    ovgraph_nodes_nb = -1
-    ovgraph_edges_nb = -1
+def recompress_to_gzip(in_filepath, compression, out_filepath, cpu):
+    """
+    Recompress a bzip2 or zstd file to gzip through a pipe,
+    using parallel (de)compressors when available
+    """
+    decompress_cmd = decompression_command(compression, cpu)
+    if decompress_cmd is None:
+        logger.fatal('No decompressor found for {0} file {1}'.format(compression, in_filepath))
+        sys.exit('Cannot read the input reads file')
+
+    pigz_bin = Binary.which('pigz')
+    if pigz_bin:
+        compress_cmd = [pigz_bin, '-1', '-c', '-p', str(cpu)]
+    else:
+        compress_cmd = [Binary.assert_which('gzip'), '-1', '-c']
 
-    if run_step:
-        logger.info('=== Overlap-graph building ===')
+    logger.info('Recompressing {0} input file to gzip'.format(compression))
 
-        cmd_line = ovgraphbuild_bin
-        cmd_line += ' -i ' + str(args.min_identity)
-        cmd_line += ' -m ' + str(args.min_overlap_length)
-        if args.debug:
-            cmd_line += ' --asqg'
-        cmd_line += ' --csv --output_basename '
-        cmd_line += ovgraphbuild_basepath
-        cmd_line += ' -r ' + clustered_ref_db_filepath
-        cmd_line += ' -s ' + sam_cov_filt_filepath
-        if args.verbose:
-            cmd_line += ' -v'
-        if args.debug:
-            cmd_line += ' --debug'
+    # Both processes are connected by a pipe, nothing is written
+    # uncompressed on disk
+    result = runner.run([decompress_cmd + [in_filepath], compress_cmd], stdout=out_filepath)
 
-        # Set t0
-        t0_wall = time.time()
+    if result.returncode:
+        logger.fatal('Recompression of {0} failed'.format(in_filepath))
+        sys.exit('Cannot read the input reads file')
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
 
-        # Output running time
-        logger.info('Overlap-graph building completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+def count_reads(fastx_filepath, fastx_format):
+    """
+    Count the reads of a fasta or fastq file with a single buffered scan.
+    Return -1 if the file format is not recognised
+    """
+    if fastx_format == 'fastq':
+        return counting.count_fastq_records(fastx_filepath)
+    elif fastx_format == 'fasta':
+        return counting.count_fasta_records(fastx_filepath)
+    logger.warning('Input fastx file format was not recognised ({0})'.format(fastx_filepath))
+    return -1
 
-        # Tag tmp files for removal
-        to_rm_filepath_list.append(ovgraphbuild_asqg_filepath)
 
-    # Get overlap graph stats
-    ovgraph_nodes_nb = int(subprocess.check_output('wc -l {0}'.format(ovgraphbuild_nodes_csv_filepath), shell=True, bufsize=0).split()[0]) - 1
-    ovgraph_edges_nb = int(subprocess.check_output('wc -l {0}'.format(ovgraphbuild_edges_csv_filepath), shell=True, bufsize=0).split()[0]) - 1
+def compute_reads_mapping_stats(args, fp, state, cpu):
+    """
+    Get input and selected reads numbers.
+    They are read from the SortMeRNA log, which SortMeRNA fills while
+    reading the input. The fastx files are only scanned when the log
+    is not available (eg. removed tmp file when resuming a run)
+    """
+    input_reads_nb, selected_reads_nb = -1, -1
+
+    log_filepath = fp.sortme_output_log_filepath
+    if (os.path.exists(log_filepath) and os.path.exists(fp.sortme_output_fastx_filepath)
+            and os.path.getmtime(log_filepath) >= os.path.getmtime(fp.sortme_output_fastx_filepath)):
+        total_reads_nb, passing_reads_nb = counting.read_sortmerna_log(log_filepath)
+        if total_reads_nb is not None and passing_reads_nb is not None:
+            input_reads_nb, selected_reads_nb = total_reads_nb, passing_reads_nb
+
+    if selected_reads_nb < 0:
+        logger.debug('Counting reads from the fastx files')
+        # Input reads are only counted when starting from reads mapping
+        if args.resume_from in (None, 'reads_mapping'):
+            input_reads_nb = count_reads(fp.input_fastx_filepath, fp.input_fastx_format)
+        selected_reads_nb = count_reads(fp.sortme_output_fastx_filepath, fp.input_fastx_format)
+
+    logger.info('=== Input ===')
+    logger.info('Input file: {}'.format(fp.input_fastx_filepath))
+    logger.info('Input file reads nb: {} reads'.format(input_reads_nb))
+
+    if input_reads_nb > 0:
+        logger.info('Identified as marker: {} / {} reads ({:.2f}%)'.format(selected_reads_nb, input_reads_nb, selected_reads_nb*100.0/input_reads_nb))
+    else:
+        logger.info('Identified as marker: {} reads'.format(selected_reads_nb))
 
-    logger.info('Overlap graph stats: {} nodes, {} edges'.format(ovgraph_nodes_nb, ovgraph_edges_nb))
+    state['input_reads_nb'] = input_reads_nb
+    state['selected_reads_nb'] = selected_reads_nb
 
-    ###############################################
-    # Graph compaction & Components identification
 
-    if args.resume_from == 'graph_compaction':
-        logger.info('Resuming from graph compaction & components identification')
-        run_step = True
+def run_alignments_filtering(args, fp, state, cpu):
+    """
+    Alignment filtering and poorly covered references filtering
+    """
+    logger.info('=== Alignment filtering ===')
+
+    # Set t0
+    t0_wall = time.time()
+
+    # The SortMeRNA alignments are parsed once into a columnar store,
+    # both filters work on its key columns. The alignment records are
+    # only stored to be written as BAM
+    alignments_nb = sam_to_store(fp.sortme_output_sam_filepath, fp.alignment_store_filepath,
+                                 records=args.bam_alignments)
+    state['to_rm_filepath_list'].append(fp.alignment_store_filepath)
+    logger.debug('{0} alignments parsed in {1:.4f} seconds wall time'.format(alignments_nb, time.time() - t0_wall))
+
+    with AlignmentStore(fp.alignment_store_filepath) as store:
+        scores = store.column('score')
+        if (scores == MISSING_SCORE).any():
+            logger.fatal('Alignment without AS tag in {0}'.format(fp.sortme_output_sam_filepath))
+            sys.exit('Missing alignment score')
+
+        # SortMeRNA outputs the alignments grouped by read. Kept
+        # alignments are ordered by read and by decreasing score
+        kept = filter_scores(store.column('read_index'), scores,
+                             args.score_threshold, geometric=not args.straight_mode)
+        # Kept lines are copied from the SortMeRNA output
+        store.write_sam(fp.sam_filt_filepath, kept, source=fp.sortme_output_sam_filepath)
 
-    if run_step:
-        logger.info('=== Graph compaction & Components identification ===')
+        # Output running time
+        elapsed = time.time() - t0_wall
+        logger.info('Good alignments filtering completed in {0:.4f} seconds wall time'.format(elapsed))
+        logger.debug('{0} / {1} alignments kept ({2:.0f} alignments/s)'.format(
+            len(kept), alignments_nb, alignments_nb / max(elapsed, 1e-6)))
+
+        if args.coverage_threshold or args.bam_alignments:
+            ref_lengths = read_ref_lengths(fp.clustered_ref_db_filepath)
+        sampled = kept
+        if args.coverage_threshold:
+            # Set t0
+            t0_wall = time.time()
 
-        cmd_line = componentsearch_bin
-        if args.optimize_components:
-            cmd_line += ' -o'
-        if args.seed:
-            cmd_line += ' -r ' + str(args.seed)
-        cmd_line += ' -N ' + str(args.min_read_node)
-        cmd_line += ' -E ' + str(args.min_overlap_edge)
-        cmd_line += ' -b ' + componentsearch_basepath
-        cmd_line += ' -n ' + ovgraphbuild_nodes_csv_filepath
-        cmd_line += ' -e ' + ovgraphbuild_edges_csv_filepath
+            sampled = kept[sample_alignments(
+                store.column('ref_index')[kept], store.column('pos')[kept], store.column('ref_span')[kept],
+                store.ref_names, ref_lengths, args.coverage_threshold, seed=args.seed, cpu=cpu)]
+            if not args.bam_alignments:
+                store.write_sam(fp.sam_cov_filt_filepath, sampled, source=fp.sortme_output_sam_filepath)
 
-        # Set t0
-        t0_wall = time.time()
+            # Output running time
+            elapsed = time.time() - t0_wall
+            logger.info('Ref coverage filtering completed in {0:.4f} seconds wall time'.format(elapsed))
+            logger.debug('{0} / {1} alignments kept ({2:.0f} alignments/s)'.format(
+                len(sampled), len(kept), len(kept) / max(elapsed, 1e-6)))
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+        if args.bam_alignments:
+            # Set t0
+            t0_wall = time.time()
 
-        # Output running time
-        logger.info('Graph compaction & Components identification completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+            # The BAM file is read once by ovgraphbuild: the fastest
+            # compression level is enough. The references are the ones
+            # of the clustered database, in its order
+            store.write_bam(fp.sam_cov_filt_filepath, sampled, references=list(ref_lengths.items()),
+                            level=1, threads=cpu)
 
-        # Tag tmp files for removal
-        #to_rm_filepath_list.append(ovgraphbuild_nodes_csv_filepath)
-        #to_rm_filepath_list.append(ovgraphbuild_edges_csv_filepath)
+            # Output running time
+            logger.info('BAM writing completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-    # Get compressed graph stats
-    compressed_graph_nodes_nb = int(subprocess.check_output('wc -l {0}'.format(componentsearch_metanodes_csv_filepath), shell=True, bufsize=0).split()[0]) - 1
-    compressed_graph_edges_nb = int(subprocess.check_output('wc -l {0}'.format(componentsearch_metaedges_csv_filepath), shell=True, bufsize=0).split()[0]) - 1
-    compressed_graph_reads_nb = int(subprocess.check_output('cut -d ";" -f5 {0} | awk "\$1!=-1" | wc -l'.format(componentsearch_components_csv_filepath), shell=True, bufsize=0).split()[0]) - 1
-    compressed_graph_excluded_reads_nb = ovgraph_nodes_nb - compressed_graph_reads_nb
-    excluded_reads_percent = compressed_graph_excluded_reads_nb * 100.0 / ovgraph_nodes_nb
-    components_nb = int(subprocess.check_output('cut -d ";" -f5 {0} | {1} | uniq | wc -l'.format(componentsearch_components_csv_filepath, sort_bin), shell=True).split()[0]) - 1
 
-    logger.info('Compressed graph: {} components'.format(components_nb))
+def run_overlap_graph_building(args, fp, state, cpu):
+    """
+    Overlap-graph building
+    """
+    logger.info('=== Overlap-graph building ===')
 
-    ################
-    # LCA labelling
+    cmd = [ovgraphbuild_bin]
+    cmd += ['-i', str(args.min_identity)]
+    cmd += ['-m', str(args.min_overlap_length)]
+    if args.debug:
+        cmd.append('--asqg')
+    cmd += ['--csv', '--output_basename', fp.ovgraphbuild_basepath]
+    cmd += ['-r', fp.clustered_ref_db_filepath]
+    cmd += ['-s', fp.sam_cov_filt_filepath]
+    if args.verbose:
+        cmd.append('-v')
+    if args.debug:
+        cmd.append('--debug')
 
-    if run_step:
-        logger.info('=== LCA labelling ===')
+    # Set t0
+    t0_wall = time.time()
 
-        # Set t0
-        t0_wall = time.time()
+    runner.check_run(cmd, verbose=args.verbose)
 
-        # Get read, metanode and component from the components file
-        cmd_line = 'tail -n +2 ' + componentsearch_components_csv_filepath
-        cmd_line += ' | sed "s/;/\\t/g" | cut -f2,4,5 | awk "\$3>=0" '
-        cmd_line += ' | ' + sort_bin + ' -k1,1 > '
-        cmd_line += read_metanode_component_filepath
+    # Output running time
+    logger.info('Overlap-graph building completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
+    # Tag tmp files for removal
+    state['to_rm_filepath_list'].append(fp.ovgraphbuild_asqg_filepath)
 
-        error_code += runner.logged_call(cmd_line, verbose=args.verbose)
 
-        # Join sam file with ref taxo on ref name, and join it to the
-        # component-node file on read name.
-        # Output is (read, metanode, component, taxo) file
-        cmd_line = 'cat ' + sam_filt_filepath + ' | cut -f1,3 | ' + sort_bin + ' -k2,2'
-        cmd_line += ' | join -12 -21 - ' + complete_ref_db_taxo_filepath
-        cmd_line += ' | ' + sort_bin + ' -k2,2 | awk "{print \$2,\$3}" | sed "s/ /\\t/g" '
-        cmd_line += ' | join -11 -21 ' + read_metanode_component_filepath
-        cmd_line += ' - | sed "s/ /\\t/g" > '
-        cmd_line += complete_taxo_filepath
+def compute_overlap_graph_stats(args, fp, state, cpu):
+    """
+    Get overlap graph stats
+    """
+    ovgraph_nodes_nb = counting.count_csv_rows(fp.ovgraphbuild_nodes_csv_filepath)
+    ovgraph_edges_nb = counting.count_csv_rows(fp.ovgraphbuild_edges_csv_filepath)
 
+    logger.info('Overlap graph stats: {} nodes, {} edges'.format(ovgraph_nodes_nb, ovgraph_edges_nb))
 
-        error_code += runner.logged_call(cmd_line, verbose=args.verbose)
+    state['ovgraph_nodes_nb'] = ovgraph_nodes_nb
+    state['ovgraph_edges_nb'] = ovgraph_edges_nb
 
-        # Compute LCA at component level using quorum threshold
-        cmd_line = 'cat ' + complete_taxo_filepath + ' | ' + sort_bin + ' -k3,3 -k1,1 | '
-        cmd_line += compute_lca_bin + ' -t 4 -f 3 -g 1 -m ' + str(args.quorum)
-        cmd_line += ' -o ' + components_lca_filepath
 
-        error_code += runner.logged_call(cmd_line, verbose=args.verbose)
+def run_graph_compaction(args, fp, state, cpu):
+    """
+    Graph compaction & Components identification
+    """
+    logger.info('=== Graph compaction & Components identification ===')
 
-        # Output running time
-        logger.info('LCA labelling completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+    cmd = [componentsearch_bin]
+    if args.optimize_components:
+        cmd.append('-o')
+    if args.seed:
+        cmd += ['-r', str(args.seed)]
+    cmd += ['-N', str(args.min_read_node)]
+    cmd += ['-E', str(args.min_overlap_edge)]
+    cmd += ['-b', fp.componentsearch_basepath]
+    cmd += ['-n', fp.ovgraphbuild_nodes_csv_filepath]
+    cmd += ['-e', fp.ovgraphbuild_edges_csv_filepath]
 
-        # Tag tmp files for removal
-        to_rm_filepath_list.append(componentsearch_basepath + '.components.tab')
-        to_rm_filepath_list.append(complete_taxo_filepath)
+    # Set t0
+    t0_wall = time.time()
 
-    # ###################################
-    # # Computing compressed graph stats
+    runner.check_run(cmd, verbose=args.verbose)
 
-    # if run_step:
-    #     logger.info('=== Computing compressed graph stats ===')
+    # Output running time
+    logger.info('Graph compaction & Components identification completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-    #     cmd_line = compute_compressed_graph_stats_bin + ' --nodes_contracted '
-    #     cmd_line += contracted_nodes_filepath + ' --edges_contracted '
-    #     cmd_line += contracted_edges_filepath + ' --components_lca '
-    #     cmd_line += components_lca_filepath
-    #     if args.true_ref_taxo:
-    #         cmd_line += ' --species_taxo ' + args.true_ref_taxo
-    #         cmd_line += ' --read_node_component ' + read_id_metanode_component_filepath
-    #     cmd_line += ' -o ' + stats_filepath
 
-    #     # Set t0
-    #     t0_wall = time.time()
+def compute_compressed_graph_stats(args, fp, state, cpu):
+    """
+    Get compressed graph stats
+    """
+    compressed_graph_nodes_nb = counting.count_csv_rows(fp.componentsearch_metanodes_csv_filepath)
+    compressed_graph_edges_nb = counting.count_csv_rows(fp.componentsearch_metaedges_csv_filepath)
+    # Reads and components are counted in a single scan of the components file
+    compressed_graph_reads_nb, components_nb = counting.count_components(fp.componentsearch_components_csv_filepath)
+    compressed_graph_excluded_reads_nb = state['ovgraph_nodes_nb'] - compressed_graph_reads_nb
+    excluded_reads_percent = 0.0
+    if state['ovgraph_nodes_nb'] > 0:
+        excluded_reads_percent = compressed_graph_excluded_reads_nb * 100.0 / state['ovgraph_nodes_nb']
 
-    #     logger.debug('CMD: {0}'.format(cmd_line))
-    #     error_code += subprocess.call(cmd_line, shell=True, bufsize=0)
+    logger.info('Compressed graph: {} components'.format(components_nb))
 
-    #     # Output running time
-    #     logger.info('Computing compressed graph stats completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
-    #     if args.verbose:
-    #         sys.stderr.write('\n')
+    state['compressed_graph_nodes_nb'] = compressed_graph_nodes_nb
+    state['compressed_graph_edges_nb'] = compressed_graph_edges_nb
+    state['compressed_graph_reads_nb'] = compressed_graph_reads_nb
+    state['compressed_graph_excluded_reads_nb'] = compressed_graph_excluded_reads_nb
+    state['excluded_reads_percent'] = excluded_reads_percent
+    state['components_nb'] = components_nb
 
-    ###################
-    # Contigs assembly
 
-    if args.resume_from == 'contigs_assembly':
-        logger.info('Resuming from contigs assembly')
-        run_step = True
+def run_read_component_extraction(args, fp, state, cpu):
+    """
+    Get read, metanode and component from the components file.
+    This is the first part of the LCA labelling, also needed by the
+    contigs assembly
+    """
+    logger.info('=== LCA labelling ===')
 
-    if run_step:
-        logger.info('=== Contigs assembly ===')
+    components_assembly.write_read_component_map(fp.componentsearch_components_csv_filepath,
+                                                 fp.read_metanode_component_filepath)
 
-        # Set t0
-        t0_wall = time.time()
 
-        components_assembly.assemble_all_components(args.assembler,
-                                                    sortme_output_fastx_filepath, read_metanode_component_filepath, components_lca_filepath,
-                                                    contigs_filepath, contigs_assembly_wkdir,
-                                                    args.cpu, args.read_correction, args.contig_coverage_threshold)
+def get_taxonomy_index(fp, state):
+    """
+    Return the taxonomy index of the complete ref db. Ref dbs
+    preprocessed without it (or modified since) get a temporary one
+    """
+    if os.path.isfile(fp.complete_ref_db_taxo_index_filepath):
+        taxo_index = TaxonomyIndex(fp.complete_ref_db_taxo_index_filepath)
+        if taxo_index.is_built_from(fp.complete_ref_db_taxo_filepath):
+            return taxo_index
+        taxo_index.close()
+        logger.warning('Outdated taxonomy index: {0}'.format(fp.complete_ref_db_taxo_index_filepath))
 
-        if not args.keep_tmp:
-            shutil.rmtree(contigs_assembly_wkdir)
+    logger.debug('Indexing taxonomies from {0}'.format(fp.complete_ref_db_taxo_filepath))
+    write_taxonomy_index(fp.complete_ref_db_taxo_filepath, fp.taxo_index_filepath)
+    state['to_rm_filepath_list'].append(fp.taxo_index_filepath)
+    return TaxonomyIndex(fp.taxo_index_filepath)
 
-        # Create symbolic link
-        if os.path.exists(contigs_symlink_filepath):
-            os.remove(contigs_symlink_filepath)
-        os.symlink(os.path.basename(contigs_filepath), contigs_symlink_filepath)
 
-        # TO DO, if it gets better results:
-        # remove redundant sequences in contigs
+def run_lca_labelling(args, fp, state, cpu):
+    """
+    LCA labelling of the components
+    """
+    # Set t0
+    t0_wall = time.time()
 
-        # Remove redundant contigs
-        cmd_line = remove_redundant_bin + ' -i ' + contigs_symlink_filepath
-        cmd_line += ' -o ' + contigs_NR_filepath
+    taxo_index = get_taxonomy_index(fp, state)
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Join the sam file with the ref taxo on ref name, and with the
+    # read-metanode-component file on read name, using in memory
+    # hash joins. Output is component --> reads taxon ids lists
+    components_taxo_dict = read_components_taxo(fp.sam_filt_filepath, taxo_index,
+                                                fp.read_metanode_component_filepath)
 
-        # Filter out small contigs
-        cmd_line = fasta_length_filter_bin + ' -m ' + str(args.min_scaffold_length)
-        cmd_line += ' -i ' + contigs_NR_filepath
-        cmd_line += ' -o ' + large_NR_contigs_filepath
+    # Compute LCA at component level using quorum threshold
+    with open(fp.components_lca_filepath, 'w') as components_lca_fh:
+        write_lca_tab(components_taxo_dict, args.quorum, components_lca_fh, taxonomy=taxo_index)
+    taxo_index.close()
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Output running time
+    logger.info('LCA labelling completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-        # Output running time
-        logger.info('Contigs assembly completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+    # Tag tmp files for removal
+    state['to_rm_filepath_list'].append(fp.componentsearch_basepath + '.components.tab')
 
-        # Evaluate assembly if true ref are provided
-        if args.true_references:
 
-            true_ref_filename = os.path.basename(args.true_references)
-            true_ref_basename, true_ref_extension = os.path.splitext(true_ref_filename)
+def run_components_assembly(args, fp, state, cpu):
+    """
+    Assemble each component. The contigs are tagged with their component
+    LCA by run_contigs_pooling once the LCA labelling is done
+    """
+    logger.info('=== Contigs assembly ===')
 
-            # Evaluate all contigs
-            cmd_line = evaluate_assembly_bin + ' -r ' + args.true_references
-            cmd_line += ' -i ' + contigs_symlink_filepath
+    # Set t0
+    t0_wall = time.time()
 
-            runner.logged_check_call(cmd_line, verbose=args.verbose)
+    components_assembly.assemble_components(args.assembler,
+                                            fp.sortme_output_fastx_filepath, fp.read_metanode_component_filepath,
+                                            fp.untagged_contigs_filepath, fp.contigs_assembly_wkdir,
+                                            cpu, args.read_correction, args.contig_coverage_threshold,
+                                            small_component_nt=args.small_component_nt)
 
-            contigs_assembly_stats_filename = contigs_symlink_basename + '.exonerate_vs_'
-            contigs_assembly_stats_filename += true_ref_basename + '.assembly.stats'
-            contigs_assembly_stats_filepath = os.path.join(workdir, contigs_assembly_stats_filename)
+    if not args.keep_tmp:
+        shutil.rmtree(fp.contigs_assembly_wkdir)
 
-            contigs_error_rate = float(subprocess.check_output('grep "error rate   =" {0}'.format(contigs_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-            contigs_error_rate_2 = float(subprocess.check_output('grep "error rate 2 =" {0}'.format(contigs_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-            contigs_ref_coverage = float(subprocess.check_output('grep "ref coverage" {0}'.format(contigs_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
+    # Output running time
+    logger.info('Components assembly completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-            # Evaluate large NR contigs
-            cmd_line = evaluate_assembly_bin + ' -r ' + args.true_references
-            cmd_line += ' -i ' + large_NR_contigs_filepath
 
-            runner.logged_check_call(cmd_line, verbose=args.verbose)
+def run_contigs_pooling(args, fp, state, cpu):
+    """
+    Pool the components contigs with their LCA, remove redundant and
+    small contigs, and evaluate the assembly if true ref are provided
+    """
+    # Set t0
+    t0_wall = time.time()
 
-            large_NR_contigs_assembly_stats_filename = large_NR_contigs_basename + '.exonerate_vs_'
-            large_NR_contigs_assembly_stats_filename += true_ref_basename + '.assembly.stats'
-            large_NR_contigs_assembly_stats_filepath = os.path.join(workdir, large_NR_contigs_assembly_stats_filename)
+    components_assembly.tag_contigs_with_lca(fp.untagged_contigs_filepath,
+                                             fp.components_lca_filepath,
+                                             fp.contigs_filepath)
 
-            try:
-                large_NR_contigs_error_rate = float(subprocess.check_output('grep "error rate   =" {0}'.format(large_NR_contigs_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-                large_NR_contigs_error_rate_2 = float(subprocess.check_output('grep "error rate 2 =" {0}'.format(large_NR_contigs_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-                large_NR_contigs_ref_coverage = float(subprocess.check_output('grep "ref coverage" {0}'.format(large_NR_contigs_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-            except subprocess.CalledProcessError:
-                large_NR_contigs_error_rate = float()
-                large_NR_contigs_error_rate_2 = float()
-                large_NR_contigs_ref_coverage = float()
+    # Create symbolic link
+    if os.path.exists(fp.contigs_symlink_filepath):
+        os.remove(fp.contigs_symlink_filepath)
+    os.symlink(os.path.basename(fp.contigs_filepath), fp.contigs_symlink_filepath)
 
-        # Tag tmp files for removal
-        to_rm_filepath_list.append(read_metanode_component_filepath)
-        to_rm_filepath_list.append(contigs_NR_filepath)
+    # TO DO, if it gets better results:
+    # remove redundant sequences in contigs
 
-    # Compute contigs assembly stats
-    contigs_stats = compute_fasta_stats(contigs_filepath)
-    large_NR_contigs_stats = compute_fasta_stats(large_NR_contigs_filepath)
+    # Remove redundant contigs
+    runner.check_run([remove_redundant_bin, '-i', fp.contigs_symlink_filepath,
+                      '-o', fp.contigs_NR_filepath], verbose=args.verbose)
 
-    ##############
-    # Scaffolding
+    # Filter out small contigs
+    runner.check_run([fasta_length_filter_bin, '-m', str(args.min_scaffold_length),
+                      '-i', fp.contigs_NR_filepath, '-o', fp.large_NR_contigs_filepath],
+                     verbose=args.verbose)
 
-    if args.resume_from == 'scaffolding':
-        logger.info('Resuming from scaffolding')
-        run_step = True
-
-    if run_step:
-        logger.info('=== Scaffolding ===')
-
-        # Set t0
-        t0_wall = time.time()
-
-        # Contigs remapping on the complete database
-        scaff_evalue = 1e-05
-
-        cmd_line = sortmerna_bin
-        cmd_line += ' --ref ' + complete_ref_db_filepath + ',' + complete_ref_db_basepath
-        cmd_line += ' --reads ' + contigs_filepath
-        cmd_line += ' --aligned ' + scaff_sortme_output_basepath
-        cmd_line += ' --sam --blast "1"'
-        cmd_line += ' --num_alignments 0 '
-        #cmd_line += ' --num_seeds 3 '
-        #cmd_line += ' --best 0 --min_lis 10 '
-        cmd_line += ' -e {0:.2e}'.format(scaff_evalue)
-        cmd_line += ' -a ' + str(args.cpu)
-        if args.verbose:
-            cmd_line += ' -v '
+    # Output running time
+    logger.info('Contigs pooling completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Evaluate assembly if true ref are provided
+    if args.true_references:
+        # Evaluate all contigs
+        evaluate_fasta(args, fp, state, fp.contigs_symlink_filepath, fp.contigs_symlink_basename,
+                       'contigs_evaluation')
+        # Evaluate large NR contigs
+        evaluate_fasta(args, fp, state, fp.large_NR_contigs_filepath, fp.large_NR_contigs_basename,
+                       'large_NR_contigs_evaluation', allow_missing=True)
 
-        # Output running time
-        logger.info('Contig mapping completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+    # Tag tmp files for removal
+    state['to_rm_filepath_list'].append(fp.read_metanode_component_filepath)
+    state['to_rm_filepath_list'].append(fp.contigs_NR_filepath)
 
-        # Set t0
-        t0_wall = time.time()
 
-        # Keep only quasi-equivalent best matches for each contig
-        # -p 0.99 is used because of the tendency of SortMeRNA to soft-clip
-        # a few nucleotides at 5’ and 3’ ends
-        cmd_line = sort_bin + ' -k1,1V -k12,12nr ' + scaff_sortme_output_blast_filepath
-        cmd_line += ' | ' + get_best_matches_bin + ' -p 0.99 -o ' + best_only_blast_filepath
+def compute_contigs_stats(args, fp, state, cpu):
+    """
+    Compute contigs assembly stats
+    """
+    state['contigs_stats'] = compute_fasta_stats(fp.contigs_filepath)
+    state['large_NR_contigs_stats'] = compute_fasta_stats(fp.large_NR_contigs_filepath)
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
 
-        # Select blast matches for scaffolding using a specific-first conserved-later approach
-        cmd_line = gener_scaff_blast_bin + ' -i ' + best_only_blast_filepath
-        cmd_line += ' -o ' + selected_best_only_blast_filepath
+def run_scaffolding(args, fp, state, cpu):
+    """
+    Scaffolding of the contigs
+    """
+    logger.info('=== Scaffolding ===')
+
+    sort_cmd = get_sort_command(fp.workdir, args.max_memory, cpu)
+
+    # Set t0
+    t0_wall = time.time()
+
+    # Contigs remapping on the complete database
+    scaff_evalue = 1e-05
+
+    cmd = [sortmerna_bin]
+    cmd += ['--ref', fp.complete_ref_db_filepath + ',' + fp.complete_ref_db_basepath]
+    cmd += ['--reads', fp.contigs_filepath]
+    cmd += ['--aligned', fp.scaff_sortme_output_basepath]
+    cmd += ['--sam', '--blast', '1']
+    cmd += ['--num_alignments', '0']
+    #cmd += ['--num_seeds', '3']
+    #cmd += ['--best', '0', '--min_lis', '10']
+    cmd += ['-e', '{0:.2e}'.format(scaff_evalue)]
+    cmd += ['-a', str(cpu)]
+    if args.verbose:
+        cmd.append('-v')
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    runner.check_run(cmd, verbose=args.verbose)
 
-        # Filter sam file based on blast scaffolding file
-        cmd_line = filter_sam_blast_bin + ' -i ' + scaff_sortme_output_sam_filepath
-        cmd_line += ' -b ' +  selected_best_only_blast_filepath
-        cmd_line += ' | ' + sort_bin + ' -k3,3 -k4,4n > ' + selected_sam_filepath
+    # Output running time
+    logger.info('Contig mapping completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Set t0
+    t0_wall = time.time()
 
-        # Bin compatible contigs matching on the same reference
-        if args.contigs_binning:
-            cmd_line = compute_contigs_compatibility_bin
-            cmd_line += ' -i ' + selected_sam_filepath
-            cmd_line += ' | ' + sort_bin + ' -k1,1n > ' + binned_sam_filepath
+    # Keep only quasi-equivalent best matches for each contig
+    # -p 0.99 is used because of the tendency of SortMeRNA to soft-clip
+    # a few nucleotides at 5’ and 3’ ends
+    runner.check_run([sort_cmd + ['-k1,1V', '-k12,12nr', fp.scaff_sortme_output_blast_filepath],
+                      [get_best_matches_bin, '-p', '0.99', '-o', fp.best_only_blast_filepath]],
+                     verbose=args.verbose)
 
-            runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Select blast matches for scaffolding using a specific-first conserved-later approach
+    runner.check_run([gener_scaff_blast_bin, '-i', fp.best_only_blast_filepath,
+                      '-o', fp.selected_best_only_blast_filepath], verbose=args.verbose)
 
-        # Convert sam to bam
-        cmd_line = 'samtools view -b -S ' + processed_sam_filepath
-        if not args.contigs_binning:
-            cmd_line += ' -T ' + complete_ref_db_filepath
-        cmd_line += ' -o ' + bam_filepath
+    # Filter sam file based on blast scaffolding file
+    runner.check_run([[filter_sam_blast_bin, '-i', fp.scaff_sortme_output_sam_filepath,
+                       '-b', fp.selected_best_only_blast_filepath],
+                      sort_cmd + ['-k3,3', '-k4,4n']],
+                     stdout=fp.selected_sam_filepath, verbose=args.verbose)
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Bin compatible contigs matching on the same reference
+    if args.contigs_binning:
+        runner.check_run([[compute_contigs_compatibility_bin, '-i', fp.selected_sam_filepath],
+                          sort_cmd + ['-k1,1n']],
+                         stdout=fp.binned_sam_filepath, verbose=args.verbose)
 
-        # Sort bam
-        cmd_line = 'samtools sort -o ' + sorted_bam_filepath + ' ' + bam_filepath
+    # Convert sam to bam
+    cmd = ['samtools', 'view', '-b', '-S', fp.processed_sam_filepath]
+    if not args.contigs_binning:
+        cmd += ['-T', fp.complete_ref_db_filepath]
+    cmd += ['-o', fp.bam_filepath]
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    runner.check_run(cmd, verbose=args.verbose)
 
-        # Generate mpileup
-        cmd_line = 'samtools mpileup -d 10000 -o ' + mpileup_filepath
-        cmd_line += ' ' + sorted_bam_filepath
+    # Sort bam
+    runner.check_run(['samtools', 'sort', '-o', fp.sorted_bam_filepath, fp.bam_filepath],
+                     verbose=args.verbose)
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Generate mpileup
+    runner.check_run(['samtools', 'mpileup', '-d', '10000', '-o', fp.mpileup_filepath,
+                      fp.sorted_bam_filepath], verbose=args.verbose)
 
-        # Scaffold contigs based on mpileup
-        cmd_line = scaffold_contigs_bin + ' -i ' + mpileup_filepath
-        cmd_line += ' -o ' + scaffolds_filepath
+    # Scaffold contigs based on mpileup
+    runner.check_run([scaffold_contigs_bin, '-i', fp.mpileup_filepath, '-o', fp.scaffolds_filepath],
+                     verbose=args.verbose)
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Create symbolic link
+    if os.path.exists(fp.scaffolds_symlink_filepath):
+        os.remove(fp.scaffolds_symlink_filepath)
+    os.symlink(os.path.basename(fp.scaffolds_filepath), fp.scaffolds_symlink_filepath)
 
-        # Create symbolic link
-        if os.path.exists(scaffolds_symlink_filepath):
-            os.remove(scaffolds_symlink_filepath)
-        os.symlink(os.path.basename(scaffolds_filepath), scaffolds_symlink_filepath)
+    # Remove redundant scaffolds
+    runner.check_run([remove_redundant_bin, '-i', fp.scaffolds_symlink_filepath,
+                      '-o', fp.scaffolds_NR_filepath], verbose=args.verbose)
 
-        # Remove redundant scaffolds
-        cmd_line = remove_redundant_bin + ' -i ' + scaffolds_symlink_filepath
-        cmd_line += ' -o ' + scaffolds_NR_filepath
+    # Filter out small scaffolds
+    runner.check_run([fasta_length_filter_bin, '-m', str(args.min_scaffold_length),
+                      '-i', fp.scaffolds_NR_filepath, '-o', fp.large_NR_scaffolds_filepath],
+                     verbose=args.verbose)
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    # Output running time
+    logger.info('Scaffolding completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-        # Filter out small scaffolds
-        cmd_line = fasta_length_filter_bin + ' -m ' + str(args.min_scaffold_length)
-        cmd_line += ' -i ' + scaffolds_NR_filepath
-        cmd_line += ' -o ' + large_NR_scaffolds_filepath
+    # check that the the resulting file is not empty
+    is_empty = True
+    try:
+        is_empty = os.path.getsize(fp.large_NR_scaffolds_filepath) == 0
+    except OSError:
+        is_empty = True
 
-        runner.logged_check_call(cmd_line, verbose=args.verbose)
+    if is_empty:
+        logger.fatal("Can't proceed all steps (abundance calculation ...) when no scaffolds are available: %s" % fp.large_NR_scaffolds_filepath)
+        sys.exit("Can't proceed further")
 
-        # Output running time
-        logger.info('Scaffolding completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+    # Evaluate assembly if true ref are provided
+    if args.true_references:
+        # Evaluate all scaffolds
+        evaluate_fasta(args, fp, state, fp.scaffolds_symlink_filepath, fp.scaffolds_symlink_basename,
+                       'scaffolds_evaluation')
+        # Evaluate large NR scaffolds
+        evaluate_fasta(args, fp, state, fp.large_NR_scaffolds_filepath, fp.large_NR_scaffolds_basename,
+                       'large_NR_scaffolds_evaluation', allow_missing=True)
 
-        # check that the the resulting file is not empty
-        is_empty = True
-        try:
-            is_empty = os.path.getsize(large_NR_scaffolds_filepath) == 0
-        except OSError:
-            is_empty = True
+    # Tag tmp files for removal
+    state['to_rm_filepath_list'].append(fp.scaff_sortme_output_blast_filepath)
+    state['to_rm_filepath_list'].append(fp.scaff_sortme_output_sam_filepath)
+    state['to_rm_filepath_list'].append(fp.best_only_blast_filepath)
+    state['to_rm_filepath_list'].append(fp.selected_best_only_blast_filepath)
+    state['to_rm_filepath_list'].append(fp.selected_sam_filepath)
+    state['to_rm_filepath_list'].append(fp.binned_sam_filepath)
+    state['to_rm_filepath_list'].append(fp.bam_filepath)
+    state['to_rm_filepath_list'].append(fp.sorted_bam_filepath)
+    state['to_rm_filepath_list'].append(fp.mpileup_filepath)
+    state['to_rm_filepath_list'].append(fp.scaffolds_NR_filepath)
+
+
+def compute_scaffolds_stats(args, fp, state, cpu):
+    """
+    Compute scaffolds assemblies stats
+    """
+    state['scaffolds_stats'] = compute_fasta_stats(fp.scaffolds_filepath)
+    state['large_NR_scaffolds_stats'] = compute_fasta_stats(fp.large_NR_scaffolds_filepath)
 
-        if is_empty:
-            logger.fatal("Can't proceed all steps (abundance calculation ...) when no scaffolds are available: %s" % large_NR_scaffolds_filepath)
-            sys.exit("Can't proceed further")
 
-        # Evaluate assembly if true ref are provided
-        if args.true_references:
+def run_abundance_calculation(args, fp, state, cpu):
+    """
+    Abundance calculation of the large NR scaffolds
+    """
+    logger.info('=== Abundance calculation ===')
+    # Set t0
+    t0_wall = time.time()
+
+    abundance = get_abundance_by_scaffold(indexdb_bin, sortmerna_bin, get_best_matches_bin,
+                                          fp.large_NR_scaffolds_filepath, fp.sortme_output_fastx_filepath,
+                                          args.best, args.min_lis, args.evalue,
+                                          get_abundance_memory(args), cpu,
+                                          output_dir_basepath=fp.workdir,
+                                          verbose=args.verbose,
+                                          keep_tmp=args.keep_tmp
+    )
 
-            true_ref_filename = os.path.basename(args.true_references)
-            true_ref_basename, true_ref_extension = os.path.splitext(true_ref_filename)
-
-            # Evaluate all scaffolds
-            cmd_line = evaluate_assembly_bin + ' -r ' + args.true_references
-            cmd_line += ' -i ' + scaffolds_symlink_filepath
-
-            runner.logged_check_call(cmd_line, verbose=args.verbose)
-
-            scaffolds_assembly_stats_filename = scaffolds_symlink_basename + '.exonerate_vs_'
-            scaffolds_assembly_stats_filename += true_ref_basename + '.assembly.stats'
-            scaffolds_assembly_stats_filepath = os.path.join(workdir, scaffolds_assembly_stats_filename)
-
-            scaffolds_error_rate = float(subprocess.check_output('grep "error rate   =" {0}'.format(scaffolds_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-            scaffolds_error_rate_2 = float(subprocess.check_output('grep "error rate 2 =" {0}'.format(scaffolds_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-            scaffolds_ref_coverage = float(subprocess.check_output('grep "ref coverage" {0}'.format(scaffolds_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-
-            # Evaluate large NR scaffolds
-            cmd_line = evaluate_assembly_bin + ' -r ' + args.true_references
-            cmd_line += ' -i ' + large_NR_scaffolds_filepath
-
-            runner.logged_check_call(cmd_line, verbose=args.verbose)
-
-            large_NR_scaffolds_assembly_stats_filename = large_NR_scaffolds_basename + '.exonerate_vs_'
-            large_NR_scaffolds_assembly_stats_filename += true_ref_basename + '.assembly.stats'
-            large_NR_scaffolds_assembly_stats_filepath = os.path.join(workdir, large_NR_scaffolds_assembly_stats_filename)
-
-            try:
-                large_NR_scaffolds_error_rate = float(subprocess.check_output('grep "error rate   =" {0}'.format(large_NR_scaffolds_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-                large_NR_scaffolds_error_rate_2 = float(subprocess.check_output('grep "error rate 2 =" {0}'.format(large_NR_scaffolds_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-                large_NR_scaffolds_ref_coverage = float(subprocess.check_output('grep "ref coverage" {0}'.format(large_NR_scaffolds_assembly_stats_filepath), shell=True, bufsize=0).decode("utf-8").split('=')[1].strip()[:-1])
-            except subprocess.CalledProcessError:
-                large_NR_scaffolds_error_rate = float()
-                large_NR_scaffolds_error_rate_2 = float()
-                large_NR_scaffolds_ref_coverage = float()
-
-        # Tag tmp files for removal
-        to_rm_filepath_list.append(scaff_sortme_output_blast_filepath)
-        to_rm_filepath_list.append(scaff_sortme_output_sam_filepath)
-        to_rm_filepath_list.append(best_only_blast_filepath)
-        to_rm_filepath_list.append(selected_best_only_blast_filepath)
-        to_rm_filepath_list.append(selected_sam_filepath)
-        to_rm_filepath_list.append(binned_sam_filepath)
-        to_rm_filepath_list.append(bam_filepath)
-        to_rm_filepath_list.append(sorted_bam_filepath)
-        to_rm_filepath_list.append(mpileup_filepath)
-        to_rm_filepath_list.append(scaffolds_NR_filepath)
-
-    # Compute scaffolds assemblies stats
-    scaffolds_stats = compute_fasta_stats(scaffolds_filepath)
-    large_NR_scaffolds_stats = compute_fasta_stats(large_NR_scaffolds_filepath)
-
-    ########################
-    # Abundance calculation
+    complete_fasta_with_abundance(fp.large_NR_scaffolds_filepath, fp.fasta_with_abundance_filepath, abundance)
 
-    scaffolds_fasta = large_NR_scaffolds_filepath
-    reads = sortme_output_fastx_filepath
-    fasta_with_abundance_filepath =  '%s.abd%s' % os.path.splitext(scaffolds_fasta)
-    abundance = None
+    logger.debug('Write abundance informations to: %s' % fp.fasta_with_abundance_filepath)
+    # Output running time
+    logger.info('Abundance calculation completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-    if args.resume_from == 'abundance_calculation':
-        logger.info('Resuming from abundance calculation')
-        run_step = True
+    state['abundance'] = abundance
 
-    if run_step:
 
-        logger.info('=== Abundance calculation ===')
-        # Set t0
-        t0_wall = time.time()
+def run_taxonomic_classification(args, fp, state, cpu):
+    """
+    Taxonomic assignment of the large NR scaffolds with RDP.
+    It does not depend on the abundance, so it can run alongside
+    the abundance calculation
+    """
+    logger.info('=== Taxonomic assignment & Krona visualization ===')
+    # Set t0
+    state['taxonomic_assignment_t0_wall'] = time.time()
 
-        abundance = get_abundance_by_scaffold(indexdb_bin, sortmerna_bin, get_best_matches_bin,
-                                              scaffolds_fasta, reads,
-                                              args.best, args.min_lis, args.evalue,
-                                              args.max_memory, args.cpu,
-                                              output_dir_basepath=workdir,
-                                              verbose=args.verbose,
-                                              keep_tmp=args.keep_tmp
-        )
+    run_rdp_classifier(rdp_exe, fp.large_NR_scaffolds_filepath,
+                       fp.rdp_classification_filepath, gene=args.training_model, cutoff=args.rdp_cutoff)
+    logger.debug('Write taxonomic assignment to: %s' % fp.rdp_classification_filepath)
 
+    # tag results below the confidence cutoff as unclassified
+    filter_rdp_file(fp.rdp_classification_filepath, fp.fltr_rdp_classification_filepath, cutoff=args.rdp_cutoff)
 
-        complete_fasta_with_abundance(scaffolds_fasta, fasta_with_abundance_filepath, abundance)
+    force_symlink(
+        os.path.relpath(fp.fltr_rdp_classification_filepath, start=args.out_dir),
+        fp.final_rdp_tab_symlink_filepath,
+    )
 
-        logger.debug('Write abundance informations to: %s' % fasta_with_abundance_filepath)
-        # Output running time
-        logger.info('Abundance calculation completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
 
-    #################################
-    # taxonomic assignment with rdp
-    if args.resume_from == 'taxonomic_assignment':
-        logger.info('Resuming from Taxonomic assignment ')
-        run_step = True
-        #If the user want to resume from this step, switch the args.perform_taxonomic_assignment
-        #to true in case the user forget it.
-        args.perform_taxonomic_assignment = True
+def run_krona_visualization(args, fp, state, cpu):
+    """
+    Build krona representation from the RDP classification and abundance
+    """
+    abundance = state.get('abundance')
+    if not abundance:
+        abundance = get_abundance_from_fasta(fp.fasta_with_abundance_filepath)
+    rdp_file_to_krona_text_file(fp.fltr_rdp_classification_filepath, fp.krona_text_filepath, abundance=abundance)
 
+    make_krona_plot(krona_bin, fp.krona_text_filepath, fp.krona_html_filepath)
 
-    if run_step and args.perform_taxonomic_assignment:
-        logger.info('=== Taxonomic assignment & Krona visualization ===')
-        # Set t0
-        t0_wall = time.time()
-        rdp_classification_filepath =  '%s.rdp.tab' % os.path.splitext(fasta_with_abundance_filepath)[0]
-        run_rdp_classifier(rdp_exe, fasta_with_abundance_filepath,
-                           rdp_classification_filepath, gene=args.training_model, cutoff=args.rdp_cutoff)
-        logger.debug('Write taxonomic assignment to: %s' % rdp_classification_filepath)
-
-        # tag results below the confidence cutoff as unclassified
-        fltr_rdp_classification_filepath = '%s.fltr.tab' % os.path.splitext(rdp_classification_filepath)[0]
-        filter_rdp_file(rdp_classification_filepath, fltr_rdp_classification_filepath, cutoff=args.rdp_cutoff)
-
-        final_rdp_tab_symlink_filepath = os.path.join(args.out_dir, 'rdp.tab')
-        force_symlink(
-            os.path.relpath(fltr_rdp_classification_filepath, start=args.out_dir),
-            final_rdp_tab_symlink_filepath,
-        )
-        #############################
-        # build krona representation
-
-        if not abundance:
-            abundance = get_abundance_from_fasta(fasta_with_abundance_filepath)
-        krona_text_filepath = '%s.krona.tab' % os.path.splitext(fltr_rdp_classification_filepath)[0]
-        rdp_file_to_krona_text_file(fltr_rdp_classification_filepath, krona_text_filepath, abundance=abundance)
-
-        krona_html_filepath =  '%s.html' % os.path.splitext(krona_text_filepath)[0]
-        make_krona_plot(krona_bin, krona_text_filepath, krona_html_filepath)
-
-        logger.debug('Write krona to: %s' % krona_html_filepath)
-        logger.info('Taxonomic assignment & Krona visualization completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
-
-        # Expose final files
-        force_symlink(
-            os.path.relpath(krona_text_filepath, start=args.out_dir),
-            final_krona_tab_symlink_filepath,
-        )
-        force_symlink(
-            os.path.relpath(krona_html_filepath, start=args.out_dir),
-            final_krona_html_symlink_filepath,
-        )
+    logger.debug('Write krona to: %s' % fp.krona_html_filepath)
+    t0_wall = state.get('taxonomic_assignment_t0_wall', time.time())
+    logger.info('Taxonomic assignment & Krona visualization completed in {0:.4f} seconds wall time'.format(time.time() - t0_wall))
+
+    # Expose final files
     force_symlink(
-        os.path.relpath(fasta_with_abundance_filepath, start=args.out_dir),
-        final_assembly_symlink_filepath,
+        os.path.relpath(fp.krona_text_filepath, start=args.out_dir),
+        fp.final_krona_tab_symlink_filepath,
     )
-    ###########################
-    # Print Assembly Statistics
+    force_symlink(
+        os.path.relpath(fp.krona_html_filepath, start=args.out_dir),
+        fp.final_krona_html_symlink_filepath,
+    )
+
+
+def build_pipeline(args, fp, state, resources=None):
+    """
+    Declare all MATAM steps with their inputs, outputs and parameters.
+    Steps are declared in the historical order, which is also the
+    priority order when several steps are ready to run.
+    Steps whose tools are given a memory size (sort -S, indexdb_rna -m,
+    java -Xmx) or load the SortMeRNA index declare it, so that the steps
+    run concurrently stay under --max_memory. A ResourcePool may be
+    shared with other pipelines
+    """
+    cache = None
+    if not args.no_cache:
+        cache = StageCache(fp.stage_cache_dir)
+
+    profiler = Profiler(fp.profile_report_filepath,
+                        cprofile_dir=fp.cprofile_dir if args.profile else None)
+
+    if resources is None:
+        resources = ResourcePool(cpu=args.cpu, memory=args.max_memory)
+
+    pipeline = Pipeline(cache=cache, profiler=profiler, resources=resources)
+
+    def add_step(name, stage, **kwargs):
+        return pipeline.add_step(Step(name, functools.partial(stage, args, fp, state), **kwargs))
+
+    clustered_ref_db = [fp.clustered_ref_db_filepath]
+
+    add_step('reads_mapping', run_reads_mapping,
+             inputs=[fp.input_fastx_filepath] + clustered_ref_db,
+             outputs=[fp.sortme_output_fastx_filepath, fp.sortme_output_sam_filepath],
+             params={'best': args.best, 'min_lis': args.min_lis, 'evalue': args.evalue},
+             binaries=[sortmerna_bin],
+             cpu=args.cpu,
+             memory=args.max_memory,
+             resume_tag='reads_mapping')
+
+    add_step('reads_mapping_stats', compute_reads_mapping_stats,
+             inputs=[fp.sortme_output_fastx_filepath],
+             skippable=False)
+
+    if args.filter_only:
+        return pipeline
+
+    add_step('alignments_filtering', run_alignments_filtering,
+             inputs=[fp.sortme_output_sam_filepath] + clustered_ref_db,
+             outputs=[fp.sam_filt_filepath, fp.sam_cov_filt_filepath],
+             params={'score_threshold': args.score_threshold, 'straight_mode': args.straight_mode,
+                     'coverage_threshold': args.coverage_threshold, 'seed': args.seed,
+                     'bam_alignments': args.bam_alignments},
+             binaries=[filter_score_bin, sample_sam_cov_bin],
+             cpu=args.cpu,
+             memory=args.max_memory if args.coverage_threshold else 0,
+             resume_tag='alignments_filtering')
+
+    add_step('overlap_graph_building', run_overlap_graph_building,
+             inputs=[fp.sam_cov_filt_filepath] + clustered_ref_db,
+             outputs=[fp.ovgraphbuild_nodes_csv_filepath, fp.ovgraphbuild_edges_csv_filepath],
+             params={'min_identity': args.min_identity, 'min_overlap_length': args.min_overlap_length},
+             binaries=[ovgraphbuild_bin],
+             resume_tag='overlap_graph_building')
+
+    add_step('overlap_graph_stats', compute_overlap_graph_stats,
+             inputs=[fp.ovgraphbuild_nodes_csv_filepath, fp.ovgraphbuild_edges_csv_filepath],
+             skippable=False)
+
+    add_step('graph_compaction', run_graph_compaction,
+             inputs=[fp.ovgraphbuild_nodes_csv_filepath, fp.ovgraphbuild_edges_csv_filepath],
+             outputs=[fp.componentsearch_metanodes_csv_filepath, fp.componentsearch_metaedges_csv_filepath,
+                      fp.componentsearch_components_csv_filepath],
+             params={'min_read_node': args.min_read_node, 'min_overlap_edge': args.min_overlap_edge,
+                     'optimize_components': args.optimize_components, 'seed': args.seed},
+             binaries=[componentsearch_bin],
+             resume_tag='graph_compaction')
+
+    add_step('compressed_graph_stats', compute_compressed_graph_stats,
+             inputs=[fp.componentsearch_metanodes_csv_filepath, fp.componentsearch_metaedges_csv_filepath,
+                     fp.componentsearch_components_csv_filepath],
+             requires=['overlap_graph_stats'],
+             skippable=False)
+
+    add_step('read_component_extraction', run_read_component_extraction,
+             inputs=[fp.componentsearch_components_csv_filepath],
+             outputs=[fp.read_metanode_component_filepath],
+             memory=args.max_memory)
+
+    add_step('lca_labelling', run_lca_labelling,
+             inputs=[fp.sam_filt_filepath, fp.complete_ref_db_taxo_filepath, fp.read_metanode_component_filepath],
+             outputs=[fp.components_lca_filepath],
+             params={'quorum': args.quorum},
+             binaries=[compute_lca_bin],
+             memory=args.max_memory)
+
+    # Components assembly only needs the read --> component file,
+    # so it runs alongside the LCA labelling.
+    # The contigs are tagged with their component LCA afterwards.
+    add_step('components_assembly', run_components_assembly,
+             inputs=[fp.sortme_output_fastx_filepath, fp.read_metanode_component_filepath],
+             outputs=[fp.untagged_contigs_filepath],
+             params={'assembler': args.assembler, 'read_correction': args.read_correction,
+                     'contig_coverage_threshold': args.contig_coverage_threshold,
+                     'small_component_nt': args.small_component_nt},
+             binaries=[Binary.which('sga'), Binary.which('sga_assemble.py'), olc_assembler_bin],
+             cpu=args.cpu,
+             resume_tag='contigs_assembly')
+
+    add_step('contigs_pooling', run_contigs_pooling,
+             inputs=[fp.untagged_contigs_filepath, fp.components_lca_filepath],
+             outputs=[fp.contigs_filepath, fp.large_NR_contigs_filepath],
+             params={'min_scaffold_length': args.min_scaffold_length},
+             binaries=[remove_redundant_bin, fasta_length_filter_bin])
+
+    add_step('contigs_stats', compute_contigs_stats,
+             inputs=[fp.contigs_filepath, fp.large_NR_contigs_filepath],
+             skippable=False)
+
+    add_step('scaffolding', run_scaffolding,
+             inputs=[fp.contigs_filepath, fp.complete_ref_db_filepath],
+             outputs=[fp.scaffolds_filepath, fp.large_NR_scaffolds_filepath],
+             params={'contigs_binning': args.contigs_binning, 'min_scaffold_length': args.min_scaffold_length},
+             binaries=[sortmerna_bin, Binary.which('samtools'), scaffold_contigs_bin],
+             cpu=args.cpu,
+             memory=args.max_memory,
+             resume_tag='scaffolding')
+
+    add_step('scaffolds_stats', compute_scaffolds_stats,
+             inputs=[fp.scaffolds_filepath, fp.large_NR_scaffolds_filepath],
+             skippable=False)
+
+    add_step('abundance_calculation', run_abundance_calculation,
+             inputs=[fp.large_NR_scaffolds_filepath, fp.sortme_output_fastx_filepath],
+             outputs=[fp.fasta_with_abundance_filepath],
+             params={'best': args.best, 'min_lis': args.min_lis, 'evalue': args.evalue},
+             binaries=[indexdb_bin, sortmerna_bin],
+             cpu=args.cpu,
+             memory=get_abundance_memory(args),
+             resume_tag='abundance_calculation')
+
+    # RDP only needs the scaffolds, so it runs alongside the abundance
+    # calculation
+    if args.perform_taxonomic_assignment:
+        add_step('taxonomic_classification', run_taxonomic_classification,
+                 inputs=[fp.large_NR_scaffolds_filepath],
+                 outputs=[fp.fltr_rdp_classification_filepath],
+                 params={'training_model': args.training_model, 'rdp_cutoff': args.rdp_cutoff},
+                 binaries=[rdp_jar or rdp_exe],
+                 memory=rdp_memory,
+                 resume_tag='taxonomic_assignment')
+
+        add_step('krona_visualization', run_krona_visualization,
+                 inputs=[fp.fltr_rdp_classification_filepath, fp.fasta_with_abundance_filepath],
+                 outputs=[fp.krona_html_filepath],
+                 binaries=[krona_bin])
+
+    return pipeline
+
+
+def print_statistics(args, state):
+    """
+    Print Assembly Statistics
+    """
+    input_reads_nb = state.get('input_reads_nb', -1)
+    selected_reads_nb = state['selected_reads_nb']
+    ovgraph_nodes_nb = state['ovgraph_nodes_nb']
+    ovgraph_edges_nb = state['ovgraph_edges_nb']
+    compressed_graph_nodes_nb = state['compressed_graph_nodes_nb']
+    compressed_graph_edges_nb = state['compressed_graph_edges_nb']
+    compressed_graph_reads_nb = state['compressed_graph_reads_nb']
+    compressed_graph_excluded_reads_nb = state['compressed_graph_excluded_reads_nb']
+    excluded_reads_percent = state['excluded_reads_percent']
+    components_nb = state['components_nb']
+    contigs_stats = state['contigs_stats']
+    large_NR_contigs_stats = state['large_NR_contigs_stats']
+    scaffolds_stats = state['scaffolds_stats']
+    large_NR_scaffolds_stats = state['large_NR_scaffolds_stats']
+    if args.true_references:
+        contigs_error_rate, contigs_error_rate_2, contigs_ref_coverage = state['contigs_evaluation']
+        large_NR_contigs_error_rate, large_NR_contigs_error_rate_2, large_NR_contigs_ref_coverage = state['large_NR_contigs_evaluation']
+        scaffolds_error_rate, scaffolds_error_rate_2, scaffolds_ref_coverage = state['scaffolds_evaluation']
+        large_NR_scaffolds_error_rate, large_NR_scaffolds_error_rate_2, large_NR_scaffolds_ref_coverage = state['large_NR_scaffolds_evaluation']
 
     if args.verbose:
         b = '=== MATAM Statistics ===\n\n'
@@ -1656,6 +1900,127 @@ def main():
 
         logger.info(b)
 
+
+def write_run_summary(args, fp, state, error_code):
+    """
+    Write the counts and stats computed during the run in a json file,
+    so they can be read by other tools instead of being recomputed
+    """
+    summary = {
+        'input_fastx': fp.input_fastx_filepath,
+        'ref_db': args.ref_db,
+        'error_code': error_code,
+        'counts': dict(),
+        'sequences': dict(),
+    }
+    for key in ('input_reads_nb', 'selected_reads_nb',
+                'ovgraph_nodes_nb', 'ovgraph_edges_nb',
+                'compressed_graph_nodes_nb', 'compressed_graph_edges_nb',
+                'compressed_graph_reads_nb', 'compressed_graph_excluded_reads_nb',
+                'excluded_reads_percent', 'components_nb'):
+        if key in state:
+            summary['counts'][key] = state[key]
+    for key in ('contigs', 'large_NR_contigs', 'scaffolds', 'large_NR_scaffolds'):
+        fasta_stats = state.get(key + '_stats')
+        if fasta_stats is None:
+            continue
+        summary['sequences'][key] = {
+            'seq_nb': fasta_stats.seq_num,
+            'min_length': fasta_stats.get_min_length(),
+            'max_length': fasta_stats.get_max_length(),
+            'avg_length': float(fasta_stats.get_avg_length()),
+            'total_nt': fasta_stats.total_nt,
+        }
+        if key + '_evaluation' in state:
+            error_rate, error_rate_2, ref_coverage = state[key + '_evaluation']
+            summary['sequences'][key].update({'error_rate': error_rate,
+                                              'error_rate_2': error_rate_2,
+                                              'ref_coverage': ref_coverage})
+
+    with open(fp.run_summary_filepath, 'w') as summary_fh:
+        json.dump(summary, summary_fh, indent=2, sort_keys=True)
+        summary_fh.write('\n')
+
+
+def prepare_run(args):
+    """
+    Create the output directories and return the files paths namespace
+    and the initial run state
+    """
+    fp = get_filepaths(args)
+
+    try:
+        if not os.path.exists(fp.workdir):
+            logger.debug('mkdir {0}'.format(fp.workdir))
+            os.makedirs(fp.workdir)
+    except OSError:
+        logger.exception('Could not create output directory {0}'.format(fp.workdir))
+        raise
+
+    # Remove log file from previous assemblies
+    # because we will only append to this file
+    if os.path.exists(fp.contigs_assembly_log_filepath):
+        os.remove(fp.contigs_assembly_log_filepath)
+
+    # If the user want to resume from the taxonomic assignment, switch
+    # args.perform_taxonomic_assignment to true in case the user forget it.
+    if args.resume_from == 'taxonomic_assignment':
+        args.perform_taxonomic_assignment = True
+
+    # The run state is shared by all steps.
+    # It stores the stats and the list of tmp files to delete at the end
+    state = {'to_rm_filepath_list': list()}
+
+    # Tag tmp files for removal
+    state['to_rm_filepath_list'].append(fp.sortme_output_log_filepath)
+    state['to_rm_filepath_list'].append(fp.sortme_output_basepath + '.blast')
+    if args.coverage_threshold:
+        state['to_rm_filepath_list'].append(fp.sam_filt_filepath)
+
+    return fp, state
+
+
+def run_matam(args, fp, state, resources=None, done_steps=()):
+    """
+    Run all the steps, except the ones listed in done_steps (eg. whose
+    outputs were produced by a batch run). Return the exit code
+    """
+    # Init error code
+    error_code = 0
+
+    pipeline = build_pipeline(args, fp, state, resources)
+
+    if args.resume_from:
+        logger.info('Resuming from {0}'.format(args.resume_from.replace('_', ' ')))
+        pipeline.resume_from(args.resume_from)
+
+    for step_name in done_steps:
+        pipeline.get_step(step_name).skipped = True
+
+    try:
+        results = pipeline.run()
+    finally:
+        # Also report the resources used when a step failed
+        pipeline.profiler.write_report()
+
+    # Steps returning an int return an error code
+    error_code += sum(r for r in results.values() if isinstance(r, int))
+
+    write_run_summary(args, fp, state, error_code)
+
+    if args.filter_only:
+        return error_code
+
+    force_symlink(
+        os.path.relpath(fp.fasta_with_abundance_filepath, start=args.out_dir),
+        fp.final_assembly_symlink_filepath,
+    )
+
+    ###########################
+    # Print Assembly Statistics
+
+    print_statistics(args, state)
+
     ###############
     # Exit program
 
@@ -1667,7 +2032,7 @@ def main():
         # won't crash if it cannot
         if not args.keep_tmp:
             logger.info('Removing tmp files')
-            rm_files(to_rm_filepath_list)
+            rm_files(state['to_rm_filepath_list'])
         #
         logger.info('{0} terminated with no error'.format(program_filename))
     # Deal with errors
@@ -1679,6 +2044,35 @@ def main():
             logger.info('Rerun the program using --verbose or --debug option')
         exit_code = 1
 
+    return exit_code
+
+
+def main():
+    """
+    """
+    # Set global t0
+    global_t0_wall = time.time()
+
+    # Arguments parsing
+    args = parse_arguments()
+
+    ##############################################
+    # Set all files and directories names + paths
+
+    fp, state = prepare_run(args)
+
+    logger_filepath = os.path.join(args.out_dir, 'matam.log')
+    update_logger_settings(logger_filepath, args.verbose, args.debug)
+
+    # Print intro infos
+    if not args.filter_only:
+        print_intro(args)
+
+    ###############
+    # Run all steps
+
+    exit_code = run_matam(args, fp, state)
+
     logger.info('Run completed in {0:.4f} seconds wall time'.format(time.time() - global_t0_wall))
 
     return exit_code
@@ -1693,7 +2087,6 @@ if __name__ == '__main__':
 
     exit_code = 0
 
-    # cProfile.run('main()')
     exit_code = main()
 
     exit(exit_code)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Run MATAM on several samples in a single job.
+
+The reads of all the samples are mapped against the reference db by a
+single SortMeRNA run, so the db index is loaded once for the whole
+batch. The E-value threshold is scaled so that each sample keeps the
+reads it would select alone (cf. sample_batch). The SortMeRNA outputs
+are split by sample, and the remaining steps of each sample are run in
+its own output directory, all the samples sharing the same cpu and
+memory budget.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import contextlib
+import collections
+import concurrent.futures
+
+import runner
+import matam_assembly
+import sample_batch
+from profiler import Profiler
+from resources import ResourcePool
+from stage_cache import StageCache
+
+logger = logging.getLogger()
+
+
+def parse_arguments():
+    """
+    Parse the batch arguments. The unknown arguments are MATAM assembly
+    options, applied to all the samples
+    """
+    parser = argparse.ArgumentParser(
+        description='Run MATAM assembly on several samples, mapping all the reads with a single SortMeRNA run.',
+        epilog='All the other options are passed to matam_assembly.py and apply to all the samples '
+               '(eg. -d, --cpu, --max_memory, --perform_taxonomic_assignment).')
+    parser.add_argument('-s', '--sample_sheet',
+                        metavar='SAMPLES',
+                        required=True,
+                        help='A tabulated file with one sample by row. '
+                             'The first column contains the sample id (must be unique), '
+                             'the second one the reads path (fasta or fastq, plain or compressed). '
+                             'Paths can be absolute or relative to the current working directory.')
+    parser.add_argument('-o', '--out_dir',
+                        metavar='OUTDIR',
+                        default='matam_batch',
+                        help='Output directory, with one sub directory by sample. '
+                             'Default is "%(default)s"')
+    parser.add_argument('--parallel_samples',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help='Number of samples assembled concurrently, '
+                             'within the --cpu and --max_memory budget. The log of each sample '
+                             '(<OUTDIR>/<sample_id>/matam.log) only has the shared reads mapping '
+                             'lines when several samples run concurrently, all the lines are in '
+                             '<OUTDIR>/matam_batch.log. Default is %(default)s')
+    args, matam_argv = parser.parse_known_args()
+
+    if '-i' in matam_argv or '--input_fastx' in matam_argv:
+        parser.error('the reads are given by the sample sheet, not by -i')
+
+    args.out_dir = os.path.abspath(args.out_dir)
+    args.parallel_samples = max(1, args.parallel_samples)
+    return args, matam_argv
+
+
+@contextlib.contextmanager
+def sample_logs(samples):
+    """
+    Context manager also writing the log lines to the matam.log file of
+    each sample
+    """
+    handlers = list()
+    for sample in samples:
+        handler = logging.FileHandler(os.path.join(sample['args'].out_dir, 'matam.log'), encoding='utf8')
+        if sample['args'].debug:
+            handler.formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        else:
+            handler.formatter = logging.Formatter('%(levelname)s - %(message)s')
+        logger.addHandler(handler)
+        handlers.append(handler)
+    try:
+        yield
+    finally:
+        for handler in handlers:
+            logger.removeHandler(handler)
+            handler.close()
+
+
+def run_shared_reads_mapping(batch_args, samples, resources, batch_profiler):
+    """
+    Map the reads of all the samples with one SortMeRNA run by reads
+    format, and split the outputs by sample. A run whose samples outputs
+    are still valid is skipped, unless resuming from the reads mapping
+    (cf. sample_batch.reads_mapping_step).
+    Return the reads mapping wall time
+    """
+    batch_workdir = os.path.join(batch_args.out_dir, 'workdir')
+    os.makedirs(batch_workdir, exist_ok=True)
+    first_sample = next(iter(samples.values()))
+    args, fp = first_sample['args'], first_sample['fp']
+    cache = None
+    if not args.no_cache:
+        cache = StageCache(os.path.join(batch_workdir, 'stage_cache'))
+    t0_wall = time.time()
+
+    samples_by_format = collections.OrderedDict()
+    for i, sample in enumerate(samples.values()):
+        fastx_format = sample['fp'].input_fastx_format
+        if fastx_format is None:
+            logger.fatal('Reads format not recognised: {0}'.format(sample['fp'].input_fastx_filepath))
+            sys.exit('Invalid reads file')
+        samples_by_format.setdefault(fastx_format, collections.OrderedDict())[i] = sample
+
+    for fastx_format, format_samples in samples_by_format.items():
+        extension = '.fastq' if fastx_format == 'fastq' else '.fasta'
+        batch_reads_filepath = os.path.join(batch_workdir, 'batch_reads' + extension + '.gz')
+        batch_basepath = os.path.join(batch_workdir, 'batch_reads.sortmerna_vs_ref_db')
+        # SortMeRNA names its fastx output after the extension of the
+        # reads file. Its content is not compressed
+        batch_fastx_filepath = batch_basepath + '.gz'
+
+        step = sample_batch.reads_mapping_step(
+            {i: s['fp'] for i, s in format_samples.items()}, fastx_format, fp.clustered_ref_db_filepath,
+            {'best': args.best, 'min_lis': args.min_lis, 'evalue': args.evalue},
+            binaries=[matam_assembly.sortmerna_bin])
+        if cache is not None:
+            if args.resume_from is None and cache.is_up_to_date(step):
+                logger.info('Reads mapping of the {0} {1} samples is up to date'.format(
+                    len(format_samples), fastx_format))
+                continue
+            cache.invalidate(step)
+
+        with batch_profiler.profile('reads_mapping_' + fastx_format, args.cpu), \
+                sample_logs(format_samples.values()):
+            logger.info('=== Reads mapping of {0} {1} samples against ref db ==='.format(
+                len(format_samples), fastx_format))
+            input_reads_nb, bases_nb = sample_batch.write_batch_reads(
+                {i: s['fp'].input_fastx_filepath for i, s in format_samples.items()},
+                batch_reads_filepath, fastx_format, args.cpu)
+
+            batch_evalue, thresholds = sample_batch.evalue_thresholds(args.evalue, bases_nb)
+            logger.info('Batch E-value threshold: {0:.2e} ({1:.2e} scaled to the batch reads length)'.format(
+                batch_evalue, args.evalue))
+
+            with resources.lease(cpu=args.cpu, memory=args.max_memory, min_cpu=1) as lease:
+                cmd = matam_assembly.get_reads_mapping_command(args, fp, batch_reads_filepath, True,
+                                                               batch_basepath, lease.cpu, evalue=batch_evalue)
+                runner.check_run(cmd, verbose=args.verbose)
+
+            selected_reads_nb = sample_batch.split_batch_outputs(
+                batch_basepath, batch_fastx_filepath,
+                {i: s['fp'] for i, s in format_samples.items()}, fastx_format, thresholds)
+
+            for i, sample in format_samples.items():
+                sample_batch.write_sample_log(sample['fp'].sortme_output_log_filepath, batch_basepath + '.log',
+                                              input_reads_nb[i], selected_reads_nb[i])
+                logger.info('Sample {0}: {1} reads, {2} selected reads'.format(
+                    os.path.basename(sample['args'].out_dir), input_reads_nb[i], selected_reads_nb[i]))
+
+            if cache is not None:
+                cache.save(step)
+
+        if not args.keep_tmp:
+            matam_assembly.rm_files([batch_reads_filepath, batch_fastx_filepath, batch_basepath + '.sam',
+                                     batch_basepath + '.blast', batch_basepath + '.log'])
+
+    elapsed = time.time() - t0_wall
+    logger.info('Batch reads mapping completed in {0:.4f} seconds wall time'.format(elapsed))
+    return elapsed
+
+
+def run_sample(sample_id, sample, resources, done_steps, own_log=False):
+    """
+    Run the MATAM steps of a sample, return the exit code.
+    With own_log, the log lines are also written to the sample log
+    (only when the samples are run one at a time)
+    """
+    t0_wall = time.time()
+    logger.info('=== Sample {0} ==='.format(sample_id))
+    try:
+        with sample_logs([sample] if own_log else []):
+            exit_code = matam_assembly.run_matam(sample['args'], sample['fp'], sample['state'],
+                                                 resources=resources, done_steps=done_steps)
+    except SystemExit as e:
+        logger.error('Sample {0} failed: {1}'.format(sample_id, e))
+        exit_code = 1
+    except Exception:
+        logger.exception('Sample {0} failed'.format(sample_id))
+        exit_code = 1
+    sample['wall_time'] = time.time() - t0_wall
+    logger.info('Sample {0} completed in {1:.4f} seconds wall time'.format(sample_id, sample['wall_time']))
+    return exit_code
+
+
+def write_throughput_report(report_filepath, samples, mapping_wall_time, total_wall_time):
+    """
+    Write the per-sample and combined throughput report, and log it
+    """
+    report_samples = list()
+    total_reads_nb = 0
+    for sample_id, sample in samples.items():
+        input_reads_nb = sample['state'].get('input_reads_nb', -1)
+        wall_time = sample.get('wall_time', 0.0)
+        total_reads_nb += max(0, input_reads_nb)
+        report_samples.append({
+            'sample_id': sample_id,
+            'input_fastx': sample['fp'].input_fastx_filepath,
+            'out_dir': sample['args'].out_dir,
+            'exit_code': sample.get('exit_code'),
+            'input_reads_nb': input_reads_nb,
+            'selected_reads_nb': sample['state'].get('selected_reads_nb', -1),
+            'wall_time': wall_time,
+        })
+
+    report = {
+        'samples_nb': len(samples),
+        'failed_samples_nb': len([s for s in report_samples if s['exit_code']]),
+        'input_reads_nb': total_reads_nb,
+        'reads_mapping_wall_time': mapping_wall_time,
+        'wall_time': total_wall_time,
+        'reads_per_second': total_reads_nb / max(total_wall_time, 1e-6),
+        'samples_per_hour': len(samples) * 3600.0 / max(total_wall_time, 1e-6),
+        'samples': report_samples,
+    }
+    with open(report_filepath, 'w') as report_fh:
+        json.dump(report, report_fh, indent=2)
+        report_fh.write('\n')
+
+    logger.info('=== Batch throughput ===')
+    for s in report_samples:
+        logger.info('{0}: {1} reads, {2:.1f} s, exit code {3}'.format(
+            s['sample_id'], s['input_reads_nb'], s['wall_time'], s['exit_code']))
+    logger.info('{0} samples, {1} reads in {2:.1f} s ({3:.0f} reads/s, {4:.1f} samples/hour)'.format(
+        report['samples_nb'], total_reads_nb, total_wall_time,
+        report['reads_per_second'], report['samples_per_hour']))
+
+
+def main():
+    """
+    """
+    # Set global t0
+    global_t0_wall = time.time()
+
+    batch_args, matam_argv = parse_arguments()
+    sample_sheet = sample_batch.read_sample_sheet(batch_args.sample_sheet)
+
+    os.makedirs(batch_args.out_dir, exist_ok=True)
+
+    # All the samples share the same options, only their reads and
+    # output directories differ
+    samples = collections.OrderedDict()
+    for sample_id, reads_filepath in sample_sheet.items():
+        args = matam_assembly.parse_arguments(matam_argv + [
+            '--input_fastx', reads_filepath,
+            '--out_dir', os.path.join(batch_args.out_dir, sample_id)])
+        fp, state = matam_assembly.prepare_run(args)
+        samples[sample_id] = {'args': args, 'fp': fp, 'state': state}
+
+    args = next(iter(samples.values()))['args']
+    matam_assembly.update_logger_settings(os.path.join(batch_args.out_dir, 'matam_batch.log'),
+                                          args.verbose, args.debug)
+    logger.info('=== MATAM batch: {0} samples ==='.format(len(samples)))
+
+    resources = ResourcePool(cpu=args.cpu, memory=args.max_memory)
+    batch_profiler = Profiler(os.path.join(batch_args.out_dir, 'matam_batch_profile.json'))
+
+    # The shared reads mapping replaces the reads mapping of each sample,
+    # unless the samples are resumed from a later step
+    done_steps = ()
+    mapping_wall_time = 0.0
+    if args.resume_from in (None, 'reads_mapping'):
+        try:
+            mapping_wall_time = run_shared_reads_mapping(batch_args, samples, resources, batch_profiler)
+        finally:
+            batch_profiler.write_report()
+        done_steps = ('reads_mapping',)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=batch_args.parallel_samples) as executor:
+        futures = collections.OrderedDict(
+            (executor.submit(run_sample, sample_id, sample, resources, done_steps,
+                             batch_args.parallel_samples == 1), sample)
+            for sample_id, sample in samples.items())
+        for future, sample in futures.items():
+            sample['exit_code'] = future.result()
+
+    write_throughput_report(os.path.join(batch_args.out_dir, 'batch_report.json'),
+                            samples, mapping_wall_time, time.time() - global_t0_wall)
+
+    return 1 if any(s['exit_code'] for s in samples.values()) else 0
+
+
+if __name__ == '__main__':
+
+    # Set logging
+
+    import logging.config
+    logging.config.dictConfig(matam_assembly.logging_config)
+
+    exit_code = main()
+
+    exit(exit_code)
@@ -8,6 +8,7 @@ import subprocess
 import time
 import logging
 from binary_utils import Binary
+from taxonomy_index import write_taxonomy_index
 
 # Create logger
 logger = logging.getLogger(__name__)
@@ -342,6 +343,8 @@ if __name__ == '__main__':
     # For the complete db taxo file
     output_complete_ref_db_taxo_filename = output_complete_ref_db_basename + '.taxo.tab'
     output_complete_ref_db_taxo_filepath = os.path.join(args.db_dir, output_complete_ref_db_taxo_filename)
+    # For the complete db taxonomy index
+    output_complete_ref_db_taxo_index_filepath = os.path.join(args.db_dir, output_complete_ref_db_basename + '.taxo.idx')
     # For the clustered db fasta file
     output_clustered_ref_db_basename = output_ref_db_basename + '.clustered'
     output_clustered_ref_db_basepath = os.path.join(args.db_dir, output_clustered_ref_db_basename)
@@ -491,6 +494,12 @@ if __name__ == '__main__':
         logger.exception('Could not rename tmp files into MATAM db files')
         raise
 
+    # Index the taxonomies once for the LCA labelling
+    logger.info('Indexing complete ref db taxonomies')
+
+    taxa_nb = write_taxonomy_index(output_complete_ref_db_taxo_filepath, output_complete_ref_db_taxo_index_filepath)
+    logger.debug('{0} taxa indexed'.format(taxa_nb))
+
     ######################################################
     # SortMeRNA indexing of complete and clustered ref db
 
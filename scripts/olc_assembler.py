@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""
+In-process overlap-layout-consensus assembly of small read sets.
+
+Follows the uncorrected path of sga_assemble.py, on exact overlaps:
+reads with ambiguous bases or shorter than MIN_READ_LENGTH are dropped,
+as are the duplicated and contained reads (on both strands). The string
+graph of the exact overlaps of at least MIN_OVERLAP nucleotides is built
+and transitively reduced, the short terminal branches are trimmed and
+the contigs are spelled along the unbranched paths.
+
+The nodes of the graph are oriented reads: node 2*i is read i and node
+2*i+1 its reverse complement, so that the complement of node u is u ^ 1.
+An overlap u --> v implies the overlap v ^ 1 --> u ^ 1, the in-edges of
+a node are read from the out-edges of its complement.
+"""
+
+import re
+import sys
+import logging
+import argparse
+from collections import defaultdict
+
+from fastx_utils import read_fastq
+
+logger = logging.getLogger(__name__)
+
+# Parameters of sga_assemble.py without correction
+MIN_READ_LENGTH = 40
+MIN_OVERLAP = 55
+MIN_BRANCH_LENGTH = 100
+TRIM_ROUNDS = 10
+
+# Seeds of the containment search, at most MIN_READ_LENGTH
+_SEED_LENGTH = 20
+
+_AMBIGUOUS_REGEX = re.compile('[^ACGT]')
+_COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def reverse_complement(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def preprocess_reads(seqs, min_length=MIN_READ_LENGTH):
+    """
+    Drop the reads shorter than min_length or with ambiguous bases, then
+    the duplicated and contained reads, on both strands.
+    Return the remaining reads, in input order
+    """
+    unique = dict()
+    for seq in seqs:
+        seq = seq.upper()
+        if len(seq) < min_length or _AMBIGUOUS_REGEX.search(seq):
+            continue
+        unique.setdefault(min(seq, reverse_complement(seq)), (len(unique), seq))
+
+    # Longest reads first, a read can only be contained in a longer one,
+    # which is looked up from the position of its first seed
+    seeds = defaultdict(list)
+    kept = list()
+    for rank, seq in sorted(unique.values(), key=lambda r: (-len(r[1]), r[0])):
+        seed = seq[:_SEED_LENGTH]
+        if any(text.startswith(seq, pos) for text, pos in seeds.get(seed, ())):
+            continue
+        kept.append((rank, seq))
+        for text in (seq, reverse_complement(seq)):
+            for pos in range(len(text) - _SEED_LENGTH + 1):
+                seeds[text[pos:pos + _SEED_LENGTH]].append((text, pos))
+
+    return [seq for rank, seq in sorted(kept)]
+
+
+def find_overlaps(reads, min_overlap=MIN_OVERLAP):
+    """
+    Find the exact suffix-prefix overlaps of at least min_overlap
+    nucleotides between the oriented reads (reads without containment).
+    Return the oriented reads sequences and their out-edges, as a list of
+    dicts (key=node, value=overlap)
+    """
+    oriented = [s for seq in reads for s in (seq, reverse_complement(seq))]
+    prefixes = defaultdict(list)
+    for v, seq in enumerate(oriented):
+        if len(seq) >= min_overlap:
+            prefixes[seq[:min_overlap]].append(v)
+
+    edges = [dict() for _ in oriented]
+    for u, seq in enumerate(oriented):
+        # Longest overlaps first
+        for i in range(1, len(seq) - min_overlap + 1):
+            for v in prefixes.get(seq[i:i + min_overlap], ()):
+                if v >> 1 != u >> 1 and v not in edges[u] and oriented[v].startswith(seq[i:]):
+                    edges[u][v] = len(seq) - i
+    return oriented, edges
+
+
+def reduce_transitive_edges(oriented, edges):
+    """
+    Remove the overlaps u --> v implied by overlaps u --> w --> v, w
+    overlapping u more than v. Return the reduced out-edges
+    """
+    reduced = list()
+    for u, u_edges in enumerate(edges):
+        u_reduced = dict()
+        for v, overlap in u_edges.items():
+            # Once w is laid after u, v starts len(w) - w_overlap + overlap
+            # nucleotides before the end of w
+            if not any(w_overlap > overlap and edges[w].get(v) == len(oriented[w]) - w_overlap + overlap
+                       for w, w_overlap in u_edges.items()):
+                u_reduced[v] = overlap
+        reduced.append(u_reduced)
+    return reduced
+
+
+def _successors(edges, removed, u):
+    return [v for v in edges[u] if v >> 1 not in removed]
+
+
+def _predecessors(edges, removed, u):
+    return [w ^ 1 for w in edges[u ^ 1] if w >> 1 not in removed]
+
+
+def unbranched_paths(edges, removed=frozenset()):
+    """
+    Return the maximal unbranched paths of the graph, without the
+    removed reads. Each read is on one path, in one orientation
+    """
+    paths = list()
+    visited = set()
+    for u in range(0, len(edges), 2):
+        if u >> 1 in visited or u >> 1 in removed:
+            continue
+        # Back to the start of the path (or around a cycle)
+        start = u
+        seen = {u >> 1}
+        while True:
+            predecessors = _predecessors(edges, removed, start)
+            if len(predecessors) != 1:
+                break
+            w = predecessors[0]
+            if w >> 1 in seen or len(_successors(edges, removed, w)) != 1:
+                break
+            seen.add(w >> 1)
+            start = w
+        path = [start]
+        seen = {start >> 1}
+        while True:
+            successors = _successors(edges, removed, path[-1])
+            if len(successors) != 1:
+                break
+            v = successors[0]
+            if v >> 1 in seen or len(_predecessors(edges, removed, v)) != 1:
+                break
+            seen.add(v >> 1)
+            path.append(v)
+        visited.update(seen)
+        paths.append(path)
+    return paths
+
+
+def spell_path(oriented, edges, path):
+    """
+    Return the sequence of a path of the graph
+    """
+    seq = [oriented[path[0]]]
+    for u, v in zip(path, path[1:]):
+        seq.append(oriented[v][edges[u][v]:])
+    return ''.join(seq)
+
+
+def trim_terminal_branches(oriented, edges, min_branch_length=MIN_BRANCH_LENGTH, rounds=TRIM_ROUNDS):
+    """
+    Remove the dead-end paths shorter than min_branch_length nucleotides
+    branching from the rest of the graph, in several rounds. When all the
+    branches of a junction are short dead ends, the longest one is kept.
+    Return the set of the removed reads
+    """
+    removed = set()
+    for _ in range(rounds):
+        # (junction node, side) --> short dead-end branches, as (length, path)
+        junction_tips = defaultdict(list)
+        for path in unbranched_paths(edges, removed):
+            predecessors = _predecessors(edges, removed, path[0])
+            successors = _successors(edges, removed, path[-1])
+            if bool(predecessors) == bool(successors):
+                continue
+            length = len(spell_path(oriented, edges, path))
+            if length >= min_branch_length:
+                continue
+            if successors:
+                junctions = [(v, 'in') for v in successors if len(_predecessors(edges, removed, v)) > 1]
+            else:
+                junctions = [(w, 'out') for w in predecessors if len(_successors(edges, removed, w)) > 1]
+            if junctions:
+                junction_tips[junctions[0]].append((length, path))
+
+        tips = list()
+        for (junction, side), branches in junction_tips.items():
+            branches_nb = len(_predecessors(edges, removed, junction) if side == 'in'
+                              else _successors(edges, removed, junction))
+            branches.sort(key=lambda b: (-b[0], b[1]))
+            tips.extend(branches[1:] if len(branches) == branches_nb else branches)
+        if not tips:
+            break
+        removed.update(u >> 1 for length, path in tips for u in path)
+    return removed
+
+
+def assemble_reads(seqs, min_overlap=MIN_OVERLAP):
+    """
+    Assemble reads (sequences). Return the contigs sequences
+    """
+    reads = preprocess_reads(seqs)
+    oriented, edges = find_overlaps(reads, min_overlap)
+    edges = reduce_transitive_edges(oriented, edges)
+    removed = trim_terminal_branches(oriented, edges)
+    return [spell_path(oriented, edges, path) for path in unbranched_paths(edges, removed)]
+
+
+def assemble_fastq(fastq, out_fasta, min_overlap=MIN_OVERLAP):
+    """
+    Assemble the reads of a fastq file into a contigs fasta file, named
+    as SGA ones. Return the number of contigs
+    """
+    contigs = assemble_reads((seq for header, seq, qual in read_fastq(fastq)), min_overlap)
+    with open(out_fasta, 'w') as out_fh:
+        for i, contig in enumerate(contigs):
+            out_fh.write('>contig-{0}\n{1}\n'.format(i, contig))
+    return len(contigs)
+
+
+if __name__ == '__main__':
+
+    # Arguments parsing
+    parser = argparse.ArgumentParser(description='Assemble the reads of a small component')
+    parser.add_argument('-i', '--input_fastq', metavar='FASTQ',
+                        type=str, required=True,
+                        help='input fastq file')
+    parser.add_argument('-o', '--output_contigs', metavar='FASTA',
+                        type=str, required=True,
+                        help='output contigs fasta file')
+    parser.add_argument('-m', '--min_overlap', metavar='INT',
+                        type=int, default=MIN_OVERLAP,
+                        help='minimal overlap between reads. Default is %(default)s')
+    args = parser.parse_args()
+
+    contigs_nb = assemble_fastq(args.input_fastq, args.output_contigs, args.min_overlap)
+    sys.stderr.write('{0} contigs assembled\n'.format(contigs_nb))
+
+    exit(0)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import logging
+import concurrent.futures
+
+from resources import ResourcePool
+
+logger = logging.getLogger(__name__)
+
+
+class Step:
+    """
+    A pipeline stage.
+
+    A step declares the files it reads (inputs), the files it writes
+    (outputs) and the parameters its outputs depend on. The pipeline
+    derives the dependencies between steps from these declarations:
+    a step depends on every step producing one of its inputs, plus the
+    steps explicitly listed in requires.
+
+    func is called with the number of cpu granted to the step, which is
+    at most the number of cpu requested. memory (MBi) is the memory the
+    step tools are allowed to use, it is reserved while the step runs.
+    binaries lists the executables
+    run by the step, they are part of the step fingerprint (cf. StageCache).
+
+    A step tagged with resume_tag is the first step of a MATAM resumable
+    stage (cf. --resume_from). Steps flagged as not skippable (eg. stats
+    computing) are always run, even when resuming from a later stage.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), params=None,
+                 requires=(), cpu=1, memory=0, resume_tag=None, skippable=True,
+                 binaries=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = dict(params or {})
+        self.requires = list(requires)
+        self.cpu = max(1, cpu)
+        self.memory = max(0, memory)
+        self.resume_tag = resume_tag
+        self.skippable = skippable
+        self.binaries = [b for b in binaries if b]
+        self.skipped = False
+        self.forced = False
+
+    def __repr__(self):
+        return 'Step({0})'.format(self.name)
+
+
+class Pipeline:
+    """
+    Run a DAG of steps, keeping at most cpu cores busy.
+
+    Steps are started as soon as all their dependencies are done,
+    in declaration order, as long as there are free cores and enough
+    free memory in the ResourcePool (a private pool of cpu cores
+    without memory limit by default). When several
+    steps are ready at once, a step requesting many cores leaves one core
+    to each of the other ready steps, so independent steps run
+    concurrently instead of waiting for each other.
+
+    When a StageCache is given, skippable steps whose outputs are still
+    valid are not run again. When a Profiler is given, the resources
+    used by each step are recorded.
+    """
+
+    def __init__(self, cpu=1, cache=None, profiler=None, resources=None):
+        self.resources = resources or ResourcePool(cpu)
+        self.cpu = self.resources.cpu
+        self.cache = cache
+        self.profiler = profiler
+        self.steps = list()
+        self.results = dict()
+        self._producers = dict()
+
+    def add_step(self, step):
+        """
+        Add a step to the pipeline and return it
+        """
+        if any(s.name == step.name for s in self.steps):
+            raise KeyError('A step named {0} already exists'.format(step.name))
+        for filepath in step.outputs:
+            self._producers[filepath] = step.name
+        self.steps.append(step)
+        return step
+
+    def get_step(self, name):
+        for step in self.steps:
+            if step.name == name:
+                return step
+        raise KeyError('No step named {0}'.format(name))
+
+    def dependencies(self, step):
+        """
+        Return the names of the steps the given step depends on
+        """
+        deps = set(step.requires)
+        for filepath in step.inputs:
+            producer = self._producers.get(filepath)
+            if producer is not None and producer != step.name:
+                deps.add(producer)
+        return deps
+
+    def resume_from(self, resume_tag):
+        """
+        Skip all the skippable steps declared before the first step
+        tagged with resume_tag, and force all the following ones to run
+        even if they are up to date
+        """
+        tags = [s.resume_tag for s in self.steps]
+        if resume_tag not in tags:
+            raise KeyError('No step tagged {0}'.format(resume_tag))
+        resume_index = tags.index(resume_tag)
+        for step in self.steps[:resume_index]:
+            if step.skippable:
+                step.skipped = True
+        for step in self.steps[resume_index:]:
+            step.forced = True
+
+    def is_up_to_date(self, step):
+        """
+        Return True if the step does not need to be run again
+        """
+        return (self.cache is not None and step.skippable and not step.forced
+                and self.cache.is_up_to_date(step))
+
+    def _check(self):
+        """
+        Check that all dependencies exist and that the graph is acyclic
+        """
+        names = {s.name for s in self.steps}
+        for step in self.steps:
+            unknown = self.dependencies(step) - names
+            if unknown:
+                raise KeyError('{0} requires unknown steps: {1}'.format(step.name, sorted(unknown)))
+        done = set()
+        remaining = list(self.steps)
+        while remaining:
+            ready = [s for s in remaining if self.dependencies(s) <= done]
+            if not ready:
+                raise ValueError('Cyclic dependencies between steps: {0}'.format(
+                    [s.name for s in remaining]))
+            done.update(s.name for s in ready)
+            remaining = [s for s in remaining if s.name not in done]
+
+    def _run_step(self, step, cpu):
+        logger.debug('Starting step {0} with {1} cpu'.format(step.name, cpu))
+        if self.profiler is None:
+            return step.func(cpu)
+        with self.profiler.profile(step.name, cpu):
+            return step.func(cpu)
+
+    def run(self):
+        """
+        Run all steps and return the dict of results (key=step name,
+        value=value returned by the step function).
+        The first exception raised by a step is re-raised once the
+        running steps are over, and no new step is started meanwhile.
+        """
+        self._check()
+
+        done = set()
+        pending = list(self.steps)
+        running = dict()
+        checked = set()
+        error = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.steps) or 1) as executor:
+            while pending or running:
+                # Start all the steps that are ready, in declaration order.
+                # Skipping a step may unlock the following ones, so loop
+                # until nothing changes
+                started = error is None
+                waiting = False
+                while started:
+                    started = False
+                    waiting = False
+                    ready = [s for s in pending if self.dependencies(s) <= done]
+                    for i, step in enumerate(ready):
+                        # Check the cache once, when the step becomes ready
+                        reason = 'skipped'
+                        if not step.skipped and step.name not in checked:
+                            checked.add(step.name)
+                            if self.is_up_to_date(step):
+                                logger.info('Step {0} is up to date'.format(step.name))
+                                step.skipped = True
+                                reason = 'up_to_date'
+                        if step.skipped:
+                            logger.debug('Skipping step {0}'.format(step.name))
+                            if self.profiler is not None:
+                                self.profiler.record_skipped(step.name, reason)
+                            pending.remove(step)
+                            done.add(step.name)
+                            started = True
+                        else:
+                            # Leave a cpu to each following ready step
+                            others = len([s for s in ready[i+1:] if not s.skipped])
+                            cpu = max(1, min(step.cpu, self.resources.free_cpu - others))
+                            lease = self.resources.acquire(cpu, step.memory, min_cpu=1, blocking=False)
+                            if lease is None:
+                                waiting = True
+                                continue
+                            if self.cache is not None:
+                                self.cache.invalidate(step)
+                            pending.remove(step)
+                            running[executor.submit(self._run_step, step, lease.cpu)] = (step, lease)
+
+                if not running:
+                    if error is None and pending:
+                        if waiting and not self.resources.is_idle():
+                            # The resources are used by another pipeline
+                            self.resources.wait_release(timeout=1.0)
+                            continue
+                        raise ValueError('Steps cannot be scheduled: {0}'.format(
+                            [s.name for s in pending]))
+                    break
+
+                # A shared pool may be released by another pipeline
+                finished, _ = concurrent.futures.wait(running, timeout=1.0 if waiting else None,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    step, lease = running.pop(future)
+                    self.resources.release(lease)
+                    try:
+                        self.results[step.name] = future.result()
+                    except BaseException as e:
+                        if error is None:
+                            logger.debug('Step {0} failed'.format(step.name))
+                            error = e
+                        continue
+                    if self.cache is not None and step.skippable:
+                        self.cache.save(step)
+                    done.add(step.name)
+                    logger.debug('Step {0} done'.format(step.name))
+
+        if error is not None:
+            raise error
+
+        return self.results
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import cProfile
+import logging
+import resource
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+# Stage profiled in the current thread, the commands run by the
+# runner module are recorded in it
+_current = threading.local()
+_commands_lock = threading.Lock()
+# Only one cProfile profiler can be enabled at a time (ValueError from
+# python 3.12), the steps starting while another one is profiled are not
+_cprofile_lock = threading.Lock()
+
+
+def maxrss_kb(maxrss):
+    """
+    ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    """
+    if sys.platform == 'darwin':
+        return maxrss // 1024
+    return maxrss
+
+
+def _cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def thread_cpu_time():
+    """
+    Return the CPU time of the calling thread, or None if the platform
+    cannot tell it apart from the whole process
+    """
+    if hasattr(resource, 'RUSAGE_THREAD'):
+        return _cpu_time(resource.getrusage(resource.RUSAGE_THREAD))
+    return None
+
+
+def read_proc_io():
+    """
+    Return the bytes read and written by the process and its waited
+    children (Linux only, empty dict elsewhere). read_bytes and
+    write_bytes count the storage I/O, rchar and wchar all the I/O
+    """
+    counters = dict()
+    try:
+        with open('/proc/self/io', 'r') as io_fh:
+            for line in io_fh:
+                key, _, value = line.partition(':')
+                if key in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+                    counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def current_stage():
+    """
+    Return the stage profiled in the current thread, or None
+    """
+    return getattr(_current, 'stage', None)
+
+
+@contextlib.contextmanager
+def attached(stage):
+    """
+    Context manager recording the commands run by the current thread
+    in the given stage (eg. in a worker thread of a step)
+    """
+    previous = current_stage()
+    _current.stage = stage
+    try:
+        yield stage
+    finally:
+        _current.stage = previous
+
+
+def record_command(command, result):
+    """
+    Record the resources used by a command (cf. runner.CommandResult)
+    in the stage profiled in the current thread. Unlike the process wide
+    values, these values are exact even when stages run concurrently
+    """
+    stage = current_stage()
+    if stage is None:
+        return
+    with _commands_lock:
+        stage['commands'].append({
+            'command': command,
+            'returncode': result.returncode,
+            'wall_time': result.wall_time,
+            'cpu_time': result.cpu_time,
+            'max_rss_kb': result.max_rss_kb,
+        })
+        stage['commands_cpu_time'] += result.cpu_time
+        stage['commands_peak_rss_kb'] = max(stage['commands_peak_rss_kb'], result.max_rss_kb)
+
+
+def _start_cprofile(name):
+    """
+    Return an enabled cProfile profiler, or None if another one is active
+    """
+    if _cprofile_lock.acquire(blocking=False):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            return profile
+        except ValueError:
+            # Enabled outside of this module (eg. python -m cProfile)
+            _cprofile_lock.release()
+    logger.info('Step {0}: another profiler is active, the cProfile dump is skipped'.format(name))
+    return None
+
+
+def _stop_cprofile(profile, filepath):
+    try:
+        profile.disable()
+        profile.dump_stats(filepath)
+    finally:
+        _cprofile_lock.release()
+
+
+class _Snapshot:
+    """
+    Process wide resources usage at a given time
+    """
+
+    def __init__(self):
+        self.wall = time.time()
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = read_proc_io()
+
+
+def _usage_delta(start, end):
+    """
+    Return the resources used between two snapshots
+    """
+    delta = {
+        'wall_time': end.wall - start.wall,
+        'process_cpu_time': _cpu_time(end.self_usage) - _cpu_time(start.self_usage),
+        'children_cpu_time': _cpu_time(end.children_usage) - _cpu_time(start.children_usage),
+        'process_peak_rss_kb': maxrss_kb(end.self_usage.ru_maxrss),
+        # The children peak RSS is the peak of the biggest child waited
+        # so far. It is only attributed when it grew meanwhile
+        'children_peak_rss_kb': None,
+    }
+    if end.children_usage.ru_maxrss > start.children_usage.ru_maxrss:
+        delta['children_peak_rss_kb'] = maxrss_kb(end.children_usage.ru_maxrss)
+    for key, value in end.io.items():
+        delta[key] = value - start.io.get(key, 0)
+    return delta
+
+
+class Profiler:
+    """
+    Record the resources used by each pipeline step and write them to
+    a json report.
+
+    For each step, the report gives the wall time, the CPU time of the
+    step thread, and the CPU time, peak RSS and I/O of the whole process
+    including the waited child processes (sortmerna, ovgraphbuild, ...).
+    These process wide values are exact for the steps run alone. When
+    steps run concurrently they include the other steps usage, so the
+    report lists the concurrent steps of each step. The commands run
+    through the runner module are also listed with their own resources
+    usage, which is exact in any case.
+
+    When cprofile_dir is given, a cProfile dump of each step thread is
+    written to cprofile_dir/<step>.prof (cf. pstats, snakeviz). As only
+    one cProfile profiler can be active at a time, a step starting while
+    another step is profiled has no dump.
+    """
+
+    def __init__(self, report_filepath, cprofile_dir=None):
+        self.report_filepath = report_filepath
+        self.cprofile_dir = cprofile_dir
+        self.stages = list()
+        self._start = _Snapshot()
+        self._lock = threading.Lock()
+        self._running = dict()
+        if self.cprofile_dir:
+            os.makedirs(self.cprofile_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def profile(self, name, cpu=1):
+        """
+        Context manager recording the resources used by a step
+        """
+        stage = {'name': name, 'cpu': cpu, 'status': 'done', 'concurrent_stages': list(),
+                 'commands': list(), 'commands_cpu_time': 0.0, 'commands_peak_rss_kb': 0}
+        with self._lock:
+            for other_name, other_stage in self._running.items():
+                other_stage['concurrent_stages'].append(name)
+                stage['concurrent_stages'].append(other_name)
+            self._running[name] = stage
+
+        thread_t0 = thread_cpu_time()
+        start = _Snapshot()
+        stage['start'] = start.wall - self._start.wall
+        profile = None
+        if self.cprofile_dir:
+            profile = _start_cprofile(name)
+        try:
+            with attached(stage):
+                yield stage
+        except BaseException:
+            stage['status'] = 'failed'
+            raise
+        finally:
+            if profile is not None:
+                _stop_cprofile(profile, os.path.join(self.cprofile_dir, name + '.prof'))
+            end = _Snapshot()
+            stage.update(_usage_delta(start, end))
+            if thread_t0 is not None:
+                stage['thread_cpu_time'] = thread_cpu_time() - thread_t0
+            with self._lock:
+                del self._running[name]
+                self.stages.append(stage)
+            logger.debug('Step {0}: {1:.2f} s wall time, {2:.2f} s children cpu time'.format(
+                name, stage['wall_time'], stage['children_cpu_time']))
+
+    def record_skipped(self, name, reason):
+        """
+        Record a step which was not run (eg. up to date)
+        """
+        with self._lock:
+            self.stages.append({'name': name, 'status': reason})
+
+    def report(self):
+        """
+        Return the report as a dict
+        """
+        with self._lock:
+            stages = list(self.stages)
+        total = _usage_delta(self._start, _Snapshot())
+        return {
+            'python': sys.version.split()[0],
+            'start_time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._start.wall)),
+            'total': total,
+            'stages': stages,
+        }
+
+    def write_report(self):
+        """
+        Write the json report
+        """
+        with open(self.report_filepath, 'w') as report_fh:
+            json.dump(self.report(), report_fh, indent=2, sort_keys=True)
+            report_fh.write('\n')
+        logger.debug('Profiling report written to {0}'.format(self.report_filepath))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import contextlib
+import collections
+
+logger = logging.getLogger(__name__)
+
+Lease = collections.namedtuple('Lease', ['cpu', 'memory'])
+
+
+class ResourcePool:
+    """
+    A budget of cores and memory (in MBi) leased to the pipeline steps
+    and to the external tools they run.
+
+    Cores are leased elastically: a lease asks for up to cpu cores and
+    gets what is free, provided it is at least min_cpu. Memory is leased
+    as requested. A request bigger than the whole budget is capped to
+    the budget, so it can always be satisfied once the pool is idle.
+    memory=None means the memory is not limited.
+
+    A single pool shared by several pipelines (eg. several samples run
+    by the same process) keeps them all under the same budget.
+    """
+
+    def __init__(self, cpu=1, memory=None):
+        self.cpu = max(1, cpu)
+        self.memory = memory
+        self.free_cpu = self.cpu
+        self.free_memory = memory
+        self._condition = threading.Condition()
+
+    def _grant(self, cpu, memory, min_cpu):
+        """
+        Return the lease that can be granted now, or None
+        """
+        cpu = min(max(0, cpu), self.cpu)
+        min_cpu = min(cpu if min_cpu is None else max(0, min_cpu), cpu)
+        if self.memory is None:
+            memory = 0
+        else:
+            memory = min(max(0, memory or 0), self.memory)
+            if memory > self.free_memory:
+                return None
+        if self.free_cpu < min_cpu:
+            return None
+        return Lease(min(cpu, self.free_cpu), memory)
+
+    def acquire(self, cpu=1, memory=0, min_cpu=None, blocking=True, timeout=None):
+        """
+        Lease cores and memory. Return the Lease, or None if the
+        resources are not available (not blocking, or timeout)
+        """
+        with self._condition:
+            lease = self._grant(cpu, memory, min_cpu)
+            if lease is None and blocking:
+                self._condition.wait_for(lambda: self._grant(cpu, memory, min_cpu) is not None, timeout)
+                lease = self._grant(cpu, memory, min_cpu)
+            if lease is not None:
+                self.free_cpu -= lease.cpu
+                if self.memory is not None:
+                    self.free_memory -= lease.memory
+            return lease
+
+    def release(self, lease):
+        """
+        Give back the resources of a lease
+        """
+        with self._condition:
+            self.free_cpu += lease.cpu
+            if self.memory is not None:
+                self.free_memory += lease.memory
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def lease(self, cpu=1, memory=0, min_cpu=None):
+        """
+        Context manager leasing resources, waiting for them if needed
+        """
+        lease = self.acquire(cpu, memory, min_cpu)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def is_idle(self):
+        """
+        Return True if nothing is leased
+        """
+        with self._condition:
+            return self.free_cpu == self.cpu and self.free_memory == self.memory
+
+    def wait_release(self, timeout=None):
+        """
+        Wait until some resources are released (or timeout)
+        """
+        with self._condition:
+            self._condition.wait(timeout)
@@ -1,54 +1,228 @@
 #!/usr/bin/env python3
 
-import sys
+import io
 import os
+import sys
+import time
+import shlex
+import signal
 import logging
+import threading
 import subprocess
+import collections
+import concurrent.futures
+
+import profiler
+from resources import ResourcePool
 
-# get the root handler to update his behavior (No prefix, no endline)
+# Commands output is logged by the root logger
 logger = logging.getLogger()
 
+# Number of output lines kept to be reported when a command fails
+TAIL_LINES = 20
 
-def logged_call(command, verbose=False):
+CommandResult = collections.namedtuple('CommandResult', [
+    'returncode',   # Return code of the command (of the last failing process for a pipe)
+    'returncodes',  # Return codes of all the processes of the pipe
+    'wall_time',
+    'cpu_time',     # User + system time of all the processes of the pipe
+    'max_rss_kb',   # Peak RSS of the biggest process of the pipe
+    'output_tail',  # Last lines of the output
+])
+
+
+def _as_pipe(args):
+    """
+    Return a list of argv lists. args is either an argv list (single
+    command) or a list of argv lists (commands chained by pipes)
+    """
+    if not args:
+        raise ValueError('Empty command')
+    if isinstance(args, str):
+        raise TypeError('Commands must be argument lists, not strings: {0}'.format(args))
+    if isinstance(args[0], (list, tuple)):
+        return [[str(a) for a in argv] for argv in args]
+    return [[str(a) for a in args]]
+
+
+def format_command(args, stdin=None, stdout=None):
     """
-    A logged version of subprocess.call. Do not wait the end of the
-    process to start logging
+    Return the shell equivalent of a command, for logging purpose
     """
-    logger.debug('CMD: {0}'.format(command))
+    command = ' | '.join(' '.join(shlex.quote(a) for a in argv) for argv in _as_pipe(args))
+    if isinstance(stdin, str):
+        command += ' < ' + shlex.quote(stdin)
+    if isinstance(stdout, str):
+        command += ' > ' + shlex.quote(stdout)
+    return command
 
-    # if true, redirect stderr to stdout, otherwise, to NULL
-    if verbose:
-        stdout = subprocess.PIPE
-        stderr = subprocess.STDOUT
+
+def _log_output(read_fd, verbose, tail):
+    """
+    Log the lines written to a pipe until all writers closed it.
+    Reading lines blocks until data is available, there is no polling
+    """
+    with io.open(read_fd, 'rb') as stream:
+        for line in stream:
+            line = line.decode(errors='replace').rstrip('\r\n')
+            tail.append(line)
+            if verbose:
+                logger.info(line)
+
+
+def _wait(process):
+    """
+    Wait a process and return its return code and resources usage
+    """
+    _, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
     else:
-        null = open(os.devnull, 'w')
-        stdout = null
-        stderr = null
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, usage
+
+
+def run(args, stdin=None, stdout=None, cwd=None, verbose=False):
+    """
+    Run a command without shell and return a CommandResult.
 
-    #Update temporally the handler (No prefix, no endline)
-    old_handlers = {handler: handler.formatter for handler in logger.handlers}
-    for handler in logger.handlers:
-        handler.formatter = logging.Formatter('%(message)s')
-        handler.terminator = ''
+    args is an argv list, or a list of argv lists whose processes are
+    chained by OS pipes (like a shell pipe, but without shell).
+    stdin and stdout are paths or file handles; the output of the last
+    process is logged (when verbose) or discarded when stdout is None.
+    The stderr of all the processes is logged line by line as it comes
+    (when verbose), and its last lines are kept in the result.
 
-    with subprocess.Popen(command, stdout=stdout, stderr=stderr, shell=True, bufsize=0) as process:
-        if verbose:
-            while process.poll() is None:
-                message = os.read(process.stdout.fileno(), 1024).decode()
-                logger.info(message)
+    The resources used by the processes are reported to the profiler
+    """
+    commands = _as_pipe(args)
+    logger.debug('CMD: {0}'.format(format_command(commands, stdin, stdout)))
+
+    t0_wall = time.time()
+    tail = collections.deque(maxlen=TAIL_LINES)
+    read_fd, write_fd = os.pipe()
+    log_thread = threading.Thread(target=_log_output, args=(read_fd, verbose, tail), daemon=True)
+    log_thread.start()
+
+    opened = list()
+    processes = list()
+    try:
+        if isinstance(stdin, str):
+            stdin = open(stdin, 'rb')
+            opened.append(stdin)
+        if isinstance(stdout, str):
+            stdout = open(stdout, 'wb')
+            opened.append(stdout)
+        elif stdout is None:
+            stdout = write_fd if verbose else subprocess.DEVNULL
+
+        previous_stdout = stdin
+        for i, argv in enumerate(commands):
+            last = i == len(commands) - 1
+            process = subprocess.Popen(argv, stdin=previous_stdout,
+                                       stdout=stdout if last else subprocess.PIPE,
+                                       stderr=write_fd, cwd=cwd)
+            if processes:
+                # Only the child processes keep the pipe open, so a
+                # process gets SIGPIPE when the next one exits
+                previous_stdout.close()
+            previous_stdout = process.stdout
+            processes.append(process)
+    except BaseException:
+        for process in processes:
+            process.kill()
+            _wait(process)
+        raise
+    finally:
+        os.close(write_fd)
+        for fh in opened:
+            fh.close()
+
+    returncodes = list()
+    cpu_time = 0.0
+    max_rss_kb = 0
+    for process in processes:
+        returncode, usage = _wait(process)
+        returncodes.append(returncode)
+        cpu_time += usage.ru_utime + usage.ru_stime
+        max_rss_kb = max(max_rss_kb, profiler.maxrss_kb(usage.ru_maxrss))
+    log_thread.join()
+
+    # As with 'set -o pipefail', the return code is the one of the last
+    # failing process. A process killed by SIGPIPE did not fail, the
+    # next one stopped reading its output on purpose (eg. head)
+    returncode = 0
+    for i, code in enumerate(returncodes):
+        if code == -signal.SIGPIPE and i < len(returncodes) - 1:
+            continue
+        if code:
+            returncode = code
+
+    result = CommandResult(returncode, returncodes, time.time() - t0_wall,
+                           cpu_time, max_rss_kb, list(tail))
+    profiler.record_command(format_command(commands), result)
+    return result
+
+
+def check_run(args, stdin=None, stdout=None, cwd=None, verbose=False):
+    """
+    Run a command (cf. run) and exit if it fails
+    """
+    result = run(args, stdin=stdin, stdout=stdout, cwd=cwd, verbose=verbose)
+    if result.returncode != 0:
+        if not verbose:
+            for line in result.output_tail:
+                logger.error(line)
+        logger.fatal('The last command returns a non-zero return code: %s' % result.returncode)
+        sys.exit('Non-zero return code')
+    return result
+
+
+def run_concurrently(commands, cpu=1, verbose=False, resources=None):
+    """
+    Run several commands concurrently, under the budget of a
+    ResourcePool (by default a pool of cpu cores). Each command is a
+    dict of run arguments (args, stdin, stdout, cwd) with the number of
+    cores (cpu, default 1) and the memory in MBi (memory, default 0) it
+    uses. Commands are started in the given order, as soon as their
+    resources are available.
+    Return the list of CommandResult, in the same order
+    """
+    if resources is None:
+        resources = ResourcePool(cpu)
+    stage = profiler.current_stage()
+
+    def run_command(command, lease):
+        try:
+            with profiler.attached(stage):
+                return run(command['args'], stdin=command.get('stdin'), stdout=command.get('stdout'),
+                           cwd=command.get('cwd'), verbose=verbose)
+        finally:
+            resources.release(lease)
 
+    if not commands:
+        return list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        futures = list()
+        for command in commands:
+            lease = resources.acquire(cpu=max(1, command.get('cpu', 1)), memory=command.get('memory', 0))
+            futures.append(executor.submit(run_command, command, lease))
+        return [future.result() for future in futures]
 
-    # rehabilitate previous handler
-    for handler in logger.handlers:
-        handler.formatter = old_handlers[handler]
-        handler.terminator = '\n'
 
-    return process.wait()
+def logged_call(command, verbose=False):
+    """
+    A logged version of subprocess.call, for shell command lines.
+    Do not wait the end of the process to start logging.
+    Prefer run, which does not need a shell
+    """
+    return run(['/bin/sh', '-c', command], verbose=verbose).returncode
 
 
 def logged_check_call(command, verbose=False):
     """
-    A logged version of subprocess.check_call
+    A logged version of subprocess.check_call, for shell command lines.
+    Prefer check_run, which does not need a shell
     """
     returncode = logged_call(command, verbose=verbose)
     if returncode != 0:
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""
+Helpers to map the reads of several samples with a single SortMeRNA run.
+
+The reads of all the samples are written to a single file, their ids
+prefixed with the sample index ('<index>|<read id>'). SortMeRNA outputs
+(aligned reads, sam and blast files) are then split back by sample,
+without the prefix.
+
+SortMeRNA computes the E-value of an alignment from the total length of
+the reads file (E = K * m * n * exp(-lambda * S), with n the number of
+nucleotides of all the reads). The batch run therefore uses the loosest
+of the sample thresholds scaled to the batch length, and each sample
+only keeps the alignments passing its own scaled threshold, ie. the
+alignments SortMeRNA would have reported for the sample run alone.
+"""
+
+import os
+import re
+import sys
+import gzip
+import logging
+import contextlib
+import subprocess
+import collections
+
+from binary_utils import Binary
+from fastx_utils import read_fasta, read_fastq, iter_line_blocks
+from pipeline import Step
+
+logger = logging.getLogger(__name__)
+
+_SAMPLE_ID_REGEX = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# Number of records written at once
+_WRITE_BATCH_SIZE = 10000
+
+
+def read_sample_sheet(sample_sheet_filepath):
+    """
+    From a tabulated file, return an ordered dict with the reads path
+    of each sample as: { sample_id1: reads_path, ...}
+    First col: sample id (letters, digits, '_', '.' and '-')
+    Second col: reads path (fasta or fastq, plain or compressed)
+    Empty lines and lines starting with # are ignored
+    """
+    samples = collections.OrderedDict()
+    with open(sample_sheet_filepath, 'r') as sheet_fh:
+        for line_number, line in enumerate(sheet_fh, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [v.strip() for v in line.split('\t')]
+            if len(fields) != 2:
+                logger.fatal('Wrong number of fields (line number:%s, file:%s)' % (line_number, sample_sheet_filepath))
+                sys.exit('Wrong number of fields')
+            sample_id, reads_path = fields
+            if not _SAMPLE_ID_REGEX.match(sample_id):
+                logger.fatal('Invalid sample id (id:%s, file:%s)' % (sample_id, sample_sheet_filepath))
+                sys.exit('Invalid id')
+            if sample_id in samples:
+                logger.fatal('Duplicated sample_id (id:%s, file:%s)' % (sample_id, sample_sheet_filepath))
+                sys.exit('Duplicated id')
+            samples[sample_id] = os.path.abspath(os.path.expanduser(reads_path))
+    if not samples:
+        logger.fatal('The sample sheet is empty: %s' % sample_sheet_filepath)
+        sys.exit('Empty sample sheet')
+    return samples
+
+
+def _prefix(sample_index):
+    return str(sample_index).encode() + b'|'
+
+
+def _format_record(header, record, fastx_format):
+    """
+    Return a fasta or fastq record (bytes)
+    """
+    if fastx_format == 'fastq':
+        return b'@' + header + b'\n' + record[0] + b'\n+\n' + record[1] + b'\n'
+    return b'>' + header + b'\n' + record[0] + b'\n'
+
+
+def _read_records(filepath, fastx_format):
+    """
+    Return a generator of (header, record) with record a tuple of
+    (sequence,) or (sequence, quality)
+    """
+    if fastx_format == 'fastq':
+        for header, seq, qual in read_fastq(filepath, as_bytes=True, full_header=True):
+            yield header, (seq, qual)
+    else:
+        for header, seq in read_fasta(filepath, as_bytes=True):
+            yield header, (seq,)
+
+
+@contextlib.contextmanager
+def _gzip_writer(filepath, threads=1):
+    """
+    Context manager returning a binary handle writing a gzip file
+    (level 1), through pigz when available
+    """
+    pigz_bin = Binary.which('pigz')
+    if pigz_bin is None:
+        with gzip.open(filepath, 'wb', compresslevel=1) as out_fh:
+            yield out_fh
+        return
+    cmd = [pigz_bin, '-1', '-c', '-p', str(max(1, threads))]
+    with open(filepath, 'wb') as out_fh:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out_fh)
+        try:
+            yield process.stdin
+        finally:
+            process.stdin.close()
+            returncode = process.wait()
+    if returncode:
+        raise IOError('Compression failed ({0}): {1}'.format(returncode, ' '.join(cmd)))
+
+
+def write_batch_reads(reads_filepaths, batch_reads_filepath, fastx_format, threads=1):
+    """
+    Write the reads of several samples (dict sample index --> reads path)
+    to a single gzip file, their ids prefixed with the sample index.
+    Return two dicts: sample index --> reads nb and
+    sample index --> nucleotides nb
+    """
+    reads_nb = dict()
+    bases_nb = dict()
+    with _gzip_writer(batch_reads_filepath, threads) as out_fh:
+        for sample_index, reads_filepath in reads_filepaths.items():
+            prefix = _prefix(sample_index)
+            records = list()
+            count = 0
+            bases = 0
+            for header, record in _read_records(reads_filepath, fastx_format):
+                records.append(_format_record(prefix + header, record, fastx_format))
+                bases += len(record[0])
+                if len(records) >= _WRITE_BATCH_SIZE:
+                    out_fh.write(b''.join(records))
+                    count += len(records)
+                    records = list()
+            out_fh.write(b''.join(records))
+            reads_nb[sample_index] = count + len(records)
+            bases_nb[sample_index] = bases
+    return reads_nb, bases_nb
+
+
+def evalue_thresholds(evalue, bases_nb):
+    """
+    Scale the E-value threshold of a sample run alone to the batch run
+    (dict sample index --> nucleotides nb, cf. write_batch_reads).
+    Return the threshold of the batch run and a dict
+    sample index --> batch E-value threshold of the sample
+    """
+    total_bases_nb = sum(bases_nb.values())
+    thresholds = {i: evalue * total_bases_nb / max(1, n) for i, n in bases_nb.items()}
+    return max(thresholds.values()), thresholds
+
+
+def _split_prefixed_lines(in_filepath, out_filepaths, copy_headers=False):
+    """
+    Split a text file whose lines start with a prefixed read id.
+    Header lines (starting with @) are copied to all the outputs
+    when copy_headers
+    """
+    out_fhs = {i: open(filepath, 'wb') for i, filepath in out_filepaths.items()}
+    try:
+        for lines in iter_line_blocks(in_filepath, as_bytes=True):
+            routed = collections.defaultdict(list)
+            for line in lines:
+                if copy_headers and line.startswith(b'@'):
+                    for i in out_fhs:
+                        routed[i].append(line)
+                    continue
+                prefix, _, line = line.partition(b'|')
+                routed[int(prefix)].append(line)
+            for i, sample_lines in routed.items():
+                out_fhs[i].write(b'\n'.join(sample_lines) + b'\n')
+    finally:
+        for fh in out_fhs.values():
+            fh.close()
+
+
+def _iter_lines(filepath):
+    for lines in iter_line_blocks(filepath, as_bytes=True):
+        yield from lines
+
+
+def _split_alignments(sam_filepath, blast_filepath, out_filepaths, thresholds):
+    """
+    Split the sam and blast files of a batch run (dict sample index -->
+    (sam path, blast path)), keeping the alignments whose E-value, read
+    from the blast file, passes the sample threshold. SortMeRNA writes
+    the alignments of a read consecutively and in the same order in both
+    files. Return the set of the prefixed ids of the reads left without
+    alignment
+    """
+    rejected_reads = set()
+    routed_sam = collections.defaultdict(list)
+    routed_blast = collections.defaultdict(list)
+    out_fhs = {i: (open(sam_out, 'wb'), open(blast_out, 'wb'))
+               for i, (sam_out, blast_out) in out_filepaths.items()}
+
+    def flush():
+        for i, lines in routed_sam.items():
+            out_fhs[i][0].write(b''.join(lines))
+        for i, lines in routed_blast.items():
+            out_fhs[i][1].write(b''.join(lines))
+        routed_sam.clear()
+        routed_blast.clear()
+
+    try:
+        blast_lines = _iter_lines(blast_filepath)
+        current_read, current_kept = None, True
+        lines_nb = 0
+        for sam_line in _iter_lines(sam_filepath):
+            if sam_line.startswith(b'@'):
+                for i in out_fhs:
+                    routed_sam[i].append(sam_line + b'\n')
+                continue
+            read_id = sam_line.split(b'\t', 1)[0]
+            blast_line = next(blast_lines, b'')
+            blast_fields = blast_line.split(b'\t')
+            if blast_fields[0] != read_id or len(blast_fields) < 11:
+                logger.fatal('The sam and blast files of the batch run do not match (read:{0})'.format(
+                    read_id.decode()))
+                sys.exit('Inconsistent SortMeRNA outputs')
+            if read_id != current_read:
+                if not current_kept:
+                    rejected_reads.add(current_read)
+                current_read, current_kept = read_id, False
+            prefix, _, sam_line = sam_line.partition(b'|')
+            i = int(prefix)
+            if float(blast_fields[10]) <= thresholds[i]:
+                current_kept = True
+                routed_sam[i].append(sam_line + b'\n')
+                routed_blast[i].append(blast_line.partition(b'|')[2] + b'\n')
+            lines_nb += 1
+            if lines_nb % _WRITE_BATCH_SIZE == 0:
+                flush()
+        if not current_kept:
+            rejected_reads.add(current_read)
+        flush()
+    finally:
+        for sam_fh, blast_fh in out_fhs.values():
+            sam_fh.close()
+            blast_fh.close()
+    return rejected_reads
+
+
+def _split_fastx(in_filepath, out_filepaths, fastx_format, rejected_reads=frozenset()):
+    """
+    Split a fasta or fastq file whose read ids are prefixed, without the
+    rejected reads (prefixed ids).
+    Return a dict sample index --> reads nb
+    """
+    reads_nb = {i: 0 for i in out_filepaths}
+    out_fhs = {i: open(filepath, 'wb') for i, filepath in out_filepaths.items()}
+    try:
+        if os.path.exists(in_filepath):
+            for header, record in _read_records(in_filepath, fastx_format):
+                if rejected_reads and header.split(None, 1)[0] in rejected_reads:
+                    continue
+                prefix, _, header = header.partition(b'|')
+                i = int(prefix)
+                out_fhs[i].write(_format_record(header, record, fastx_format))
+                reads_nb[i] += 1
+    finally:
+        for fh in out_fhs.values():
+            fh.close()
+    return reads_nb
+
+
+def split_batch_outputs(batch_basepath, batch_fastx_filepath, samples_fp, fastx_format, thresholds=None):
+    """
+    Split the SortMeRNA outputs of a batch run into the SortMeRNA output
+    files of each sample (dict sample index --> files paths namespace).
+    When thresholds are given (cf. evalue_thresholds), only the
+    alignments passing the E-value threshold of their sample are kept.
+    Return a dict sample index --> selected reads nb
+    """
+    batch_sam_filepath = batch_basepath + '.sam'
+    batch_blast_filepath = batch_basepath + '.blast'
+    rejected_reads = frozenset()
+    if thresholds is not None and os.path.exists(batch_blast_filepath):
+        rejected_reads = _split_alignments(
+            batch_sam_filepath, batch_blast_filepath,
+            {i: (fp.sortme_output_sam_filepath, fp.sortme_output_basepath + '.blast')
+             for i, fp in samples_fp.items()},
+            thresholds)
+    else:
+        _split_prefixed_lines(
+            batch_sam_filepath,
+            {i: fp.sortme_output_sam_filepath for i, fp in samples_fp.items()},
+            copy_headers=True)
+        if os.path.exists(batch_blast_filepath):
+            _split_prefixed_lines(
+                batch_blast_filepath,
+                {i: fp.sortme_output_basepath + '.blast' for i, fp in samples_fp.items()})
+    return _split_fastx(
+        batch_fastx_filepath,
+        {i: fp.sortme_output_fastx_filepath for i, fp in samples_fp.items()},
+        fastx_format, rejected_reads)
+
+
+def write_sample_log(log_filepath, batch_log_filepath, input_reads_nb, selected_reads_nb):
+    """
+    Write the reads numbers of a sample in the SortMeRNA log format
+    (cf. counting.read_sortmerna_log)
+    """
+    with open(log_filepath, 'w') as log_fh:
+        log_fh.write(' Sample reads of the SortMeRNA batch run ({0})\n'.format(batch_log_filepath))
+        log_fh.write('    Total reads = {0}\n'.format(input_reads_nb))
+        log_fh.write('    Total reads passing E-value threshold = {0}\n'.format(selected_reads_nb))
+
+
+def reads_mapping_step(samples_fp, fastx_format, ref_db_filepath, params, binaries=()):
+    """
+    Return the step recording the shared reads mapping of the samples
+    (key=sample index, value=fp) of a reads format in a StageCache.
+    Its fingerprint covers the reads of all the samples, in their batch
+    order, the ref db and the SortMeRNA parameters. Its outputs are the
+    split outputs of each sample
+    """
+    reads_filepaths = [fp.input_fastx_filepath for fp in samples_fp.values()]
+    outputs = [filepath for fp in samples_fp.values()
+               for filepath in (fp.sortme_output_fastx_filepath, fp.sortme_output_sam_filepath,
+                                fp.sortme_output_log_filepath)]
+    return Step('reads_mapping_' + fastx_format, None,
+                inputs=reads_filepaths + [ref_db_filepath],
+                outputs=outputs,
+                params=dict(params, samples=reads_filepaths),
+                binaries=binaries)
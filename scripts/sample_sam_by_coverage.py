@@ -1,11 +1,42 @@
 #!/usr/bin/env python3
 
+"""
+Subsample the alignments of highly covered references.
+
+For each reference, alignments are processed by starting position.
+When the coverage at a position is above the threshold, alignments
+starting there are removed in a random order, as long as they do not
+make the coverage drop below the threshold anywhere on their span.
+
+The input sam file does not need to be sorted. Alignments are bucketed
+by reference in a first pass, as integers only (buckets are spilled to
+disk over a memory limit), the references are sampled one by one, and a
+second pass writes the kept alignments in the input order (ie. grouped
+by read).
+"""
+
+import os
 import sys
-import re
+import zlib
+import array
+import shutil
 import random
+import logging
 import argparse
+import tempfile
+import collections
+import multiprocessing
+
 import numpy as np
 
+from fastx_utils import read_fasta, iter_line_blocks
+from cigar_utils import get_ref_span
+
+logger = logging.getLogger(__name__)
+
+# Default size of the buckets kept in memory before being spilled to disk
+MAX_BUFFER_SIZE = 256 * 1024 * 1024
+
 
 def tab_list_group_by(tab_list, factor_index=0):
     """
@@ -37,120 +68,350 @@ def read_tab_file_handle_sorted(tab_file_handle, factor_index=0):
     tab_file_handle.close()
 
 
-def read_fasta_file_handle(fasta_file_handle):
-    """
-    Parse a fasta file and return a generator
-    """
-    # Variables initialization
-    header = ''
-    seqlines = list()
-    sequence_nb = 0
-    # Reading input file
-    for line in fasta_file_handle:
-        if line[0] == '>':
-            # Yield the last read header and sequence
-            if sequence_nb:
-                yield (header, ''.join(seqlines))
-                del seqlines[:]
-            # Get header
-            header = line[1:].rstrip()
-            sequence_nb += 1
-        else:
-            # Concatenate sequence
-            seqlines.append(line.strip())
-    # Yield the input file last sequence
-    yield (header, ''.join(seqlines))
-    # Close input file
-    fasta_file_handle.close()
+def get_alignment_length_on_ref(cigar):
+    """
+    """
+    return get_ref_span(cigar)
+
+
+def coverage_from_spans(starts, ends, ref_length):
+    """
+    Return the coverage of a reference by the [start, end) spans of its
+    alignments (int arrays), with a difference array: +1 at each start,
+    -1 at each end, then a cumulative sum
+    """
+    starts = np.clip(starts, 0, ref_length)
+    ends = np.clip(ends, starts, ref_length)
+    diff = np.bincount(starts, minlength=ref_length + 1) - np.bincount(ends, minlength=ref_length + 1)
+    return np.cumsum(diff[:ref_length])
+
+
+def compute_ref_coverage(ref_sam_tab_list, ref_length):
+    """
+    """
+    starts = np.array([int(alignment_tab[3]) - 1 for alignment_tab in ref_sam_tab_list], dtype=np.int64) #SAM positions are 1-based
+    lengths = np.array([get_ref_span(alignment_tab[5]) for alignment_tab in ref_sam_tab_list], dtype=np.int64)
+    return coverage_from_spans(starts, starts + lengths, ref_length)
+
+
+def sparse_table(values):
+    """
+    Return the sparse table of an array for range minimum queries:
+    level k holds the minimum of each window of 2**k values
+    """
+    table = [values]
+    width = 1
+    while 2 * width <= len(values):
+        previous = table[-1]
+        table.append(np.minimum(previous[:-width], previous[width:]))
+        width *= 2
+    return table
 
 
-def parse_cigar(cigar):
+def range_min(table, starts, ends):
     """
-    Parse a CIGAR string and return a list of (operation, count) tuples
+    Return the minimum of each non empty [start, end) range (int arrays)
+    of a sparse table, as the minimum of two overlapping windows
+    """
+    levels = np.frexp((ends - starts).astype(np.float64))[1] - 1
+    mins = np.empty(len(starts), dtype=table[0].dtype)
+    for level in np.unique(levels):
+        mask = levels == level
+        level_table = table[level]
+        mins[mask] = np.minimum(level_table[starts[mask]], level_table[ends[mask] - (1 << int(level))])
+    return mins
+
+
+def read_ref_lengths(fasta_ref):
     """
-    cigar_tab = list()
-    count_str = ''
-    for c in cigar:
-        if c.isdigit():
-            count_str += c
+    Return a dict ref id (bytes) --> ref length
+    """
+    return {header.split()[0]: len(seq) for header, seq in read_fasta(fasta_ref, as_bytes=True)}
+
+
+# Under this number of alignments, a bulk removal costs more numpy calls
+# than removing them one by one
+_BULK_REMOVAL_SIZE = 8
+
+
+def sample_reference(line_numbers, starts, lengths, ref_length, threshold, rng=random):
+    """
+    Sample the alignments of a reference, given as int arrays of line
+    numbers, starting positions (0-based) and lengths on the reference.
+    Return the line numbers of the removed alignments
+    """
+    order = np.argsort(starts, kind='stable')
+    line_numbers, starts, lengths = line_numbers[order], starts[order], lengths[order]
+    ends = np.minimum(starts + lengths, ref_length)
+
+    ref_coverage_list = coverage_from_spans(starts, ends, ref_length)
+
+    # The coverage only decreases, so an alignment whose span is already
+    # covered at the threshold somewhere can never be removed
+    removable = ends > starts
+    table = sparse_table(ref_coverage_list)
+    removable[removable] = range_min(table, starts[removable], ends[removable]) > threshold
+
+    # Alignments are removed by starting position, where the coverage
+    # is above the threshold
+    group_starts, group_indices, group_sizes = np.unique(starts, return_index=True, return_counts=True)
+    in_ref = group_starts < ref_length
+    group_starts, group_indices, group_sizes = group_starts[in_ref], group_indices[in_ref], group_sizes[in_ref]
+    over = ref_coverage_list[group_starts] > threshold
+
+    removable = removable.tolist()
+    starts_list, ends_list = starts.tolist(), ends.tolist()
+    removed = list()
+    for first, size in zip(group_indices[over].tolist(), group_sizes[over].tolist()):
+        group_start = starts_list[first]
+        num_alignments_to_remove = int(ref_coverage_list[group_start]) - threshold
+        if num_alignments_to_remove <= 0:
+            continue
+        if size == 1:
+            candidates = [first] if removable[first] else []
         else:
-            operation = c
-            count = 1
-            if count_str:
-                count = int(count_str)
-            if cigar_tab and operation == cigar_tab[-1][0]:
-                cigar_tab[-1][1] += count
-            else:
-                cigar_tab.append((operation, count))
-            count_str = ''
-    #
-    return cigar_tab
+            random_alignments_order_indices = list(range(size))
+            rng.shuffle(random_alignments_order_indices)
+            candidates = [i for i in (j + first for j in random_alignments_order_indices) if removable[i]]
 
+        # Each removal lowers the coverage by one at most, so when many
+        # first candidates can all be removed without reaching the
+        # threshold, they are removed at once
+        selected = candidates[:num_alignments_to_remove]
+        if len(selected) >= _BULK_REMOVAL_SIZE:
+            group_end = max(ends_list[i] for i in selected)
+            span = ref_coverage_list[group_start:group_end]
+            if span.min() - len(selected) >= threshold:
+                ended = np.cumsum(np.bincount(ends[selected] - group_start, minlength=len(span) + 1))
+                span -= len(selected) - ended[:len(span)]
+                removed.extend(selected)
+                continue
 
-def get_alignment_length_on_ref(cigar):
+        for i in candidates:
+            if num_alignments_to_remove <= 0:
+                break
+            # Spans are read long: a contiguous slice minimum is cheaper
+            # than updating a range minimum structure after each removal
+            span = ref_coverage_list[starts_list[i]:ends_list[i]]
+            if span.min() > threshold:
+                span -= 1
+                num_alignments_to_remove -= 1
+                removed.append(i)
+    return line_numbers[removed]
+
+
+def get_reference_seed(seed, ref_id):
     """
+    Return the sampling seed of a reference (bytes id), derived from the
+    global seed. The sampling of a reference does not depend on the
+    other references, nor on the order they are processed in
     """
-    return sum((count for operation, count in parse_cigar(cigar) if operation in ('M','D','N','=','X')))
+    return zlib.crc32(ref_id, seed & 0xffffffff)
 
 
-def compute_ref_coverage(ref_sam_tab_list, ref_length):
+def _sample_reference_task(task):
     """
+    Sample a reference from a picklable task (cf. sample_reference)
     """
-    # Init ref coverage list
-    ref_coverage_list = np.zeros(ref_length, dtype=np.int)
-    # Read alignments on the ref
-    for alignment_tab in ref_sam_tab_list:
-        starting_pos = int(alignment_tab[3]) - 1 #SAM positions are 1-based
-        cigar = alignment_tab[5]
-        alignment_length_on_ref = get_alignment_length_on_ref(cigar)
-        end_pos = starting_pos + alignment_length_on_ref - 1 #We want the last mapped nucleotide, not the first free one
-        ref_coverage_list[starting_pos:end_pos+1] += 1
-    #
-    return ref_coverage_list
-
-
-def sample_by_depth(sam_handler, fasta_ref_handler, threshold, sampled_out_sam_handler):
-    """
-    sample the SAM file based on the coverage at each pos
-    """
-    # Read reference sequences and store them in a dict
-    ref_seq_dict = dict()
-    for header, seq in read_fasta_file_handle(fasta_ref_handler):
-        seqid = header.split()[0]
-        ref_seq_dict[seqid] = seq.upper()
-    # Read SAM by ref
-    # OPTI: instead of storing all SAM records for each ref in mem, we could read twice the file block corresponding to this ref
-    for ref_sam_tab_list in read_tab_file_handle_sorted((l for l in sam_handler if l[0]!='@'), 2):
-        ref_id = ref_sam_tab_list[0][2]
-        ref_length = len(ref_seq_dict[ref_id])
-        # Compute ref coverage list
-        ref_coverage_list = compute_ref_coverage(ref_sam_tab_list, ref_length)
-        #
-        for pos_sam_tab_list in tab_list_group_by(ref_sam_tab_list, 3):
-            starting_pos = int(pos_sam_tab_list[0][3]) - 1 #SAM positions are 1-based
-            ref_coverage = ref_coverage_list[starting_pos]
-            if ref_coverage <= threshold:
-                for alignment_tab in pos_sam_tab_list:
-                    print('{}'.format('\t'.join(alignment_tab)), file=sampled_out_sam_handler)
-            else:
-                num_alignments_to_remove = ref_coverage - threshold
-                random_alignments_order_indices = [i for i in range(len(pos_sam_tab_list))]
-                random.shuffle(random_alignments_order_indices)
-                #
-                for i in random_alignments_order_indices:
-                    alignment_tab = pos_sam_tab_list[i]
-                    if num_alignments_to_remove > 0:
-                        starting_pos = int(alignment_tab[3]) - 1 #SAM positions are 1-based
-                        cigar = alignment_tab[5]
-                        alignment_length_on_ref = get_alignment_length_on_ref(cigar)
-                        end_pos = starting_pos + alignment_length_on_ref - 1 #We want the last mapped nucleotide, not the first free one
-                        if min(ref_coverage_list[starting_pos:end_pos+1]) <= threshold:
-                            print('{}'.format('\t'.join(alignment_tab)), file=sampled_out_sam_handler)
-                        else:
-                            ref_coverage_list[starting_pos:end_pos+1] -= 1
-                            num_alignments_to_remove -= 1
-                    else:
-                        print('{}'.format('\t'.join(alignment_tab)), file=sampled_out_sam_handler)
+    line_numbers, starts, lengths, ref_length, threshold, seed = task
+    return sample_reference(line_numbers, starts, lengths, ref_length, threshold, random.Random(seed))
+
+
+def _iter_sampled_references(tasks, cpu):
+    """
+    Return a generator of the removed line numbers of each sampling
+    task, processed by cpu processes. Only a few tasks are submitted
+    ahead, so the alignments of all the references are not loaded at
+    once
+    """
+    if cpu <= 1:
+        for task in tasks:
+            yield _sample_reference_task(task)
+        return
+    # Pool processes are started by a fork server: forking this process,
+    # whose other threads may hold locks, could deadlock them
+    with multiprocessing.get_context('forkserver').Pool(processes=cpu) as pool:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(_sample_reference_task, (task,)))
+            if len(pending) >= 2 * cpu:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def sample_alignments(ref_index, positions, ref_spans, ref_ids, ref_lengths, threshold, seed=0, cpu=1):
+    """
+    Sample alignments given as int arrays (eg. alignment store columns)
+    of reference index in ref_ids (negative when unaligned), starting
+    position (0-based) and span on the reference. The sampling is the
+    one of sample_sam_file on these alignments written in this order.
+    Return a boolean array of the kept alignments
+    """
+    ref_index = np.asarray(ref_index)
+    keep = np.ones(len(ref_index), dtype=bool)
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    logger.debug('Coverage sampling seed: {0}'.format(seed))
+
+    # Alignments of each reference, in the input order
+    order = np.argsort(ref_index, kind='stable')
+    refs, ref_firsts = np.unique(ref_index[order], return_index=True)
+    ref_lasts = np.append(ref_firsts[1:], len(order))
+
+    def iter_tasks():
+        for ref, first, last in zip(refs.tolist(), ref_firsts.tolist(), ref_lasts.tolist()):
+            if ref < 0:
+                continue
+            ref_id = ref_ids[ref]
+            if ref_id not in ref_lengths:
+                logger.fatal('Reference not found in the references file (id:%s)' % ref_id.decode())
+                sys.exit('Unknown reference')
+            indices = order[first:last]
+            yield (indices, np.asarray(positions)[indices].astype(np.int64),
+                   np.asarray(ref_spans)[indices].astype(np.int64), ref_lengths[ref_id],
+                   threshold, get_reference_seed(seed, ref_id))
+
+    for removed in _iter_sampled_references(iter_tasks(), cpu):
+        keep[removed] = False
+    return keep
+
+
+class _Buckets:
+    """
+    Alignments of each reference, as (line number, position, length on
+    the reference) int64 triples in typed arrays, ie. 24 bytes by
+    alignment without any python object. When the arrays in memory
+    exceed max_buffer_size bytes, they are appended to a binary spill
+    file by reference
+    """
+
+    RECORD_SIZE = 3 * 8
+
+    def __init__(self, tmp_dir, max_buffer_size):
+        self.tmp_dir = tmp_dir
+        self.max_buffer_size = max_buffer_size
+        self.records = dict()
+        self.spill_filepaths = dict()
+        self.buffer_size = 0
+
+    def add(self, ref_id, line_number, position, length):
+        records = self.records.get(ref_id)
+        if records is None:
+            records = self.records[ref_id] = array.array('q')
+        records.extend((line_number, position, length))
+        self.buffer_size += self.RECORD_SIZE
+        if self.buffer_size > self.max_buffer_size:
+            self.spill()
+
+    def spill(self):
+        for ref_id, records in self.records.items():
+            if ref_id not in self.spill_filepaths:
+                self.spill_filepaths[ref_id] = os.path.join(self.tmp_dir, 'ref_{0}'.format(len(self.spill_filepaths)))
+            with open(self.spill_filepaths[ref_id], 'ab') as spill_fh:
+                records.tofile(spill_fh)
+        logger.debug('{0} bytes of alignments spilled to disk'.format(self.buffer_size))
+        self.records.clear()
+        self.buffer_size = 0
+
+    def ref_ids(self):
+        return set(self.records) | set(self.spill_filepaths)
+
+    def alignments(self, ref_id):
+        """
+        Return the line numbers, positions and lengths on the reference
+        of the alignments of a reference, as int arrays. The in-memory
+        records of the reference are released
+        """
+        values = np.frombuffer(self.records.pop(ref_id, array.array('q')), dtype=np.int64)
+        if ref_id in self.spill_filepaths:
+            values = np.concatenate((np.fromfile(self.spill_filepaths.pop(ref_id), dtype=np.int64), values))
+        values = values.reshape(-1, 3)
+        return values[:, 0], values[:, 1], values[:, 2]
+
+
+def _iter_numbered_blocks(in_sam):
+    """
+    Return a generator of (first line number, lines) of the blocks of
+    non empty lines
+    """
+    line_number = 0
+    for lines in iter_line_blocks(in_sam, as_bytes=True):
+        yield line_number, lines
+        line_number += len(lines)
+
+
+def sample_sam_file(in_sam, out_sam, ref_lengths, threshold, tmp_dir=None,
+                    max_buffer_size=MAX_BUFFER_SIZE, seed=0, cpu=1):
+    """
+    Sample a sam file (path) by coverage and write the kept alignments
+    to out_sam (path or binary file handle), in the input order.
+    Header lines are not written.
+
+    The file is read twice. The first pass only keeps integers for each
+    alignment (spilled to tmp_dir over max_buffer_size bytes), and
+    samples the references one at a time. The removal decisions are a
+    boolean by line, the second pass streams the kept lines.
+
+    References are sampled by cpu processes, each one with its own seed
+    derived from seed (a random one when None): the output only depends
+    on the input and the seed.
+    Return the number of input and output alignments
+    """
+    spill_dir = tempfile.mkdtemp(prefix='sample_sam_', dir=tmp_dir)
+    try:
+        # First pass: bucket the alignments by reference
+        buckets = _Buckets(spill_dir, max_buffer_size)
+        lines_nb = 0
+        for first_line_number, lines in _iter_numbered_blocks(in_sam):
+            lines_nb = first_line_number + len(lines)
+            for line_number, line in enumerate(lines, first_line_number):
+                if line.startswith(b'@'):
+                    continue
+                fields = line.split(b'\t', 6)
+                ref_id = fields[2]
+                if ref_id == b'*':
+                    continue
+                if ref_id not in ref_lengths:
+                    logger.fatal('Reference not found in the references file (id:%s, file:%s)' % (ref_id.decode(), in_sam))
+                    sys.exit('Unknown reference')
+                # SAM positions are 1-based
+                buckets.add(ref_id, line_number, int(fields[3]) - 1, get_ref_span(fields[5]))
+
+        # Sample each reference
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        logger.debug('Coverage sampling seed: {0}'.format(seed))
+        tasks = (buckets.alignments(ref_id) + (ref_lengths[ref_id], threshold, get_reference_seed(seed, ref_id))
+                 for ref_id in sorted(buckets.ref_ids()))
+        keep = np.ones(lines_nb, dtype=bool)
+        for removed in _iter_sampled_references(tasks, cpu):
+            keep[removed] = False
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # Second pass: write the kept alignments, in the input order
+    in_alignments_nb = 0
+    out_alignments_nb = 0
+    out_fh = open(out_sam, 'wb') if isinstance(out_sam, str) else out_sam
+    try:
+        for first_line_number, lines in _iter_numbered_blocks(in_sam):
+            block_keep = keep[first_line_number:first_line_number + len(lines)].tolist()
+            kept_lines = list()
+            for line, kept in zip(lines, block_keep):
+                if line.startswith(b'@'):
+                    continue
+                in_alignments_nb += 1
+                if kept:
+                    kept_lines.append(line)
+            if kept_lines:
+                out_fh.write(b'\n'.join(kept_lines) + b'\n')
+                out_alignments_nb += len(kept_lines)
+    finally:
+        if out_fh is not out_sam:
+            out_fh.close()
+
+    return in_alignments_nb, out_alignments_nb
 
 
 if __name__ == '__main__':
@@ -159,19 +420,17 @@ if __name__ == '__main__':
     # -i / --input_sam
     parser.add_argument('-i', '--input_sam',
                         metavar='INSAM',
-                        type=argparse.FileType('r'),
                         default='-',
-                        help='Input sam file, sorted by reference and position')
+                        help='Input sam file, in any order')
     # -o / --output_sam
     parser.add_argument('-o', '--output_sam',
                         metavar='OUTSAM',
-                        type=argparse.FileType('w'),
+                        type=argparse.FileType('wb'),
                         default='-',
-                        help='Output filtered sam file')
+                        help='Output filtered sam file, in the input order')
     # -r / --references
     parser.add_argument('-r', '--references',
                         metavar='REF',
-                        type=argparse.FileType('r'),
                         required=True,
                         help='References fasta file')
     # -c / --cov_threshold
@@ -181,8 +440,47 @@ if __name__ == '__main__':
                         default=50,
                         help='Identity threshold. '
                              'Default is %(default)s')
+    # --tmp_dir
+    parser.add_argument('--tmp_dir',
+                        metavar='DIR',
+                        help='Directory of the temporary files. '
+                             'Default is the system temporary directory')
+    # --seed
+    parser.add_argument('--seed',
+                        metavar='INT',
+                        type=int,
+                        help='Seed of the sampling. The same input and seed give the same output. '
+                             'Default is a random seed')
+    # --cpu
+    parser.add_argument('--cpu',
+                        metavar='CPU',
+                        type=int,
+                        default=1,
+                        help='Number of processes sampling the references. '
+                             'Default is %(default)s cpu')
+    # --max_buffer_size
+    parser.add_argument('--max_buffer_size',
+                        metavar='MB',
+                        type=int,
+                        default=MAX_BUFFER_SIZE // 1024 // 1024,
+                        help='Alignments kept in memory before being spilled to disk (in MBi). '
+                             'Default is %(default)s MBi')
     #
     args = parser.parse_args()
-    #
-    random.seed()
-    sample_by_depth(args.input_sam, args.references, args.cov_threshold, args.output_sam)
\ No newline at end of file
+
+    # The input is read twice, so it is copied when read from stdin
+    input_sam = args.input_sam
+    tmp_input = None
+    if input_sam == '-':
+        fd, tmp_input = tempfile.mkstemp(suffix='.sam', dir=args.tmp_dir)
+        with os.fdopen(fd, 'wb') as tmp_fh:
+            shutil.copyfileobj(sys.stdin.buffer, tmp_fh)
+        input_sam = tmp_input
+    try:
+        sample_sam_file(input_sam, args.output_sam, read_ref_lengths(args.references),
+                        args.cov_threshold, tmp_dir=args.tmp_dir,
+                        max_buffer_size=args.max_buffer_size * 1024 * 1024,
+                        seed=args.seed, cpu=args.cpu)
+    finally:
+        if tmp_input is not None:
+            os.remove(tmp_input)
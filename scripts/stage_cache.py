@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes read at the beginning and at the end of a file
+# to compute its quick digest
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(filepath, chunk_size=DIGEST_CHUNK_SIZE):
+    """
+    Compute a quick content digest of a file from its size and its first
+    and last chunk_size bytes. This is cheap even on multi-GB files and is
+    only used to tell apart a rewritten file from a touched one
+    """
+    h = hashlib.sha1()
+    size = os.path.getsize(filepath)
+    h.update(str(size).encode())
+    with open(filepath, 'rb') as fh:
+        h.update(fh.read(chunk_size))
+        if size > 2 * chunk_size:
+            fh.seek(-chunk_size, os.SEEK_END)
+        h.update(fh.read(chunk_size))
+    return h.hexdigest()
+
+
+def file_signature(filepath, with_digest=True):
+    """
+    Return the signature of a file (size, mtime and quick digest),
+    or None if the file does not exist
+    """
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    signature = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if with_digest:
+        signature['digest'] = file_digest(filepath)
+    return signature
+
+
+def same_file_content(recorded, current):
+    """
+    Compare two file signatures. Files are considered identical when
+    sizes are equal and either mtimes or content digests are equal
+    """
+    if recorded is None or current is None:
+        return recorded is current
+    if recorded['size'] != current['size']:
+        return False
+    if recorded['mtime_ns'] == current['mtime_ns']:
+        return True
+    return recorded.get('digest') is not None and recorded.get('digest') == current.get('digest')
+
+
+def binary_signature(binary_path):
+    """
+    Return the signature of a binary (path, size and mtime). A rebuilt
+    or upgraded binary invalidates the steps using it
+    """
+    if binary_path is None:
+        return None
+    signature = file_signature(binary_path, with_digest=False)
+    if signature is None:
+        return None
+    signature['path'] = os.path.realpath(binary_path)
+    return signature
+
+
+class StageCache:
+    """
+    Record a fingerprint for each step run and tell whether a step
+    outputs are still valid.
+
+    The fingerprint of a step is made of its parameters, the signatures
+    of its input files and the signatures of the binaries it runs. A step
+    is up to date when its fingerprint did not change since its last
+    successful run and its outputs were not modified since.
+
+    Records are stored as json files in cache_dir, one per (step name,
+    outputs) so that runs with different parameters writing to different
+    files do not overwrite each other records.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _record_filepath(self, step):
+        key = json.dumps([step.name, sorted(step.outputs)])
+        return os.path.join(self.cache_dir, '{0}.{1}.json'.format(step.name, hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+    def fingerprint(self, step):
+        """
+        Compute the current fingerprint of a step
+        """
+        return {
+            'params': json.loads(json.dumps(step.params, sort_keys=True)),
+            'binaries': {b: binary_signature(b) for b in sorted(step.binaries)},
+            'inputs': {f: file_signature(f) for f in sorted(step.inputs)},
+        }
+
+    def _load(self, step):
+        try:
+            with open(self._record_filepath(step), 'r') as record_fh:
+                return json.load(record_fh)
+        except (OSError, ValueError):
+            return None
+
+    def is_up_to_date(self, step):
+        """
+        Return True if the step outputs are still valid
+        """
+        if not step.outputs:
+            return False
+        record = self._load(step)
+        if record is None:
+            return False
+
+        current = self.fingerprint(step)
+        if record['params'] != current['params']:
+            logger.debug('{0}: parameters changed'.format(step.name))
+            return False
+        if record['binaries'] != current['binaries']:
+            logger.debug('{0}: binaries changed'.format(step.name))
+            return False
+        if set(record['inputs']) != set(current['inputs']):
+            return False
+        for filepath, signature in current['inputs'].items():
+            if signature is None or not same_file_content(record['inputs'][filepath], signature):
+                logger.debug('{0}: input changed: {1}'.format(step.name, filepath))
+                return False
+        for filepath in step.outputs:
+            recorded = record['outputs'].get(filepath)
+            signature = file_signature(filepath, with_digest=False)
+            if signature is not None and recorded is not None and signature['mtime_ns'] != recorded['mtime_ns']:
+                # Only compute the content digest when needed
+                signature = file_signature(filepath)
+            if signature is None or not same_file_content(recorded, signature):
+                logger.debug('{0}: output missing or modified: {1}'.format(step.name, filepath))
+                return False
+        return True
+
+    def invalidate(self, step):
+        """
+        Remove the step record, eg. before running it
+        """
+        try:
+            os.remove(self._record_filepath(step))
+        except OSError:
+            pass
+
+    def save(self, step):
+        """
+        Record the fingerprint and outputs signatures of a step that
+        just ran successfully
+        """
+        record = self.fingerprint(step)
+        record['outputs'] = {f: file_signature(f) for f in step.outputs}
+        tmp_filepath = self._record_filepath(step) + '.tmp'
+        with open(tmp_filepath, 'w') as record_fh:
+            json.dump(record, record_fh, indent=1, sort_keys=True)
+        os.replace(tmp_filepath, self._record_filepath(step))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+"""
+Interned taxonomies.
+
+A taxonomy is a ';' separated lineage. Each taxon is interned as an
+integer id given its parent, so that a taxonomy is the path of its taxon
+ids from the root, and comparing lineages is comparing integers.
+
+TaxoTrie interns the taxonomies met on the fly. TaxonomyIndex is the
+frozen taxonomy of a ref db, built once at db preprocessing time next to
+the *.taxo.tab file, and memory mapped by its consumers.
+
+Index file layout: a magic string, the length of a json header (uint64,
+little endian), the json header (counts, signature of the source taxo
+file, dtype, offset and length of each column), then the columns, each
+one starting on a 64 bytes boundary.
+
+Columns, for t taxa and r references:
+    parents       int32[t]   parent taxon id, -1 for the top level taxa
+    depths        uint16[t]  depth of the taxon, 1 for the top level taxa
+    names         uint8      taxa names, concatenated
+    names_offsets int64[t+1] start of each taxon name
+    ref_ids       S[r]       reference ids, sorted
+    ref_taxa      int32[r]   taxon id of each reference
+Taxon ids are numbered in the order of the lineages strings, so sorting
+taxon ids sorts their lineages.
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import logging
+import argparse
+
+import numpy as np
+
+from stage_cache import file_signature, same_file_content
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MATAMTAX'
+VERSION = 1
+_ALIGNMENT = 64
+
+
+class TaxoTrie:
+    """
+    Trie of the taxonomies. Each taxon is interned as an integer node id
+    given its parent node, so that a taxonomy is stored once, as the
+    path of its node ids from the root
+    """
+
+    def __init__(self, sep=';'):
+        self.sep = sep
+        self.node_ids = dict()
+        self.names = list()
+        self.parents = list()
+        self.depths = list()
+        self.paths = dict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def path(self, taxo):
+        """
+        Return the node ids path of a taxonomy (separated string),
+        adding its missing nodes
+        """
+        path = self.paths.get(taxo)
+        if path is None:
+            path = list()
+            parent_id = -1
+            for name in taxo.split(self.sep):
+                node_id = self.node_ids.get((parent_id, name))
+                if node_id is None:
+                    node_id = len(self.names)
+                    self.node_ids[(parent_id, name)] = node_id
+                    self.names.append(name)
+                    self.parents.append(parent_id)
+                    self.depths.append(len(path) + 1)
+                path.append(node_id)
+                parent_id = node_id
+            path = self.paths[taxo] = tuple(path)
+        return path
+
+    def lineage(self, node_id):
+        """
+        Return the taxonomy of a node (separated string)
+        """
+        names = list()
+        while node_id >= 0:
+            names.append(self.names[node_id])
+            node_id = self.parents[node_id]
+        return self.sep.join(reversed(names))
+
+
+def read_ref_taxo(taxo_tab_filepath):
+    """
+    Read a (ref, taxo) tab file. Return a dict: ref --> taxo
+    """
+    with open(taxo_tab_filepath, 'r') as taxo_tab_fh:
+        return {t[0]: t[1] for t in (l.split() for l in taxo_tab_fh) if len(t) > 1}
+
+
+def write_taxonomy_index(taxo_tab_filepath, index_filepath):
+    """
+    Build the taxonomy index of a (ref, taxo) tab file.
+    Return the number of taxa
+    """
+    ref_taxo_dict = read_ref_taxo(taxo_tab_filepath)
+
+    # All the lineages, sorted to number the taxa
+    lineages = set()
+    for taxo in set(ref_taxo_dict.values()):
+        names = taxo.split(';')
+        lineages.update(';'.join(names[:i + 1]) for i in range(len(names)))
+    lineages = sorted(lineages)
+    taxon_ids = {lineage: taxon_id for taxon_id, lineage in enumerate(lineages)}
+
+    parents = np.empty(len(lineages), dtype='<i4')
+    depths = np.empty(len(lineages), dtype='<u2')
+    names = list()
+    for taxon_id, lineage in enumerate(lineages):
+        parent_lineage, sep, name = lineage.rpartition(';')
+        parents[taxon_id] = taxon_ids[parent_lineage] if sep else -1
+        depths[taxon_id] = lineage.count(';') + 1
+        names.append(name.encode())
+    names_offsets = np.zeros(len(names) + 1, dtype='<i8')
+    np.cumsum([len(n) for n in names], out=names_offsets[1:])
+
+    ref_ids = sorted(r.encode() for r in ref_taxo_dict)
+    ref_taxa = np.array([taxon_ids[ref_taxo_dict[r.decode()]] for r in ref_ids], dtype='<i4')
+    ref_ids = np.array(ref_ids, dtype='S{0}'.format(max([len(r) for r in ref_ids], default=1)))
+
+    columns = (
+        ('parents', parents),
+        ('depths', depths),
+        ('names', np.frombuffer(b''.join(names), dtype='u1')),
+        ('names_offsets', names_offsets),
+        ('ref_ids', ref_ids),
+        ('ref_taxa', ref_taxa),
+    )
+    header = {
+        'version': VERSION,
+        'taxa_nb': len(lineages),
+        'refs_nb': len(ref_ids),
+        'source': file_signature(taxo_tab_filepath),
+        'columns': dict(),
+    }
+    offset = 0
+    for name, column in columns:
+        header['columns'][name] = {'dtype': column.dtype.str, 'offset': offset, 'length': len(column)}
+        offset += -(-column.nbytes // _ALIGNMENT) * _ALIGNMENT
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // _ALIGNMENT) * _ALIGNMENT
+
+    with open(index_filepath, 'wb') as out_fh:
+        out_fh.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for name, column in columns:
+            out_fh.seek(data_start + header['columns'][name]['offset'])
+            out_fh.write(column.tobytes())
+        out_fh.truncate(data_start + offset)
+
+    return len(lineages)
+
+
+class TaxonomyIndex:
+    """
+    Read access to a taxonomy index file. Columns are memory mapped
+    numpy arrays. Has the TaxoTrie interface, with taxon ids as taxa
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, 'rb') as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError('Not a taxonomy index: {0}'.format(filepath))
+            header_length, = struct.unpack('<Q', fh.read(8))
+            header = json.loads(fh.read(header_length).decode())
+        if header['version'] != VERSION:
+            raise ValueError('Unsupported taxonomy index version: {0}'.format(header['version']))
+        self.data_start = -(-(len(MAGIC) + 8 + header_length) // _ALIGNMENT) * _ALIGNMENT
+        self.taxa_nb = header['taxa_nb']
+        self.refs_nb = header['refs_nb']
+        # Indexes written before the signature only have the size
+        self.source = header.get('source')
+        self.columns = header['columns']
+        with open(filepath, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.parents = self.column('parents')
+        self.depths = self.column('depths')
+        self.paths = dict()
+
+    def __len__(self):
+        return self.taxa_nb
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release the memory mapping
+        """
+        self.parents = self.depths = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Columns are still referenced, the mapping is released with them
+            pass
+
+    def column(self, name):
+        """
+        Return a column, as a read-only numpy array
+        """
+        column = self.columns[name]
+        return np.frombuffer(self._mmap, dtype=column['dtype'], count=column['length'],
+                             offset=self.data_start + column['offset'])
+
+    def is_built_from(self, taxo_tab_filepath):
+        """
+        Whether the index is up to date with a taxo tab file: same size,
+        and same mtime or same content digest
+        """
+        return same_file_content(self.source, file_signature(taxo_tab_filepath))
+
+    def name(self, taxon_id):
+        """
+        Return the name of a taxon
+        """
+        offsets = self.column('names_offsets')
+        start, end = int(offsets[taxon_id]), int(offsets[taxon_id + 1])
+        return self._mmap[self.data_start + self.columns['names']['offset'] + start:
+                          self.data_start + self.columns['names']['offset'] + end].decode()
+
+    def path(self, taxon_id):
+        """
+        Return the taxon ids path of a taxon, from the root
+        """
+        path = self.paths.get(taxon_id)
+        if path is None:
+            parent_id = int(self.parents[taxon_id])
+            path = self.paths[taxon_id] = (self.path(parent_id) if parent_id >= 0 else ()) + (taxon_id,)
+        return path
+
+    def lineage(self, taxon_id):
+        """
+        Return the taxonomy of a taxon (';' separated string)
+        """
+        if taxon_id < 0:
+            return ''
+        return ';'.join(self.name(t) for t in self.path(taxon_id))
+
+    def ref_taxa(self, ref_ids):
+        """
+        Return the taxon ids of references (str), -1 for references
+        missing from the index
+        """
+        index_ref_ids = self.column('ref_ids')
+        ref_ids = [r.encode() for r in ref_ids]
+        if not ref_ids or not len(index_ref_ids):
+            return np.full(len(ref_ids), -1, dtype=np.int32)
+        # Longer ids would be truncated by the conversion
+        keys = np.array([r if len(r) <= index_ref_ids.itemsize else b'' for r in ref_ids],
+                        dtype=index_ref_ids.dtype)
+        positions = np.minimum(np.searchsorted(index_ref_ids, keys), len(index_ref_ids) - 1)
+        found = (index_ref_ids[positions] == keys) & (keys != b'')
+        return np.where(found, self.column('ref_taxa')[positions], -1)
+
+
+if __name__ == '__main__':
+
+    # Arguments parsing
+    parser = argparse.ArgumentParser(description='Build the taxonomy index of a ref db taxo file')
+    parser.add_argument('-i', '--input_tab', metavar='TAB',
+                        type=str, required=True,
+                        help='input (ref, taxo) tab file')
+    parser.add_argument('-o', '--output_index', metavar='INDEX',
+                        type=str, required=True,
+                        help='output taxonomy index file')
+    args = parser.parse_args()
+
+    taxa_nb = write_taxonomy_index(args.input_tab, args.output_index)
+    sys.stderr.write('{0} taxa indexed\n'.format(taxa_nb))
+
+    exit(0)
@@ -0,0 +1,119 @@
+import io
+import os
+import sys
+import random
+
+import pytest
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+from alignment_store import AlignmentStore, AlignmentStoreWriter, sam_to_store, MISSING_SCORE
+from filter_score_multialign import filter_sam_file, filter_scores
+from sample_sam_by_coverage import sample_sam_file, sample_alignments
+
+
+SAM_LINES = [
+    '@HD\tVN:1.0',
+    '@SQ\tSN:a\tLN:100',
+    'r1\t0\ta\t1\t255\t20M\t*\t0\t0\tACGTNACGTRACGTACGTAC\tIIIIIIIIIIIIIIIIIIII\tAS:i:40\tNM:i:0',
+    'r1\t16\tb\t12\t30\t3S10M2I5M\t=\t40\t-35\tacgtACGTACGTACGTACGT\t*\tNM:i:1\tAS:i:-3',
+    'r2\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*',
+    'r3\t0\ta\t50\t255\t10M2D10M\ta\t7\t0\tACGTACGTACGTACGTACGT\t*\tAS:i:35',
+]
+
+
+def _write_sam(tmpdir, lines, name='in.sam'):
+    sam_filepath = os.path.join(str(tmpdir), name)
+    with open(sam_filepath, 'w') as sam_fh:
+        sam_fh.write('\n'.join(lines) + '\n')
+    return sam_filepath
+
+
+def test_roundtrip(tmpdir):
+    sam_filepath = _write_sam(tmpdir, SAM_LINES)
+    store_filepath = os.path.join(str(tmpdir), 'in.store')
+    assert sam_to_store(sam_filepath, store_filepath) == 4
+    with AlignmentStore(store_filepath) as store:
+        assert (store.reads_nb, store.ref_names) == (3, [b'a', b'b'])
+        assert store.sam_header == SAM_LINES[:2]
+        assert store.column('read_index').tolist() == [0, 0, 1, 2]
+        assert store.column('ref_index').tolist() == [0, 1, -1, 0]
+        assert store.column('pos').tolist() == [0, 11, -1, 49]
+        assert store.column('ref_span').tolist() == [20, 15, 0, 22]
+        assert store.column('score').tolist() == [40, -3, MISSING_SCORE, 35]
+        out_fh = io.BytesIO()
+        store.write_sam(out_fh, header=True)
+        # IUPAC codes are kept, the sequence case is not
+        expected = '\n'.join(SAM_LINES).replace('acgt', 'ACGT') + '\n'
+        assert out_fh.getvalue().decode() == expected
+    # Temporary column files are removed
+    assert sorted(os.listdir(str(tmpdir))) == ['in.sam', 'in.store']
+
+
+def test_reads_across_chunks(tmpdir):
+    store_filepath = os.path.join(str(tmpdir), 'in.store')
+    lines = [l.encode() for l in SAM_LINES[2:]]
+    with AlignmentStoreWriter(store_filepath) as writer:
+        writer.add_sam_lines(lines[:1])
+        writer.add_sam_lines(lines[1:])
+    with AlignmentStore(store_filepath) as store:
+        assert store.column('read_index').tolist() == [0, 0, 1, 2]
+        # Lines are written in the order of the indices
+        assert [l for b in store.iter_sam_lines([3, 0]) for l in b] == [lines[3].replace(b'acgt', b'ACGT'),
+                                                                     lines[0]]
+
+
+def test_copy_from_source(tmpdir):
+    sam_filepath = _write_sam(tmpdir, SAM_LINES)
+    store_filepath = os.path.join(str(tmpdir), 'in.store')
+    sam_to_store(sam_filepath, store_filepath, records=False)
+    with AlignmentStore(store_filepath) as store:
+        out_fh = io.BytesIO()
+        assert store.write_sam(out_fh, [3, 1], source=sam_filepath) == 2
+        assert out_fh.getvalue().decode() == SAM_LINES[5] + '\n' + SAM_LINES[3] + '\n'
+        with pytest.raises(ValueError):
+            store.write_sam(io.BytesIO())
+        other_filepath = _write_sam(tmpdir, SAM_LINES[:-1], 'other.sam')
+        with pytest.raises(ValueError):
+            store.write_sam(io.BytesIO(), source=other_filepath)
+
+
+def _make_sam(tmpdir):
+    rng = random.Random(1)
+    lines = list()
+    for i in range(300):
+        for _ in range(rng.randint(1, 4)):
+            lines.append('r{0}\t0\t{1}\t{2}\t255\t20M\t*\t0\t0\tACGT\t*\tAS:i:{3}\tNM:i:0'.format(
+                i, rng.choice('ab'), rng.randint(1, 81), rng.randint(20, 40)))
+    return _write_sam(tmpdir, lines)
+
+
+@pytest.mark.parametrize('geometric', [False, True])
+def test_filters_on_columns(tmpdir, geometric):
+    """
+    The filters on the store columns give the sam file filters output
+    """
+    sam_filepath = _make_sam(tmpdir)
+    filt_fh = io.BytesIO()
+    filter_sam_file(sam_filepath, filt_fh, 0.8, geometric)
+    filt_filepath = os.path.join(str(tmpdir), 'filt.sam')
+    with open(filt_filepath, 'wb') as out_fh:
+        out_fh.write(filt_fh.getvalue())
+    cov_fh = io.BytesIO()
+    ref_lengths = {b'a': 100, b'b': 100}
+    sample_sam_file(filt_filepath, cov_fh, ref_lengths, 20, tmp_dir=str(tmpdir), seed=3)
+
+    store_filepath = os.path.join(str(tmpdir), 'in.store')
+    sam_to_store(sam_filepath, store_filepath, records=False)
+    with AlignmentStore(store_filepath) as store:
+        kept = filter_scores(store.column('read_index'), store.column('score'), 0.8, geometric)
+        out_fh = io.BytesIO()
+        store.write_sam(out_fh, kept, source=sam_filepath)
+        assert out_fh.getvalue() == filt_fh.getvalue()
+        sampled = kept[sample_alignments(store.column('ref_index')[kept], store.column('pos')[kept],
+                                         store.column('ref_span')[kept], store.ref_names, ref_lengths, 20, seed=3)]
+        out_fh = io.BytesIO()
+        store.write_sam(out_fh, sampled, source=sam_filepath)
+        assert out_fh.getvalue() == cov_fh.getvalue()
@@ -0,0 +1,171 @@
+import io
+import os
+import sys
+import gzip
+import random
+import struct
+import subprocess
+
+import numpy as np
+import pytest
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+from bam_utils import BgzfWriter, BGZF_EOF, BGZF_BLOCK_SIZE, encode_tags, reg2bin, BAM_RECORD_DTYPE
+from alignment_store import AlignmentStore, sam_to_store
+from binary_utils import Binary
+
+
+def test_bgzf_writer():
+    data = os.urandom(3 * BGZF_BLOCK_SIZE) + b'ACGT' * 50000
+    outputs = list()
+    for threads in (1, 3):
+        out_fh = io.BytesIO()
+        with BgzfWriter(out_fh, threads=threads) as writer:
+            for k in range(0, len(data), 10000):
+                writer.write(data[k:k + 10000])
+        outputs.append(out_fh.getvalue())
+    assert outputs[0] == outputs[1]
+    assert outputs[0].endswith(BGZF_EOF)
+    # BGZF files are gzip files
+    assert gzip.decompress(outputs[0]) == data
+    # Each block gives its size
+    bgzf = outputs[0]
+    offset = 0
+    while offset < len(bgzf):
+        assert bgzf[offset + 12:offset + 16] == b'BC\x02\x00'
+        offset += struct.unpack('<H', bgzf[offset + 16:offset + 18])[0] + 1
+    assert offset == len(bgzf)
+
+
+def test_encode_tags():
+    assert encode_tags(b'AS:i:40\tNM:i:-1') == b'ASC\x28NMc\xff'
+    assert encode_tags(b'XS:i:70000\tXZ:Z:ab') == b'XSI' + struct.pack('<I', 70000) + b'XZZab\x00'
+    assert encode_tags(b'XB:B:s,1,-2') == b'XBBs' + struct.pack('<ihh', 2, 1, -2)
+    assert encode_tags(b'') == b''
+
+
+def test_reg2bin():
+    assert reg2bin([-1, 0, 16383, 16383, 1 << 26], [0, 100, 16384, 16385, (1 << 26) + 1]).tolist() == \
+        [4680, 4681, 4681, 585, 4681 + (1 << 12)]
+
+
+def _read_bam(bam_bytes):
+    """
+    Minimal BAM parser: return the header text, the references and the
+    records (fixed part, read name, cigar, packed sequence, qualities, tags)
+    """
+    data = gzip.decompress(bam_bytes)
+    assert data[:4] == b'BAM\1'
+    l_text, = struct.unpack_from('<i', data, 4)
+    text = data[8:8 + l_text].decode()
+    offset = 8 + l_text
+    n_ref, = struct.unpack_from('<i', data, offset)
+    offset += 4
+    references = list()
+    for _ in range(n_ref):
+        l_name, = struct.unpack_from('<i', data, offset)
+        name = data[offset + 4:offset + 3 + l_name]
+        l_ref, = struct.unpack_from('<i', data, offset + 4 + l_name)
+        references.append((name, l_ref))
+        offset += 8 + l_name
+    records = list()
+    while offset < len(data):
+        fixed = np.frombuffer(data, dtype=BAM_RECORD_DTYPE, count=1, offset=offset)[0]
+        end = offset + 4 + int(fixed['block_size'])
+        offset += BAM_RECORD_DTYPE.itemsize
+        name = data[offset:offset + fixed['l_read_name'] - 1]
+        offset += int(fixed['l_read_name'])
+        cigar = np.frombuffer(data, dtype='<u4', count=int(fixed['n_cigar_op']), offset=offset).tolist()
+        offset += 4 * int(fixed['n_cigar_op'])
+        seq = data[offset:offset + (int(fixed['l_seq']) + 1) // 2]
+        offset += len(seq)
+        qual = data[offset:offset + int(fixed['l_seq'])]
+        offset += len(qual)
+        records.append((fixed, name, cigar, seq, qual, data[offset:end]))
+        offset = end
+    return text, references, records
+
+
+def test_write_bam(tmpdir):
+    lines = [
+        '@HD\tVN:1.0',
+        '@SQ\tSN:a\tLN:100',
+        '@SQ\tSN:b\tLN:200',
+        '@PG\tID:sortmerna',
+        'r1\t0\tb\t1\t255\t3S5M\t*\t0\t0\tACGTNAC\t+++++++\tAS:i:40',
+        'r2\t16\ta\t20\t30\t6M\t=\t40\t-35\tACGTAC\t*\tAS:i:-3\tNM:i:0',
+        'r3\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*',
+    ]
+    sam_filepath = os.path.join(str(tmpdir), 'in.sam')
+    with open(sam_filepath, 'w') as sam_fh:
+        sam_fh.write('\n'.join(lines) + '\n')
+    store_filepath = os.path.join(str(tmpdir), 'in.store')
+    sam_to_store(sam_filepath, store_filepath)
+    out_fh = io.BytesIO()
+    with AlignmentStore(store_filepath) as store:
+        assert store.write_bam(out_fh, [1, 0, 2]) == 3
+    text, references, records = _read_bam(out_fh.getvalue())
+    assert text == '\n'.join(lines[:4]) + '\n'
+    assert references == [(b'a', 100), (b'b', 200)]
+
+    (fixed, name, cigar, seq, qual, tags) = records[0]
+    assert name == b'r2'
+    assert (fixed['ref_id'], fixed['pos'], fixed['next_ref_id'], fixed['next_pos'], fixed['tlen']) == (0, 19, 0, 39, -35)
+    assert (fixed['flag'], fixed['mapq'], fixed['bin'], fixed['l_seq']) == (16, 30, 4681, 6)
+    assert cigar == [6 << 4]
+    assert seq == bytes([0x12, 0x48, 0x12])
+    assert qual == b'\xff' * 6
+    assert tags == b'ASc\xfdNMC\x00'
+
+    (fixed, name, cigar, seq, qual, tags) = records[1]
+    assert (name, fixed['ref_id'], fixed['pos']) == (b'r1', 1, 0)
+    assert cigar == [3 << 4 | 4, 5 << 4]
+    # Odd length sequences are padded
+    assert seq == bytes([0x12, 0x48, 0xf1, 0x20])
+    assert qual == b'\x0a' * 7
+
+    (fixed, name, cigar, seq, qual, tags) = records[2]
+    assert (name, fixed['ref_id'], fixed['pos'], fixed['bin'], fixed['l_seq']) == (b'r3', -1, -1, 4680, 0)
+    assert (cigar, seq, qual, tags) == ([], b'', b'', b'')
+
+
+@pytest.mark.skipif(
+    not Binary.which('ovgraphbuild'),
+    reason='ovgraphbuild is missing'
+)
+def test_ovgraphbuild_bam_input(tmpdir):
+    """
+    ovgraphbuild builds the same overlap graph from the filtered
+    alignments given as SAM or as BAM
+    """
+    rng = random.Random(0)
+    ref = ''.join(rng.choice('ACGT') for _ in range(400))
+    ref_filepath = os.path.join(str(tmpdir), 'ref.fa')
+    with open(ref_filepath, 'w') as ref_fh:
+        ref_fh.write('>ref\n{0}\n'.format(ref))
+    sam_filepath = os.path.join(str(tmpdir), 'in.sam')
+    with open(sam_filepath, 'w') as sam_fh:
+        for k, pos in enumerate(range(0, 301, 25)):
+            sam_fh.write('\t'.join(('r{0}'.format(k), '0', 'ref', str(pos + 1), '255', '100M', '*', '0', '0',
+                                    ref[pos:pos + 100], '*', 'AS:i:100')) + '\n')
+    store_filepath = os.path.join(str(tmpdir), 'in.store')
+    sam_to_store(sam_filepath, store_filepath)
+    bam_filepath = os.path.join(str(tmpdir), 'in.bam')
+    with AlignmentStore(store_filepath) as store:
+        store.write_bam(bam_filepath, references=[(b'ref', len(ref))], level=1)
+
+    graphs = list()
+    for alignments_filepath in (sam_filepath, bam_filepath):
+        basepath = alignments_filepath + '.ovgb'
+        subprocess.check_call([Binary.which('ovgraphbuild'), '-i', '1.0', '-m', '50', '--csv',
+                               '--output_basename', basepath, '-r', ref_filepath, '-s', alignments_filepath])
+        graph = list()
+        for ext in ('.nodes.csv', '.edges.csv'):
+            with open(basepath + ext) as csv_fh:
+                graph.append(sorted(csv_fh))
+        graphs.append(graph)
+    assert len(graphs[0][1]) > 1
+    assert graphs[0] == graphs[1]
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+from cigar_utils import cigar_info, parse_cigar, get_ref_span, get_operations_count
+
+
+def test_cigar_info():
+    info = cigar_info('5H3S10M2I4D1N2=3X6S')
+    assert info.codes == bytes([5, 4, 0, 1, 2, 3, 7, 8, 4])
+    assert info.counts == (5, 3, 10, 2, 4, 1, 2, 3, 6)
+    assert info.ref_span == 10 + 4 + 1 + 2 + 3
+    assert info.query_span == 10 + 2 + 2 + 3
+    assert (info.left_clip, info.right_clip) == (3, 6)
+
+
+def test_cigar_info_bytes_and_edge_cases():
+    assert cigar_info(b'100M') == cigar_info('100M')
+    assert cigar_info('M').ref_span == 1
+    assert cigar_info('*').ref_span == 0
+    only_clip = cigar_info('10S')
+    assert (only_clip.left_clip, only_clip.right_clip) == (10, 0)
+    with pytest.raises(ValueError):
+        cigar_info('10M5')
+    with pytest.raises(ValueError):
+        cigar_info('10Q')
+
+
+def test_parse_cigar_merges_operations():
+    assert parse_cigar('5M3M2D') == [('M', 8), ('D', 2)]
+    # The returned list can be modified without altering the cache
+    cigar_tab = parse_cigar('2S10M')
+    del cigar_tab[0]
+    assert parse_cigar('2S10M') == [('S', 2), ('M', 10)]
+
+
+def test_counts():
+    assert get_ref_span('10M2I3D5M') == 18
+    assert get_operations_count('10M2I3D5M', 'ID') == 5
+    assert get_operations_count('10M2I3D5M', 'M') == 15
@@ -0,0 +1,218 @@
+import os
+import sys
+import random
+import subprocess
+from collections import defaultdict
+
+import pytest
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+import components_assembly
+from components_assembly import partition_reads_by_component, AssemblyScheduler
+
+
+def _write_reads(tmpdir, rng):
+    """
+    Write random reads and their components. Return the file paths and
+    the expected fastq records of each component
+    """
+    fastq_filepath = os.path.join(str(tmpdir), 'reads.fq')
+    rmc_filepath = os.path.join(str(tmpdir), 'rmc.tab')
+    expected = defaultdict(list)
+    with open(fastq_filepath, 'w') as fastq_fh, open(rmc_filepath, 'w') as rmc_fh:
+        for i in range(500):
+            seq = ''.join(rng.choice('ACGT') for _ in range(rng.randint(20, 40)))
+            fastq_fh.write('@r{0} desc\n{1}\n+\n{2}\n'.format(i, seq, 'I' * len(seq)))
+            component_id = rng.choice(['7', '3', '12', '5', '1', 'NULL', None])
+            if component_id is not None:
+                rmc_fh.write('r{0}\t{1}\t{2}\n'.format(i, i // 10, component_id))
+            if component_id not in ('NULL', None):
+                expected[component_id].append('@r{0}\n{1}\n+\n{2}\n'.format(i, seq, 'I' * len(seq)))
+
+    return fastq_filepath, rmc_filepath, expected
+
+
+def test_partition_reads_by_component(tmpdir):
+    fastq_filepath, rmc_filepath, expected = _write_reads(tmpdir, random.Random(0))
+    directory = os.path.join(str(tmpdir), 'components')
+    # Fewer open files than components
+    components = partition_reads_by_component(fastq_filepath, rmc_filepath, directory, max_open_files=2)
+    assert list(components) == list(expected)
+    for component_id, component_reads in components.items():
+        assert component_reads.fastq == os.path.join(directory, 'component{0}_reads.fq'.format(component_id))
+        with open(component_reads.fastq) as fq_fh:
+            assert fq_fh.read() == ''.join(expected[component_id])
+        assert component_reads.reads_nb == len(expected[component_id])
+        assert component_reads.nucleotides_nb == sum(len(r.split('\n')[1]) for r in expected[component_id])
+
+
+def test_write_read_component_map(tmpdir):
+    rng = random.Random(1)
+    components_filepath = os.path.join(str(tmpdir), 'components.csv')
+    with open(components_filepath, 'w') as components_fh:
+        components_fh.write('id;read;x;metanode;component\n')
+        for i in range(300):
+            components_fh.write('{0};r{1};x;{2};{3}\n'.format(
+                i, rng.randint(0, 150), rng.randint(0, 20), rng.choice(['-1', '0', '3', '12', 'NULL'])))
+    rmc_filepath = os.path.join(str(tmpdir), 'rmc.tab')
+    written_nb = components_assembly.write_read_component_map(components_filepath, rmc_filepath)
+
+    # Same output as the former shell pipeline
+    cmd_line = 'tail -n +2 {0} | sed "s/;/\\t/g" | cut -f2,4,5 | awk "\\$3>=0" | sort -k1,1'.format(
+        components_filepath)
+    expected = subprocess.check_output(cmd_line, shell=True, env=dict(os.environ, LC_ALL='C'))
+    with open(rmc_filepath, 'rb') as rmc_fh:
+        assert rmc_fh.read() == expected
+    assert written_nb == expected.count(b'\n')
+
+
+def test_assembly_scheduler():
+    scheduler = AssemblyScheduler([(1, 'a', None), (100, 'b', None), (2, 'c', None), (1, 'd', None)], cpu=4)
+    jobs = iter(scheduler)
+    # The largest component starts first, with most of the cores
+    assert next(jobs) == ('b', 3, None)
+    assert next(jobs) == ('c', 1, None)
+    assert scheduler.free_cores == 0
+    scheduler.release(3)
+    # The two last components share the idle cores
+    assert next(jobs)[1:] == (1, None)
+    assert next(jobs)[1:] == (2, None)
+    assert list(jobs) == []
+
+    scheduler = AssemblyScheduler([(1, 'a', None), (1, 'b', None)], cpu=1)
+    jobs = iter(scheduler)
+    assert next(jobs) == ('a', 1, None)
+    scheduler.cancel()
+    assert list(jobs) == []
+
+
+def _fake_assemble_component(assembler_name, in_fastq, workdir, read_correction, cpu, coverage_threshold,
+                             reads_nt=None, small_component_nt=None):
+    """
+    Write the first read of a component as its contig. Fails on the
+    components listed in the FAIL environment variable
+    """
+    if os.path.basename(in_fastq) in os.environ.get('FAIL', '').split():
+        raise subprocess.CalledProcessError(1, 'sga')
+    fasta = in_fastq + '.fa'
+    with open(in_fastq) as fq_fh, open(fasta, 'w') as fa_fh:
+        fa_fh.write('>contig\n{0}\n'.format(fq_fh.readlines()[1].strip()))
+    return fasta
+
+
+def _read_contigs(contigs_filepath):
+    with open(contigs_filepath) as contigs_fh:
+        lines = contigs_fh.read().split('\n')
+    return lines[0::2][:-1], lines[1::2]
+
+
+def test_assemble_components(tmpdir, monkeypatch):
+    monkeypatch.setattr(components_assembly, 'assemble_component', _fake_assemble_component)
+    fastq_filepath, rmc_filepath, expected = _write_reads(tmpdir, random.Random(1))
+    workdir = os.path.join(str(tmpdir), 'components')
+    contigs_filepath = os.path.join(str(tmpdir), 'contigs.fa')
+    # A single process: the jobs run in this one
+    components_fasta = components_assembly.assemble_components('SGA', fastq_filepath, rmc_filepath, contigs_filepath,
+                                                               workdir, 1, 'no', None)
+    # Contigs are pooled largest components first
+    order = sorted(expected, key=lambda c: sum(len(r.split('\n')[1]) for r in expected[c]), reverse=True)
+    assert list(components_fasta) == order
+    headers, seqs = _read_contigs(contigs_filepath)
+    assert headers == ['>{0} component={1} lca=NULL'.format(i + 1, c) for i, c in enumerate(order)]
+    assert seqs == [expected[c][0].split('\n')[1] for c in order]
+
+
+def test_assemble_components_resume(tmpdir, monkeypatch):
+    monkeypatch.setattr(components_assembly, 'assemble_component', _fake_assemble_component)
+    fastq_filepath, rmc_filepath, expected = _write_reads(tmpdir, random.Random(1))
+    workdir = os.path.join(str(tmpdir), 'components')
+    contigs_filepath = os.path.join(str(tmpdir), 'contigs.fa')
+    # A failing component does not stop the others
+    monkeypatch.setenv('FAIL', 'component3_reads.fq component7_reads.fq')
+    with pytest.raises(SystemExit):
+        components_assembly.assemble_components('SGA', fastq_filepath, rmc_filepath, contigs_filepath,
+                                                workdir, 1, 'no', None)
+    checkpoint_filepath = os.path.join(workdir, components_assembly.CHECKPOINT_FILENAME)
+    with open(checkpoint_filepath) as checkpoint_fh:
+        assert sorted(l.split('\t')[0] for l in checkpoint_fh.readlines()[1:]) == ['1', '12', '5']
+    os.unlink(os.path.join(workdir, 'component12_reads.fq.fa'))
+
+    # Only the unfinished components are assembled
+    log_filepath = os.path.join(str(tmpdir), 'assembled.log')
+    def assemble_component(assembler_name, in_fastq, *args):
+        with open(log_filepath, 'a') as log_fh:
+            log_fh.write(os.path.basename(in_fastq) + '\n')
+        return _fake_assemble_component(assembler_name, in_fastq, *args)
+    monkeypatch.setattr(components_assembly, 'assemble_component', assemble_component)
+    monkeypatch.delenv('FAIL')
+    components_assembly.assemble_components('SGA', fastq_filepath, rmc_filepath, contigs_filepath, workdir, 1, 'no', None)
+    with open(log_filepath) as log_fh:
+        assert sorted(log_fh.read().split()) == ['component12_reads.fq', 'component3_reads.fq', 'component7_reads.fq']
+    headers, seqs = _read_contigs(contigs_filepath)
+    assert sorted(seqs) == sorted(expected[c][0].split('\n')[1] for c in expected)
+
+    # Other reads of the same size: nothing is reused
+    with open(fastq_filepath) as fq_fh:
+        reads = fq_fh.read()
+    with open(fastq_filepath, 'w') as fq_fh:
+        fq_fh.write(reads.replace('A', 'C'))
+    os.unlink(log_filepath)
+    components_assembly.assemble_components('SGA', fastq_filepath, rmc_filepath, contigs_filepath, workdir, 1, 'no', None)
+    with open(log_filepath) as log_fh:
+        assert sorted(log_fh.read().split()) == sorted('component{0}_reads.fq'.format(c) for c in expected)
+
+
+def test_assemble_components_pool(tmpdir):
+    # The in-process assembler needs no binary in the pool processes
+    fastq_filepath, rmc_filepath, expected = _write_reads(tmpdir, random.Random(1))
+    outputs = list()
+    for cpu in (1, 3):
+        workdir = os.path.join(str(tmpdir), 'components{0}'.format(cpu))
+        contigs_filepath = os.path.join(str(tmpdir), 'contigs{0}.fa'.format(cpu))
+        components_assembly.assemble_components('SGA', fastq_filepath, rmc_filepath, contigs_filepath,
+                                                workdir, cpu, 'no', None, small_component_nt=10 ** 6)
+        with open(contigs_filepath) as contigs_fh:
+            outputs.append(contigs_fh.read())
+    assert outputs[0]
+    assert outputs[0] == outputs[1]
+
+
+class _FakeAssembler:
+
+    runs = list()
+    contig_length = 100
+
+    def build_command_line(self, fastq_file, workdir, read_correction, cpu):
+        self.fastq_file = fastq_file
+        self.read_correction = read_correction
+        self.fasta_file = os.path.join(workdir, 'contigs.fa')
+
+    def run(self):
+        _FakeAssembler.runs.append(self.read_correction)
+        os.makedirs(os.path.dirname(self.fasta_file), exist_ok=True)
+        with open(self.fasta_file, 'w') as fa_fh:
+            fa_fh.write('>contig\n{0}\n'.format('A' * _FakeAssembler.contig_length))
+        return self.fasta_file
+
+
+def test_assemble_component_correction(tmpdir, monkeypatch):
+    monkeypatch.setattr(components_assembly.AssemblerFactory, 'get', lambda self, name: _FakeAssembler())
+    fastq_filepath = os.path.join(str(tmpdir), 'reads.fq')
+    with open(fastq_filepath, 'w') as fastq_fh:
+        fastq_fh.write('@r\n{0}\n+\n{1}\n'.format('A' * 3000, 'I' * 3000))
+    workdir = os.path.join(str(tmpdir), 'wkdir')
+    for reads_nt, contig_length, runs in (
+            # Reads counted from the fastq: covered 30x
+            (None, 100, ['auto', 'yes']),
+            (None, 1000, ['auto']),
+            # Reads nucleotides given by the partition
+            (1000, 100, ['auto']),
+            (5000, 100, ['auto', 'yes'])):
+        _FakeAssembler.runs = list()
+        _FakeAssembler.contig_length = contig_length
+        assert components_assembly.assemble_component('fake', fastq_filepath, workdir, 'auto', 2, 20,
+                                                      reads_nt) == os.path.join(workdir, 'contigs.fa')
+        assert _FakeAssembler.runs == runs
@@ -0,0 +1,78 @@
+import io
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+from compute_lca_from_tab import compute_lca, read_components_taxo, write_lca_tab
+from taxonomy_index import TaxoTrie, TaxonomyIndex, write_taxonomy_index
+
+
+def _write(tmpdir, name, lines):
+    filepath = os.path.join(str(tmpdir), name)
+    with open(filepath, 'w') as fh:
+        fh.write(''.join(l + '\n' for l in lines))
+    return filepath
+
+
+def test_read_components_taxo(tmpdir):
+    sam_filepath = _write(tmpdir, 'filt.sam', [
+        '@HD\tVN:1.0',
+        'r2\t0\tref1\t1\t255\t4M\t*\t0\t0\tACGT\t*\tAS:i:4',
+        'r1\t0\tref2\t1\t255\t4M\t*\t0\t0\tACGT\t*\tAS:i:4',
+        'r1\t0\tref1\t1\t255\t4M\t*\t0\t0\tACGT\t*\tAS:i:4',
+        'r3\t0\tref3\t1\t255\t4M\t*\t0\t0\tACGT\t*\tAS:i:4',
+        'r4\t0\tref1\t1\t255\t4M\t*\t0\t0\tACGT\t*\tAS:i:4',
+        'r5\t0\tnotaxo\t1\t255\t4M\t*\t0\t0\tACGT\t*\tAS:i:4',
+    ])
+    ref_taxo_filepath = _write(tmpdir, 'taxo.tab', ['ref1\tA;B;C', 'ref2\tA;B;D', 'ref3\tA;E'])
+    index_filepath = os.path.join(str(tmpdir), 'taxo.idx')
+    write_taxonomy_index(ref_taxo_filepath, index_filepath)
+    # r4 is not in a component
+    read_component_filepath = _write(tmpdir, 'rmc.tab', ['r1\t1\t10', 'r2\t2\t10', 'r3\t3\t2', 'r5\t4\t2'])
+
+    with TaxonomyIndex(index_filepath) as taxo_index:
+        components_taxo_dict = read_components_taxo(sam_filepath, taxo_index, read_component_filepath)
+        assert {c: [[taxo_index.lineage(t) for t in g] for g in f] for c, f in components_taxo_dict.items()} == \
+            {'10': [['A;B;C', 'A;B;D'], ['A;B;C']], '2': [['A;E']]}
+        assert list(components_taxo_dict) == ['10', '2']
+        out_fh = io.StringIO()
+        write_lca_tab(components_taxo_dict, 1.0, out_fh, taxonomy=taxo_index)
+        assert out_fh.getvalue() == '10\tA;B\n2\tA;E\n'
+        # r2 and half of r1 vote for A;B;C
+        assert compute_lca(components_taxo_dict['10'], 0.75, taxo_index) == 'A;B;C'
+
+
+def test_compute_lca_quorum():
+    trie = TaxoTrie()
+    factor_taxo_list = [['A;B;C'], ['A;B;C', 'A;D'], ['A;B;E'], ['A;D;F']]
+    assert compute_lca(factor_taxo_list, 1.0, trie) == 'A'
+    assert compute_lca(factor_taxo_list, 0.5, trie) == 'A;B'
+    # Among the least voted nodes reaching the quorum, the deepest wins,
+    # then the last voted
+    assert compute_lca(factor_taxo_list, 0.25, trie) == 'A;D;F'
+    assert compute_lca([['A;B'], ['A;C']], 0.5, trie) == 'A;C'
+    assert compute_lca([['A'], ['B']], 0.6, trie) == 'Root'
+    assert trie.path('A;B;C') == (0, 1, 2)
+    assert trie.lineage(2) == 'A;B;C'
+
+
+def test_taxonomy_index(tmpdir):
+    ref_taxo_filepath = _write(tmpdir, 'taxo.tab', ['r2\tA;B2', 'r1\tA;B;C', 'r3\tA;B', 'r4\tNULL', 'bad'])
+    index_filepath = os.path.join(str(tmpdir), 'taxo.idx')
+    assert write_taxonomy_index(ref_taxo_filepath, index_filepath) == 5
+    with TaxonomyIndex(index_filepath) as taxo_index:
+        assert taxo_index.is_built_from(ref_taxo_filepath)
+        # A renamed taxon keeps the file size, the index is outdated
+        os.utime(ref_taxo_filepath, ns=(0, 0))
+        assert taxo_index.is_built_from(ref_taxo_filepath)
+        _write(tmpdir, 'taxo.tab', ['r2\tA;B3', 'r1\tA;B;C', 'r3\tA;B', 'r4\tNULL', 'bad'])
+        os.utime(ref_taxo_filepath, ns=(10**9, 10**9))
+        assert not taxo_index.is_built_from(ref_taxo_filepath)
+        # Taxon ids are in the order of the lineages, not of a tree walk
+        assert [taxo_index.lineage(t) for t in range(len(taxo_index))] == ['A', 'A;B', 'A;B2', 'A;B;C', 'NULL']
+        assert (taxo_index.parents.tolist(), taxo_index.depths.tolist()) == ([-1, 0, 0, 1, -1], [1, 2, 2, 3, 1])
+        assert taxo_index.path(3) == (0, 1, 3)
+        assert taxo_index.ref_taxa(['r1', 'r3', 'r0', 'r4', 'r10000']).tolist() == [3, 1, -1, 4, -1]
@@ -0,0 +1,52 @@
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+import counting
+
+
+def _write(tmpdir, filename, content):
+    filepath = os.path.join(str(tmpdir), filename)
+    with open(filepath, 'w') as fh:
+        fh.write(content)
+    return filepath
+
+
+def test_count_lines(tmpdir):
+    assert counting.count_lines(_write(tmpdir, 'empty', '')) == 0
+    assert counting.count_lines(_write(tmpdir, 'a', 'a\nb\nc\n')) == 3
+    assert counting.count_lines(_write(tmpdir, 'b', 'a\nb\nc')) == 3
+
+
+def test_count_fasta_records_across_blocks(tmpdir):
+    filepath = _write(tmpdir, 'reads.fa', '>r1\nACGT\nAC\n>r2\nGG\n>r3\nT\n')
+    assert counting.count_fasta_records(filepath) == 3
+    # Headers must be found even when split between two blocks
+    for buffer_size in range(1, 8):
+        assert counting.count_fasta_records(filepath, buffer_size=buffer_size) == 3
+        assert counting.count_lines(filepath, buffer_size=buffer_size) == 7
+
+
+def test_count_fastq_records(tmpdir):
+    filepath = _write(tmpdir, 'reads.fq', '@r1\nACGT\n+\n>>>>\n@r2\nACGT\n+\n@@@@\n')
+    assert counting.count_fastq_records(filepath) == 2
+
+
+def test_count_components(tmpdir):
+    filepath = _write(tmpdir, 'components.csv',
+                      'id;read;x;metanode;component\n'
+                      '0;r0;x;1;0\n1;r1;x;1;0\n2;r2;x;2;3\n3;r3;x;3;-1\n')
+    assert counting.count_csv_rows(filepath) == 4
+    assert counting.count_components(filepath) == (3, 2)
+
+
+def test_read_sortmerna_log(tmpdir):
+    filepath = _write(tmpdir, 'sortme.log',
+                      ' Results:\n    Total reads = 2000\n'
+                      '    Total reads passing E-value threshold = 150 (7.50%)\n'
+                      '    Total reads failing E-value threshold = 1850 (92.50%)\n')
+    assert counting.read_sortmerna_log(filepath) == (2000, 150)
+    assert counting.read_sortmerna_log(os.path.join(str(tmpdir), 'missing.log')) == (None, None)
@@ -0,0 +1,81 @@
+import io
+import os
+import sys
+import bz2
+import gzip
+import shutil
+
+import pytest
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+import fastx_utils
+
+FASTA = '>r1 desc\nACGT\nAC\n\n>r2\r\nGG\r\n>r3\nT'
+FASTA_RECORDS = [('r1 desc', 'ACGTAC'), ('r2', 'GG'), ('r3', 'T')]
+
+FASTQ = '@r1 desc\nACGT\n+\nIIII\n\n@r2\nAC\n+r2\nII\n'
+
+
+@pytest.mark.parametrize('buffer_size', [1, 2, 3, 5, 8, 13, 1024])
+def test_read_fasta_buffer_sizes(buffer_size):
+    stream = io.BytesIO(FASTA.encode())
+    assert list(fastx_utils.read_fasta(stream, buffer_size=buffer_size)) == FASTA_RECORDS
+
+
+@pytest.mark.parametrize('buffer_size', [1, 2, 3, 5, 8, 13, 1024])
+def test_read_fastq_buffer_sizes(buffer_size):
+    stream = io.BytesIO(FASTQ.encode())
+    assert list(fastx_utils.read_fastq(stream, buffer_size=buffer_size)) == \
+        [('r1', 'ACGT', 'IIII'), ('r2', 'AC', 'II')]
+
+
+@pytest.mark.parametrize('buffer_size', [1, 2, 3, 5, 8, 13, 1024])
+def test_read_fastq_trailing_spaces(buffer_size):
+    # No blank line: the lines must be stripped whatever the block boundaries
+    stream = io.BytesIO(b'@r1 \nACGT \n+\nIIII\t\n@r2\nAC\n+ \nII \n')
+    assert list(fastx_utils.read_fastq(stream, buffer_size=buffer_size)) == \
+        [('r1', 'ACGT', 'IIII'), ('r2', 'AC', 'II')]
+    blocks = fastx_utils.iter_line_blocks(io.BytesIO(b'ACGT \nII\n'), buffer_size=buffer_size)
+    assert [l for lines in blocks for l in lines] == [b'ACGT', b'II']
+
+
+def test_read_fastq_full_header_as_bytes():
+    records = list(fastx_utils.read_fastq(io.StringIO(FASTQ), as_bytes=True, full_header=True))
+    assert records == [(b'r1 desc', b'ACGT', b'IIII'), (b'r2', b'AC', b'II')]
+
+
+@pytest.mark.parametrize('compress', [gzip.compress, bz2.compress])
+def test_read_compressed_file(tmpdir, compress):
+    # The compression is detected from the content, not the file name
+    filepath = os.path.join(str(tmpdir), 'reads.fa')
+    with open(filepath, 'wb') as fh:
+        fh.write(compress(FASTA.encode()))
+    assert list(fastx_utils.read_fasta(filepath)) == FASTA_RECORDS
+    assert list(fastx_utils.read_fasta_file_handle(open(filepath, 'r'))) == FASTA_RECORDS
+
+
+def test_read_empty_file():
+    assert list(fastx_utils.read_fasta(io.BytesIO(b''))) == []
+    assert list(fastx_utils.read_fastq(io.BytesIO(b''))) == []
+
+
+def test_sniff_format_and_compression(tmpdir):
+    filepath = os.path.join(str(tmpdir), 'reads.txt')
+    with open(filepath, 'wb') as fh:
+        fh.write(gzip.compress(FASTQ.encode()))
+    assert fastx_utils.file_compression(filepath) == 'gzip'
+    assert fastx_utils.sniff_format(filepath) == 'fastq'
+    assert fastx_utils.strip_compression_suffix('reads.fq.gz') == 'reads.fq'
+    assert fastx_utils.strip_compression_suffix('reads.fq') == 'reads.fq'
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason='zstd is not installed')
+def test_read_zstd_file(tmpdir):
+    import subprocess
+    filepath = os.path.join(str(tmpdir), 'reads.fq.zst')
+    with open(filepath, 'wb') as fh:
+        fh.write(subprocess.run(['zstd', '-c'], input=FASTQ.encode(), stdout=subprocess.PIPE, check=True).stdout)
+    assert list(fastx_utils.read_fastq(filepath)) == [('r1', 'ACGT', 'IIII'), ('r2', 'AC', 'II')]
@@ -0,0 +1,61 @@
+import io
+import os
+import sys
+
+import pytest
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+from filter_score_multialign import filter_sam_file
+
+
+def _sam_line(read_id, ref, score):
+    return '{0}\t0\t{1}\t1\t255\t4M\t*\t0\t0\tACGT\t*\tAS:i:{2}\tNM:i:0'.format(read_id, ref, score)
+
+
+SAM = '\n'.join([
+    '@HD\tVN:1.0',
+    _sam_line('r1', 'a', 90),
+    _sam_line('r1', 'b', 100),
+    _sam_line('r1', 'c', 85),
+    _sam_line('r1', 'd', 70),
+    _sam_line('r2', 'a', 50),
+    _sam_line('r10', 'a', 60),
+    _sam_line('r10', 'b', 60),
+    _sam_line('r10', 'c', 53),
+]) + '\n'
+
+
+def _filter(threshold, geometric, buffer_size=1024 * 1024):
+    out_fh = io.BytesIO()
+    counts = filter_sam_file(io.BytesIO(SAM.encode()), out_fh, threshold, geometric, buffer_size)
+    lines = out_fh.getvalue().decode().splitlines()
+    return counts, [(l.split('\t')[0], l.split('\t')[2]) for l in lines]
+
+
+@pytest.mark.parametrize('buffer_size', [7, 50, 100, 1024 * 1024])
+def test_straight_mode(buffer_size):
+    counts, kept = _filter(0.9, False, buffer_size)
+    assert counts == (8, 5)
+    # Best scores first, ties keep the input order
+    assert kept == [('r1', 'b'), ('r1', 'a'), ('r2', 'a'),
+                    ('r10', 'a'), ('r10', 'b')]
+
+
+@pytest.mark.parametrize('buffer_size', [7, 50, 1024 * 1024])
+def test_geometric_mode(buffer_size):
+    counts, kept = _filter(0.9, True, buffer_size)
+    # 85 >= 0.9*90 is kept, 70 < 0.9*85 is not
+    assert counts == (8, 6)
+    assert kept == [('r1', 'b'), ('r1', 'a'), ('r1', 'c'), ('r2', 'a'),
+                    ('r10', 'a'), ('r10', 'b')]
+
+
+def test_score_tag_not_at_sortmerna_position():
+    sam = 'r1\t0\ta\t1\t255\t4M\t*\t0\t0\tACGT\t*\tAS:i:10\tNM:i:0\tXX:i:1\n'
+    sam += 'r1\t0\tb\t1\t255\t4M\t*\t0\t0\tACGT\t*\tAS:i:20\tNM:i:0\tXX:i:1\n'
+    out_fh = io.BytesIO()
+    assert filter_sam_file(io.BytesIO(sam.encode()), out_fh, 0.9) == (2, 1)
+    assert out_fh.getvalue().split(b'\t')[2] == b'b'
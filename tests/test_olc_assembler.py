@@ -0,0 +1,76 @@
+import os
+import sys
+import random
+
+import pytest
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+from olc_assembler import preprocess_reads, assemble_reads, reverse_complement
+from assembler_factory import AssemblerFactory, OLC
+
+
+def _random_seq(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def test_preprocess_reads():
+    rng = random.Random(0)
+    seq = _random_seq(rng, 100)
+    reads = [seq, seq[:30], seq[:50] + 'N' + seq[51:], reverse_complement(seq), seq[10:70],
+             reverse_complement(seq[20:90]), seq[50:] + _random_seq(rng, 50), seq.lower()]
+    # Short, ambiguous, duplicated and contained reads are dropped
+    assert preprocess_reads(reads) == [seq, reads[6]]
+
+
+def test_assemble_reads():
+    rng = random.Random(1)
+    genome = _random_seq(rng, 1500)
+    # Tiled reads on both strands, overlapping by 80 nucleotides
+    reads = [genome[i:i + 120] for i in range(0, len(genome) - 80, 40)]
+    reads = [r if k % 2 else reverse_complement(r) for k, r in enumerate(reads)]
+    rng.shuffle(reads)
+    contigs = assemble_reads(reads)
+    assert len(contigs) == 1
+    assert contigs[0] in (genome, reverse_complement(genome))
+
+    # A short dead end branching from the genome is trimmed
+    tip = genome[1010:1080] + _random_seq(rng, 20)
+    contigs = assemble_reads(reads + [tip])
+    assert len(contigs) == 1
+    assert contigs[0] in (genome, reverse_complement(genome))
+
+    # Not overlapping enough
+    assert sorted(assemble_reads([genome[:100], genome[60:160]])) == sorted([genome[:100], genome[60:160]])
+
+
+def test_in_process_engine_not_selectable():
+    assert 'OLC' not in [a.name() for a in AssemblerFactory.ASSEMBLER_ENGINES]
+    with pytest.raises(KeyError):
+        AssemblerFactory().get('OLC')
+
+
+def test_assembler_for_component(tmpdir, monkeypatch):
+    # SGA needs its binaries to be instantiated
+    monkeypatch.setattr(AssemblerFactory, 'get', lambda self, name: name)
+    factory = AssemblerFactory()
+    assert isinstance(factory.get_for_component('SGA', 1000, 'no', 20000), OLC)
+    assert isinstance(factory.get_for_component('SGA', 1000, 'auto', 20000), OLC)
+    # Corrected reads, large components, or disabled
+    for nucleotides_nb, read_correction, small_component_nt in ((1000, 'yes', 20000), (30000, 'no', 20000),
+                                                                (1000, 'no', 0), (None, 'no', 20000)):
+        assert factory.get_for_component('SGA', nucleotides_nb, read_correction, small_component_nt) == 'SGA'
+
+    rng = random.Random(2)
+    genome = _random_seq(rng, 300)
+    fastq_filepath = os.path.join(str(tmpdir), 'reads.fq')
+    with open(fastq_filepath, 'w') as fastq_fh:
+        for i in range(0, 201, 40):
+            fastq_fh.write('@r{0}\n{1}\n+\n{2}\n'.format(i, genome[i:i + 100], 'I' * 100))
+    assembler = OLC()
+    assembler.build_command_line(fastq_filepath, os.path.join(str(tmpdir), 'assembly'))
+    fasta_filepath = assembler.run()
+    with open(fasta_filepath) as fasta_fh:
+        assert fasta_fh.read() == '>contig-0\n{0}\n'.format(genome)
@@ -0,0 +1,118 @@
+import os
+import sys
+import threading
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+import pytest
+from pipeline import Pipeline, Step
+from resources import ResourcePool
+
+
+def _recorder(log, name, result=None):
+    def func(cpu):
+        log.append(name)
+        return result
+    return func
+
+
+def test_pipeline_dependencies_from_files():
+    p = Pipeline()
+    p.add_step(Step('a', _recorder([], 'a'), outputs=['a.txt']))
+    b = p.add_step(Step('b', _recorder([], 'b'), inputs=['a.txt', 'input.txt'], outputs=['b.txt']))
+    c = p.add_step(Step('c', _recorder([], 'c'), requires=['a']))
+    assert p.dependencies(b) == {'a'}
+    assert p.dependencies(c) == {'a'}
+
+
+def test_pipeline_run_order_and_results():
+    log = []
+    p = Pipeline(cpu=1)
+    p.add_step(Step('c', _recorder(log, 'c', 3), inputs=['b.txt']))
+    p.add_step(Step('a', _recorder(log, 'a', 1), outputs=['a.txt']))
+    p.add_step(Step('b', _recorder(log, 'b', 2), inputs=['a.txt'], outputs=['b.txt']))
+    results = p.run()
+    assert log == ['a', 'b', 'c']
+    assert results == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_pipeline_independent_steps_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def func(cpu):
+        # Would raise BrokenBarrierError if both steps were not running together
+        barrier.wait()
+        return cpu
+
+    p = Pipeline(cpu=4)
+    p.add_step(Step('big', func, cpu=4))
+    p.add_step(Step('small', func, cpu=1))
+    results = p.run()
+    assert results == {'big': 3, 'small': 1}
+
+
+def test_pipeline_memory_budget():
+    running = []
+    overlaps = []
+
+    def func(cpu):
+        running.append(1)
+        overlaps.append(len(running))
+        time.sleep(0.1)
+        running.pop()
+
+    # Both steps fit in the cores but not in the memory
+    p = Pipeline(resources=ResourcePool(cpu=4, memory=1000))
+    p.add_step(Step('a', func, memory=800))
+    p.add_step(Step('b', func, memory=800))
+    p.add_step(Step('c', func, memory=5000))
+    p.run()
+    assert overlaps == [1, 1, 1]
+
+
+def test_resource_pool():
+    pool = ResourcePool(cpu=4, memory=1000)
+    lease = pool.acquire(cpu=3, memory=600)
+    assert lease == (3, 600)
+    # Elastic cores, exact memory
+    assert pool.acquire(cpu=2, memory=0, min_cpu=1) == (1, 0)
+    assert pool.acquire(cpu=1, memory=600, blocking=False) is None
+    assert pool.acquire(cpu=1, memory=100, timeout=0.01) is None
+    pool.release(lease)
+    assert pool.acquire(cpu=8, memory=5000, min_cpu=1) == (3, 1000)
+
+
+def test_pipeline_resume_from():
+    log = []
+    p = Pipeline()
+    p.add_step(Step('a', _recorder(log, 'a'), outputs=['a.txt'], resume_tag='first'))
+    p.add_step(Step('a_stats', _recorder(log, 'a_stats'), inputs=['a.txt'], skippable=False))
+    p.add_step(Step('b', _recorder(log, 'b'), inputs=['a.txt'], resume_tag='second'))
+    p.resume_from('second')
+    p.run()
+    assert log == ['a_stats', 'b']
+
+
+def test_pipeline_failure_stops_scheduling():
+    log = []
+
+    def fail(cpu):
+        sys.exit('Non-zero return code')
+
+    p = Pipeline()
+    p.add_step(Step('a', fail, outputs=['a.txt']))
+    p.add_step(Step('b', _recorder(log, 'b'), inputs=['a.txt']))
+    with pytest.raises(SystemExit):
+        p.run()
+    assert log == []
+
+
+def test_pipeline_cyclic_dependencies():
+    p = Pipeline()
+    p.add_step(Step('a', _recorder([], 'a'), inputs=['b.txt'], outputs=['a.txt']))
+    p.add_step(Step('b', _recorder([], 'b'), inputs=['a.txt'], outputs=['b.txt']))
+    with pytest.raises(ValueError):
+        p.run()
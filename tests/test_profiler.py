@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import subprocess
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+import pytest
+from pipeline import Pipeline, Step
+from profiler import Profiler
+
+
+def test_profiler_report(tmpdir):
+    report_filepath = os.path.join(str(tmpdir), 'profile.json')
+    cprofile_dir = os.path.join(str(tmpdir), 'profile')
+    profiler = Profiler(report_filepath, cprofile_dir=cprofile_dir)
+
+    def child(cpu):
+        subprocess.check_call([sys.executable, '-c', 'sum(range(10**6))'])
+
+    p = Pipeline(cpu=1, profiler=profiler)
+    p.add_step(Step('a', child, outputs=['a.txt']))
+    p.add_step(Step('b', lambda cpu: sum(range(10**5)), inputs=['a.txt'], skippable=False))
+    p.add_step(Step('c', lambda cpu: None, inputs=['a.txt']))
+    p.get_step('c').skipped = True
+    p.run()
+    profiler.write_report()
+
+    with open(report_filepath) as fh:
+        report = json.load(fh)
+    stages = {s['name']: s for s in report['stages']}
+    assert stages['a']['status'] == 'done'
+    assert stages['a']['children_cpu_time'] > 0
+    assert stages['a']['wall_time'] >= 0
+    assert stages['a']['concurrent_stages'] == []
+    assert stages['c']['status'] == 'skipped'
+    assert report['total']['wall_time'] >= stages['a']['wall_time']
+    assert sorted(os.listdir(cprofile_dir)) == ['a.prof', 'b.prof']
+
+
+def test_profiler_failed_step(tmpdir):
+    profiler = Profiler(os.path.join(str(tmpdir), 'profile.json'))
+
+    def fail(cpu):
+        raise RuntimeError('failed')
+
+    p = Pipeline(cpu=1, profiler=profiler)
+    p.add_step(Step('a', fail))
+    with pytest.raises(RuntimeError):
+        p.run()
+    assert profiler.stages[0]['status'] == 'failed'
+
+
+def test_profiler_concurrent_cprofile(tmpdir):
+    cprofile_dir = os.path.join(str(tmpdir), 'profile')
+    profiler = Profiler(os.path.join(str(tmpdir), 'profile.json'), cprofile_dir=cprofile_dir)
+    # A step starting while another one is profiled runs without cProfile
+    with profiler.profile('a'):
+        with profiler.profile('b'):
+            sum(range(10**4))
+    with profiler.profile('c'):
+        pass
+    assert sorted(os.listdir(cprofile_dir)) == ['a.prof', 'c.prof']
+    assert sorted(s['name'] for s in profiler.stages) == ['a', 'b', 'c']
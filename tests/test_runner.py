@@ -0,0 +1,57 @@
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+import pytest
+import runner
+from profiler import Profiler
+
+
+def test_run_pipe_to_file(tmpdir):
+    in_filepath = os.path.join(str(tmpdir), 'in.txt')
+    out_filepath = os.path.join(str(tmpdir), 'out.txt')
+    with open(in_filepath, 'w') as fh:
+        fh.write('b\nc\na\nb\n')
+    result = runner.run([['sort', in_filepath], ['uniq', '-c']], stdout=out_filepath)
+    assert result.returncode == 0
+    assert result.returncodes == [0, 0]
+    with open(out_filepath) as fh:
+        assert fh.read().split() == ['1', 'a', '2', 'b', '1', 'c']
+
+
+def test_run_sigpipe_is_not_an_error(tmpdir):
+    out_filepath = os.path.join(str(tmpdir), 'out.txt')
+    result = runner.run([['yes'], ['head', '-n', '3']], stdout=out_filepath)
+    assert result.returncode == 0
+    with open(out_filepath) as fh:
+        assert fh.read() == 'y\ny\ny\n'
+
+
+def test_run_failure_and_output_tail():
+    result = runner.run([sys.executable, '-c', 'import sys; sys.stderr.write("oops\\n"); sys.exit(3)'])
+    assert result.returncode == 3
+    assert result.output_tail == ['oops']
+    with pytest.raises(SystemExit):
+        runner.check_run(['false'])
+    with pytest.raises(TypeError):
+        runner.run('true')
+
+
+def test_run_concurrently_and_profiling(tmpdir):
+    profiler = Profiler(os.path.join(str(tmpdir), 'profile.json'))
+    commands = [{'args': ['sleep', '0.2'], 'cpu': 1} for _ in range(4)]
+    with profiler.profile('step', cpu=2) as stage:
+        results = runner.run_concurrently(commands, cpu=2)
+    assert [r.returncode for r in results] == [0, 0, 0, 0]
+    # 2 commands at once
+    assert 0.4 <= stage['wall_time'] < 0.8
+    assert len(stage['commands']) == 4
+    assert stage['commands'][0]['command'] == 'sleep 0.2'
+
+
+def test_logged_call():
+    assert runner.logged_call('true | false') == 1
+    assert runner.logged_call('exit 0') == 0
@@ -0,0 +1,189 @@
+import os
+import sys
+import gzip
+import math
+import argparse
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+import pytest
+import counting
+import fastx_utils
+import sample_batch
+from stage_cache import StageCache
+
+
+def _write(tmpdir, filename, content):
+    filepath = os.path.join(str(tmpdir), filename)
+    with open(filepath, 'w') as fh:
+        fh.write(content)
+    return filepath
+
+
+def test_read_sample_sheet(tmpdir):
+    filepath = _write(tmpdir, 'sheet.tsv', '# id\treads\nS1\ta.fq\n\nS2\t/data/b.fa.gz\n')
+    samples = sample_batch.read_sample_sheet(filepath)
+    assert list(samples) == ['S1', 'S2']
+    assert samples['S1'] == os.path.abspath('a.fq')
+    assert samples['S2'] == '/data/b.fa.gz'
+    with pytest.raises(SystemExit):
+        sample_batch.read_sample_sheet(_write(tmpdir, 'dup.tsv', 'S1\ta.fq\nS1\tb.fq\n'))
+    with pytest.raises(SystemExit):
+        sample_batch.read_sample_sheet(_write(tmpdir, 'bad.tsv', 'S 1\ta.fq\n'))
+
+
+def test_batch_reads_round_trip(tmpdir):
+    reads = {
+        0: _write(tmpdir, 'a.fq', '@r1 desc\nACGT\n+\nIIII\n@r2\nGGGG\n+\nIIII\n'),
+        1: _write(tmpdir, 'b.fq', '@r1\nTTTT\n+\nIIII\n'),
+    }
+    batch_filepath = os.path.join(str(tmpdir), 'batch.fq.gz')
+    assert sample_batch.write_batch_reads(reads, batch_filepath, 'fastq') == ({0: 2, 1: 1}, {0: 8, 1: 4})
+    with gzip.open(batch_filepath, 'rt') as fh:
+        assert fh.read().split('\n')[::4] == ['@0|r1 desc', '@0|r2', '@1|r1', '']
+
+    # Fake SortMeRNA outputs, read r2 of sample 0 not aligned
+    basepath = os.path.join(str(tmpdir), 'batch.sortme')
+    _write(tmpdir, 'batch.sortme.fq', '@0|r1 desc\nACGT\n+\nIIII\n@1|r1\nTTTT\n+\nIIII\n')
+    _write(tmpdir, 'batch.sortme.sam', '@HD\tVN:1.0\n0|r1\t0\tref\n0|r1\t0\tref2\n1|r1\t0\tref\n')
+    _write(tmpdir, 'batch.sortme.blast', '0|r1\tref\n1|r1\tref\n')
+    samples_fp = dict()
+    for i in reads:
+        fp = argparse.Namespace()
+        fp.sortme_output_basepath = os.path.join(str(tmpdir), 's{0}'.format(i))
+        fp.sortme_output_fastx_filepath = fp.sortme_output_basepath + '.fq'
+        fp.sortme_output_sam_filepath = fp.sortme_output_basepath + '.sam'
+        fp.sortme_output_log_filepath = fp.sortme_output_basepath + '.log'
+        samples_fp[i] = fp
+    selected = sample_batch.split_batch_outputs(basepath, basepath + '.fq', samples_fp, 'fastq')
+    assert selected == {0: 1, 1: 1}
+
+    with open(samples_fp[0].sortme_output_fastx_filepath) as fh:
+        assert fh.read() == '@r1 desc\nACGT\n+\nIIII\n'
+    with open(samples_fp[0].sortme_output_sam_filepath) as fh:
+        assert fh.read() == '@HD\tVN:1.0\nr1\t0\tref\nr1\t0\tref2\n'
+    with open(samples_fp[1].sortme_output_basepath + '.blast') as fh:
+        assert fh.read() == 'r1\tref\n'
+
+    sample_batch.write_sample_log(samples_fp[0].sortme_output_log_filepath, basepath + '.log', 2, 1)
+    assert counting.read_sortmerna_log(samples_fp[0].sortme_output_log_filepath) == (2, 1)
+
+
+def _fake_sortmerna(reads_filepath, evalue, basepath):
+    """
+    Mimic the SortMeRNA E-value filter: E = K * m * n * exp(-lambda * S),
+    with n the nucleotides nb of the reads file. The alignment scores
+    are given in the read headers
+    """
+    reads = list(fastx_utils.read_fasta(reads_filepath))
+    n = sum(len(seq) for _, seq in reads)
+    with open(basepath + '.fa', 'w') as fa_fh, open(basepath + '.sam', 'w') as sam_fh, \
+            open(basepath + '.blast', 'w') as blast_fh:
+        sam_fh.write('@HD\tVN:1.0\n')
+        for header, seq in reads:
+            read_id, scores = header.split()
+            aligned = False
+            for k, score in enumerate(scores.split(',')):
+                e = 0.1 * 1000 * n * math.exp(-0.3 * int(score))
+                if e <= evalue:
+                    aligned = True
+                    sam_fh.write('{0}\t0\tref{1}\t1\t255\t*\t*\t0\t0\t{2}\t*\tAS:i:{3}\n'.format(
+                        read_id, k, seq, score))
+                    blast_fh.write('{0}\tref{1}\t100\t4\t0\t0\t1\t4\t1\t4\t{2:.6g}\t{3}\n'.format(
+                        read_id, k, e, score))
+            if aligned:
+                fa_fh.write('>{0}\n{1}\n'.format(header, seq))
+
+
+def _sample_fp(basepath):
+    fp = argparse.Namespace()
+    fp.sortme_output_basepath = basepath
+    fp.sortme_output_fastx_filepath = basepath + '.fa'
+    fp.sortme_output_sam_filepath = basepath + '.sam'
+    return fp
+
+
+def _read_file(filepath):
+    with open(filepath) as fh:
+        return fh.read()
+
+
+def test_batch_selects_the_single_sample_reads(tmpdir):
+    evalue = 1e-5
+    # Sample 1 is the smallest one, the batch run uses its looser threshold
+    filler = ''.join('>f{0} 90\n{1}\n'.format(k, 'ACGT' * 25) for k in range(16))
+    reads = {
+        0: _write(tmpdir, 'a.fa', '>a1 85\nACGTACGTAC\n>a2 90,70\nACGTACGTAC\n'
+                                  '>a3 65\nACGTACGTAC\n>a4 50\nACGTACGTAC\n' + filler),
+        1: _write(tmpdir, 'b.fa', '>b1 90\nACGTACGTAC\n'),
+    }
+
+    # Sample 0 run alone
+    single_basepath = os.path.join(str(tmpdir), 'single')
+    _fake_sortmerna(reads[0], evalue, single_basepath)
+
+    # Batch run, its E-value threshold scaled to the batch reads length
+    batch_filepath = os.path.join(str(tmpdir), 'batch.fa.gz')
+    reads_nb, bases_nb = sample_batch.write_batch_reads(reads, batch_filepath, 'fasta')
+    assert reads_nb == {0: 20, 1: 1}
+    batch_evalue, thresholds = sample_batch.evalue_thresholds(evalue, bases_nb)
+    assert thresholds[0] == pytest.approx(evalue * 1650 / 1640)
+    assert batch_evalue == thresholds[1] == pytest.approx(evalue * 165)
+    batch_basepath = os.path.join(str(tmpdir), 'batch')
+    _fake_sortmerna(batch_filepath, batch_evalue, batch_basepath)
+
+    samples_fp = {i: _sample_fp(os.path.join(str(tmpdir), 's{0}'.format(i))) for i in reads}
+    selected = sample_batch.split_batch_outputs(batch_basepath, batch_basepath + '.fa',
+                                                samples_fp, 'fasta', thresholds)
+    assert selected == {0: 18, 1: 1}
+    for extension in ('.fa', '.sam'):
+        assert _read_file(samples_fp[0].sortme_output_basepath + extension) == \
+            _read_file(single_basepath + extension)
+    # The blast E-values are the batch ones
+    batch_blast = _read_file(samples_fp[0].sortme_output_basepath + '.blast')
+    single_blast = _read_file(single_basepath + '.blast')
+    assert [l.split('\t')[:2] for l in batch_blast.split('\n')] == \
+        [l.split('\t')[:2] for l in single_blast.split('\n')]
+
+    # Without the sample thresholds, the reads passing only the batch
+    # threshold are kept (a3, and the second alignment of a2)
+    samples_fp = {i: _sample_fp(os.path.join(str(tmpdir), 'u{0}'.format(i))) for i in reads}
+    selected = sample_batch.split_batch_outputs(batch_basepath, batch_basepath + '.fa', samples_fp, 'fasta')
+    assert selected[0] == 19
+
+
+def test_reads_mapping_step(tmpdir):
+    samples_fp = dict()
+    for i in range(2):
+        fp = _sample_fp(os.path.join(str(tmpdir), 's{0}'.format(i)))
+        fp.input_fastx_filepath = _write(tmpdir, 'r{0}.fa'.format(i), '>r{0}\nACGT\n'.format(i))
+        fp.sortme_output_log_filepath = fp.sortme_output_basepath + '.log'
+        for filepath in (fp.sortme_output_fastx_filepath, fp.sortme_output_sam_filepath,
+                         fp.sortme_output_log_filepath):
+            _write(tmpdir, os.path.basename(filepath), 's{0}\n'.format(i))
+        samples_fp[i] = fp
+    ref_db_filepath = _write(tmpdir, 'ref.fa', '>ref\nACGTACGT\n')
+    params = {'best': 10, 'min_lis': 10, 'evalue': 1e-5}
+    cache = StageCache(os.path.join(str(tmpdir), 'cache'))
+    step = sample_batch.reads_mapping_step(samples_fp, 'fasta', ref_db_filepath, params)
+    assert not cache.is_up_to_date(step)
+    cache.save(step)
+    assert cache.is_up_to_date(sample_batch.reads_mapping_step(samples_fp, 'fasta', ref_db_filepath, params))
+
+    # Other SortMeRNA parameters, or samples in another order
+    assert not cache.is_up_to_date(sample_batch.reads_mapping_step(
+        samples_fp, 'fasta', ref_db_filepath, dict(params, evalue=1e-3)))
+    swapped_fp = {0: samples_fp[1], 1: samples_fp[0]}
+    assert not cache.is_up_to_date(sample_batch.reads_mapping_step(swapped_fp, 'fasta', ref_db_filepath, params))
+
+    # The reads of a sample changed
+    _write(tmpdir, 'r1.fa', '>r1\nACGA\n')
+    assert not cache.is_up_to_date(sample_batch.reads_mapping_step(samples_fp, 'fasta', ref_db_filepath, params))
+    _write(tmpdir, 'r1.fa', '>r1\nACGT\n')
+    assert cache.is_up_to_date(sample_batch.reads_mapping_step(samples_fp, 'fasta', ref_db_filepath, params))
+
+    # An output of a sample is missing
+    os.unlink(samples_fp[0].sortme_output_sam_filepath)
+    assert not cache.is_up_to_date(sample_batch.reads_mapping_step(samples_fp, 'fasta', ref_db_filepath, params))
@@ -0,0 +1,160 @@
+import io
+import os
+import sys
+import random
+
+import numpy as np
+import pytest
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+from sample_sam_by_coverage import sample_sam_file, get_alignment_length_on_ref, coverage_from_spans, \
+    sparse_table, range_min, get_reference_seed, tab_list_group_by, compute_ref_coverage
+
+
+REF_LENGTHS = {b'a': 100, b'b': 60}
+
+
+def _sam_line(read_id, ref, pos, cigar='20M'):
+    return '{0}\t0\t{1}\t{2}\t255\t{3}\t*\t0\t0\t*\t*\tAS:i:40'.format(read_id, ref, pos, cigar)
+
+
+def _make_sam(tmpdir):
+    # Alignments grouped by read, the references and positions are mixed
+    rng = random.Random(1)
+    lines = ['@HD\tVN:1.0']
+    for i in range(300):
+        lines.append(_sam_line('r{0}'.format(i), 'a', rng.randint(1, 81), rng.choice(['20M', '10M2D10M', '5S15M'])))
+        if i % 3 == 0:
+            lines.append(_sam_line('r{0}'.format(i), 'b', rng.randint(1, 41)))
+    sam_filepath = os.path.join(str(tmpdir), 'in.sam')
+    with open(sam_filepath, 'w') as sam_fh:
+        sam_fh.write('\n'.join(lines) + '\n')
+    return sam_filepath, lines[1:]
+
+
+def _coverage(lines, ref):
+    coverage = np.zeros(REF_LENGTHS[ref.encode()], dtype=int)
+    for line in lines:
+        fields = line.split('\t')
+        if fields[2] == ref:
+            start = int(fields[3]) - 1
+            coverage[start:start + get_alignment_length_on_ref(fields[5])] += 1
+    return coverage
+
+
+@pytest.mark.parametrize('max_buffer_size', [100, 1024 * 1024])
+def test_sample_sam_file(tmpdir, max_buffer_size):
+    sam_filepath, lines = _make_sam(tmpdir)
+    out_fh = io.BytesIO()
+    counts = sample_sam_file(sam_filepath, out_fh, REF_LENGTHS, 30, tmp_dir=str(tmpdir),
+                             max_buffer_size=max_buffer_size, seed=2)
+    out_lines = out_fh.getvalue().decode().splitlines()
+    assert counts == (len(lines), len(out_lines))
+    assert len(out_lines) < len(lines)
+    # Kept alignments are in the input order, without the header
+    index = {line: i for i, line in enumerate(lines)}
+    assert [index[l] for l in out_lines] == sorted(index[l] for l in out_lines)
+    # The coverage is only reduced where it is above the threshold,
+    # and never below the threshold
+    for ref in ('a', 'b'):
+        before, after = _coverage(lines, ref), _coverage(out_lines, ref)
+        assert (after >= np.minimum(before, 30)).all()
+    # Temporary files are removed
+    assert sorted(os.listdir(str(tmpdir))) == ['in.sam']
+
+
+def test_sample_sam_file_spill_is_transparent(tmpdir):
+    sam_filepath, lines = _make_sam(tmpdir)
+    outputs = list()
+    for max_buffer_size in (100, 1024 * 1024):
+        out_fh = io.BytesIO()
+        sample_sam_file(sam_filepath, out_fh, REF_LENGTHS, 30, tmp_dir=str(tmpdir),
+                        max_buffer_size=max_buffer_size, seed=3)
+        outputs.append(out_fh.getvalue())
+    assert outputs[0] == outputs[1]
+
+
+def test_sample_sam_file_is_reproducible(tmpdir):
+    sam_filepath, lines = _make_sam(tmpdir)
+    outputs = list()
+    for seed, cpu in ((4, 1), (4, 3), (5, 1)):
+        out_fh = io.BytesIO()
+        sample_sam_file(sam_filepath, out_fh, REF_LENGTHS, 10, tmp_dir=str(tmpdir), seed=seed, cpu=cpu)
+        outputs.append(out_fh.getvalue())
+    assert outputs[0] == outputs[1]
+    assert outputs[0] != outputs[2]
+
+
+def test_sample_sam_file_below_threshold(tmpdir):
+    sam_filepath, lines = _make_sam(tmpdir)
+    out_fh = io.BytesIO()
+    sample_sam_file(sam_filepath, out_fh, REF_LENGTHS, 1000, tmp_dir=str(tmpdir))
+    assert out_fh.getvalue().decode().splitlines() == lines
+
+
+def test_coverage_and_range_min():
+    rng = np.random.RandomState(0)
+    starts = rng.randint(0, 90, 200)
+    ends = starts + rng.randint(1, 30, 200)
+    coverage = coverage_from_spans(starts, ends, 100)
+    expected = np.zeros(100, dtype=int)
+    for start, end in zip(starts, ends):
+        expected[start:end] += 1
+    assert (coverage == expected).all()
+    ends = np.minimum(ends, 100)
+    mins = range_min(sparse_table(coverage), starts, ends)
+    assert mins.tolist() == [coverage[s:e].min() for s, e in zip(starts, ends)]
+
+
+def _baseline_sample_by_depth(lines, threshold, seed):
+    """
+    Sampling of the former sort | sample_sam_by_coverage.py pipe, the
+    alignments sorted by reference and position (in the input order for
+    a same position), with the shuffle order of sample_sam_file
+    """
+    tabs = sorted((l.split('\t') for l in lines), key=lambda t: (t[2], int(t[3])))
+    kept = list()
+    for ref_sam_tab_list in tab_list_group_by(tabs, 2):
+        ref_id = ref_sam_tab_list[0][2]
+        rng = random.Random(get_reference_seed(seed, ref_id.encode()))
+        ref_coverage_list = compute_ref_coverage(ref_sam_tab_list, REF_LENGTHS[ref_id.encode()])
+        for pos_sam_tab_list in tab_list_group_by(ref_sam_tab_list, 3):
+            starting_pos = int(pos_sam_tab_list[0][3]) - 1
+            ref_coverage = ref_coverage_list[starting_pos]
+            if ref_coverage <= threshold:
+                kept.extend(pos_sam_tab_list)
+                continue
+            num_alignments_to_remove = ref_coverage - threshold
+            random_alignments_order_indices = [i for i in range(len(pos_sam_tab_list))]
+            rng.shuffle(random_alignments_order_indices)
+            for i in random_alignments_order_indices:
+                alignment_tab = pos_sam_tab_list[i]
+                if num_alignments_to_remove > 0:
+                    end_pos = starting_pos + get_alignment_length_on_ref(alignment_tab[5]) - 1
+                    if min(ref_coverage_list[starting_pos:end_pos+1]) <= threshold:
+                        kept.append(alignment_tab)
+                    else:
+                        ref_coverage_list[starting_pos:end_pos+1] -= 1
+                        num_alignments_to_remove -= 1
+                else:
+                    kept.append(alignment_tab)
+    return sorted('\t'.join(t) for t in kept)
+
+
+@pytest.mark.parametrize('positions_nb', [40, 4])
+@pytest.mark.parametrize('threshold', [3, 10, 30])
+def test_sample_sam_file_matches_baseline(tmpdir, positions_nb, threshold):
+    # Few starting positions give large groups, removed in bulk
+    rng = random.Random(positions_nb)
+    lines = [_sam_line('r{0}'.format(i), rng.choice('ab'), rng.randint(1, positions_nb),
+                       rng.choice(['20M', '10M2D10M', '5S15M', '3M1I16M'])) for i in range(400)]
+    sam_filepath = os.path.join(str(tmpdir), 'in.sam')
+    with open(sam_filepath, 'w') as sam_fh:
+        sam_fh.write('\n'.join(lines) + '\n')
+    for seed in (0, 1, 2):
+        out_fh = io.BytesIO()
+        sample_sam_file(sam_filepath, out_fh, REF_LENGTHS, threshold, tmp_dir=str(tmpdir), seed=seed)
+        assert sorted(out_fh.getvalue().decode().splitlines()) == _baseline_sample_by_depth(lines, threshold, seed)
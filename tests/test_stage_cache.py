@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(CURRENT_DIR, '..', 'scripts')
+sys.path.append(SCRIPTS_DIR)
+
+from pipeline import Pipeline, Step
+from stage_cache import StageCache
+
+
+def _write(filepath, content):
+    with open(filepath, 'w') as fh:
+        fh.write(content)
+
+
+def _copy_step(log, in_filepath, out_filepath, params=None):
+    def func(cpu):
+        log.append(out_filepath)
+        with open(in_filepath) as in_fh:
+            _write(out_filepath, in_fh.read())
+    return Step(os.path.basename(out_filepath), func,
+                inputs=[in_filepath], outputs=[out_filepath], params=params)
+
+
+def _run(tmpdir, log, params=None):
+    d = str(tmpdir)
+    p = Pipeline(cache=StageCache(os.path.join(d, 'cache')))
+    p.add_step(_copy_step(log, os.path.join(d, 'in.txt'), os.path.join(d, 'a.txt'), params))
+    p.add_step(_copy_step(log, os.path.join(d, 'a.txt'), os.path.join(d, 'b.txt')))
+    p.run()
+    return p
+
+
+def test_up_to_date_steps_are_skipped(tmpdir):
+    _write(os.path.join(str(tmpdir), 'in.txt'), 'reads')
+    log = []
+    _run(tmpdir, log)
+    assert len(log) == 2
+    p = _run(tmpdir, log)
+    assert len(log) == 2
+    assert all(s.skipped for s in p.steps)
+
+
+def test_params_change_reruns_step(tmpdir):
+    _write(os.path.join(str(tmpdir), 'in.txt'), 'reads')
+    log = []
+    _run(tmpdir, log, params={'min_overlap_length': 50})
+    _run(tmpdir, log, params={'min_overlap_length': 60})
+    # Only the first step is rerun, the second one gets the same content
+    assert [os.path.basename(f) for f in log] == ['a.txt', 'b.txt', 'a.txt']
+
+
+def test_input_change_reruns_steps(tmpdir):
+    in_filepath = os.path.join(str(tmpdir), 'in.txt')
+    _write(in_filepath, 'reads')
+    log = []
+    _run(tmpdir, log)
+    _write(in_filepath, 'other reads')
+    _run(tmpdir, log)
+    assert len(log) == 4
+
+
+def test_touched_input_is_still_up_to_date(tmpdir):
+    in_filepath = os.path.join(str(tmpdir), 'in.txt')
+    _write(in_filepath, 'reads')
+    log = []
+    _run(tmpdir, log)
+    t = time.time() + 10
+    os.utime(in_filepath, (t, t))
+    _run(tmpdir, log)
+    assert len(log) == 2
+
+
+def test_missing_output_reruns_step(tmpdir):
+    _write(os.path.join(str(tmpdir), 'in.txt'), 'reads')
+    log = []
+    _run(tmpdir, log)
+    os.remove(os.path.join(str(tmpdir), 'b.txt'))
+    _run(tmpdir, log)
+    assert [os.path.basename(f) for f in log] == ['a.txt', 'b.txt', 'b.txt']
+
+
+def test_forced_steps_ignore_cache(tmpdir):
+    _write(os.path.join(str(tmpdir), 'in.txt'), 'reads')
+    log = []
+    _run(tmpdir, log)
+    d = str(tmpdir)
+    p = Pipeline(cache=StageCache(os.path.join(d, 'cache')))
+    p.add_step(_copy_step(log, os.path.join(d, 'in.txt'), os.path.join(d, 'a.txt')))
+    p.get_step('a.txt').resume_tag = 'a'
+    p.resume_from('a')
+    p.run()
+    assert len(log) == 3